@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Deadline-Aware Async Acquisition for Lidar Devices
+#
+# Mixin that gives a lidar driver 'await ascan()' and 'async for ... in
+# astream()' on top of the driver's single (blocking) acquisition attempt.
+# Driver calls run in a dedicated single-thread executor, so they're
+# serialized and never block the event loop.  Failed attempts are retried
+# with exponential backoff, bounded by both a retry count and a deadline, and
+# the result is always a structured dict rather than an endless retry loop.
+#
+# N.B. a cancelled or timed-out attempt can't interrupt the driver call that
+#      is already running in the executor thread, its result is dropped and
+#      the next attempt queues up behind it.
+#
+################################################################################
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+
+DEF_SCAN_TIMEOUT = 2.0      # secs, overall deadline for one rotation
+DEF_SCAN_RETRIES = 3        # retries after the first failed attempt
+DEF_BACKOFF = 0.05          # secs, doubled after each failed attempt
+DEF_MAX_BACKOFF = 1.0       # secs
+
+
+class AsyncAcquisition():
+    ''' Drivers provide _acquireOnce(names) -> dict (of arrays)|None, and optionally _recover() '''
+    _executor = None
+
+    def __init_subclass__(cls, **kwargs):
+        # N.B. a driver without an acquisition attempt fails when it's defined, not on its first scan
+        super().__init_subclass__(**kwargs)
+        if not callable(getattr(cls, '_acquireOnce', None)):
+            raise TypeError(f"Lidar driver '{cls.__name__}' doesn't provide _acquireOnce()")
+
+    def _recover(self):
+        ''' Called (in the executor) after a failed attempt, e.g., to restart the motor '''
+        pass
+
+    def _getExecutor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lidar")
+        return self._executor
+
+    def _shutdownExecutor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def acall(self, func, *args):
+        ''' Run a (blocking) driver call in the driver's executor, e.g., a setter while streaming '''
+        return await asyncio.get_running_loop().run_in_executor(self._getExecutor(), func, *args)
+
+    async def ascan(self, names=['angles', 'distances', 'intensities'], timeout=DEF_SCAN_TIMEOUT,
+                    retries=DEF_SCAN_RETRIES, backoff=DEF_BACKOFF):
+        ''' Acquire one rotation, within 'timeout' secs and at most 'retries' retries
+
+        Returns {'ok': <bool>, 'values': <dict>|None, 'error': <str>|None,
+        'attempts': <int>, 'elapsed': <secs>}.  Cancelling the calling task
+        raises CancelledError as usual.
+        '''
+        loop = asyncio.get_running_loop()
+        executor = self._getExecutor()
+        start = time.monotonic()
+        deadline = start + timeout
+        attempts = 0
+        error = None
+        while attempts <= retries:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                error = "timeout"
+                break
+            attempts += 1
+            try:
+                values = await asyncio.wait_for(loop.run_in_executor(executor, self._acquireOnce, names),
+                                                remaining)
+            except asyncio.TimeoutError:
+                error = "timeout"
+                break
+            except Exception as ex:
+                logging.warning(f"Acquisition attempt failed: {ex}")
+                values = None
+            if values:
+                return {'ok': True, 'values': values, 'error': None,
+                        'attempts': attempts, 'elapsed': time.monotonic() - start}
+            error = "no data"
+            if attempts > retries:
+                break
+            delay = min(backoff * (2 ** (attempts - 1)), DEF_MAX_BACKOFF, deadline - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # N.B. recovering (e.g., restarting the motor) counts against the deadline too
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                error = "timeout"
+                break
+            try:
+                await asyncio.wait_for(loop.run_in_executor(executor, self._recover), remaining)
+            except asyncio.TimeoutError:
+                error = "timeout"
+                break
+            except Exception as ex:
+                logging.warning(f"Recovery after a failed attempt failed: {ex}")
+        logging.warning(f"Failed to acquire a rotation ({error}) after {attempts} attempt(s)")
+        return {'ok': False, 'values': None, 'error': error,
+                'attempts': attempts, 'elapsed': time.monotonic() - start}
+
+    async def astream(self, names=['angles', 'distances', 'intensities'], timeout=DEF_SCAN_TIMEOUT,
+                      retries=DEF_SCAN_RETRIES, backoff=DEF_BACKOFF):
+        ''' Yield ascan() results until streaming is turned off, or a rotation can't be acquired
+
+        The failed result is yielded before the stream ends.
+        '''
+        self.streaming = True
+        self.numScans = 0
+        while self.streaming:
+            result = await self.ascan(names, timeout, retries, backoff)
+            self.numScans += 1
+            yield result
+            if not result['ok']:
+                self.streaming = False
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Coalescing of streamed frames into multi-frame messages
+#
+# While the link keeps up, each (serialized) frame is sent on its own, as
+# soon as it's put.  Once it doesn't (i.e., frames queued up behind the
+# last send, or the transport still has bytes buffered), frames are
+# coalesced: the frames waiting are held until 'maxFrames' of them (or
+# 'maxBytes', or so many bytes that another frame like them wouldn't fit)
+# are waiting or the oldest has waited 'maxLatency' secs, and then sent as
+# one message, once the transport's backlog has drained enough for the
+# batch to fit in 'maxBytes' with it (so batching doesn't add to what's
+# queued ahead of the link).  A batch is its frames joined by newlines
+# (serialized JSON doesn't contain any), so clients split it without
+# parsing it.
+#
+# N.B. this saves the per-message overhead of small frames, large frames
+#  are sent one at a time without being held
+#
+################################################################################
+
+import asyncio
+from collections import deque
+import logging
+import time
+
+import websockets
+
+
+DEF_MAX_LATENCY = 0.02      # secs a frame is held for coalescing
+DEF_MAX_FRAMES = 16         # frames in a batch
+DEF_MAX_BYTES = 4096        # (serialized) bytes in a batch, at least one frame is always sent
+DRAIN_POLL = 0.002          # secs between checks of the send backlog
+
+FRAME_SEPARATOR = "\n"
+
+
+def joinFrames(frames):
+    return FRAME_SEPARATOR.join(frames)
+
+def splitFrames(message):
+    ''' The frames of a message, whether or not it's a batch '''
+    if isinstance(message, bytes):
+        message = message.decode()
+    return message.split(FRAME_SEPARATOR)
+
+
+class FrameBatcher():
+    ''' Sends frames with 'send' (async), coalescing them while the link is backed up
+
+    'backlog' is an optional callable returning the bytes still buffered
+    for sending (e.g., the transport's write buffer size).  At most a
+    batch's worth of frames wait here, put() waits for room, so the caller's
+    own queueing (e.g., the replay buffer evicting old frames) applies.
+    A frame only joins a batch if it fits in 'maxBytes'.
+    '''
+    def __init__(self, send, maxLatency=DEF_MAX_LATENCY, maxFrames=DEF_MAX_FRAMES, maxBytes=DEF_MAX_BYTES,
+                 backlog=None):
+        if (maxLatency < 0) or (maxFrames < 1) or (maxBytes < 1):
+            raise ValueError(f"Invalid batching: maxLatency={maxLatency}, maxFrames={maxFrames}, maxBytes={maxBytes}")
+        self.send = send
+        self.maxLatency = maxLatency
+        self.maxFrames = int(maxFrames)
+        self.maxBytes = int(maxBytes)
+        self.backlog = backlog
+        self.pending = deque()
+        self.pendingBytes = 0
+        self.ready = asyncio.Event()
+        self.room = asyncio.Event()
+        self.sent = asyncio.Event()
+        self.congested = False
+        self.task = None
+        self.numPut = 0
+        self.numFrames = 0
+        self.numMessages = 0
+        self.numBatches = 0
+        self.largestBatch = 0
+        self.heldTime = 0.0
+
+    def _full(self):
+        return (len(self.pending) >= self.maxFrames) or (self.pendingBytes >= self.maxBytes)
+
+    def _noRoom(self):
+        # N.B. e.g., a single frame over half of maxBytes, nothing like it can join it
+        return (self.pendingBytes + (self.pendingBytes / len(self.pending))) > self.maxBytes
+
+    def _check(self):
+        # N.B. a failed send stops the batcher, it's raised to whoever puts frames next
+        if self.task and self.task.done() and not self.task.cancelled() and self.task.exception():
+            raise self.task.exception()
+
+    async def put(self, frame):
+        ''' Queue a frame for sending, waiting while a batch's worth is already waiting '''
+        self._check()
+        while self.pending and (self._full() or ((self.pendingBytes + len(frame)) > self.maxBytes)):
+            self.room.clear()
+            await self.room.wait()
+            self._check()
+        self.pending.append((time.monotonic(), frame))
+        self.pendingBytes += len(frame)
+        self.numPut += 1
+        self.ready.set()
+
+    async def flush(self):
+        ''' Wait until the frames put so far have been sent '''
+        target = self.numPut
+        while (self.numFrames < target) and self.task and not self.task.done():
+            self.sent.clear()
+            await self.sent.wait()
+        self._check()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            if self.task.done() and not self.task.cancelled():
+                # N.B. a failed send's exception is dropped if nobody put a frame after it
+                self.task.exception()
+            self.task.cancel()
+            self.task = None
+        self.pending.clear()
+        self.pendingBytes = 0
+        self.room.set()
+
+    async def _run(self):
+        try:
+            await self._sendLoop()
+        finally:
+            self.room.set()
+            self.sent.set()
+
+    async def _sendLoop(self):
+        while True:
+            if not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+            held = 0.0
+            if self.congested:
+                # hold the frames waiting, for more to join them
+                while not (self._full() or self._noRoom()):
+                    remaining = self.pending[0][0] + self.maxLatency - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.ready.clear()
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                # N.B. the batch waits here rather than in the backlog, so what comes in meanwhile waits
+                #  upstream (where stale frames are skipped)
+                while self.backlog and self.backlog() and ((self.backlog() + self.pendingBytes) > self.maxBytes):
+                    await asyncio.sleep(DRAIN_POLL)
+                held = time.monotonic() - self.pending[0][0]
+            frames = [frame for _, frame in self.pending]
+            self.pending.clear()
+            self.pendingBytes = 0
+            self.room.set()
+            try:
+                await self.send(joinFrames(frames))
+            except websockets.exceptions.ConnectionClosed:
+                # N.B. e.g., the client went away, whoever puts frames next finds out
+                raise
+            except Exception as ex:
+                logging.warning(f"Failed to send {len(frames)} frame(s): {ex}")
+                raise
+            self.numFrames += len(frames)
+            self.numMessages += 1
+            if len(frames) > 1:
+                self.numBatches += 1
+            self.largestBatch = max(self.largestBatch, len(frames))
+            self.heldTime += held
+            self.congested = bool(self.pending) or bool(self.backlog and self.backlog())
+            self.sent.set()
+
+    def status(self):
+        return {'batchFrames': self.numFrames, 'batchMessages': self.numMessages,
+                'batchBatches': self.numBatches, 'batchLargest': self.largestBatch,
+                'batchCongested': self.congested,
+                'batchMeanHeldMs': round(1000.0 * self.heldTime / self.numMessages, 2) if self.numMessages else None}
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Multi-Sensor Extrinsic Calibration and Point Cloud Fusion Library
+#
+# Each sensor's pose in the site frame is given by its extrinsics (x, y, yaw),
+# plus the tilt of its scan plane.  Rotations from all sensors are transformed
+# into site coordinates and merged into a single point cloud per tick.
+#
+################################################################################
+
+import logging
+import numpy as np
+
+from ..shared import MIN_TILT_ANGLE, MAX_TILT_ANGLE, DEF_TILT_ANGLE
+
+
+#### TODO
+####  * estimate extrinsics from overlapping perimeter captures
+
+
+DEF_TIME_TOLERANCE = 0.05  # secs, rotations within this of the tick are merged
+DEF_MAX_SENSORS = 8
+
+
+class Extrinsics():
+    ''' Pose of a sensor in the site frame
+
+    Angles are given in degrees and distances in meters.  The tilt is modelled
+    as a pitch of the scan plane about the sensor's y-axis, so the point at
+    azimuth theta and range d, (d cos(theta), d sin(theta), 0) in the scan
+    plane, is (d cos(theta) cos(tilt), d sin(theta)) projected onto the ground
+    plane.
+    '''
+    def __init__(self, x=0.0, y=0.0, yaw=0.0, tilt=DEF_TILT_ANGLE):
+        if (tilt > MAX_TILT_ANGLE) or (tilt < MIN_TILT_ANGLE):
+            raise ValueError(f"Invalid tilt angle ({tilt})")
+        self.x = float(x)
+        self.y = float(y)
+        self.yaw = float(yaw)
+        self.tilt = float(tilt)
+
+        # precompute everything that doesn't depend on the samples
+        yawRad = np.radians(self.yaw)
+        c, s = np.cos(yawRad), np.sin(yawRad)
+        self.rotation = np.array([[c, -s], [s, c]])
+        self.translation = np.array([self.x, self.y])
+        self.cosTilt = np.cos(np.radians(self.tilt))
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(**{k: d[k] for k in ('x', 'y', 'yaw', 'tilt') if k in d})
+
+    def toDict(self):
+        return {'x': self.x, 'y': self.y, 'yaw': self.yaw, 'tilt': self.tilt}
+
+    def toSite(self, angles, distances, out=None):
+        ''' Transform polar samples (radians, meters) into site (x, y) coordinates
+
+        Returns an (N, 2) array, written into 'out' if one is given.
+        '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        local = np.empty((len(angles), 2))
+        local[:, 0] = distances * np.cos(angles) * self.cosTilt
+        local[:, 1] = distances * np.sin(angles)
+        if out is None:
+            out = np.empty_like(local)
+        np.matmul(local, self.rotation.T, out=out)
+        out += self.translation
+        return out
+
+
+class SensorFusion():
+    ''' Merge rotations from multiple sensors into one site-frame point cloud per tick
+
+    Sensors push their latest rotation with add(), and fuse() returns the cloud
+    made from every sensor's rotation that lies within the time tolerance of
+    the tick.  Stale sensors are left out of the tick rather than delaying it.
+    A rotation is fused into one tick at most: it's consumed by the tick it's
+    merged into, and dropped once it's too old for any later tick.
+    '''
+    def __init__(self, extrinsics=None, tolerance=DEF_TIME_TOLERANCE):
+        self.extrinsics = {}
+        self.tolerance = tolerance
+        self.latest = {}
+        self.numTicks = 0
+        self.numDropped = 0
+        for sensorId, ext in (extrinsics or {}).items():
+            self.setExtrinsics(sensorId, ext)
+
+    def setExtrinsics(self, sensorId, ext):
+        if isinstance(ext, dict):
+            ext = Extrinsics.fromDict(ext)
+        if (sensorId not in self.extrinsics) and (len(self.extrinsics) >= DEF_MAX_SENSORS):
+            logging.error(f"Too many sensors, ignoring: {sensorId}")
+            return True
+        self.extrinsics[sensorId] = ext
+        self.latest.pop(sensorId, None)
+        return False
+
+    def removeSensor(self, sensorId):
+        self.latest.pop(sensorId, None)
+        return self.extrinsics.pop(sensorId, None) is None
+
+    def add(self, sensorId, rotation, stamp):
+        ''' Record a sensor's latest rotation (dict with 'angles' and 'distances', optional 'intensities') '''
+        if sensorId not in self.extrinsics:
+            logging.error(f"No extrinsics for sensor, ignoring rotation: {sensorId}")
+            return True
+        ext = self.extrinsics[sensorId]
+        # N.B. samples without a return (zero distance) would land on the sensor's position
+        distances = np.asarray(rotation['distances'], dtype=np.float64)
+        valid = distances > 0
+        xy = ext.toSite(np.asarray(rotation['angles'], dtype=np.float64)[valid], distances[valid])
+        intensities = rotation.get('intensities')
+        if intensities is None:
+            intensities = np.zeros(len(xy), dtype=np.int32)
+        else:
+            intensities = np.asarray(intensities, dtype=np.int32)[valid]
+        self.latest[sensorId] = (stamp, xy, intensities)
+        return False
+
+    def fuse(self, tick=None):
+        ''' Return the fused cloud for the tick (defaults to the newest rotation's stamp)
+
+        The cloud is a dict of arrays: 'x', 'y', 'intensities', 'sensors' (index
+        into 'sensorIds'), plus the 'stamp' of the tick.
+        '''
+        if not self.latest:
+            return None
+        if tick is None:
+            tick = max(stamp for stamp, _, _ in self.latest.values())
+        selected = [(sensorId, entry) for sensorId, entry in self.latest.items()
+                    if abs(tick - entry[0]) <= self.tolerance]
+        stale = [sensorId for sensorId, entry in self.latest.items() if entry[0] < (tick - self.tolerance)]
+        # N.B. rotations newer than the tick are kept for the next one
+        for sensorId in [sensorId for sensorId, _ in selected] + stale:
+            del self.latest[sensorId]
+        self.numDropped += len(stale)
+        self.numTicks += 1
+
+        sizes = [len(entry[1]) for _, entry in selected]
+        total = sum(sizes)
+        xy = np.empty((total, 2))
+        intensities = np.empty(total, dtype=np.int32)
+        sensors = np.empty(total, dtype=np.int8)
+        start = 0
+        for i, ((sensorId, (stamp, pts, ints)), size) in enumerate(zip(selected, sizes)):
+            xy[start:start + size] = pts
+            intensities[start:start + size] = ints
+            sensors[start:start + size] = i
+            start += size
+        return {'x': xy[:, 0], 'y': xy[:, 1], 'intensities': intensities,
+                'sensors': sensors, 'sensorIds': [sensorId for sensorId, _ in selected],
+                'stamp': tick}
+
+    def toPolar(self, cloud, origin=(0.0, 0.0)):
+        ''' Express a fused cloud as (angles, distances) about a site origin, for polar zone tests '''
+        dx = cloud['x'] - origin[0]
+        dy = cloud['y'] - origin[1]
+        return np.arctan2(dy, dx), np.hypot(dx, dy)
+
+    def status(self):
+        return {'sensors': list(self.extrinsics.keys()), 'tolerance': self.tolerance,
+                'numTicks': self.numTicks, 'numDropped': self.numDropped}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Process-Pool Offload for Shapely Geometry Jobs
+#
+# Unioning, simplifying and buffering reference polygons can take hundreds of
+# milliseconds on large perimeters, so UIs submit them to a process pool and
+# keep refreshing while they run.  Jobs are identified by a kind (e.g.,
+# 'reference'), and a new job of the same kind supersedes (cancels, or
+# ignores the result of) the one in flight.  Results are cached by input.
+#
+################################################################################
+
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import logging
+import threading
+
+import numpy as np
+import shapely
+
+
+DEF_MAX_WORKERS = 2
+DEF_CACHE_SIZE = 32
+
+
+def _digest(args):
+    ''' Hash of a job's inputs (geometries and arrays by content, everything else by repr) '''
+    h = hashlib.blake2b(digest_size=16)
+    def _add(arg):
+        if isinstance(arg, shapely.Geometry):
+            h.update(shapely.to_wkb(arg))
+        elif isinstance(arg, np.ndarray):
+            h.update(str((arg.dtype, arg.shape)).encode())
+            h.update(np.ascontiguousarray(arg).tobytes())
+        elif isinstance(arg, (list, tuple)):
+            h.update(b'[')
+            for a in arg:
+                _add(a)
+            h.update(b']')
+        else:
+            h.update(repr(arg).encode())
+    _add(args)
+    return h.hexdigest()
+
+
+class GeometryJobs():
+    def __init__(self, maxWorkers=DEF_MAX_WORKERS, cacheSize=DEF_CACHE_SIZE):
+        self.pool = ProcessPoolExecutor(max_workers=maxWorkers)
+        self.cacheSize = cacheSize
+        self.cache = OrderedDict()
+        self.pending = {}   # kind -> (key, future) of the job in flight
+        self.latest = {}    # kind -> result of the newest job that completed
+        self.lock = threading.Lock()
+        self.numHits = 0
+        self.numMisses = 0
+        self.numSuperseded = 0
+
+    def submit(self, kind, func, *args):
+        ''' Start a job (superseding any other of this kind), returns its future '''
+        key = (func.__name__, _digest(args))
+        with self.lock:
+            if key in self.cache:
+                self.numHits += 1
+                self.cache.move_to_end(key)
+                self._supersede(kind)
+                self.latest[kind] = self.cache[key]
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            pending = self.pending.get(kind)
+            if pending and (pending[0] == key):
+                return pending[1]
+            self.numMisses += 1
+            self._supersede(kind)
+            future = self.pool.submit(func, *args)
+            self.pending[kind] = (key, future)
+        future.add_done_callback(lambda f: self._done(kind, key, f))
+        return future
+
+    def _supersede(self, kind):
+        # N.B. a job that's already running can't be stopped, its result is cached but not used
+        pending = self.pending.pop(kind, None)
+        if pending:
+            pending[1].cancel()
+            self.numSuperseded += 1
+
+    def _done(self, kind, key, future):
+        if future.cancelled():
+            return
+        ex = future.exception()
+        if ex:
+            logging.error(f"Geometry job '{kind}' failed: {ex}")
+            with self.lock:
+                if self.pending.get(kind, (None,))[0] == key:
+                    del self.pending[kind]
+            return
+        result = future.result()
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+            if self.pending.get(kind, (None,))[0] == key:
+                del self.pending[kind]
+                self.latest[kind] = result
+
+    def get(self, kind):
+        ''' Latest completed result of this kind (None if there isn't one yet) '''
+        with self.lock:
+            return self.latest.get(kind)
+
+    def busy(self, kind):
+        with self.lock:
+            return kind in self.pending
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def status(self):
+        return {'hits': self.numHits, 'misses': self.numMisses,
+                'superseded': self.numSuperseded, 'pending': list(self.pending)}
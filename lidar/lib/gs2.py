@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# YDLIDAR GS2 Solid-State ToF Sensor Library
+#
+# Native serial driver for the GS2 (see the Development Manual in tof/docs/),
+# with the same interface as lib/lidar.py's Lidar so that it can be served by
+# wsLidar.  Each frame holds 160 samples from two cameras (L1-L80, R1-R80).
+# The per-device angle/distance correction from the manual is reduced to
+# per-pixel lookup tables when the device parameters are read, so decoding a
+# frame is a handful of array operations.
+#
+################################################################################
+
+import logging
+import time
+
+import numpy as np
+
+from ..shared import MIN_ANGLE, MAX_ANGLE, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE
+from .asyncAcquire import AsyncAcquisition
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+
+DEF_PORT_PATH = "/dev/ttyUSB0"
+DEF_BAUD_RATE = 921600
+DEF_MAX_ANGLE = 180.0   # degrees
+DEF_MIN_ANGLE = -180.0  # degrees
+DEF_SCAN_FREQ = 28.0    # Hz, frame rate (fixed)
+DEF_MAX_RANGE = 0.3     # meters
+DEF_MIN_RANGE = 0.025   # meters
+DEF_SAMPLE_RATE = 4     # KHz (fixed, only validated)
+DEF_TIMEOUT = 1.0       # secs to wait for a frame before giving up
+
+GS2_MIN_RANGE = 0.025   # meters
+GS2_MAX_RANGE = 0.3     # meters
+
+READ_SIZE = 4096
+HEADER = b'\xA5\xA5\xA5\xA5'
+HEADER_LEN = 8          # header, address, type, length
+NUM_PIXELS = 160
+HALF_PIXELS = NUM_PIXELS // 2
+FRAME_DATA_LEN = 2 + (2 * NUM_PIXELS)
+FRAME_LEN = HEADER_LEN + FRAME_DATA_LEN + 1
+ADDRESSES = (0x01, 0x02, 0x04)
+
+CMD_GET_ADDRESS = 0x60
+CMD_GET_PARAMS = 0x61
+CMD_GET_VERSION = 0x62
+CMD_START = 0x63
+CMD_STOP = 0x64
+CMD_RESET = 0x67
+
+# mechanical constants of the GS2, from the SDK
+ANGLE_PX = 1.22
+ANGLE_PY = 5.315
+ANGLE_P_ANGLE = 22.5
+
+
+def encodePacket(address, packetType, data=b''):
+    ''' Build a GS2 packet (also used for commands and by emulators) '''
+    body = bytes([address, packetType]) + len(data).to_bytes(2, 'little') + bytes(data)
+    return HEADER + body + bytes([sum(body) & 0xFF])
+
+def encodeFrame(address, distances, intensities, env=0):
+    ''' Encode a scan frame of 160 samples (mm, 0-127) as the device would send it '''
+    s = (np.asarray(distances, dtype=np.uint16) & 0x1FF) | \
+        (np.asarray(intensities, dtype=np.uint16) << 9)
+    data = int(env).to_bytes(2, 'little') + s.astype('<u2').tobytes()
+    return encodePacket(address, CMD_START, data)
+
+def decodeFrames(data):
+    ''' Find and decode all the valid scan frames in a chunk of the byte stream
+
+    Returns (frames, packets, consumed), where 'frames' is a dict of arrays:
+    'addresses' (k), 'env' (k), 'distances' (k x 160, mm) and 'intensities'
+    (k x 160), 'packets' is a list of (address, type, data) for any other
+    (i.e., command response) packets, and 'consumed' is the number of
+    leading bytes of 'data' that no longer need to be kept.
+    '''
+    buf = np.frombuffer(data, dtype=np.uint8)
+    n = len(buf)
+    isA5 = buf == 0xA5
+    starts = np.flatnonzero(isA5[:-3] & isA5[1:-2] & isA5[2:-1] & isA5[3:]) if n >= 4 else np.zeros(0, dtype=np.int64)
+    hasHeader = starts + HEADER_LEN <= n
+    hdrStarts = starts[hasHeader]
+    lengths = buf[hdrStarts + 6].astype(np.int64) | (buf[hdrStarts + 7].astype(np.int64) << 8)
+    ends = hdrStarts + HEADER_LEN + lengths + 1
+    complete = ends <= n
+
+    # validate all the complete scan frames at once
+    types = buf[hdrStarts + 5]
+    isFrame = complete & (types == CMD_START) & (lengths == FRAME_DATA_LEN)
+    valid = np.zeros(len(hdrStarts), dtype=bool)
+    fIdx = np.flatnonzero(isFrame)
+    if len(fIdx):
+        rows = buf[(hdrStarts[fIdx] + 4)[:, None] + np.arange(FRAME_LEN - 4)]
+        valid[fIdx] = (rows[:, :-1].sum(axis=1, dtype=np.uint32) & 0xFF) == rows[:, -1]
+    # other packets are rare (command responses), check them one at a time
+    for i in np.flatnonzero(complete & ~isFrame):
+        body = buf[hdrStarts[i] + 4:ends[i] - 1]
+        valid[i] = (int(body.sum(dtype=np.uint32)) & 0xFF) == buf[ends[i] - 1]
+
+    selected = []
+    prevEnd = 0
+    for i in np.flatnonzero(valid):
+        if hdrStarts[i] >= prevEnd:
+            selected.append(i)
+            prevEnd = ends[i]
+    sel = np.array(selected, dtype=np.int64)
+    pending = np.concatenate((starts[~hasHeader], hdrStarts[~complete]))
+    pending = pending[pending >= prevEnd]
+    consumed = int(pending.min()) if len(pending) else max(int(prevEnd), n - 3)
+
+    frameSel = sel[isFrame[sel]] if len(sel) else sel
+    rows = buf[(hdrStarts[frameSel] + HEADER_LEN)[:, None] + np.arange(FRAME_DATA_LEN)]
+    words = rows.view('<u2') if len(frameSel) else np.zeros((0, NUM_PIXELS + 1), dtype=np.uint16)
+    frames = {'addresses': buf[hdrStarts[frameSel] + 4],
+              'env': words[:, 0],
+              'distances': words[:, 1:] & 0x1FF,
+              'intensities': words[:, 1:] >> 9}
+    packets = [(int(buf[hdrStarts[i] + 4]), int(types[i]),
+                bytes(buf[hdrStarts[i] + HEADER_LEN:ends[i] - 1]))
+               for i in sel if not isFrame[i]]
+    return frames, packets, consumed
+
+
+class Calibration():
+    ''' Per-device correction of raw GS2 samples into (angle, distance)
+
+    Following the manual's conversion function, for each pixel the corrected
+    point is X = dist, Y = slope * (dist - ANGLE_PX) + offset, where the slope
+    and offset depend only on the pixel and the device's K/B/bias parameters,
+    so they are computed once here rather than per frame.
+    '''
+    def __init__(self, k0, b0, k1, b1, bias):
+        self.params = {'k0': k0, 'b0': b0, 'k1': k1, 'b1': b1, 'bias': bias}
+        rot = ANGLE_P_ANGLE + bias
+        n = np.arange(NUM_PIXELS)
+        left = n < HALF_PIXELS
+        pixelU = np.where(left, HALF_PIXELS - n, NUM_PIXELS - n).astype(np.float64)
+        k = np.where(left, k0, k1)
+        b = np.where(left, b0, b1)
+        lin = (k * pixelU) - b
+        theta = np.where(b > 1, lin, np.degrees(np.arctan(lin)))
+        self.slope = np.where(left, np.tan(np.radians(theta - rot)), np.tan(np.radians(theta + rot)))
+        self.offset = np.where(left, -ANGLE_PY, ANGLE_PY)
+
+    @classmethod
+    def fromBytes(cls, data):
+        k0, b0, k1, b1 = np.frombuffer(data[:8], dtype='<u2') / 10000.0
+        bias = np.frombuffer(data[8:9], dtype=np.int8)[0] / 10.0
+        return cls(float(k0), float(b0), float(k1), float(b1), float(bias))
+
+    def correct(self, distances):
+        ''' Map raw distances (k x 160, mm) to (angles in degrees clockwise [0, 360), distances in mm) '''
+        x = distances.astype(np.float64)
+        y = (self.slope * (x - ANGLE_PX)) + self.offset
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angles = np.degrees(np.arctan(y / x)) % 360.0
+        dists = np.where(distances > 0, np.hypot(x, y), 0.0)
+        return np.nan_to_num(angles), dists
+
+
+class GS2Lidar(AsyncAcquisition):
+    ''' GS2 driver with the same public surface as lib/lidar.py's Lidar
+
+    A "rotation" is one frame from each of the (up to three) cascaded modules.
+    '''
+    LIDAR_VERSION = "1.3.0"  # N.B. Must match lidar.py library's version
+
+    def __init__(self, **kwargs):
+        self.port = kwargs.get('port', None) or DEF_PORT_PATH
+        self.baud = kwargs.get('baud', DEF_BAUD_RATE)
+        self.scanFreq = kwargs.get('scanFreq', DEF_SCAN_FREQ)
+        self.sampleRate = kwargs.get('sampleRate', DEF_SAMPLE_RATE)
+        self.maxAngle = kwargs.get('maxAngle', DEF_MAX_ANGLE)
+        self.minAngle = kwargs.get('minAngle', DEF_MIN_ANGLE)
+        self.maxRange = min(kwargs.get('maxRange', DEF_MAX_RANGE), GS2_MAX_RANGE)
+        self.minRange = max(kwargs.get('minRange', DEF_MIN_RANGE), GS2_MIN_RANGE)
+        self.zeroFilter = kwargs.get('zeroFilter', True)
+        self.timeout = kwargs.get('timeout', DEF_TIMEOUT)
+        # per-module mounting yaw (degrees), keyed by module address
+        self.moduleYaw = {int(k): v for k, v in kwargs.get('moduleYaw', {}).items()}
+        self.numScans = None
+        self.scanning = False
+        self.streaming = False
+        self.buffer = bytearray()
+        self.frames = {}
+        self.rotations = []
+        self.calibrations = {}
+        self.version = None
+
+        if serial is None:
+            raise RuntimeError("The GS2 driver requires pyserial")
+        # N.B. 'device' may be any file-like serial stand-in (e.g., a pty)
+        self.device = kwargs.get('device', None)
+        if self.device is None:
+            self.device = serial.Serial(self.port, self.baud, timeout=0.1)
+        logging.debug(f"Port: {self.port}")
+
+        self._command(CMD_STOP)
+        responses = self._command(CMD_GET_PARAMS)
+        for address, data in responses:
+            self.calibrations[address] = Calibration.fromBytes(data)
+        if not self.calibrations:
+            raise RuntimeError("Failed to read GS2 device parameters")
+        self.version = {a: d[:3].hex() for a, d in self._command(CMD_GET_VERSION)}
+        if self.setAngles(self.minAngle, self.maxAngle) or \
+           self.setRanges(self.minRange, self.maxRange):
+            raise ValueError("Invalid lidar options")
+
+    def _read(self):
+        waiting = getattr(self.device, 'in_waiting', 0)
+        data = self.device.read(max(waiting, READ_SIZE) if waiting else READ_SIZE)
+        if not data:
+            time.sleep(0.001)
+            return {'addresses': []}, []
+        self.buffer += data
+        frames, packets, consumed = decodeFrames(bytes(self.buffer))
+        del self.buffer[:consumed]
+        return frames, packets
+
+    def _command(self, cmd, data=b'', wait=0.3):
+        ''' Send a command to all modules and return the list of (address, data) responses '''
+        self.device.write(encodePacket(0x00, cmd, data))
+        if hasattr(self.device, 'flush'):
+            self.device.flush()
+        responses = []
+        expected = len(self.calibrations)
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            _, packets = self._read()
+            responses += [(a, d) for a, t, d in packets if t == cmd]
+            if expected and (len(responses) >= expected):
+                break
+        return responses
+
+    def readRotation(self, timeout=None):
+        ''' Return the next set of module frames as a dict of arrays, or None on timeout '''
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while not self.rotations:
+            if time.monotonic() > deadline:
+                return None
+            frames, _ = self._read()
+            for i, address in enumerate(frames['addresses']):
+                address = int(address)
+                if address in self.frames:
+                    # a module repeated before the others reported, emit what we have
+                    self.rotations.append(self._assemble())
+                self.frames[address] = (frames['distances'][i], frames['intensities'][i])
+                if len(self.frames) >= len(self.calibrations):
+                    self.rotations.append(self._assemble())
+        return self.rotations.pop(0)
+
+    def _assemble(self):
+        angles, distances, intensities, modules = [], [], [], []
+        for address, (dists, ints) in sorted(self.frames.items()):
+            cal = self.calibrations.get(address)
+            if cal is None:
+                continue
+            a, d = cal.correct(dists)
+            angles.append(a + self.moduleYaw.get(address, 0.0))
+            distances.append(d)
+            intensities.append(ints)
+            modules.append(np.full(len(a), address, dtype=np.uint8))
+        self.frames = {}
+        rad = np.radians(np.concatenate(angles) % 360.0)
+        rot = {'angles': np.where(rad >= np.pi, rad - (2 * np.pi), rad),
+               'distances': np.concatenate(distances) / 1000.0,
+               'intensities': np.concatenate(intensities).astype(np.int32),
+               'modules': np.concatenate(modules), 'stamp': time.time()}
+        keep = (rot['angles'] >= np.radians(self.minAngle)) & (rot['angles'] <= np.radians(self.maxAngle))
+        outOfRange = (rot['distances'] < self.minRange) | (rot['distances'] > self.maxRange)
+        rot['distances'] = np.where(outOfRange, 0.0, rot['distances'])
+        if self.zeroFilter:
+            keep &= rot['distances'] > 0
+        for k in ('angles', 'distances', 'intensities', 'modules'):
+            rot[k] = rot[k][keep]
+        return rot
+
+    def laserEnable(self, enable):
+        if enable:
+            if not self.scanning:
+                self.buffer = bytearray()
+                self.frames = {}
+                self.rotations = []
+                self.device.write(encodePacket(0x00, CMD_START))
+                self.scanning = True
+        else:
+            if self.scanning:
+                self.scanning = False
+                self._command(CMD_STOP, wait=0.1)
+            self.streaming = False
+        return False
+
+    def _acquireOnce(self, names):
+        if (self.device is None) or (not self.scanning):
+            return None
+        rot = self.readRotation()
+        if rot is None:
+            return None
+        # N.B. the rotation's arrays are handed on as they are, they're only made lists when serialized
+        return {name: rot[name] for name in names if name in rot}
+
+    def _recover(self):
+        if (self.device is not None) and (not self.scanning):
+            self.laserEnable(True)
+
+    def scan(self, names=['angles', 'distances', 'intensities']):
+        self.streaming = False
+        wasScanning = self.scanning
+        self.laserEnable(True)
+        rot = self.readRotation()
+        if not wasScanning:
+            self.laserEnable(False)
+        if rot is None:
+            logging.error("Timed out waiting for a frame")
+            return None
+        # N.B. the (sync) scan's values are lists, as they've always been
+        return {name: rot[name].tolist() for name in names}
+
+    def stream(self, names):
+        self.streaming = True
+        self.numScans = 0
+        while self.streaming:
+            self.numScans += 1
+            rot = self.readRotation()
+            if rot is None:
+                yield None
+                continue
+            yield {name: rot[name] for name in names}
+
+    def status(self):
+        stat = {'laser': True, 'ok': self.device is not None, 'scanning': self.scanning,
+                'streaming': self.streaming, 'numScans': self.numScans,
+                'minAngle': self.minAngle, 'maxAngle': self.maxAngle,
+                'minRange': self.minRange, 'maxRange': self.maxRange,
+                'scanFreq': self.scanFreq, 'sampleRate': self.sampleRate,
+                'driver': 'gs2', 'modules': sorted(self.calibrations.keys()),
+                'deviceInfo': self.version}
+        return stat
+
+    def setAngles(self, minAngle, maxAngle):
+        if minAngle >= maxAngle:
+            logging.error(f"Invalid minAngle and maxAngle pair ({minAngle} >= {maxAngle}))")
+            return True
+        return self.setMinAngle(minAngle) or self.setMaxAngle(maxAngle)
+
+    def setMinAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid minAngle ({angle})")
+            return True
+        self.minAngle = angle
+        return False
+
+    def setMaxAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid maxAngle ({angle})")
+            return True
+        self.maxAngle = angle
+        return False
+
+    def getAngles(self):
+        return self.maxAngle, self.minAngle
+
+    def setRanges(self, minRange, maxRange):
+        if minRange >= maxRange:
+            logging.error(f"Invalid minRange and maxRange pair ({minRange} >= {maxRange}))")
+            return True
+        return self.setMinRange(minRange) or self.setMaxRange(maxRange)
+
+    def setMinRange(self, range):
+        if (range > GS2_MAX_RANGE) or (range < GS2_MIN_RANGE):
+            logging.error(f"Invalid minRange ({range})")
+            return True
+        self.minRange = range
+        return False
+
+    def setMaxRange(self, range):
+        if (range > GS2_MAX_RANGE) or (range < GS2_MIN_RANGE):
+            logging.error(f"Invalid maxRange ({range})")
+            return True
+        self.maxRange = range
+        return False
+
+    def getRanges(self):
+        return self.maxRange, self.minRange
+
+    def setScanFreq(self, scanFreq):
+        # N.B. the GS2's frame rate is fixed
+        logging.warning(f"GS2 frame rate is fixed, ignoring scan frequency ({scanFreq})")
+        return False
+
+    def getScanFreq(self):
+        return self.scanFreq
+
+    def setSampleRate(self, sampleRate):
+        if (sampleRate > MAX_SAMPLE_RATE) or (sampleRate < MIN_SAMPLE_RATE):
+            logging.error(f"Invalid sample rate ({sampleRate})")
+            return True
+        self.sampleRate = sampleRate
+        return False
+
+    def getSampleRate(self):
+        return self.sampleRate
+
+    def getVersion(self):
+        return GS2Lidar.LIDAR_VERSION
+
+    def done(self):
+        self.streaming = False
+        self._shutdownExecutor()
+        res = self.laserEnable(False)
+        if hasattr(self.device, 'close'):
+            self.device.close()
+        self.device = None
+        return not res
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Time-Partitioned Scan History Store
+#
+# Appends rotations to hourly segments of flat binary files (one per array,
+# plus each rotation's timestamp and first point), so a segment's stamps are
+# its index and time-range queries are a binary search and a slice of
+# memory-mapped files.  Retention is tiered: raw rotations are kept for the
+# last 'rawHours', per-angle-bin min/median aggregates at 1 sec for
+# 'secondDays', and 1 min aggregates for 'minuteWeeks'.  Closed segments are
+# aggregated and expired by a background compaction thread.  Each segment's
+# size is tracked as it's written and expired, so the status doesn't walk
+# the tree.
+#
+################################################################################
+
+import calendar
+import logging
+import os
+import shutil
+import threading
+import time
+import warnings
+
+import numpy as np
+
+
+TIERS = ('raw', '1s', '1m')
+TIER_SECS = {'1s': 1, '1m': 60}
+
+SEGMENT_SECS = 3600
+SEGMENT_FORMAT = "%Y%m%d-%H"   # UTC
+
+RAW_FIELDS = {'stamps': np.float64, 'offsets': np.int64, 'angles': np.float32,
+              'distances': np.float32, 'intensities': np.uint16}
+AGG_FIELDS = {'stamps': np.float64, 'min': np.float32, 'median': np.float32}
+
+DEF_DIRECTORY = "./.lidarHistory"
+DEF_RAW_HOURS = 6
+DEF_SECOND_DAYS = 3
+DEF_MINUTE_WEEKS = 4
+DEF_ANGLE_BIN = 1.0             # degrees, of the aggregates
+DEF_COMPACT_INTERVAL = 60.0     # secs
+CHUNK_SECS = 60                 # raw rotations aggregated at a time
+
+
+def segmentKey(stamp):
+    return int(stamp // SEGMENT_SECS)
+
+def segmentName(key):
+    return time.strftime(SEGMENT_FORMAT, time.gmtime(key * SEGMENT_SECS))
+
+def segmentFromName(name):
+    return calendar.timegm(time.strptime(name, SEGMENT_FORMAT)) // SEGMENT_SECS
+
+def _map(path, dtype, rowSize=1):
+    ''' Memory-map a (possibly still growing) flat file, up to its last complete row '''
+    itemSize = np.dtype(dtype).itemsize * rowSize
+    try:
+        numRows = os.path.getsize(path) // itemSize
+    except OSError:
+        numRows = 0
+    if numRows == 0:
+        return np.zeros((0, rowSize) if rowSize > 1 else 0, dtype=dtype)
+    shape = (numRows, rowSize) if rowSize > 1 else (numRows,)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+def _dirSize(path):
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except OSError:
+        return 0
+
+def _grouped(values, groups, numGroups):
+    ''' Rows of values stacked by (sorted) group, (groups x max group size x columns), nan padded '''
+    starts = np.searchsorted(groups, np.arange(numGroups))
+    counts = np.diff(np.append(starts, len(groups)))
+    padded = np.full((numGroups, max(counts.max(), 1), values.shape[1]), np.nan, dtype=np.float32)
+    padded[groups, np.arange(len(groups)) - starts[groups]] = values
+    return padded
+
+def _nanReduce(func, values):
+    # N.B. bins without any returns in a group are all-nan, and stay nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return func(values, axis=1)
+
+
+class HistoryStore():
+    def __init__(self, directory=DEF_DIRECTORY, rawHours=DEF_RAW_HOURS, secondDays=DEF_SECOND_DAYS,
+                 minuteWeeks=DEF_MINUTE_WEEKS, angleBin=DEF_ANGLE_BIN):
+        if rawHours < 1:
+            raise ValueError(f"Invalid history retention: rawHours={rawHours}")
+        self.directory = directory
+        self.retention = {'raw': rawHours * 3600, '1s': secondDays * 86400, '1m': minuteWeeks * 7 * 86400}
+        self.angleBin = angleBin
+        self.numBins = int(np.ceil(360.0 / angleBin))
+        self.lock = threading.Lock()
+        self.segments = {}
+        # bytes in each tier's segments, and overall (kept up to date, rather than walking the tree)
+        self.sizes = {}
+        self.numBytes = 0
+        for tier in TIERS:
+            os.makedirs(self._tierDir(tier), exist_ok=True)
+            names = [n for n in os.listdir(self._tierDir(tier)) if not n.endswith(".tmp")]
+            self.segments[tier] = sorted(segmentFromName(n) for n in names)
+            self.sizes[tier] = {key: _dirSize(self._segmentDir(tier, key)) for key in self.segments[tier]}
+            self.numBytes += sum(self.sizes[tier].values())
+        self.files = None
+        self.segment = None
+        self.numPoints = 0
+        self.numCompactions = 0
+        self.worker = None
+        self.stopEvent = threading.Event()
+
+    def _tierDir(self, tier):
+        return os.path.join(self.directory, tier)
+
+    def _segmentDir(self, tier, key):
+        return os.path.join(self._tierDir(tier), segmentName(key))
+
+    def _openSegment(self, key):
+        self.close()
+        path = self._segmentDir('raw', key)
+        os.makedirs(path, exist_ok=True)
+        self.files = {name: open(os.path.join(path, name), "ab") for name in RAW_FIELDS}
+        self.numPoints = os.path.getsize(os.path.join(path, 'distances')) // 4
+        self.segment = key
+        with self.lock:
+            if key not in self.segments['raw']:
+                self.segments['raw'] = sorted(self.segments['raw'] + [key])
+                self.sizes['raw'][key] = _dirSize(path)
+                self.numBytes += self.sizes['raw'][key]
+
+    def append(self, stamp, angles, distances, intensities=None):
+        ''' Add a rotation (radians, meters) taken at 'stamp' (secs since the epoch) '''
+        key = segmentKey(stamp)
+        if key != self.segment:
+            self._openSegment(key)
+        distances = np.asarray(distances, dtype=np.float32)
+        if intensities is None:
+            intensities = np.zeros(len(distances))
+        # N.B. points, then offsets, then stamps, so readers only see complete rotations
+        self.files['angles'].write(np.asarray(angles, dtype=np.float32).tobytes())
+        self.files['distances'].write(distances.tobytes())
+        self.files['intensities'].write(np.asarray(intensities, dtype=np.uint16).tobytes())
+        self.files['offsets'].write(np.int64(self.numPoints).tobytes())
+        self.files['stamps'].write(np.float64(stamp).tobytes())
+        for name in RAW_FIELDS:
+            self.files[name].flush()
+        self.numPoints += len(distances)
+        size = (len(distances) * (4 + 4 + 2)) + 8 + 8
+        with self.lock:
+            self.sizes['raw'][key] = self.sizes['raw'].get(key, 0) + size
+            self.numBytes += size
+
+    def close(self):
+        if self.files:
+            for f in self.files.values():
+                f.close()
+        self.files = None
+        self.segment = None
+
+    def _overlapping(self, tier, start, end):
+        with self.lock:
+            return [k for k in self.segments[tier]
+                    if (k * SEGMENT_SECS <= end) and ((k + 1) * SEGMENT_SECS > start)]
+
+    def _rawSegment(self, key, start, end):
+        path = self._segmentDir('raw', key)
+        stamps = _map(os.path.join(path, 'stamps'), np.float64)
+        offsets = _map(os.path.join(path, 'offsets'), np.int64)
+        i0 = int(np.searchsorted(stamps, start, side='left'))
+        i1 = int(np.searchsorted(stamps, end, side='right'))
+        if i0 >= i1:
+            return None
+        points = {name: _map(os.path.join(path, name), RAW_FIELDS[name])
+                  for name in ('angles', 'distances', 'intensities')}
+        p0 = int(offsets[i0])
+        p1 = int(offsets[i1]) if i1 < len(offsets) else len(points['distances'])
+        values = {name: v[p0:p1] for name, v in points.items()}
+        values['stamps'] = stamps[i0:i1]
+        values['offsets'] = offsets[i0:i1] - p0
+        return values
+
+    def _aggSegment(self, tier, key, start, end):
+        path = self._segmentDir(tier, key)
+        stamps = _map(os.path.join(path, 'stamps'), np.float64)
+        i0 = int(np.searchsorted(stamps, start, side='left'))
+        i1 = int(np.searchsorted(stamps, end, side='right'))
+        if i0 >= i1:
+            return None
+        values = {name: _map(os.path.join(path, name), AGG_FIELDS[name], self.numBins)[i0:i1]
+                  for name in ('min', 'median')}
+        values['stamps'] = stamps[i0:i1]
+        return values
+
+    def tierFor(self, start, now=None):
+        ''' The finest tier whose retention still covers 'start' '''
+        now = time.time() if now is None else now
+        for tier in TIERS:
+            if start >= (now - self.retention[tier]):
+                return tier
+        return TIERS[-1]
+
+    def query(self, start, end, tier=None):
+        ''' Return the history between two times (secs since the epoch), as a dict of arrays
+
+        Raw: 'stamps' and (first point) 'offsets' per rotation, and the rotations'
+        'angles', 'distances' and 'intensities'.  Aggregates: 'stamps' and the
+        per-bin 'min' and 'median' ranges (rows), and the bins' 'angles'.  Arrays
+        from a single segment are memory-mapped views.
+        '''
+        tier = tier or self.tierFor(start)
+        if tier not in TIERS:
+            raise ValueError(f"Unknown history tier: {tier}")
+        parts = []
+        for key in self._overlapping(tier, start, end):
+            try:
+                part = self._rawSegment(key, start, end) if tier == 'raw' else \
+                       self._aggSegment(tier, key, start, end)
+            except (OSError, ValueError):
+                part = None     # e.g., expired while querying
+            if part:
+                parts.append(part)
+        if tier == 'raw':
+            names = ('stamps', 'offsets', 'angles', 'distances', 'intensities')
+            dtypes = {'offsets': np.int64} | RAW_FIELDS
+        else:
+            names = ('stamps', 'min', 'median')
+            dtypes = AGG_FIELDS
+        if len(parts) == 1:
+            values = parts[0]
+        elif not parts:
+            values = {n: np.zeros((0, self.numBins) if n in ('min', 'median') else 0, dtype=dtypes[n])
+                      for n in names}
+        else:
+            if tier == 'raw':
+                base = np.cumsum([0] + [len(p['distances']) for p in parts[:-1]])
+                for p, b in zip(parts, base):
+                    p['offsets'] = p['offsets'] + b
+            values = {n: np.concatenate([p[n] for p in parts]) for n in names}
+        values['tier'] = tier
+        if tier != 'raw':
+            values['angles'] = np.radians((np.arange(self.numBins) + 0.5) * self.angleBin - 180.0)
+        return values
+
+    def _binned(self, raw):
+        ''' Per-rotation (rows) min range in each angle bin, nan where there's no return '''
+        counts = np.diff(np.append(raw['offsets'], len(raw['distances'])))
+        rows = np.repeat(np.arange(len(counts)), counts)
+        valid = raw['distances'] > 0
+        bins = ((np.degrees(raw['angles'][valid]) + 180.0) / self.angleBin).astype(np.int64) % self.numBins
+        binned = np.full((len(counts), self.numBins), np.inf, dtype=np.float32)
+        np.minimum.at(binned, (rows[valid], bins), raw['distances'][valid])
+        binned[np.isinf(binned)] = np.nan
+        return binned
+
+    def _writeAgg(self, tier, key, stamps, mins, medians):
+        path = self._segmentDir(tier, key)
+        tmpPath = f"{path}.tmp"
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        os.makedirs(tmpPath)
+        for name, values in (('stamps', stamps), ('min', mins), ('median', medians)):
+            np.asarray(values, dtype=AGG_FIELDS[name]).tofile(os.path.join(tmpPath, name))
+        size = _dirSize(tmpPath)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmpPath, path)
+        with self.lock:
+            self.segments[tier] = sorted(set(self.segments[tier]) | {key})
+            self.numBytes += size - self.sizes[tier].get(key, 0)
+            self.sizes[tier][key] = size
+
+    def _aggregate(self, tier, key):
+        ''' Build a segment's aggregates, 1s from the raw rotations and 1m from the 1s aggregates '''
+        secs = TIER_SECS[tier]
+        start = key * SEGMENT_SECS
+        stamps, mins, medians = [], [], []
+        for chunk in range(start, start + SEGMENT_SECS, CHUNK_SECS if tier == '1s' else SEGMENT_SECS):
+            end = chunk + (CHUNK_SECS if tier == '1s' else SEGMENT_SECS) - 1e-6
+            if tier == '1s':
+                part = self._rawSegment(key, chunk, end)
+                if part is None:
+                    continue
+                lows = highs = self._binned(part)
+            else:
+                # N.B. a minute's min is the min of its seconds' mins, its median the median of their medians
+                part = self._aggSegment('1s', key, chunk, end)
+                if part is None:
+                    continue
+                lows, highs = np.asarray(part['min']), np.asarray(part['median'])
+            slots = ((part['stamps'] - chunk) // secs).astype(np.int64)
+            used, groups = np.unique(slots, return_inverse=True)
+            stamps.append(chunk + (used * secs))
+            mins.append(_nanReduce(np.nanmin, _grouped(lows, groups, len(used))))
+            medians.append(_nanReduce(np.nanmedian, _grouped(highs, groups, len(used))))
+        if not stamps:
+            return
+        self._writeAgg(tier, key, np.concatenate(stamps), np.concatenate(mins), np.concatenate(medians))
+
+    def _expire(self, tier, key):
+        with self.lock:
+            self.segments[tier] = [k for k in self.segments[tier] if k != key]
+            self.numBytes -= self.sizes[tier].pop(key, 0)
+        shutil.rmtree(self._segmentDir(tier, key), ignore_errors=True)
+
+    def compact(self, now=None):
+        ''' Aggregate closed segments and apply the retention, returns the number of segments changed '''
+        now = time.time() if now is None else now
+        current = segmentKey(now)
+        changed = 0
+        with self.lock:
+            segments = {tier: list(keys) for tier, keys in self.segments.items()}
+        for key in segments['raw']:
+            if (key < current) and (key != self.segment) and (key not in segments['1s']):
+                self._aggregate('1s', key)
+                changed += 1
+        with self.lock:
+            segments['1s'] = list(self.segments['1s'])
+        for key in segments['1s']:
+            if (key < current) and (key not in segments['1m']):
+                self._aggregate('1m', key)
+                changed += 1
+        # N.B. a tier's segments only expire once they're aggregated into the next one
+        with self.lock:
+            segments = {tier: list(keys) for tier, keys in self.segments.items()}
+        for i, tier in enumerate(TIERS):
+            for key in segments[tier]:
+                expired = ((key + 1) * SEGMENT_SECS) < (now - self.retention[tier])
+                coarser = (i + 1 == len(TIERS)) or (key in segments[TIERS[i + 1]])
+                if expired and coarser and (key != self.segment):
+                    self._expire(tier, key)
+                    changed += 1
+        self.numCompactions += 1
+        return changed
+
+    def _compactLoop(self, interval):
+        while not self.stopEvent.wait(interval):
+            try:
+                self.compact()
+            except (OSError, ValueError) as ex:
+                logging.warning(f"History compaction failed: {ex}")
+
+    def start(self, interval=DEF_COMPACT_INTERVAL):
+        ''' Run compaction every 'interval' secs, on a background thread '''
+        self.stop()
+        self.stopEvent.clear()
+        self.worker = threading.Thread(target=self._compactLoop, args=(interval,),
+                                       name="history-compact", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        if self.worker:
+            self.stopEvent.set()
+            self.worker.join()
+        self.worker = None
+
+    def status(self):
+        with self.lock:
+            segments = {tier: len(keys) for tier, keys in self.segments.items()}
+            size = self.numBytes
+        return {'historySegments': segments, 'historyBytes': size, 'historyCompactions': self.numCompactions}
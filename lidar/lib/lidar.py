@@ -9,6 +9,7 @@ import logging
 
 from ..shared import (MIN_ANGLE, MAX_ANGLE, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE,
                       MIN_SCAN_FREQ, MAX_SCAN_FREQ)
+from .asyncAcquire import AsyncAcquisition, DEF_SCAN_RETRIES
 
 import ydlidar
 
@@ -16,8 +17,8 @@ import ydlidar
 
 
 #### TODO
-####  * laser: setAutoIntensity, enableGlassNoise, enableSunNoise, getDeviceInfo, getUserVersion
-####  * use asyncio and add streaming option
+####  * laser: setAutoIntensity, getDeviceInfo, getUserVersion
+####  * streaming option
 ####    - keep sending points until get END message
 ####    - while in STREAM mode can handle: HALT and STATUS messages, as well as GET and VERSION commands
 ####    - exit STREAM mode when get: INIT, STOP, SET, SCAN, LASER
@@ -38,7 +39,7 @@ DEF_MIN_RANGE = 0.02    # meters
 DEF_SAMPLE_RATE = 4     # KHz
 
 
-class Lidar():
+class Lidar(AsyncAcquisition):
     LIDAR_VERSION = "1.3.0"
 
     def __init__(self, **kwargs):
@@ -103,19 +104,16 @@ class Lidar():
             self.streaming = False
         return False
 
-    def scan(self, names=['angles', 'distances', 'intensities']):
-        print("SCAN:::::::::")
-        self.streaming = False
+    def _acquireOnce(self, names):
+        ''' One (blocking) attempt at getting a rotation, returns None on failure '''
+        if not self.laser:
+            return None
         ret = self.laser.doProcessSimple(self.laserScan)
-        print(f"> {ret}, {ydlidar.os_isOk()}, {self.laserScan.points}")
-        while not (ret and ydlidar.os_isOk() and self.laserScan.points):
-            self.laser.turnOn()
-            self.laserScan = ydlidar.LaserScan()
-            self.laser.turnOff()
-            ret = self.laser.doProcessSimple(self.laserScan)
-            print(f">> {ret}, {ydlidar.os_isOk()}, {self.laserScan.points}")
-
-        angles, distances, intensities = zip(*[(p.angle, p.range, int(p.intensity)) for p in self.laserScan.points if not (self.zeroFilter and (p.range <= 0))])
+        if not (ret and ydlidar.os_isOk() and self.laserScan.points):
+            return None
+        points = [(p.angle, p.range, int(p.intensity)) for p in self.laserScan.points
+                  if not (self.zeroFilter and (p.range <= 0))]
+        angles, distances, intensities = zip(*points) if points else ((), (), ())
 
         results = {}
         if 'angles' in names:
@@ -126,6 +124,25 @@ class Lidar():
             results['intensities'] = intensities
         return results
 
+    def _recover(self):
+        if not self.laser:
+            return
+        if not self.laser.isScanning():
+            # N.B. only spin the motor up if it isn't already running (e.g., in standby)
+            self.laser.turnOn()
+        self.laserScan = ydlidar.LaserScan()
+
+    def scan(self, names=['angles', 'distances', 'intensities'], retries=DEF_SCAN_RETRIES):
+        ''' Blocking single scan, returns None if no rotation after the given retries (see ascan()) '''
+        self.streaming = False
+        for _ in range(retries + 1):
+            results = self._acquireOnce(names)
+            if results:
+                return results
+            self._recover()
+        logging.error("Failed to acquire a rotation")
+        return None
+
     def stream(self, names):
         print("STREAM!!!!!!!!!!!!!!!!!!!!!")
         self.streaming = True
@@ -151,6 +168,16 @@ class Lidar():
             print("TTTTTT")
             yield results
 
+    def enableSunNoise(self, enable):
+        ''' Have the SDK filter out points with ambient light (sun) interference '''
+        self.laser.enableSunNoise(enable)
+        return False
+
+    def enableGlassNoise(self, enable):
+        ''' Have the SDK filter out points with specular reflection (glass) interference '''
+        self.laser.enableGlassNoise(enable)
+        return False
+
     def status(self):
         stat = {'laser': None, 'ok': ydlidar.os_isOk(), 'scanning': None,
                 'streaming': self.streaming, 'numScans': self.numScans,
@@ -234,6 +261,7 @@ class Lidar():
 
     def done(self):
         self.streaming = False
+        self._shutdownExecutor()
         ydlidar.os_shutdown()
         res = (not self.laser.turnOff()) or (not self.laser.disconnecting())
         self.laser = None
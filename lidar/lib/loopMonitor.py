@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Event Loop Lag Monitor
+#
+# A task that sleeps for a fixed interval and records how late it wakes up,
+# i.e., how long callbacks/coroutines hold the event loop without yielding.
+# Keeps the recent samples, for percentiles in status().
+#
+################################################################################
+
+import asyncio
+from collections import deque
+import time
+
+import numpy as np
+
+
+DEF_INTERVAL = 0.05     # secs between wake ups
+DEF_WINDOW = 1200       # samples kept (a minute at the default interval)
+
+
+class LoopMonitor():
+    def __init__(self, interval=DEF_INTERVAL, window=DEF_WINDOW):
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+        self.maxLag = 0.0
+        self.task = None
+
+    def start(self):
+        ''' Start sampling the running loop's lag '''
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - start - self.interval)
+            self.lags.append(lag)
+            self.maxLag = max(self.maxLag, lag)
+
+    def status(self):
+        if not self.lags:
+            return {'loopLagP50Ms': None, 'loopLagP99Ms': None, 'loopLagMaxMs': None}
+        p50, p99 = np.percentile(np.fromiter(self.lags, dtype=np.float64), [50, 99])
+        return {'loopLagP50Ms': round(float(p50) * 1000.0, 2), 'loopLagP99Ms': round(float(p99) * 1000.0, 2),
+                'loopLagMaxMs': round(self.maxLag * 1000.0, 2)}
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Persisted Model Store
+#
+# Saves learned/compiled state (reference perimeters, backgrounds, zone
+# tables) so a restarted service can detect from its first rotation instead
+# of re-capturing.  Each model is a versioned .npz of uncompressed arrays plus
+# JSON metadata; the arrays are memory-mapped (copy-on-write) on load, and the
+# metadata is checked against what the caller expects (e.g., the sensor's
+# current angle/range config), with stale models ignored.
+#
+################################################################################
+
+import json
+import logging
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+
+MODEL_VERSION = 1
+
+DEF_MODEL_DIR = "./.lidarModels"
+
+META_NAME = "_meta"
+SENSOR_KEYS = ('minAngle', 'maxAngle', 'minRange', 'maxRange')
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")  # zip local file header (fixed part)
+
+
+def modelPath(name, directory=DEF_MODEL_DIR):
+    return os.path.join(directory, f"{name}.npz")
+
+def sensorConfig(status):
+    ''' The parts of a driver's status() that models are only valid for '''
+    return {k: status[k] for k in SENSOR_KEYS if k in status}
+
+def saveModel(path, kind, arrays, meta={}):
+    ''' Write a model atomically, returns True on error '''
+    meta = dict(meta, kind=kind, version=MODEL_VERSION)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmpPath = f"{path}.tmp"
+    try:
+        with open(tmpPath, "wb") as f:
+            # N.B. np.savez() doesn't compress, which is what lets the arrays be memory-mapped
+            np.savez(f, **{k: np.asarray(v) for k, v in arrays.items()},
+                     **{META_NAME: np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)})
+        os.replace(tmpPath, path)
+    except (OSError, TypeError, ValueError) as ex:
+        logging.error(f"Failed to save model '{path}': {ex}")
+        return True
+    logging.debug(f"Saved {kind} model: {path}")
+    return False
+
+def _mmapMember(path, info):
+    ''' Memory-map an uncompressed .npy member of a zip file (copy-on-write), or None if it can't be '''
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        header = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+        f.seek(info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1])
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+        offset = f.tell()
+    if dtype.hasobject or (np.prod(shape) == 0):
+        return None
+    return np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=shape,
+                     order=('F' if fortran else 'C'))
+
+def _matches(value, expected):
+    if isinstance(expected, float) or isinstance(value, float):
+        return isinstance(value, (int, float)) and np.isclose(value, expected)
+    return value == expected
+
+def loadModel(path, kind, expect={}, mmap=True):
+    ''' Return (arrays, meta) of a saved model, or None if it's missing, not the given kind/version, or stale
+
+    Every item of 'expect' must match the model's metadata.
+    '''
+    if not os.path.exists(path):
+        return None
+    try:
+        with zipfile.ZipFile(path) as zf:
+            meta = json.loads(np.load(zf.open(f"{META_NAME}.npy")).tobytes())
+            if (meta.get('kind') != kind) or (meta.get('version') != MODEL_VERSION):
+                logging.warning(f"Ignoring model '{path}': not a version {MODEL_VERSION} {kind} model")
+                return None
+            stale = [k for k, v in expect.items() if not _matches(meta.get(k), v)]
+            if stale:
+                logging.warning(f"Ignoring stale model '{path}': {', '.join(stale)} changed")
+                return None
+            arrays = {}
+            for info in zf.infolist():
+                name = info.filename[:-len(".npy")]
+                if name == META_NAME:
+                    continue
+                array = _mmapMember(path, info) if mmap else None
+                arrays[name] = array if array is not None else np.load(zf.open(info.filename))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile) as ex:
+        logging.warning(f"Ignoring unreadable model '{path}': {ex}")
+        return None
+    logging.debug(f"Loaded {kind} model: {path}")
+    return arrays, meta
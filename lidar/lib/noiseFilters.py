@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Composable Noise-Rejection Filters
+#
+# An ordered chain of filter stages applied to each rotation, each working on
+# whole arrays: intensity limits, isolated-point removal (by angular
+# neighbour range consistency), range jump clipping (mixed returns at edges),
+# and sun/glass noise, using the device's per-point interference flags where
+# the driver provides them, or the SDK's own filtering where it doesn't.
+# Each stage counts the points it removed from the last rotation.
+#
+################################################################################
+
+import numpy as np
+
+
+FLAG_GLASS = 2  # specular reflection (T-mini Pro sample flag)
+FLAG_SUN = 3    # ambient light interference
+
+DEF_MIN_INTENSITY = 0
+DEF_MAX_INTENSITY = 255
+DEF_MAX_RANGE_DIFF = 0.1    # meters, between consistent angular neighbours
+DEF_RELATIVE_DIFF = 0.03    # fraction of the range, added to maxRangeDiff
+DEF_MAX_ANGLE_GAP = 2.0     # degrees, farther apart points aren't neighbours
+DEF_MIN_NEIGHBORS = 1
+DEF_MAX_JUMP = 0.3          # meters
+
+
+def _neighbors(angles, distances):
+    ''' Return the (circular) previous and next neighbours' ranges and angular gaps '''
+    prevDist = np.roll(distances, 1)
+    nextDist = np.roll(distances, -1)
+    prevGap = np.abs(np.angle(np.exp(1j * (angles - np.roll(angles, 1)))))
+    nextGap = np.abs(np.angle(np.exp(1j * (np.roll(angles, -1) - angles))))
+    return prevDist, nextDist, prevGap, nextGap
+
+
+class IntensityFilter():
+    name = 'intensity'
+
+    def __init__(self, minIntensity=DEF_MIN_INTENSITY, maxIntensity=DEF_MAX_INTENSITY):
+        self.minIntensity = minIntensity
+        self.maxIntensity = maxIntensity
+
+    def mask(self, points):
+        if 'intensities' not in points:
+            return None
+        intensities = points['intensities']
+        return (intensities >= self.minIntensity) & (intensities <= self.maxIntensity)
+
+
+class IsolatedPointFilter():
+    ''' Drops points whose range isn't consistent with any of their angular neighbours '''
+    name = 'isolated'
+
+    def __init__(self, maxRangeDiff=DEF_MAX_RANGE_DIFF, relativeDiff=DEF_RELATIVE_DIFF,
+                 maxAngleGap=DEF_MAX_ANGLE_GAP, minNeighbors=DEF_MIN_NEIGHBORS):
+        self.maxRangeDiff = maxRangeDiff
+        self.relativeDiff = relativeDiff
+        self.maxAngleGap = np.radians(maxAngleGap)
+        self.minNeighbors = minNeighbors
+
+    def mask(self, points):
+        angles, distances = points['angles'], points['distances']
+        if len(distances) < 3:
+            return None
+        prevDist, nextDist, prevGap, nextGap = _neighbors(angles, distances)
+        tolerance = self.maxRangeDiff + (self.relativeDiff * distances)
+        consistent = ((np.abs(distances - prevDist) <= tolerance) & (prevGap <= self.maxAngleGap)).astype(np.int8) + \
+                     ((np.abs(distances - nextDist) <= tolerance) & (nextGap <= self.maxAngleGap))
+        return consistent >= self.minNeighbors
+
+
+class RangeJumpFilter():
+    ''' Clips the far-side point at each range jump between neighbours (likely a mixed return at an edge) '''
+    name = 'rangeJump'
+
+    def __init__(self, maxJump=DEF_MAX_JUMP, maxAngleGap=DEF_MAX_ANGLE_GAP):
+        self.maxJump = maxJump
+        self.maxAngleGap = np.radians(maxAngleGap)
+
+    def mask(self, points):
+        angles, distances = points['angles'], points['distances']
+        if len(distances) < 3:
+            return None
+        prevDist, nextDist, prevGap, nextGap = _neighbors(angles, distances)
+        farOfPrev = ((distances - prevDist) > self.maxJump) & (prevGap <= self.maxAngleGap)
+        farOfNext = ((distances - nextDist) > self.maxJump) & (nextGap <= self.maxAngleGap)
+        return ~(farOfPrev | farOfNext)
+
+
+class FlagFilter():
+    ''' Drops points the device flagged, or has the driver filter them if it doesn't report flags '''
+    def __init__(self, name, flag, driverHook):
+        self.name = name
+        self.flag = flag
+        self.driverHook = driverHook
+
+    def mask(self, points):
+        if 'flags' not in points:
+            return None
+        return points['flags'] != self.flag
+
+
+STAGES = {
+    'intensity': IntensityFilter,
+    'isolated': IsolatedPointFilter,
+    'rangeJump': RangeJumpFilter,
+    'sunNoise': lambda: FlagFilter('sunNoise', FLAG_SUN, 'enableSunNoise'),
+    'glassNoise': lambda: FlagFilter('glassNoise', FLAG_GLASS, 'enableGlassNoise'),
+}
+
+
+class NoiseFilterChain():
+    def __init__(self, stages=None):
+        ''' stages: [{'stage': <name>, <param>: <value>, ...}, ...], applied in order '''
+        self.config = []
+        self.stages = []
+        for conf in (stages or []):
+            conf = dict(conf)
+            name = conf.pop('stage', None)
+            if name not in STAGES:
+                raise ValueError(f"Unknown noise filter stage: {name}")
+            self.stages.append(STAGES[name](**conf))
+            self.config.append({'stage': name} | conf)
+        self.removed = {stage.name: 0 for stage in self.stages}
+        self.totalRemoved = dict(self.removed)
+        self.numRotations = 0
+
+    def driverHooks(self):
+        ''' Return {<driver method>: <bool>} for the driver-side (SDK) noise filters '''
+        hooks = {'enableSunNoise': False, 'enableGlassNoise': False}
+        for stage in self.stages:
+            if getattr(stage, 'driverHook', None):
+                hooks[stage.driverHook] = True
+        return hooks
+
+    def apply(self, points):
+        ''' Filter a rotation (dict of equal length arrays/lists), returns a dict of arrays
+
+        N.B. points are kept in the device's order, neighbours are the adjacent samples (the angles
+         wrap around within a rotation, and the angular gaps between neighbours are circular)
+        '''
+        points = {k: np.asarray(v) for k, v in points.items()}
+        for stage in self.stages:
+            keep = stage.mask(points)
+            if keep is None:
+                self.removed[stage.name] = 0
+                continue
+            removed = len(keep) - int(np.count_nonzero(keep))
+            self.removed[stage.name] = removed
+            self.totalRemoved[stage.name] += removed
+            if removed:
+                points = {k: v[keep] for k, v in points.items()}
+        self.numRotations += 1
+        return points
+
+    def status(self):
+        return {'noiseRemoved': dict(self.removed), 'noiseTotalRemoved': dict(self.totalRemoved)}
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Log-Odds Occupancy Grid Library
+#
+# Integrates rotations into a fixed-size 2D log-odds grid in the sensor frame,
+# for detecting slow changes (e.g., a critter sitting still, or something dug
+# up) that per-rotation foreground tests miss.  Rays are traversed in batches:
+# all the rays of a rotation are sampled at cell-sized steps in one array, and
+# each cell is updated at most once per rotation.
+#
+################################################################################
+
+import logging
+import numpy as np
+
+from ..shared import MAX_RANGE
+
+
+GRID_VERSION = 1
+
+DEF_CELL_SIZE = 0.02   # meters
+DEF_LOG_HIT = 0.85     # log-odds added to a cell with a return in it
+DEF_LOG_MISS = -0.4    # log-odds added to a cell a ray passed through
+DEF_LOG_MIN = -4.0
+DEF_LOG_MAX = 4.0
+DEF_DECAY = 0.999      # per-rotation decay of the log-odds toward unknown (0)
+DEF_CHANGE_THRESHOLD = 1.0  # log-odds magnitude for a cell to count as known
+
+
+class OccupancyGrid():
+    def __init__(self, cellSize=DEF_CELL_SIZE, maxRange=MAX_RANGE, logHit=DEF_LOG_HIT,
+                 logMiss=DEF_LOG_MISS, logMin=DEF_LOG_MIN, logMax=DEF_LOG_MAX, decay=DEF_DECAY):
+        self.cellSize = cellSize
+        self.maxRange = maxRange
+        self.logHit = logHit
+        self.logMiss = logMiss
+        self.logMin = logMin
+        self.logMax = logMax
+        self.decay = decay
+        self.size = int(np.ceil((2 * maxRange) / cellSize)) + 1
+        self.center = self.size // 2
+        # N.B. one extra cell at the end absorbs the unused ray samples
+        self._flat = np.zeros((self.size * self.size) + 1, dtype=np.float32)
+        self.grid = self._flat[:-1].reshape(self.size, self.size)
+        self.numRotations = 0
+
+        # ray samples at (just under) cell-sized steps, shared by every rotation
+        self.steps = np.arange(0, maxRange, cellSize * 0.9, dtype=np.float32)
+        self._stepCells = self.steps / np.float32(cellSize)
+
+    def _cells(self, x, y):
+        col = np.floor((x / self.cellSize) + 0.5).astype(np.int32) + self.center
+        row = np.floor((y / self.cellSize) + 0.5).astype(np.int32) + self.center
+        return (row * self.size) + col
+
+    def integrate(self, angles, distances):
+        ''' Add a rotation (radians, meters) to the grid, decaying the previous state '''
+        angles = np.asarray(angles, dtype=np.float32)
+        distances = np.asarray(distances, dtype=np.float32)
+        valid = (distances > 0) & (distances < self.maxRange)
+        angles = angles[valid]
+        distances = distances[valid]
+        if self.decay < 1.0:
+            self.grid *= self.decay
+        if len(angles) == 0:
+            self.numRotations += 1
+            return
+
+        # all rays are sampled over the same steps (trimmed to the longest ray),
+        # with steps at or beyond a ray's return sent to a sacrificial cell
+        numSteps = np.searchsorted(self.steps, distances.max())
+        steps = self._stepCells[:numSteps]
+        offset = self.center + 0.5
+        cols = (np.outer(np.cos(angles), steps) + offset).astype(np.int32)
+        rows = (np.outer(np.sin(angles), steps) + offset).astype(np.int32)
+        cells = (rows * self.size) + cols
+        along = self.steps[None, :numSteps] < (distances[:, None] - self.cellSize)
+        freeCells = np.where(along, cells, self.size * self.size).ravel()
+        hitCells = np.unique(self._cells(distances * np.cos(angles), distances * np.sin(angles)))
+
+        # N.B. fancy-indexed updates apply once per distinct cell, however
+        #      many rays passed through it, and a return wins over a pass-through
+        flat = self._flat
+        prevHits = flat[hitCells]
+        flat[freeCells] = np.maximum(flat[freeCells] + self.logMiss, self.logMin)
+        flat[hitCells] = np.minimum(prevHits + self.logHit, self.logMax)
+        flat[-1] = 0.0
+        self.numRotations += 1
+
+    def probabilities(self):
+        return 1.0 / (1.0 + np.exp(-self.grid))
+
+    def cellCenters(self, cells):
+        ''' Return the sensor-frame (x, y) of flat cell indices '''
+        row, col = np.divmod(np.asarray(cells), self.size)
+        return np.column_stack(((col - self.center) * self.cellSize,
+                                (row - self.center) * self.cellSize))
+
+    def diff(self, baseline, threshold=DEF_CHANGE_THRESHOLD):
+        ''' Compare with a baseline grid (of the same geometry)
+
+        Returns a dict with the flat indices and (x, y) centers of cells that
+        are now occupied but were free in the baseline ('appeared'), and that
+        were occupied but are now free ('vanished').
+        '''
+        if (baseline.size != self.size) or (baseline.cellSize != self.cellSize):
+            raise ValueError("Baseline grid geometry doesn't match")
+        cur = self.grid.reshape(-1)
+        base = baseline.grid.reshape(-1)
+        appeared = np.flatnonzero((cur > threshold) & (base < -threshold))
+        vanished = np.flatnonzero((cur < -threshold) & (base > threshold))
+        return {'appeared': appeared, 'appearedXY': self.cellCenters(appeared),
+                'vanished': vanished, 'vanishedXY': self.cellCenters(vanished)}
+
+    def save(self, path):
+        ''' Snapshot the grid to disk (.npz, with the geometry as metadata) '''
+        np.savez_compressed(path, grid=self.grid, version=GRID_VERSION,
+                            cellSize=self.cellSize, maxRange=self.maxRange,
+                            params=np.array([self.logHit, self.logMiss, self.logMin,
+                                             self.logMax, self.decay]),
+                            numRotations=self.numRotations)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['version']) != GRID_VERSION:
+                raise ValueError(f"Unsupported occupancy grid version: {int(data['version'])}")
+            logHit, logMiss, logMin, logMax, decay = data['params']
+            grid = cls(float(data['cellSize']), float(data['maxRange']), logHit, logMiss,
+                       logMin, logMax, decay)
+            if data['grid'].shape != grid.grid.shape:
+                raise ValueError("Occupancy grid snapshot is corrupt")
+            grid.grid[:] = data['grid']
+            grid.numRotations = int(data['numRotations'])
+        logging.debug(f"Loaded occupancy grid: {path}")
+        return grid
+
+    def reset(self):
+        self.grid[:] = 0.0
+        self.numRotations = 0
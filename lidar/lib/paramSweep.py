@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Detection Parameter Sweep
+#
+# Scores detection configurations (the session analyzer's detector and
+# tracker parameters) against labelled recordings (intervals with and without
+# critters), by precision, recall and detection latency.  Configurations are
+# a grid, or a random sample, of a parameter space.
+#
+# The work is split by what each parameter invalidates, so nothing is
+# computed twice: each session's decoded (angle sorted) rotations, binned
+# rotations, per-point inside-the-reference and foreground masks (per
+# reference/background parameters) and per-rotation largest clusters (per
+# cluster distance) are cached on disk, shared by every configuration (and
+# worker process) that needs them.  The tracker, cheap, is the only step run
+# for every configuration.
+#
+################################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import itertools
+import logging
+import os
+import time
+
+import numpy as np
+import yaml
+
+from .regionClassify import RegionClassifier, LABEL_INSIDE
+from .refGeometry import deriveGeometry
+from .scanRate import ActivityDetector, DEF_ANGLE_BIN, DEF_FOREGROUND_DIST, DEF_LEARN_RATE
+from .sessionAnalyzer import (captureReference, indexSession, stampSecs, trackEvents, _pieces, _rotations,
+                              DEF_MODEL, DEF_MARGIN, DEF_TOLERANCE, DEF_NUM_REF, DEF_CLUSTER_DIST,
+                              DEF_MIN_CLUSTER, DEF_MIN_HITS, DEF_MAX_MISSED, DEF_MAX_GAP)
+
+
+DEF_CACHE_DIR = "./.lidarSweep"
+DEF_BLOCK_POINTS = 1 << 21  # points classified at a time
+
+DETECTOR_DEFAULTS = {'model': DEF_MODEL, 'margin': DEF_MARGIN, 'tolerance': DEF_TOLERANCE, 'numRef': DEF_NUM_REF,
+                     'angleBin': DEF_ANGLE_BIN, 'foregroundDist': DEF_FOREGROUND_DIST, 'learnRate': DEF_LEARN_RATE,
+                     'clusterDist': DEF_CLUSTER_DIST}
+TRACKER_DEFAULTS = {'minCluster': DEF_MIN_CLUSTER, 'minHits': DEF_MIN_HITS, 'maxMissed': DEF_MAX_MISSED,
+                    'maxGap': DEF_MAX_GAP}
+REFERENCE_KEYS = ('numRef', 'margin', 'tolerance')
+BACKGROUND_KEYS = ('angleBin', 'foregroundDist', 'learnRate')
+
+DEF_SPACE = {'model': ['reference', 'background', 'both'], 'margin': [-0.0025, -0.01, -0.05, -0.1],
+             'clusterDist': [0.05, 0.1, 0.2], 'minCluster': [2, 3, 5, 8], 'minHits': [1, 2, 3],
+             'maxMissed': [3, 6, 12]}
+
+
+def _secs(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return float(stampSecs([np.datetime64(value, 'us')])[0])
+
+def loadLabels(path):
+    ''' A labelled session: {'recordings': [<path>, ...], 'critters': [[<start>, <end>], ...], 'empty': [...]}
+
+    Times are (local) datetimes, as in the recordings' "sampleTime"s; recording
+    paths are relative to the labels file.
+    '''
+    with open(path, "r") as f:
+        labels = yaml.safe_load(f) or {}
+    base = os.path.dirname(os.path.abspath(path))
+    return {'name': os.path.splitext(os.path.basename(path))[0],
+            'recordings': [os.path.join(base, p) for p in labels.get('recordings', [])],
+            'critters': [(_secs(s), _secs(e)) for s, e in labels.get('critters', [])],
+            'empty': [(_secs(s), _secs(e)) for s, e in labels.get('empty', [])]}
+
+def _tag(params, keys):
+    return "-".join(f"{params[k]:g}" for k in keys)
+
+def effectiveConfig(config):
+    ''' A full config, with the parameters its model doesn't use cleared (so equivalent configs are equal) '''
+    config = DETECTOR_DEFAULTS | TRACKER_DEFAULTS | config
+    if config['model'] == 'background':
+        config.update({k: None for k in REFERENCE_KEYS})
+    elif config['model'] == 'reference':
+        config.update({k: None for k in BACKGROUND_KEYS})
+    return config
+
+def gridConfigs(space):
+    ''' Every combination of the space's values (lists, or {'min', 'max', 'step'} ranges) '''
+    values = {k: (list(np.arange(v['min'], v['max'] + (v['step'] / 2), v['step']).round(6))
+                  if isinstance(v, dict) else list(v)) for k, v in space.items()}
+    configs = [dict(zip(values, combo)) for combo in itertools.product(*values.values())]
+    return _unique(configs)
+
+def randomConfigs(space, num, seed=None):
+    ''' 'num' random configs: values picked from lists, or uniformly from {'min', 'max'[, 'step']} ranges '''
+    rng = np.random.default_rng(seed)
+
+    def pick(v):
+        if not isinstance(v, dict):
+            return v[rng.integers(len(v))]
+        value = rng.uniform(v['min'], v['max'])
+        return round(v['min'] + (round((value - v['min']) / v['step']) * v['step']), 6) if 'step' in v else value
+
+    return _unique([{k: pick(v) for k, v in space.items()} for _ in range(num)])
+
+def _unique(configs):
+    unique = {}
+    for config in configs:
+        config = effectiveConfig({k: (v.item() if isinstance(v, np.generic) else v) for k, v in config.items()})
+        unique.setdefault(tuple(sorted(config.items())), config)
+    return list(unique.values())
+
+
+class SweepSession():
+    ''' A labelled session's cached intermediate results '''
+    def __init__(self, labels, cacheDir=DEF_CACHE_DIR):
+        self.labels = labels
+        digest = hashlib.sha1()
+        for path in labels['recordings']:
+            stat = os.stat(path)
+            digest.update(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        self.directory = os.path.join(cacheDir, digest.hexdigest()[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.index = None
+        self._points = None
+        self._rotationIds = None
+        self.numComputed = 0
+
+    def _cached(self, name, compute):
+        ''' An array from the cache (memory-mapped), computed and saved if it's not there '''
+        path = os.path.join(self.directory, f"{name}.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+        array = compute()
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, "wb") as f:
+            np.save(f, array)
+        os.replace(tmpPath, path)
+        self.numComputed += 1
+        return np.load(path, mmap_mode='r')
+
+    def _index(self):
+        if self.index is None:
+            self.index = indexSession(self.labels['recordings'])
+        return self.index
+
+    def _decode(self):
+        stamps, counts, angles, distances = [], [], [], []
+        index = self._index()
+        for stamp, a, d, _ in _rotations(_pieces(index, 0, sum(len(offsets) for _, offsets, _ in index))):
+            order = np.argsort(a, kind='stable')
+            stamps.append(stamp)
+            counts.append(len(a))
+            angles.append(a[order])
+            distances.append(d[order])
+        return {'stamps': stampSecs(stamps), 'offsets': np.concatenate(([0], np.cumsum(counts))),
+                'angles': np.concatenate(angles), 'distances': np.concatenate(distances)}
+
+    def points(self):
+        ''' The session's rotations: 'stamps' (secs), 'offsets' (of each rotation's first point, and the
+            end), and the (angle sorted within each rotation) 'angles' and 'distances' '''
+        if self._points is None:
+            decoded = {}
+
+            def compute(name):
+                if not decoded:
+                    decoded.update(self._decode())
+                return decoded[name]
+
+            self._points = {name: self._cached(name, lambda name=name: compute(name))
+                            for name in ('stamps', 'offsets', 'angles', 'distances')}
+        return self._points
+
+    def rotationIds(self):
+        if self._rotationIds is None:
+            offsets = self.points()['offsets']
+            self._rotationIds = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        return self._rotationIds
+
+    def reference(self, numRef):
+        return captureReference(self._index(), numRef)
+
+    def inside(self, numRef, margin, tolerance):
+        ''' Per-point mask of the points inside the reference region's inner margin '''
+        def compute():
+            classifier = RegionClassifier.fromGeometry(deriveGeometry(self.reference(numRef), (margin, margin),
+                                                                      tolerance))
+            points = self.points()
+            inside = np.zeros(len(points['distances']), dtype=bool)
+            for i in range(0, len(inside), DEF_BLOCK_POINTS):
+                block = slice(i, i + DEF_BLOCK_POINTS)
+                labels, _, _ = classifier.classify(points['angles'][block], points['distances'][block])
+                inside[block] = labels == LABEL_INSIDE
+            return inside
+        return self._cached(f"inside-{numRef}-{margin:g}-{tolerance:g}", compute)
+
+    def binned(self, angleBin):
+        ''' Per-rotation (rows) min range in each angle bin, inf where there's no return '''
+        def compute():
+            detector = ActivityDetector(angleBin)
+            points = self.points()
+            valid = points['distances'] > 0
+            bins = ((np.degrees(points['angles'][valid]) + 180.0) / angleBin).astype(np.int64) % detector.numBins
+            binned = np.full((len(points['stamps']), detector.numBins), np.inf)
+            np.minimum.at(binned, (self.rotationIds()[valid], bins), points['distances'][valid])
+            return binned
+        return self._cached(f"binned-{angleBin:g}", compute)
+
+    def foreground(self, angleBin, foregroundDist, learnRate):
+        ''' Per-point mask of the points closer than the background (as learned up to their rotation) '''
+        def compute():
+            detector = ActivityDetector(angleBin, foregroundDist, learnRate)
+            binned = self.binned(angleBin)
+            before = np.empty(binned.shape)
+            for i, current in enumerate(binned):
+                before[i] = detector.background
+                detector.updateBinned(current)
+            points = self.points()
+            bins = ((np.degrees(points['angles']) + 180.0) / angleBin).astype(np.int64) % detector.numBins
+            with np.errstate(invalid='ignore'):
+                return (points['distances'] > 0) & \
+                       (points['distances'] < (before[self.rotationIds(), bins] - foregroundDist))
+        return self._cached(f"foreground-{angleBin:g}-{foregroundDist:g}-{learnRate:g}", compute)
+
+    def candidates(self, config):
+        if config['model'] == 'background':
+            return self.foreground(*[config[k] for k in BACKGROUND_KEYS])
+        inside = self.inside(*[config[k] for k in REFERENCE_KEYS])
+        if config['model'] == 'both':
+            return inside & self.foreground(*[config[k] for k in BACKGROUND_KEYS])
+        return inside
+
+    def clusterSizes(self, config):
+        ''' Per-rotation size of the largest cluster of candidate points (as the session analyzer finds them) '''
+        def compute():
+            points = self.points()
+            index = np.flatnonzero(self.candidates(config))
+            rotations = self.rotationIds()[index]
+            x = points['distances'][index] * np.cos(points['angles'][index])
+            y = points['distances'][index] * np.sin(points['angles'][index])
+            sizes = np.zeros(len(points['stamps']), dtype=np.int64)
+            if len(index) == 0:
+                return sizes
+            near = np.hypot(np.diff(x), np.diff(y)) <= config['clusterDist']
+            linked = np.concatenate(([False], near & (rotations[1:] == rotations[:-1])))
+            clusterIds = np.cumsum(~linked) - 1
+            clusterSizes = np.bincount(clusterIds)
+            # N.B. clusters can straddle the end of the rotation
+            firsts = np.flatnonzero(np.concatenate(([True], rotations[1:] != rotations[:-1])))
+            lasts = np.append(firsts[1:], len(index)) - 1
+            wrap = (clusterIds[firsts] != clusterIds[lasts]) & \
+                   (np.hypot(x[firsts] - x[lasts], y[firsts] - y[lasts]) <= config['clusterDist'])
+            clusterSizes[clusterIds[firsts[wrap]]] += clusterSizes[clusterIds[lasts[wrap]]]
+            clusterSizes[clusterIds[lasts[wrap]]] = 0
+            np.maximum.at(sizes, rotations[~linked], clusterSizes)
+            return sizes
+        tags = ["clusters", config['model']]
+        if config['model'] != 'background':
+            tags.append(_tag(config, REFERENCE_KEYS))
+        if config['model'] != 'reference':
+            tags.append(_tag(config, BACKGROUND_KEYS))
+        tags.append(f"{config['clusterDist']:g}")
+        return self._cached("-".join(tags), compute)
+
+
+def _overlaps(event, interval):
+    return (event['start'] <= interval[1]) and (event['end'] >= interval[0])
+
+def score(events, labels):
+    ''' Counts and latencies of a session's events against its labels
+
+    Events overlapping an empty interval are false positives, others overlapping a
+    critter interval true positives (events only in unlabelled time don't count).
+    A critter is detected if a true positive overlaps it, its latency is from the
+    start of its interval to the first one's confirmation.
+    '''
+    false = [e for e in events if any(_overlaps(e, interval) for interval in labels['empty'])]
+    true = [e for e in events if (e not in false) and any(_overlaps(e, c) for c in labels['critters'])]
+    latencies = []
+    for critter in labels['critters']:
+        detections = [e for e in true if _overlaps(e, critter)]
+        if detections:
+            latencies.append(max(0.0, float(min(e['confirmed'] for e in detections) - critter[0])))
+    return {'truePositives': len(true), 'falsePositives': len(false),
+            'critters': len(labels['critters']), 'detected': len(latencies), 'latencies': latencies,
+            'emptySecs': sum(e - s for s, e in labels['empty'])}
+
+def metrics(scores):
+    ''' Precision, recall and latency over sessions' scores '''
+    totals = {k: sum(s[k] for s in scores) for k in ('truePositives', 'falsePositives', 'critters', 'detected',
+                                                     'emptySecs')}
+    latencies = [latency for s in scores for latency in s['latencies']]
+    found = totals['truePositives'] + totals['falsePositives']
+    precision = (totals['truePositives'] / found) if found else None
+    recall = (totals['detected'] / totals['critters']) if totals['critters'] else None
+    f1 = (2 * precision * recall / (precision + recall)) if (precision and recall) else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': round(f1, 4),
+            'latencyMean': round(float(np.mean(latencies)), 3) if latencies else None,
+            'latencyMedian': round(float(np.median(latencies)), 3) if latencies else None,
+            'latencyMax': round(float(np.max(latencies)), 3) if latencies else None,
+            'falsePerHour': round(totals['falsePositives'] * 3600 / totals['emptySecs'], 3)
+                            if totals['emptySecs'] else None,
+            'truePositives': totals['truePositives'], 'falsePositives': totals['falsePositives'],
+            'missed': totals['critters'] - totals['detected']}
+
+def _prepare(args):
+    labels, cacheDir = args
+    session = SweepSession(labels, cacheDir)
+    session.points()
+    return session.numComputed
+
+def _intermediate(args):
+    labels, cacheDir, kind, params = args
+    session = SweepSession(labels, cacheDir)
+    getattr(session, kind)(*params)
+    return session.numComputed
+
+def _evaluate(args):
+    ''' Score configs that share their detector parameters (so their clusters) '''
+    labelsList, cacheDir, configs = args
+    results = []
+    computed = 0
+    perSession = []
+    for labels in labelsList:
+        session = SweepSession(labels, cacheDir)
+        perSession.append((labels, session.points()['stamps'], session.clusterSizes(configs[0])))
+        computed += session.numComputed
+    for config in configs:
+        tracker = {k: config[k] for k in TRACKER_DEFAULTS}
+        scores = [score(trackEvents({'stamps': stamps, 'clusterSize': sizes}, **tracker), labels)
+                  for labels, stamps, sizes in perSession]
+        results.append(dict(config, **metrics(scores)))
+    return results, computed
+
+def _map(executor, func, jobs):
+    return list(executor.map(func, jobs)) if executor else [func(job) for job in jobs]
+
+def sweep(labelsList, configs, workers=None, cacheDir=DEF_CACHE_DIR):
+    ''' Score configs against labelled sessions, in parallel, returns (results best first, summary) '''
+    start = time.perf_counter()
+    configs = _unique(configs)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    try:
+        # decode the sessions, then the reference and background masks, then the clusters and the scores
+        computed = sum(_map(executor, _prepare, [(labels, cacheDir) for labels in labelsList]))
+        jobs = set()
+        for config in configs:
+            if config['model'] != 'background':
+                jobs.add(('inside', tuple(config[k] for k in REFERENCE_KEYS)))
+            if config['model'] != 'reference':
+                jobs.add(('foreground', tuple(config[k] for k in BACKGROUND_KEYS)))
+        computed += sum(_map(executor, _intermediate, [(labels, cacheDir, kind, params)
+                                                       for labels in labelsList for kind, params in sorted(jobs)]))
+        groups = {}
+        for config in configs:
+            groups.setdefault(tuple(config[k] for k in DETECTOR_DEFAULTS), []).append(config)
+        results = []
+        for groupResults, groupComputed in _map(executor, _evaluate,
+                                                [(labelsList, cacheDir, group) for group in groups.values()]):
+            results += groupResults
+            computed += groupComputed
+    finally:
+        if executor:
+            executor.shutdown()
+    results.sort(key=lambda r: (-r['f1'], r['latencyMean'] if r['latencyMean'] is not None else np.inf))
+    summary = {'configs': len(configs), 'sessions': len(labelsList), 'detectorGroups': len(groups),
+               'intermediatesComputed': computed, 'elapsedSecs': round(time.perf_counter() - start, 3)}
+    logging.info(f"Sweep: {summary}")
+    return results, summary
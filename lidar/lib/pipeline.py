@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Rotation Processing Pipeline
+#
+# An ordered list of named stages, each taking and returning an array-backed
+# Rotation (updated in place, never converted to lists until it's
+# serialized).  Stages can be declared in config, added and removed at
+# runtime, and are timed individually.  Expensive stages can run on a worker
+# thread or process; in streaming mode each stage has a bounded input queue
+# (dropping the oldest rotation when full), so a slow stage can't back up
+# acquisition, and a rotation a stage fails on is dropped without stopping
+# the stream.
+#
+################################################################################
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import json
+import logging
+import time
+
+import numpy as np
+
+from ..shared import MessageTypes
+from .fusion import SensorFusion, DEF_TIME_TOLERANCE
+from .history import HistoryStore
+from .noiseFilters import NoiseFilterChain
+from .occupancy import OccupancyGrid, DEF_CHANGE_THRESHOLD
+from .sessionAnalyzer import RotationDetector
+from .temporalFilter import TemporalFilter
+from .wcLidar import LidarClient
+from .zones import ZoneMap
+
+
+DEF_QUEUE_SIZE = 2      # rotations waiting at each stage in streaming mode
+DEF_SENSOR = 'local'    # this sensor's id in a fusion stage
+DEF_DIFF_EVERY = 10     # rotations between an occupancy stage's comparisons with its baseline
+WORKERS = (None, 'thread', 'process')
+
+
+class Rotation():
+    ''' A rotation as a dict-like set of equal length arrays, plus a stamp and metadata '''
+    def __init__(self, arrays, stamp=None, meta=None):
+        self.arrays = {k: np.asarray(v) for k, v in arrays.items()}
+        self.stamp = time.monotonic() if stamp is None else stamp
+        self.meta = {} if meta is None else meta
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __setitem__(self, name, value):
+        self.arrays[name] = np.asarray(value)
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __len__(self):
+        return len(self.arrays['angles']) if 'angles' in self.arrays else 0
+
+    def __bool__(self):
+        return bool(self.arrays)
+
+    def get(self, name, default=None):
+        return self.arrays.get(name, default)
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def items(self):
+        return self.arrays.items()
+
+    def update(self, arrays):
+        ''' Replace (some of) the arrays, e.g., with a filter's output '''
+        for k, v in arrays.items():
+            self.arrays[k] = np.asarray(v)
+        return self
+
+    def select(self, keep):
+        ''' Keep only the points selected by a mask (or indices) '''
+        for k, v in self.arrays.items():
+            self.arrays[k] = v[keep]
+        return self
+
+    def toDict(self, names=None):
+        ''' Return the (named) arrays as lists, plus the metadata, for serializing '''
+        values = {k: v.tolist() for k, v in self.arrays.items() if (names is None) or (k in names)}
+        return values | self.meta
+
+
+class Stage():
+    ''' Base class of pipeline stages, subclasses override process() '''
+    def __init__(self, name, worker=None):
+        if worker not in WORKERS:
+            raise ValueError(f"Invalid worker for stage '{name}': {worker}")
+        self.name = name
+        self.worker = worker
+        self.conf = None    # set if the stage was made from config (needed for process workers)
+        self.resetStats()
+
+    def process(self, rotation):
+        ''' Return the (updated) rotation, or None to drop it '''
+        return rotation
+
+    def close(self):
+        ''' Release anything the stage holds, called when it's removed from a pipeline '''
+        pass
+
+    def resetStats(self):
+        self.count = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.lastTime = 0.0
+        self.dropped = 0
+        self.errors = 0
+
+    def _timed(self, elapsed):
+        self.count += 1
+        self.totalTime += elapsed
+        self.lastTime = elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+
+    def status(self):
+        return {'name': self.name, 'worker': self.worker, 'count': self.count,
+                'meanMs': round(1000 * self.totalTime / self.count, 3) if self.count else None,
+                'maxMs': round(1000 * self.maxTime, 3), 'lastMs': round(1000 * self.lastTime, 3),
+                'dropped': self.dropped, 'errors': self.errors}
+
+
+class FunctionStage(Stage):
+    def __init__(self, name, func, worker=None):
+        super().__init__(name, worker)
+        self.func = func
+
+    def process(self, rotation):
+        return self.func(rotation)
+
+
+class NoiseStage(Stage):
+    def __init__(self, name='noise', worker=None, stages=None):
+        super().__init__(name, worker)
+        self.chain = NoiseFilterChain(stages)
+
+    def process(self, rotation):
+        return rotation.update(self.chain.apply(rotation))
+
+
+class TemporalStage(Stage):
+    def __init__(self, name='temporal', worker=None, **kwargs):
+        super().__init__(name, worker)
+        self.filter = TemporalFilter(**kwargs)
+
+    def process(self, rotation):
+        filtered = self.filter.update(rotation['angles'], rotation['distances'], rotation.get('intensities'))
+        rotation.arrays = filtered
+        return rotation
+
+
+class ZoneStage(Stage):
+    ''' Drops points in exclude zones and adds the zone results to the metadata '''
+    def __init__(self, name='zones', worker=None, zones=None):
+        super().__init__(name, worker)
+        self.zoneMap = ZoneMap.fromConfig(zones)
+
+    def process(self, rotation):
+        if not self.zoneMap.zones:
+            return rotation
+        _, keep, results = self.zoneMap.classify(rotation['angles'], rotation['distances'],
+                                                 rotation.get('intensities'))
+        rotation.meta['zones'] = results
+        return rotation.select(keep)
+
+
+class HistoryStage(Stage):
+    ''' Records every rotation in a history store, compacted on a background thread '''
+    def __init__(self, name='history', worker=None, **kwargs):
+        # N.B. a process worker would open (and compact) the same store as the pipeline's copy of the stage
+        if worker == 'process':
+            raise ValueError(f"Stage '{name}' can't run in a process")
+        super().__init__(name, worker)
+        self.store = HistoryStore(**kwargs)
+        self.store.start()
+
+    def process(self, rotation):
+        # N.B. rotations are stamped with the monotonic clock, history is kept in wall-clock time
+        stamp = time.time() - (time.monotonic() - rotation.stamp)
+        self.store.append(stamp, rotation['angles'], rotation['distances'], rotation.get('intensities'))
+        return rotation
+
+    def close(self):
+        self.store.stop()
+        self.store.close()
+
+    def status(self):
+        return super().status() | self.store.status()
+
+
+class FusionStage(Stage):
+    ''' Replaces each rotation with the site-frame cloud fused from it and its peers' latest rotations
+
+    The fused cloud is given as angles and distances about the site origin (so the zones of later
+    stages, and of the data stream, are in the site frame), plus its 'x', 'y' and 'sensors' (index
+    into the 'sensors' list in the 'fusion' metadata).  Peers are other lidar servers given by
+    {<id>: {'host': <str>, 'cmdPort': <int>, 'dataPort': <int>}}, whose data streams are subscribed
+    to (N.B. their streams have to be started by their own clients).  With a 'detector' config (see
+    RotationDetector, e.g., {'model': 'background'}), the largest cluster of candidate points in
+    the fused cloud is added to the metadata.
+    '''
+    def __init__(self, name='fusion', worker=None, sensor=DEF_SENSOR, extrinsics=None, peers=None,
+                 tolerance=DEF_TIME_TOLERANCE, detector=None):
+        super().__init__(name, worker)
+        extrinsics = dict(extrinsics or {})
+        extrinsics.setdefault(sensor, {})
+        self.sensor = sensor
+        self.fusion = SensorFusion(extrinsics, tolerance)
+        self.peers = {}
+        for peerId, peer in (peers or {}).items():
+            if peerId not in self.fusion.extrinsics:
+                raise ValueError(f"No extrinsics for peer sensor: {peerId}")
+            self.peers[peerId] = LidarClient(peer['host'], peer['cmdPort'], peer['dataPort'])
+        self.detector = RotationDetector(**detector) if detector else None
+        self.numPeerRotations = 0
+
+    def _drainPeers(self):
+        for peerId, client in self.peers.items():
+            while True:
+                try:
+                    frame = json.loads(client.msgQ.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+                values = frame.get('values')
+                if (frame.get('type') != MessageTypes.REPLY.value) or not values or ('angles' not in values):
+                    continue
+                self.fusion.add(peerId, values, frame['stamp'])
+                self.numPeerRotations += 1
+
+    def process(self, rotation):
+        # N.B. peers stamp their rotations in wall-clock time
+        stamp = time.time() - (time.monotonic() - rotation.stamp)
+        self._drainPeers()
+        self.fusion.add(self.sensor, rotation, stamp)
+        cloud = self.fusion.fuse(stamp)
+        angles, distances = self.fusion.toPolar(cloud)
+        rotation.arrays = {'angles': angles, 'distances': distances, 'intensities': cloud['intensities'],
+                           'x': cloud['x'], 'y': cloud['y'], 'sensors': cloud['sensors']}
+        rotation.meta['fusion'] = {'sensors': cloud['sensorIds']}
+        if self.detector:
+            numCandidates, size, x, y = self.detector.update(angles, distances)
+            rotation.meta['cluster'] = {'candidates': numCandidates, 'size': size,
+                                        'x': float(x) if size else None, 'y': float(y) if size else None}
+        return rotation
+
+    def close(self):
+        for client in self.peers.values():
+            client.close()
+
+    def status(self):
+        return super().status() | {'fusion': self.fusion.status(), 'peerRotations': self.numPeerRotations}
+
+
+class OccupancyStage(Stage):
+    ''' Integrates every rotation into an occupancy grid, and adds its changes from a baseline to the metadata
+
+    The baseline is a saved grid ('baseline' path, of the same geometry), compared with every
+    'diffEvery' rotations.  The grid is saved to 'snapshot' (if given) when the stage is closed,
+    e.g., to be a later baseline.
+    '''
+    def __init__(self, name='occupancy', worker=None, baseline=None, snapshot=None,
+                 threshold=DEF_CHANGE_THRESHOLD, diffEvery=DEF_DIFF_EVERY, **kwargs):
+        # N.B. the grid is the stage's state, a process worker's copy of it would be lost
+        if worker == 'process':
+            raise ValueError(f"Stage '{name}' can't run in a process")
+        super().__init__(name, worker)
+        self.grid = OccupancyGrid(**kwargs)
+        self.baseline = OccupancyGrid.load(baseline) if baseline else None
+        if self.baseline and ((self.baseline.size != self.grid.size) or
+                              (self.baseline.cellSize != self.grid.cellSize)):
+            raise ValueError(f"Occupancy baseline geometry doesn't match: {baseline}")
+        self.snapshot = snapshot
+        self.threshold = threshold
+        self.diffEvery = diffEvery
+        self.changes = None
+
+    def process(self, rotation):
+        self.grid.integrate(rotation['angles'], rotation['distances'])
+        if self.baseline and ((self.grid.numRotations % self.diffEvery) == 0):
+            diff = self.grid.diff(self.baseline, self.threshold)
+            self.changes = {'appeared': len(diff['appeared']), 'vanished': len(diff['vanished'])}
+        if self.changes:
+            rotation.meta['occupancy'] = self.changes
+        return rotation
+
+    def close(self):
+        if self.snapshot:
+            self.grid.save(self.snapshot)
+
+    def status(self):
+        return super().status() | {'occupancyRotations': self.grid.numRotations, 'occupancyChanges': self.changes}
+
+
+STAGE_TYPES = {'noise': NoiseStage, 'temporal': TemporalStage, 'zones': ZoneStage, 'history': HistoryStage,
+               'fusion': FusionStage, 'occupancy': OccupancyStage}
+
+
+def registerStage(stageType, cls):
+    STAGE_TYPES[stageType] = cls
+
+def makeStage(conf):
+    ''' conf: {'stage': <type>, 'name': <str>, 'worker': None|'thread'|'process', <param>: <value>, ...} '''
+    params = dict(conf)
+    stageType = params.pop('stage', None)
+    if stageType not in STAGE_TYPES:
+        raise ValueError(f"Unknown stage type: {stageType}")
+    params.setdefault('name', stageType)
+    stage = STAGE_TYPES[stageType](**params)
+    stage.conf = dict(conf)
+    return stage
+
+
+# the stage run by a process worker, made from its config in the worker process
+_workerStage = None
+
+def _initWorker(conf):
+    global _workerStage
+
+    _workerStage = makeStage(dict(conf, worker=None))
+
+def _runWorker(rotation):
+    return _workerStage.process(rotation)
+
+def _drained():
+    ''' Queued behind a worker's last rotation, it's done once the worker is '''
+    pass
+
+
+class Pipeline():
+    def __init__(self, stages=None, queueSize=DEF_QUEUE_SIZE):
+        self.stages = []
+        self.executors = {}
+        self.queueSize = queueSize
+        self.tasks = []
+        self.queues = []
+        self._stages = []
+        self.sink = None
+        self.sinkDropped = 0
+        self.sinkErrors = 0
+        self.retiring = []      # futures done once a removed stage's worker is and the stage's closed
+        for stage in (stages or []):
+            self.add(stage)
+
+    @classmethod
+    def fromConfig(cls, confs, queueSize=DEF_QUEUE_SIZE):
+        return cls([makeStage(conf) for conf in (confs or [])], queueSize)
+
+    def toConfig(self):
+        ''' The config of the stages that can be declared in config, in order '''
+        return [stage.conf for stage in self.stages if stage.conf]
+
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    def add(self, stage, index=None):
+        ''' Add a stage (at the end, or before the given index), returns True on error '''
+        if stage.name in self.names():
+            logging.error(f"Duplicate pipeline stage: {stage.name}")
+            return True
+        if stage.worker == 'process':
+            if not stage.conf:
+                logging.error(f"Stage '{stage.name}' must be made from config to run in a process")
+                return True
+            self.executors[stage.name] = ProcessPoolExecutor(max_workers=1, initializer=_initWorker,
+                                                             initargs=(stage.conf,))
+        elif stage.worker == 'thread':
+            self.executors[stage.name] = ThreadPoolExecutor(max_workers=1,
+                                                            thread_name_prefix=f"stage-{stage.name}")
+        if index is None:
+            self.stages.append(stage)
+        else:
+            self.stages.insert(index, stage)
+        self._restart()
+        return False
+
+    def remove(self, name):
+        if name not in self.names():
+            logging.warning(f"No such pipeline stage: {name}")
+            return True
+        removed = [stage for stage in self.stages if stage.name == name]
+        self.stages = [stage for stage in self.stages if stage.name != name]
+        # N.B. the stage's loop is stopped, and its worker finishes what it's doing, before it's closed
+        self._restart()
+        self._retire(self.executors.pop(name, None), removed)
+        return False
+
+    def _retire(self, executor, stages):
+        ''' Close stages once their worker is done, without waiting for it on the event loop '''
+        self.retiring = [future for future in self.retiring if not future.done()]
+        if executor is None:
+            for stage in stages:
+                stage.close()
+            return
+        try:
+            future = executor.submit(_drained)
+        except RuntimeError as ex:
+            # e.g., a broken process pool, there's nothing to wait for
+            logging.warning(f"Pipeline worker already stopped: {ex}")
+            for stage in stages:
+                stage.close()
+        else:
+            future.add_done_callback(lambda _: [stage.close() for stage in stages])
+            self.retiring.append(future)
+        executor.shutdown(wait=False)
+
+    def _restart(self):
+        ''' Streaming mode: rebuild the stage queues and tasks for the current stages '''
+        if self.tasks:
+            self.start(self.sink)
+
+    def process(self, rotation):
+        ''' Run all the stages inline (ignoring workers), returns the rotation or None if dropped '''
+        for stage in self.stages:
+            rotation = self._run(stage, rotation)
+            if rotation is None:
+                break
+        return rotation
+
+    def _run(self, stage, rotation):
+        start = time.perf_counter()
+        rotation = stage.process(rotation)
+        stage._timed(time.perf_counter() - start)
+        return rotation
+
+    async def _arun(self, stage, rotation):
+        executor = self.executors.get(stage.name)
+        if executor is None:
+            return self._run(stage, rotation)
+        start = time.perf_counter()
+        if stage.worker == 'process':
+            rotation = await asyncio.get_running_loop().run_in_executor(executor, _runWorker, rotation)
+        else:
+            rotation = await asyncio.get_running_loop().run_in_executor(executor, stage.process, rotation)
+        stage._timed(time.perf_counter() - start)
+        return rotation
+
+    async def aprocess(self, rotation):
+        ''' Run all the stages, with worker stages off the event loop '''
+        for stage in list(self.stages):
+            rotation = await self._arun(stage, rotation)
+            if rotation is None:
+                break
+        return rotation
+
+    def start(self, sink):
+        ''' Streaming mode: rotations given to submit() flow through a queue per stage to 'sink' (async) '''
+        self.stop()
+        stages = list(self.stages)
+        self.queues = [asyncio.Queue(self.queueSize) for _ in range(len(stages) + 1)]
+        loop = asyncio.get_running_loop()
+        self._stages = stages
+        self.sink = sink
+        self.tasks = [loop.create_task(self._stageLoop(i)) for i in range(len(stages))]
+        self.tasks.append(loop.create_task(self._sinkLoop(sink, self.queues[-1])))
+
+    async def _stageLoop(self, index):
+        stage = self._stages[index]
+        inQ = self.queues[index]
+        while True:
+            rotation = await inQ.get()
+            # N.B. a failed rotation is dropped, the stage carries on with the next one
+            try:
+                rotation = await self._arun(stage, rotation)
+            except Exception as ex:
+                logging.error(f"Pipeline stage '{stage.name}' failed: {ex}")
+                stage.errors += 1
+                continue
+            if rotation is not None:
+                self._put(index + 1, rotation)
+
+    async def _sinkLoop(self, sink, inQ):
+        while True:
+            rotation = await inQ.get()
+            try:
+                await sink(rotation)
+            except Exception as ex:
+                logging.error(f"Pipeline sink failed: {ex}")
+                self.sinkErrors += 1
+
+    def _put(self, index, rotation):
+        queue = self.queues[index]
+        if queue.full():
+            # N.B. keep up with acquisition, the oldest rotation waiting for this stage is dropped
+            queue.get_nowait()
+            if index < len(self._stages):
+                self._stages[index].dropped += 1
+            else:
+                self.sinkDropped += 1
+        queue.put_nowait(rotation)
+
+    def submit(self, rotation):
+        ''' Streaming mode: queue a rotation for the first stage (never blocks) '''
+        if not self.tasks:
+            logging.warning("Pipeline not started, dropping rotation")
+            return True
+        self._put(0, rotation)
+        return False
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.queues = []
+        self._stages = []
+        self.sink = None
+
+    def shutdown(self):
+        ''' Stop, and close every stage (those with a worker once it's done, see 'retiring') '''
+        self.stop()
+        for stage in self.stages:
+            self._retire(self.executors.pop(stage.name, None), [stage])
+        self.executors = {}
+
+    def status(self):
+        return {'pipeline': [stage.status() for stage in self.stages], 'sinkDropped': self.sinkDropped,
+                'sinkErrors': self.sinkErrors}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Scan Recordings
+#
+# Streaming reader of the JSON recordings that lidarPlot.py writes (an array
+# of {"sampleTime": <datetime>, "data": [[angle, distance, intensity], ...]},
+# one rotation at a time, so a recording of any size is read in bounded
+# memory), and export to columnar Parquet for offline analytics: a row per
+# point with 'timestamp', 'rotation' (sequence number within the recording),
+# 'angle' (radians), 'range' (meters) and 'intensity' columns, and a row
+# group per time slice and angle sector, so readers skip the row groups
+# outside a time/angle range.
+#
+################################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+import logging
+import mmap
+import os
+import re
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+DEF_CHUNK_SIZE = 1 << 20        # chars read from a recording at a time
+DEF_SLICE_SECS = 60             # time slice of each row group
+DEF_ANGLE_SECTORS = 4           # row groups per time slice
+DEF_MAX_ROWS = 1 << 20          # rows buffered before a slice is written early
+DEF_COMPRESSION = "zstd"
+
+COLUMNS = ('timestamp', 'rotation', 'angle', 'range', 'intensity')
+
+_ROTATION_START = re.compile(rb'\{\s*"sampleTime"\s*:\s*"([^"]*)"')
+
+
+def _requireArrow():
+    if pa is None:
+        raise RuntimeError("Exporting recordings requires pyarrow")
+
+def _schema():
+    return pa.schema([('timestamp', pa.timestamp('us')), ('rotation', pa.int64()),
+                      ('angle', pa.float32()), ('range', pa.float32()), ('intensity', pa.uint16())])
+
+def _rotation(record):
+    ''' (stamp, angles, distances, intensities) of a recorded rotation '''
+    stamp = np.datetime64(datetime.fromisoformat(record['sampleTime']), 'us')
+    points = np.asarray(record['data'], dtype=np.float64).reshape(-1, 3)
+    return stamp, points[:, 0], points[:, 1], points[:, 2]
+
+def indexRecording(path):
+    ''' Return the file offsets and (datetime64) stamps of a recording's rotations, without decoding them
+
+    N.B. this relies on each rotation starting with its "sampleTime", as lidarPlot.py writes them.
+    '''
+    offsets, stamps = [], []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype='datetime64[us]')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for match in _ROTATION_START.finditer(m):
+                offsets.append(match.start())
+                stamps.append(datetime.fromisoformat(match.group(1).decode()))
+    return np.array(offsets, dtype=np.int64), np.array(stamps, dtype='datetime64[us]')
+
+def iterRecording(path, offset=0, count=None, chunkSize=DEF_CHUNK_SIZE):
+    ''' Yield a recording's rotations, as (datetime64 stamp, angles, distances, intensities)
+
+    Starts at the rotation at 'offset' (see indexRecording()), and stops after
+    'count' rotations if given.
+
+    N.B. recordings cut short (e.g., lidarPlot.py killed mid-write) end at
+    their last complete rotation.
+    '''
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    with open(path, "r") as f:
+        # N.B. rotations start with an ASCII '{', so their byte offsets are valid text file positions
+        f.seek(offset)
+        while (count is None) or (count > 0):
+            # skip the array's punctuation between rotations
+            while (pos < len(buf)) and (buf[pos] in " \t\r\n,["):
+                pos += 1
+            if (pos < len(buf)) and (buf[pos] == "]"):
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    if buf[pos:].strip():
+                        logging.warning(f"Recording '{path}' is truncated, ignoring its last rotation")
+                    return
+                chunk = f.read(chunkSize)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            pos = end
+            if count is not None:
+                count -= 1
+            try:
+                yield _rotation(record)
+            except (KeyError, TypeError, ValueError) as ex:
+                logging.warning(f"Skipping malformed rotation in '{path}': {ex}")
+
+def exportRecording(path, outPath, sliceSecs=DEF_SLICE_SECS, angleSectors=DEF_ANGLE_SECTORS,
+                    maxRows=DEF_MAX_ROWS, compression=DEF_COMPRESSION):
+    ''' Export a recording to a Parquet file, returns a summary of it, or None on error
+
+    Each 'sliceSecs' of rotations (or less, after 'maxRows' points) is all
+    that's ever held in memory, and is written as a row group per angle sector
+    (in time order within each).
+    '''
+    _requireArrow()
+    schema = _schema().with_metadata({'source': os.path.basename(path), 'sliceSecs': str(sliceSecs)})
+    sliceUs = int(sliceSecs * 1e6)
+    summary = {'input': path, 'output': outPath, 'rotations': 0, 'rows': 0, 'rowGroups': 0}
+    pending = []
+    numPending = 0
+    current = None
+
+    def flush(writer):
+        stamps, rotations, angles, distances, intensities = zip(*pending)
+        counts = [len(a) for a in angles]
+        angles = np.concatenate(angles)
+        sectors = np.minimum((((angles + np.pi) % (2 * np.pi)) * (angleSectors / (2 * np.pi))).astype(np.int64),
+                             angleSectors - 1)
+        order = np.argsort(sectors, kind='stable')
+        table = pa.Table.from_arrays([
+            pa.array(np.repeat(np.array(stamps), counts), type=pa.timestamp('us')),
+            pa.array(np.repeat(np.array(rotations, dtype=np.int64), counts)),
+            pa.array(angles.astype(np.float32)),
+            pa.array(np.concatenate(distances).astype(np.float32)),
+            pa.array(np.clip(np.rint(np.concatenate(intensities)), 0, 0xffff).astype(np.uint16))],
+            schema=schema).take(order)
+        bounds = np.searchsorted(sectors[order], np.arange(angleSectors + 1))
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if last > first:
+                writer.write_table(table.slice(first, last - first), row_group_size=(last - first))
+                summary['rowGroups'] += 1
+        summary['rows'] += len(table)
+        pending.clear()
+
+    os.makedirs(os.path.dirname(outPath) or ".", exist_ok=True)
+    tmpPath = f"{outPath}.tmp"
+    try:
+        with pq.ParquetWriter(tmpPath, schema, compression=compression) as writer:
+            for seq, (stamp, angles, distances, intensities) in enumerate(iterRecording(path)):
+                slot = stamp.astype(np.int64) // sliceUs
+                if pending and ((slot != current) or ((numPending + len(angles)) > maxRows)):
+                    flush(writer)
+                    numPending = 0
+                current = slot
+                pending.append((stamp, seq, angles, distances, intensities))
+                numPending += len(angles)
+                summary['rotations'] += 1
+            if pending:
+                flush(writer)
+        os.replace(tmpPath, outPath)
+    except (OSError, pa.ArrowException) as ex:
+        logging.error(f"Failed to export recording '{path}': {ex}")
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        return None
+    logging.debug(f"Exported {summary['rotations']} rotations from '{path}' to '{outPath}'")
+    return summary
+
+def _exportOne(args):
+    path, outDir, kwargs = args
+    name = os.path.splitext(os.path.basename(path))[0]
+    return exportRecording(path, os.path.join(outDir, f"{name}.parquet"), **kwargs)
+
+def exportRecordings(paths, outDir, workers=None, **kwargs):
+    ''' Export recordings in parallel (a process each), to a Parquet file each in 'outDir'
+
+    Returns the summaries (None for the recordings that failed), in order.
+    '''
+    _requireArrow()
+    jobs = [(path, outDir, kwargs) for path in paths]
+    if (workers == 1) or (len(jobs) <= 1):
+        return [_exportOne(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_exportOne, jobs))
+
+def _stamp(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return pa.scalar(np.datetime64(value, 'us'), pa.timestamp('us'))
+
+def _filter(start, end, minAngle, maxAngle):
+    expr = None
+    terms = [(start, lambda v: ds.field('timestamp') >= _stamp(v)),
+             (end, lambda v: ds.field('timestamp') <= _stamp(v)),
+             (minAngle, lambda v: ds.field('angle') >= v),
+             (maxAngle, lambda v: ds.field('angle') <= v)]
+    for value, term in terms:
+        if value is not None:
+            expr = term(value) if expr is None else (expr & term(value))
+    return expr
+
+def scanExport(path, start=None, end=None, minAngle=None, maxAngle=None, columns=None):
+    ''' Yield record batches of an export (a Parquet file, or a directory of them) in the given time/angle range
+
+    The predicates are pushed down to the scan: row groups (time slices and angle
+    sectors) whose statistics are outside the range aren't read at all, and the
+    rest are filtered a batch at a time.  Times are datetimes (or ISO strings), angles
+    are in radians.
+    '''
+    _requireArrow()
+    dataset = ds.dataset(path, format="parquet")
+    yield from dataset.to_batches(columns=list(columns) if columns else None,
+                                  filter=_filter(start, end, minAngle, maxAngle))
+
+def readExport(path, start=None, end=None, minAngle=None, maxAngle=None, columns=None):
+    ''' Return an export's rows in the given time/angle range, as a pyarrow Table (see scanExport()) '''
+    _requireArrow()
+    dataset = ds.dataset(path, format="parquet")
+    return dataset.to_table(columns=list(columns) if columns else None,
+                            filter=_filter(start, end, minAngle, maxAngle))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Reference Region Geometry and its Derived-Geometry Cache
+#
+# The reference region is the union of a number of captured frames.  What's
+# derived from it for a given (margins, tolerance) -- the simplified region,
+# its inner/outer margin polygons (buffered), their per-angle range envelopes
+# and prepared predicates -- is kept in a size-bounded LRU cache keyed by
+# (reference ID, margins, tolerance), so dragging the margins back and forth
+# doesn't recompute it.  Recapturing the reference gives it a new ID and
+# invalidates everything derived from the old one.
+#
+################################################################################
+
+from collections import OrderedDict
+import threading
+import time
+
+import numpy as np
+import shapely
+from shapely import union_all
+from shapely.geometry import Polygon
+
+from ..shared import MIN_ANGLE_RESOLUTION
+from .modelStore import loadModel, saveModel
+
+
+DEF_MAX_SIZE = 64
+DEF_ANGLE_BIN = MIN_ANGLE_RESOLUTION    # degrees, of the envelopes
+
+
+def _coords(geom):
+    ''' Exterior coords (N x 2 array) of a polygon, or of the largest part of a multipolygon '''
+    if geom.is_empty:
+        return None
+    if geom.geom_type == 'MultiPolygon':
+        geom = max(geom.geoms, key=lambda g: g.area)
+    return np.asarray(geom.exterior.coords)
+
+def _largest(geom):
+    if geom.geom_type == 'MultiPolygon':
+        return max(geom.geoms, key=lambda g: g.area)
+    return geom
+
+def unionScans(scans):
+    ''' Union of the scans' polygons (scans are (N x 2) arrays of x, y points in meters) '''
+    # N.B. buffer(0) repairs self-intersecting scan outlines
+    return _largest(union_all([Polygon(xy).buffer(0) for xy in scans if len(xy) >= 3]))
+
+def envelope(geom, angles):
+    ''' Range of the geometry's boundary at each of the angles (radians), seen from the sensor
+
+    N.B. assumes the region is star-shaped around the sensor, as a scan's outline is
+    '''
+    xy = _coords(geom)
+    if xy is None:
+        return np.zeros(len(angles))
+    theta = np.arctan2(xy[:, 1], xy[:, 0])
+    r = np.hypot(xy[:, 0], xy[:, 1])
+    order = np.argsort(theta)
+    return np.interp(angles, theta[order], r[order], period=(2 * np.pi))
+
+def deriveGeometry(reference, margins, tolerance, angleBin=DEF_ANGLE_BIN):
+    ''' Simplified region, inner/outer margin polygons and their envelopes, for (margins, tolerance) '''
+    start = time.perf_counter()
+    region = reference.simplify(tolerance=tolerance) if tolerance else reference
+    inner = _largest(region.buffer(margins[0]))
+    outer = _largest(region.buffer(margins[1]))
+    angles = np.radians((np.arange(int(np.ceil(360.0 / angleBin))) + 0.5) * angleBin - 180.0)
+    return {'region': region, 'inner': inner, 'outer': outer,
+            'envelope': {'angles': angles, 'inner': envelope(inner, angles),
+                         'outer': envelope(outer, angles)},
+            'computeTime': time.perf_counter() - start}
+
+def referenceRegion(scans, tolerance, margins):
+    ''' Union of the scans, simplified and buffered by the (inner, outer) margins, as coords
+
+    The scans can also be an already unioned reference region.  Returns a dict with
+    the region's, and its inner and outer margins', exterior coords, the region's
+    area, and the reference region.
+    '''
+    reference = scans if isinstance(scans, shapely.Geometry) else unionScans(scans)
+    derived = deriveGeometry(reference, margins, tolerance)
+    return {'region': _coords(derived['region']), 'inner': _coords(derived['inner']),
+            'outer': _coords(derived['outer']), 'area': derived['region'].area,
+            'reference': reference}
+
+def saveReference(path, reference, meta={}):
+    ''' Persist a reference region (meta: e.g., the sensor config it was captured with), returns True on error '''
+    return saveModel(path, 'reference', {'wkb': np.frombuffer(shapely.to_wkb(reference), dtype=np.uint8)}, meta)
+
+def loadReference(path, expect={}):
+    ''' Return a saved reference region if it matches 'expect', else None '''
+    model = loadModel(path, 'reference', expect, mmap=False)
+    return None if model is None else shapely.from_wkb(model[0]['wkb'].tobytes())
+
+
+class ReferenceGeometryCache():
+    def __init__(self, maxSize=DEF_MAX_SIZE, angleBin=DEF_ANGLE_BIN):
+        self.maxSize = maxSize
+        self.angleBin = angleBin
+        self.entries = OrderedDict()
+        self.reference = None
+        self.refId = 0
+        self.lock = threading.Lock()
+        self.numHits = 0
+        self.numMisses = 0
+        self.numEvicted = 0
+        self.numInvalidated = 0
+        self.timeSaved = 0.0
+
+    def setReference(self, reference):
+        ''' Use a new (recaptured) reference region, invalidating everything derived from the old one '''
+        with self.lock:
+            self.reference = reference
+            self.refId += 1
+            self.numInvalidated += len(self.entries)
+            self.entries.clear()
+            return self.refId
+
+    def _key(self, margins, tolerance, refId=None):
+        return (self.refId if refId is None else refId,
+                tuple(round(float(m), 6) for m in margins), round(float(tolerance), 6))
+
+    def get(self, margins, tolerance):
+        ''' Return the derived geometry for (margins, tolerance) if it's cached, else None '''
+        key = self._key(margins, tolerance)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.numMisses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.numHits += 1
+            self.timeSaved += entry['computeTime']
+            return entry
+
+    def put(self, margins, tolerance, entry, refId=None):
+        ''' Cache derived geometry (e.g., from a worker process), returns True if it's stale '''
+        key = self._key(margins, tolerance, refId)
+        # N.B. prepared state doesn't survive pickling, so prepare here
+        for name in ('region', 'inner', 'outer'):
+            shapely.prepare(entry[name])
+        with self.lock:
+            if key[0] != self.refId:
+                return True
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.numEvicted += 1
+            return False
+
+    def derive(self, margins, tolerance):
+        ''' Return the derived geometry, computing (and caching) it on a miss '''
+        reference, refId = self.reference, self.refId
+        if reference is None:
+            return None
+        entry = self.get(margins, tolerance)
+        if entry is None:
+            entry = deriveGeometry(reference, margins, tolerance, self.angleBin)
+            self.put(margins, tolerance, entry, refId)
+        return entry
+
+    def status(self):
+        lookups = self.numHits + self.numMisses
+        return {'refId': self.refId, 'entries': len(self.entries), 'hits': self.numHits,
+                'misses': self.numMisses, 'hitRate': round(self.numHits / lookups, 3) if lookups else None,
+                'timeSavedMs': round(1000 * self.timeSaved, 1), 'evicted': self.numEvicted,
+                'invalidated': self.numInvalidated}
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Vectorized Point-in-Region Classification
+#
+# Holds the reference region's inner/outer margin polygons, and any number of
+# zone polygons, as prepared geometries and labels every point of a rotation
+# in one call with shapely's vectorized contains_xy, instead of building a
+# Polygon per scan.  This is also what compiles the zone masks (see zones.py).
+#
+# Every polygon also gets exact radial bounds per angular wedge (the nearest
+# and farthest its boundary comes to the sensor in it): a point nearer than
+# the nearest is on the sensor's side, one farther than the farthest is
+# outside, so only points between them need contains_xy.  Zones are small, so
+# most points are ruled out for all of them at once by the zones' combined
+# bounds.
+#
+################################################################################
+
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon
+
+from ..shared import MIN_ANGLE_RESOLUTION
+
+
+LABEL_NONE = -1     # no return
+LABEL_INSIDE = 0    # inside the inner margin, i.e., closer than the reference perimeter
+LABEL_MARGIN = 1    # between the margins, i.e., on the reference perimeter
+LABEL_OUTSIDE = 2   # beyond the outer margin
+
+LABEL_NAMES = {LABEL_INSIDE: 'inside', LABEL_MARGIN: 'margin', LABEL_OUTSIDE: 'outside'}
+
+DEF_WEDGE = MIN_ANGLE_RESOLUTION / 2    # degrees, of the radial bounds
+DEF_SEGMENT = 0.05                      # meters, longest boundary segment for the radial bounds
+
+
+def _polygon(geom):
+    ''' A prepared polygon, from a polygon or its (N x 2) coords '''
+    if geom is None:
+        return None
+    if not isinstance(geom, shapely.Geometry):
+        geom = Polygon(np.asarray(geom, dtype=np.float64))
+    shapely.prepare(geom)
+    return geom
+
+def radialBounds(poly, numWedges, segment=DEF_SEGMENT):
+    ''' Nearest and farthest the polygon's boundary is from the sensor in each wedge, and if the sensor's inside it
+
+    Each boundary segment (after splitting them to at most 'segment' meters) bounds
+    every wedge it spans by its nearest point and farthest end.  Wedges without
+    any boundary get (inf, -inf), they're all inside or all outside.
+    '''
+    nearest = np.full(numWedges, np.inf)
+    farthest = np.full(numWedges, -np.inf)
+    scale = numWedges / (2 * np.pi)
+    for ring in shapely.get_parts(shapely.segmentize(poly.boundary, segment)):
+        xy = shapely.get_coordinates(ring)
+        p0, d = xy[:-1], np.diff(xy, axis=0)
+        t = np.clip(-np.einsum('ij,ij->i', p0, d) / np.maximum(np.einsum('ij,ij->i', d, d), 1e-18), 0.0, 1.0)
+        near = np.hypot(*(p0 + (t[:, None] * d)).T)
+        r = np.hypot(xy[:, 0], xy[:, 1])
+        far = np.maximum(r[:-1], r[1:])
+        # the wedges spanned, going the short way around from one end to the other
+        w = (np.arctan2(xy[:, 1], xy[:, 0]) + np.pi) * scale
+        dw = ((w[1:] - w[:-1] + (numWedges / 2)) % numWedges) - (numWedges / 2)
+        first = np.floor(np.minimum(w[:-1], w[:-1] + dw)).astype(np.int64)
+        counts = np.floor(np.maximum(w[:-1], w[:-1] + dw)).astype(np.int64) - first + 1
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        wedges = (np.repeat(first, counts) + offsets) % numWedges
+        np.minimum.at(nearest, wedges, np.repeat(near, counts))
+        np.maximum.at(farthest, wedges, np.repeat(far, counts))
+    # N.B. widen by a wedge each way, for points binned into a neighbouring wedge by rounding
+    nearest = np.minimum(nearest, np.minimum(np.roll(nearest, 1), np.roll(nearest, -1)))
+    farthest = np.maximum(farthest, np.maximum(np.roll(farthest, 1), np.roll(farthest, -1)))
+    return nearest, farthest, bool(poly.contains(Point(0.0, 0.0)))
+
+
+class RegionClassifier():
+    def __init__(self, inner=None, outer=None, zones=None, wedge=DEF_WEDGE):
+        ''' inner/outer: the reference margins, zones: {<name>: <polygon or coords>} '''
+        self.numWedges = int(np.ceil(360.0 / wedge))
+        self.setReference(inner, outer)
+        self.setZones(zones)
+
+    @classmethod
+    def fromGeometry(cls, derived, zones=None):
+        ''' From derived reference geometry (see refGeometry.deriveGeometry()) '''
+        return cls(derived['inner'], derived['outer'], zones)
+
+    def setReference(self, inner, outer):
+        self.inner = _polygon(inner)
+        self.outer = _polygon(outer)
+        self.innerBounds = radialBounds(self.inner, self.numWedges) if self.inner is not None else None
+        self.outerBounds = radialBounds(self.outer, self.numWedges) if self.outer is not None else None
+
+    @staticmethod
+    def _contains(poly, bounds, wedges, distances, x, y):
+        nearest, farthest, originInside = bounds
+        inside = (distances < nearest[wedges]) if originInside else np.zeros(len(distances), dtype=bool)
+        unsure = (distances >= nearest[wedges]) & (distances <= farthest[wedges])
+        inside[unsure] = shapely.contains_xy(poly, x[unsure], y[unsure])
+        return inside
+
+    def _wedges(self, angles):
+        return ((angles + np.pi) * (self.numWedges / (2 * np.pi))).astype(np.int64) % self.numWedges
+
+    def setZones(self, zones):
+        self.zoneNames = []
+        self.zonePolys = []
+        self.zoneBounds = []
+        self._combineBounds()
+        for name, poly in (zones or {}).items():
+            self.setZone(name, poly)
+
+    def setZone(self, name, poly):
+        ''' Add or replace a zone '''
+        poly = _polygon(poly)
+        bounds = radialBounds(poly, self.numWedges)
+        if name in self.zoneNames:
+            i = self.zoneNames.index(name)
+            self.zonePolys[i] = poly
+            self.zoneBounds[i] = bounds
+        else:
+            self.zoneNames.append(name)
+            self.zonePolys.append(poly)
+            self.zoneBounds.append(bounds)
+        self._combineBounds()
+
+    def removeZone(self, name):
+        i = self.zoneNames.index(name)
+        del self.zoneNames[i], self.zonePolys[i], self.zoneBounds[i]
+        self._combineBounds()
+
+    def _combineBounds(self):
+        # N.B. everything nearer than the boundary of a zone the sensor's in is a candidate for it
+        self.zonesNearest = np.full(self.numWedges, np.inf)
+        self.zonesFarthest = np.full(self.numWedges, -np.inf)
+        for nearest, farthest, originInside in self.zoneBounds:
+            np.minimum(self.zonesNearest, 0.0 if originInside else nearest, out=self.zonesNearest)
+            np.maximum(self.zonesFarthest, farthest, out=self.zonesFarthest)
+
+    def points(self, angles, distances):
+        ''' The points (radians, meters) as (wedges, distances, x, y), for labelling the same points repeatedly '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        return self._wedges(angles), distances, distances * np.cos(angles), distances * np.sin(angles)
+
+    def inZone(self, name, angles=None, distances=None, points=None):
+        ''' Whether each point (radians, meters, or given by points()) is in the named zone '''
+        wedges, distances, x, y = points if points else self.points(angles, distances)
+        i = self.zoneNames.index(name)
+        return self._contains(self.zonePolys[i], self.zoneBounds[i], wedges, distances, x, y) & (distances > 0)
+
+    def classify(self, angles, distances):
+        ''' Label a rotation's points (radians, meters)
+
+        Returns (labels, zoneIds, counts): each point's region label, the index
+        (in zoneNames) of the zone it's in (-1 if none, the last if overlapping),
+        and the per-region and per-zone point counts.
+        '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        valid = distances > 0
+        x = distances * np.cos(angles)
+        y = distances * np.sin(angles)
+
+        wedges = self._wedges(angles)
+        labels = np.full(len(distances), LABEL_OUTSIDE, dtype=np.int8)
+        if self.outer is not None:
+            labels[self._contains(self.outer, self.outerBounds, wedges, distances, x, y)] = LABEL_MARGIN
+        if self.inner is not None:
+            labels[self._contains(self.inner, self.innerBounds, wedges, distances, x, y)] = LABEL_INSIDE
+        labels[~valid] = LABEL_NONE
+
+        zoneIds = np.full(len(distances), -1, dtype=np.int16)
+        zoneCounts = np.zeros(len(self.zonePolys), dtype=np.int64)
+        if self.zonePolys:
+            # only the points within some zone's bounds are tested against each zone
+            index = np.flatnonzero(valid & (distances >= self.zonesNearest[wedges]) &
+                                   (distances <= self.zonesFarthest[wedges]))
+            w, d, px, py = wedges[index], distances[index], x[index], y[index]
+            for i, (poly, bounds) in enumerate(zip(self.zonePolys, self.zoneBounds)):
+                inZone = self._contains(poly, bounds, w, d, px, py)
+                zoneIds[index[inZone]] = i
+                zoneCounts[i] = np.count_nonzero(inZone)
+
+        regionCounts = np.bincount(labels[valid], minlength=len(LABEL_NAMES))
+        counts = {'regions': {name: int(regionCounts[label]) for label, name in LABEL_NAMES.items()},
+                  'zones': {name: int(count) for name, count in zip(self.zoneNames, zoneCounts)}}
+        return labels, zoneIds, counts
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Replay buffer of sequenced data frames
+#
+# Every frame added gets the next sequence number (as its first field, so
+# clients can find it without parsing the frame) and is kept, serialized,
+# until it's evicted by the buffer's frame, byte or age bounds.  Sequence
+# numbers restart when the server does, so every frame also has the buffer's
+# (random) epoch, a client resuming with another epoch's sequence number is
+# told where this epoch's frames pick up instead.  A frame can
+# be one stream's (e.g., the output of that stream's filter), it's then only
+# sent to that stream's clients, and has the stream's id as its second field.  A client
+# that reconnects after getting up to some sequence number is sent the
+# frames after it, or told where the frames pick up again if some of them
+# have been evicted in the meantime.  Clients that are sent frames as
+# they're added (i.e., not catching up) can skip the frames that have waited
+# too long, so a slow link doesn't fall further and further behind.
+#
+# N.B. the newest frame is never evicted, so a zero age bound gives a live
+#  only stream (clients that fall behind skip to the newest frame)
+#
+################################################################################
+
+import asyncio
+from collections import deque
+from itertools import islice
+import json
+import re
+import secrets
+import time
+
+
+DEF_MAX_SECS = 10.0              # secs a frame is kept for replay
+DEF_MAX_FRAMES = 600             # frames kept (a minute at 10 Hz)
+DEF_MAX_BYTES = 8 * 1024 * 1024  # (serialized) bytes kept
+
+SEQ_PREFIX = re.compile(r'^\{"seq": (\d+)')
+STREAM_PREFIX = re.compile(r'^\{"seq": \d+, "stream": (\d+)')
+EPOCH_PREFIX = re.compile(r'^\{"seq": \d+, (?:"stream": \d+, )?"epoch": (\d+)')
+
+
+def frameSeq(frame):
+    ''' The sequence number of a (serialized) frame, None if it doesn't have one (e.g., a gap marker) '''
+    match = SEQ_PREFIX.match(frame)
+    if match:
+        return int(match.group(1))
+    return json.loads(frame).get('seq')
+
+def frameStream(frame):
+    ''' The stream id of a (serialized) frame, None if it isn't a filtered stream's '''
+    match = STREAM_PREFIX.match(frame)
+    return int(match.group(1)) if match else None
+
+def frameEpoch(frame):
+    ''' The epoch of a (serialized) frame, None if it doesn't have one (e.g., a gap marker) '''
+    match = EPOCH_PREFIX.match(frame)
+    return int(match.group(1)) if match else None
+
+
+class ReplayBuffer():
+    def __init__(self, maxSecs=DEF_MAX_SECS, maxFrames=DEF_MAX_FRAMES, maxBytes=DEF_MAX_BYTES, epoch=None):
+        self.epoch = secrets.randbits(32) if epoch is None else epoch
+        self.frames = deque()   # (seq, monotonic secs added, serialized frame, stream)
+        self.bytes = 0
+        self.lastSeq = 0        # N.B. sequence numbers start at 1, so 0 is "before the first frame"
+        self.added = asyncio.Event()
+        self.numEvicted = 0
+        self.numResumes = 0
+        self.numReplayed = 0
+        self.numGaps = 0
+        self.numSkipped = 0
+        self.configure(maxSecs, maxFrames, maxBytes)
+
+    def configure(self, maxSecs=DEF_MAX_SECS, maxFrames=DEF_MAX_FRAMES, maxBytes=DEF_MAX_BYTES):
+        if (maxSecs < 0) or (maxFrames < 1) or (maxBytes < 1):
+            raise ValueError(f"Invalid replay bounds: maxSecs={maxSecs}, maxFrames={maxFrames}, maxBytes={maxBytes}")
+        self.maxSecs = maxSecs
+        self.maxFrames = int(maxFrames)
+        self.maxBytes = int(maxBytes)
+        self._evict(time.monotonic())
+
+    @property
+    def config(self):
+        return {'maxSecs': self.maxSecs, 'maxFrames': self.maxFrames, 'maxBytes': self.maxBytes}
+
+    def _evict(self, now):
+        while (len(self.frames) > 1) and ((len(self.frames) > self.maxFrames) or (self.bytes > self.maxBytes) or
+                                          ((now - self.frames[0][1]) > self.maxSecs)):
+            _, _, frame, _ = self.frames.popleft()
+            self.bytes -= len(frame)
+            self.numEvicted += 1
+
+    def add(self, frame, stream=None):
+        ''' Serialize a frame (dict) with the next sequence number, and wake up whoever waits for it
+
+        A frame of a 'stream' (an int, None for every stream's) is only given to that stream's
+        clients, the stream's id is in the frame if it isn't zero (i.e., the unfiltered stream).
+        '''
+        self.lastSeq += 1
+        head = {'seq': self.lastSeq, 'stream': stream} if stream else {'seq': self.lastSeq}
+        frame = json.dumps(head | {'epoch': self.epoch} | frame)
+        now = time.monotonic()
+        self.frames.append((self.lastSeq, now, frame, stream))
+        self.bytes += len(frame)
+        self._evict(now)
+        self.added.set()
+        self.added = asyncio.Event()
+        return self.lastSeq
+
+    def next(self):
+        ''' An awaitable for the next frame to be added (N.B. bound to the frames added so far when called) '''
+        return self.added.wait()
+
+    def since(self, seq, maxAge=None, limit=None, stream=None):
+        ''' The (seq, frame)s after 'seq' (at most 'limit'), and the sequence number they pick up at if some are missing
+
+        With a 'stream', the other streams' frames are given as None (so the caller moves past them).
+
+        Frames are missing when they've been evicted, or 'seq' is from before the sequence restarted
+        (i.e., it's newer than the last frame), or they're older than 'maxAge' secs (but the newest).
+        Otherwise the second value is None.
+        '''
+        now = time.monotonic()
+        self._evict(now)
+        if not self.frames:
+            if seq == self.lastSeq:
+                return [], None
+            self.numGaps += 1
+            return [], self.lastSeq + 1
+        first = self.frames[0][0]
+        start = skip = seq - first + 1
+        nextSeq = None
+        if (seq > self.lastSeq) or (seq < first - 1):
+            self.numGaps += 1
+            start = skip = 0
+            nextSeq = first
+        if maxAge is not None:
+            while (skip < len(self.frames) - 1) and ((now - self.frames[skip][1]) > maxAge):
+                skip += 1
+            if skip > start:
+                self.numSkipped += skip - start
+                nextSeq = self.frames[skip][0]
+        # N.B. the sequence numbers in the buffer are consecutive
+        end = None if limit is None else skip + limit
+        return [(s, frame if (stream is None) or (tag is None) or (tag == stream) else None)
+                for s, _, frame, tag in islice(self.frames, skip, end)], nextSeq
+
+    def restart(self):
+        ''' Note a client resuming with another epoch's sequence number, returns the one its frames pick up at '''
+        self.numGaps += 1
+        return self.frames[0][0] if self.frames else self.lastSeq + 1
+
+    def resume(self, seq):
+        ''' Note a client resuming after 'seq', returns the number of frames it'll be sent again '''
+        self.numResumes += 1
+        replayed = 0
+        if self.frames and ((self.frames[0][0] - 1) <= seq <= self.lastSeq):
+            replayed = self.lastSeq - seq
+        self.numReplayed += replayed
+        return replayed
+
+    def status(self):
+        return {'replayEpoch': self.epoch, 'replayFrames': len(self.frames), 'replayBytes': self.bytes,
+                'replayFirstSeq': self.frames[0][0] if self.frames else None, 'replayLastSeq': self.lastSeq,
+                'replayEvicted': self.numEvicted, 'replayResumes': self.numResumes,
+                'replayReplayed': self.numReplayed, 'replayGaps': self.numGaps, 'replaySkipped': self.numSkipped}
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Latest-Rotation Cache
+#
+# Holds the most recent completed rotation (from streaming or a standby
+# scan) so that requests with a freshness bound can be answered without
+# touching the device, and lets requests wait for the next rotation.
+#
+################################################################################
+
+import asyncio
+import time
+
+
+class RotationCache():
+    def __init__(self):
+        self.points = None
+        self.stamp = None
+        self.numRotations = 0
+        self.numHits = 0
+        self.numMisses = 0
+        self._ready = asyncio.Event()
+
+    def put(self, points, stamp=None):
+        ''' Cache a rotation, 'stamp' is when it was acquired (monotonic secs, defaults to now) '''
+        if not points:
+            return
+        self.points = points
+        # N.B. its age counts from acquisition, so time spent in the pipeline before getting here counts too
+        self.stamp = time.monotonic() if stamp is None else stamp
+        self.numRotations += 1
+        # wake everyone waiting for this rotation, later waiters get a new event
+        ready = self._ready
+        self._ready = asyncio.Event()
+        ready.set()
+
+    def age(self):
+        ''' Age of the cached rotation (secs), or None if there isn't one '''
+        if self.stamp is None:
+            return None
+        return time.monotonic() - self.stamp
+
+    def get(self, maxAge):
+        ''' Return the cached rotation if it's no older than maxAge secs, else None '''
+        age = self.age()
+        if (age is None) or (age > maxAge):
+            self.numMisses += 1
+            return None
+        self.numHits += 1
+        return self.points
+
+    async def next(self, timeout):
+        ''' Wait for the next rotation to be put, returns None on timeout '''
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.points
+
+    def clear(self):
+        self.points = None
+        self.stamp = None
+
+    def status(self):
+        age = self.age()
+        return {'cacheAgeMs': None if age is None else round(age * 1000.0, 1),
+                'cacheHits': self.numHits, 'cacheMisses': self.numMisses}
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Adaptive Scan Rate Controller
+#
+# Drops the lidar to its minimum scan frequency and sample rate while the
+# scene is quiet, and ramps to the maximum as soon as foreground activity
+# appears.  Activity is the number of angle bins whose range is well short of
+# a slowly learned background.  Ramping up is immediate, ramping down needs a
+# run of quiet rotations (hysteresis) and a minimum time since the last rate
+# change (so the rate can't flap).
+#
+################################################################################
+
+import time
+
+import numpy as np
+
+from ..shared import MIN_SCAN_FREQ, MAX_SCAN_FREQ, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE
+from .modelStore import loadModel, saveModel
+
+
+DEF_ANGLE_BIN = 1.0           # degrees
+DEF_FOREGROUND_DIST = 0.15    # meters closer than the background to count as foreground
+DEF_LEARN_RATE = 0.05         # background EMA weight of each (quiet) rotation
+DEF_ACTIVE_BINS = 3           # foreground bins that make the scene active
+DEF_QUIET_BINS = 1            # foreground bins at or below which a rotation is quiet
+DEF_QUIET_ROTATIONS = 30      # consecutive quiet rotations before ramping down
+DEF_MIN_CHANGE_INTERVAL = 5.0 # secs between ramping up and back down
+
+
+class ActivityDetector():
+    ''' Per-angle-bin background of ranges, with a count of foreground bins per rotation '''
+    def __init__(self, angleBin=DEF_ANGLE_BIN, foregroundDist=DEF_FOREGROUND_DIST,
+                 learnRate=DEF_LEARN_RATE):
+        self.angleBin = angleBin
+        self.foregroundDist = foregroundDist
+        self.learnRate = learnRate
+        self.numBins = int(np.ceil(360.0 / angleBin))
+        self.background = np.full(self.numBins, np.nan)
+
+    def binned(self, angles, distances):
+        ''' A rotation's (radians, meters) min range in each bin, inf where there's no return '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        valid = distances > 0
+        bins = ((np.degrees(angles[valid]) + 180.0) / self.angleBin).astype(np.int64) % self.numBins
+        current = np.full(self.numBins, np.inf)
+        np.minimum.at(current, bins, distances[valid])
+        return current
+
+    def update(self, angles, distances):
+        ''' Add a rotation (radians, meters), returns the number of foreground bins '''
+        return self.updateBinned(self.binned(angles, distances))
+
+    def foreground(self, current):
+        ''' A binned rotation's (see binned()) foreground bins, as a mask, without learning from it '''
+        known = np.isfinite(current) & np.isfinite(self.background)
+        foreground = np.zeros(self.numBins, dtype=bool)
+        foreground[known] = current[known] < (self.background[known] - self.foregroundDist)
+        return foreground
+
+    def updateBinned(self, current):
+        ''' Add a binned rotation (see binned()), returns the number of foreground bins '''
+        seen = np.isfinite(current)
+        known = seen & np.isfinite(self.background)
+        foreground = self.foreground(current)
+
+        # learn the background everywhere but the foreground
+        learn = seen & ~foreground
+        fresh = learn & ~known
+        self.background[fresh] = current[fresh]
+        update = learn & known
+        self.background[update] += self.learnRate * (current[update] - self.background[update])
+        return int(np.count_nonzero(foreground))
+
+    def reset(self):
+        self.background[:] = np.nan
+
+    def save(self, path, meta={}):
+        ''' Persist the background (meta: e.g., the sensor config it was learned with), returns True on error '''
+        return saveModel(path, 'background', {'background': self.background},
+                         dict(meta, angleBin=self.angleBin))
+
+    def restore(self, path, expect={}):
+        ''' Load a saved background if it's for the same bins (and 'expect'), returns True if there wasn't one '''
+        model = loadModel(path, 'background', dict(expect, angleBin=self.angleBin))
+        if (model is None) or (model[0]['background'].shape != self.background.shape):
+            return True
+        self.background = np.array(model[0]['background'], dtype=np.float64)
+        return False
+
+
+class ScanRateController():
+    def __init__(self, minFreq=MIN_SCAN_FREQ, maxFreq=MAX_SCAN_FREQ, minRate=MIN_SAMPLE_RATE,
+                 maxRate=MAX_SAMPLE_RATE, activeBins=DEF_ACTIVE_BINS, quietBins=DEF_QUIET_BINS,
+                 quietRotations=DEF_QUIET_ROTATIONS, minChangeInterval=DEF_MIN_CHANGE_INTERVAL,
+                 **kwargs):
+        self.low = (minFreq, minRate)
+        self.high = (maxFreq, maxRate)
+        self.activeBins = activeBins
+        self.quietBins = quietBins
+        self.quietRotations = quietRotations
+        self.minChangeInterval = minChangeInterval
+        self.detector = ActivityDetector(**kwargs)
+        self.active = False
+        self.numQuiet = 0
+        self.lastChange = None
+        self.lastStamp = None
+        self.numChanges = 0
+        self.motorTime = {}     # secs spent at each scan frequency
+        self.numSamples = 0
+        self.numRotations = 0
+        self.cpuTime = 0.0
+
+    def setting(self):
+        return self.high if self.active else self.low
+
+    def update(self, angles, distances, now=None):
+        ''' Add a rotation, returns the new (scanFreq, sampleRate) if the rate should change, else None '''
+        start = time.process_time()
+        now = time.monotonic() if now is None else now
+        if self.lastStamp is not None:
+            freq = self.setting()[0]
+            self.motorTime[freq] = self.motorTime.get(freq, 0.0) + (now - self.lastStamp)
+        self.lastStamp = now
+        self.numRotations += 1
+        self.numSamples += len(distances)
+
+        activity = self.detector.update(angles, distances)
+        change = None
+        if activity >= self.activeBins:
+            self.numQuiet = 0
+            if not self.active:
+                change = True
+        else:
+            self.numQuiet = self.numQuiet + 1 if activity <= self.quietBins else 0
+            if self.active and (self.numQuiet >= self.quietRotations) and \
+               ((self.lastChange is None) or ((now - self.lastChange) >= self.minChangeInterval)):
+                change = False
+        if change is not None:
+            self.active = change
+            self.lastChange = now
+            self.numChanges += 1
+        self.cpuTime += time.process_time() - start
+        return None if change is None else self.setting()
+
+    def status(self):
+        scanFreq, sampleRate = self.setting()
+        return {'adaptiveActive': self.active, 'adaptiveScanFreq': scanFreq,
+                'adaptiveSampleRate': sampleRate, 'adaptiveChanges': self.numChanges,
+                'motorTime': {str(k): round(v, 3) for k, v in self.motorTime.items()}}
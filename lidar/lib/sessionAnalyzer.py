@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Offline Session Analyzer
+#
+# Runs detection over recorded sessions (lidarPlot.py recordings), headless
+# and faster than real time.  Each rotation's candidate points (closer than
+# the reference region's inner margin, as in lidarGeom's detect(), and/or
+# closer than a learned per-angle background) are grouped into clusters of
+# neighbouring points, and a tracker turns runs of rotations with a big
+# enough cluster into events.
+#
+# The session is split into chunks of rotations (across and within files)
+# that are analyzed in parallel worker processes.  The reference region is
+# captured once, up front; the background, the only per-rotation state, is
+# re-learned over the rotations before each chunk (its warmup); and the
+# tracker, which is cheap, runs over the chunks' per-rotation results in
+# order, so events spanning chunk boundaries are found as if it were all
+# analyzed in one pass.
+#
+################################################################################
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import time
+
+import numpy as np
+
+from .recordings import indexRecording, iterRecording
+from .refGeometry import deriveGeometry, unionScans
+from .regionClassify import RegionClassifier, LABEL_INSIDE
+from .scanRate import ActivityDetector, DEF_ANGLE_BIN, DEF_FOREGROUND_DIST, DEF_LEARN_RATE
+
+
+MODELS = ('reference', 'background', 'both')
+
+DEF_MODEL = 'reference'
+DEF_MARGIN = -0.0025        # meters, of the reference region's inner margin (as in lidarGeom's detect())
+DEF_TOLERANCE = 0.02        # meters, of the reference region's simplification
+DEF_NUM_REF = 50            # rotations unioned into the reference region
+DEF_CLUSTER_DIST = 0.1      # meters between neighbouring points of a cluster
+DEF_MIN_CLUSTER = 3         # points in a cluster for a rotation to be a hit
+DEF_MIN_HITS = 2            # consecutive hits that start an event
+DEF_MAX_MISSED = 6          # rotations without a hit that end an event
+DEF_MAX_GAP = 1.0           # secs between rotations (e.g., between recordings) that ends an event
+DEF_CHUNK_ROTATIONS = 20000
+DEF_WARMUP = 400            # rotations the background is learned over before a chunk
+
+
+def stampSecs(stamps):
+    ''' datetime64 stamps as float secs '''
+    return np.asarray(stamps, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+def secsStamp(secs):
+    return str(np.datetime64(int(round(secs * 1e6)), 'us'))
+
+def cartesian(angles, distances):
+    return distances * np.cos(angles), distances * np.sin(angles)
+
+def largestCluster(x, y, clusterDist=DEF_CLUSTER_DIST):
+    ''' Size and centroid of the largest cluster of (angle ordered) points, neighbours within 'clusterDist' '''
+    if len(x) == 0:
+        return 0, np.nan, np.nan
+    gaps = np.hypot(np.diff(x), np.diff(y)) > clusterDist
+    starts = np.concatenate(([0], np.flatnonzero(gaps) + 1))
+    ends = np.append(starts[1:], len(x))
+    sizes = ends - starts
+    # N.B. clusters can straddle the end of the rotation
+    if (len(starts) > 1) and (np.hypot(x[0] - x[-1], y[0] - y[-1]) <= clusterDist):
+        sizes[0] += sizes[-1]
+        sizes[-1] = 0
+    i = int(np.argmax(sizes))
+    members = np.arange(starts[i], ends[i])
+    if (i == 0) and (sizes[-1] == 0) and (len(starts) > 1):
+        members = np.concatenate((members, np.arange(starts[-1], ends[-1])))
+    return int(sizes[i]), float(x[members].mean()), float(y[members].mean())
+
+
+class RotationDetector():
+    ''' Finds each rotation's candidate points and their largest cluster '''
+    def __init__(self, reference=None, model=DEF_MODEL, margin=DEF_MARGIN, tolerance=DEF_TOLERANCE,
+                 angleBin=DEF_ANGLE_BIN, foregroundDist=DEF_FOREGROUND_DIST, learnRate=DEF_LEARN_RATE,
+                 clusterDist=DEF_CLUSTER_DIST, numRef=DEF_NUM_REF):
+        if model not in MODELS:
+            raise ValueError(f"Invalid detection model: {model}")
+        if (model != 'background') and (reference is None):
+            raise ValueError(f"The '{model}' model needs a reference region")
+        self.model = model
+        self.clusterDist = clusterDist
+        self.classifier = None
+        if model != 'background':
+            self.classifier = RegionClassifier.fromGeometry(deriveGeometry(reference, (margin, margin), tolerance))
+        self.background = ActivityDetector(angleBin, foregroundDist, learnRate) if model != 'reference' else None
+
+    def learn(self, angles, distances):
+        ''' Update the background only (e.g., warming up before a chunk) '''
+        if self.background:
+            self.background.update(angles, distances)
+
+    def candidates(self, angles, distances):
+        ''' Mask of a rotation's candidate points (and learn the background from it) '''
+        candidates = np.zeros(len(distances), dtype=bool)
+        if self.classifier:
+            labels, _, _ = self.classifier.classify(angles, distances)
+            candidates |= labels == LABEL_INSIDE
+        if self.background:
+            bg = self.background
+            valid = distances > 0
+            bins = ((np.degrees(angles) + 180.0) / bg.angleBin).astype(np.int64) % bg.numBins
+            before = bg.background[bins]
+            bg.update(angles, distances)
+            with np.errstate(invalid='ignore'):
+                foreground = valid & (distances < (before - bg.foregroundDist))
+            candidates = (candidates & foreground) if self.model == 'both' else foreground
+        return candidates
+
+    def update(self, angles, distances):
+        ''' Returns the number of candidate points, and the size and centroid of their largest cluster '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        candidates = self.candidates(angles, distances)
+        x, y = cartesian(angles[candidates], distances[candidates])
+        order = np.argsort(angles[candidates], kind='stable')
+        return (int(np.count_nonzero(candidates)),) + largestCluster(x[order], y[order], self.clusterDist)
+
+
+class EventTracker():
+    ''' Turns per-rotation hits (a big enough cluster) into events '''
+    def __init__(self, minCluster=DEF_MIN_CLUSTER, minHits=DEF_MIN_HITS, maxMissed=DEF_MAX_MISSED,
+                 maxGap=DEF_MAX_GAP):
+        self.minCluster = minCluster
+        self.minHits = minHits
+        self.maxMissed = maxMissed
+        self.maxGap = maxGap
+        self.events = []
+        self.event = None
+        self.run = []
+        self.missed = 0
+        self.last = None
+
+    def _close(self):
+        if self.event:
+            self.events.append(self.event)
+        self.event = None
+        self.missed = 0
+
+    def update(self, stamp, clusterSize, x=np.nan, y=np.nan):
+        if (self.last is not None) and ((stamp - self.last) > self.maxGap):
+            self._close()
+            self.run = []
+        self.last = stamp
+        if clusterSize < self.minCluster:
+            self.run = []
+            if self.event:
+                self.missed += 1
+                if self.missed > self.maxMissed:
+                    self._close()
+            return
+        self.missed = 0
+        if self.event:
+            self.event['end'] = stamp
+            self.event['rotations'] += 1
+            if clusterSize > self.event['peakPoints']:
+                self.event.update(peakPoints=clusterSize, x=x, y=y)
+            return
+        self.run.append((stamp, clusterSize, x, y))
+        if len(self.run) >= self.minHits:
+            peak = max(self.run, key=lambda hit: hit[1])
+            self.event = {'start': self.run[0][0], 'end': stamp, 'confirmed': stamp, 'rotations': len(self.run),
+                          'peakPoints': peak[1], 'x': peak[2], 'y': peak[3]}
+            self.run = []
+
+    def finish(self):
+        ''' Close any open event, returns all the events '''
+        self._close()
+        return self.events
+
+
+def trackEvents(results, minCluster=DEF_MIN_CLUSTER, minHits=DEF_MIN_HITS, maxMissed=DEF_MAX_MISSED,
+                maxGap=DEF_MAX_GAP):
+    ''' Events from per-rotation results (dict of 'stamps', 'clusterSize', and optionally 'x', 'y' arrays)
+
+    The same events an EventTracker finds from the rotations one at a time, but
+    stepping through the runs of hits rather than every rotation.
+    '''
+    stamps = np.asarray(results['stamps'])
+    sizes = np.asarray(results['clusterSize'])
+    if len(stamps) == 0:
+        return []
+    x = results.get('x', np.full(len(stamps), np.nan))
+    y = results.get('y', np.full(len(stamps), np.nan))
+    hits = sizes >= minCluster
+    breaks = np.concatenate(([True], np.diff(stamps) > maxGap))
+    runStarts = np.flatnonzero(hits & (breaks | ~np.concatenate(([False], hits[:-1]))))
+    runEnds = np.flatnonzero(hits & (np.append(breaks[1:], True) | ~np.append(hits[1:], False))) + 1
+
+    events = []
+    event = None
+    lastHit = None
+    for first, last in zip(runStarts, runEnds):
+        peak = first + int(np.argmax(sizes[first:last]))
+        if event:
+            if ((first - lastHit - 1) <= maxMissed) and not breaks[lastHit + 1:first + 1].any():
+                event['end'] = stamps[last - 1]
+                event['rotations'] += int(last - first)
+                if sizes[peak] > event['peakPoints']:
+                    event.update(peakPoints=sizes[peak], x=x[peak], y=y[peak])
+                lastHit = last - 1
+                continue
+            events.append(event)
+            event = None
+        if (last - first) >= minHits:
+            event = {'start': stamps[first], 'end': stamps[last - 1], 'confirmed': stamps[first + minHits - 1],
+                     'rotations': int(last - first), 'peakPoints': sizes[peak], 'x': x[peak], 'y': y[peak]}
+            lastHit = last - 1
+    if event:
+        events.append(event)
+    return events
+
+def indexSession(paths):
+    ''' Index recordings as one session, returns [(path, offsets, stamps)] in time order '''
+    index = []
+    for path in paths:
+        offsets, stamps = indexRecording(path)
+        if len(offsets):
+            index.append((path, offsets, stamps))
+        else:
+            logging.warning(f"Empty recording, ignoring: {path}")
+    return sorted(index, key=lambda entry: entry[2][0])
+
+def _pieces(index, first, last):
+    ''' (path, offset, count) pieces of the session's rotations [first, last) '''
+    pieces = []
+    base = 0
+    for path, offsets, _ in index:
+        lo, hi = max(first, base), min(last, base + len(offsets))
+        if lo < hi:
+            pieces.append((path, int(offsets[lo - base]), hi - lo))
+        base += len(offsets)
+    return pieces
+
+def planChunks(index, chunkRotations=DEF_CHUNK_ROTATIONS, warmup=DEF_WARMUP):
+    ''' Split the session into chunks, each with the pieces to warm up over and to analyze '''
+    total = sum(len(offsets) for _, offsets, _ in index)
+    return [{'warmup': _pieces(index, max(0, first - warmup), first),
+             'pieces': _pieces(index, first, min(total, first + chunkRotations))}
+            for first in range(0, total, chunkRotations)]
+
+def _rotations(pieces):
+    for path, offset, count in pieces:
+        yield from iterRecording(path, offset, count)
+
+def analyzeChunk(chunk, reference=None, detector={}):
+    ''' Per-rotation results of a chunk: 'stamps' (secs), 'candidates', 'clusterSize' and cluster 'x', 'y' '''
+    rotationDetector = RotationDetector(reference, **detector)
+    for _, angles, distances, _ in _rotations(chunk['warmup']):
+        rotationDetector.learn(angles, distances)
+    stamps, results = [], []
+    for stamp, angles, distances, _ in _rotations(chunk['pieces']):
+        stamps.append(stamp)
+        results.append(rotationDetector.update(angles, distances))
+    results = np.array(results, dtype=np.float64).reshape(-1, 4)
+    return {'stamps': stampSecs(stamps), 'candidates': results[:, 0].astype(np.int64),
+            'clusterSize': results[:, 1].astype(np.int64), 'x': results[:, 2], 'y': results[:, 3]}
+
+def _analyzeJob(args):
+    return analyzeChunk(*args)
+
+def captureReference(index, numRef=DEF_NUM_REF):
+    ''' Reference region from the session's first 'numRef' rotations (as detect() captures it) '''
+    scans = [np.column_stack(cartesian(angles, distances))[distances > 0]
+             for _, angles, distances, _ in _rotations(_pieces(index, 0, numRef))]
+    return unionScans(scans)
+
+def analyzeSession(paths, reference=None, detector={}, tracker={}, workers=None,
+                   chunkRotations=DEF_CHUNK_ROTATIONS, warmup=DEF_WARMUP):
+    ''' Analyze recordings (as one session, in time order), returns (events, summary, per-rotation results)
+
+    'detector' and 'tracker' are RotationDetector and EventTracker parameters.  The
+    reference region is captured from the session's first rotations unless given.
+    '''
+    start = time.perf_counter()
+    index = indexSession(paths)
+    if not index:
+        return [], {'rotations': 0}, None
+    if (reference is None) and (detector.get('model', DEF_MODEL) != 'background'):
+        reference = captureReference(index, detector.get('numRef', DEF_NUM_REF))
+    chunks = planChunks(index, chunkRotations, warmup)
+    jobs = [(chunk, reference, detector) for chunk in chunks]
+    if (workers == 1) or (len(jobs) == 1):
+        parts = [_analyzeJob(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(_analyzeJob, jobs))
+    results = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    events = trackEvents(results, **tracker)
+    elapsed = time.perf_counter() - start
+
+    sessionSecs = float(results['stamps'][-1] - results['stamps'][0]) if len(results['stamps']) else 0.0
+    minCluster = tracker.get('minCluster', DEF_MIN_CLUSTER)
+    summary = {'files': len(index), 'rotations': len(results['stamps']), 'chunks': len(chunks),
+               'start': secsStamp(results['stamps'][0]), 'end': secsStamp(results['stamps'][-1]),
+               'sessionSecs': round(sessionSecs, 3), 'elapsedSecs': round(elapsed, 3),
+               'speedup': round(sessionSecs / elapsed, 1),
+               'hitRotations': int(np.count_nonzero(results['clusterSize'] >= minCluster)),
+               'meanCandidates': round(float(results['candidates'].mean()), 3),
+               'maxCluster': int(results['clusterSize'].max()),
+               'events': len(events), 'eventSecs': round(sum(e['end'] - e['start'] for e in events), 3)}
+    return events, summary, results
+
+def eventsToDicts(events):
+    ''' Events with their times as (ISO) strings, for serializing '''
+    return [dict(e, start=secsStamp(e['start']), end=secsStamp(e['end']), confirmed=secsStamp(e['confirmed']),
+                 duration=round(float(e['end'] - e['start']), 3), rotations=int(e['rotations']),
+                 peakPoints=int(e['peakPoints']), x=round(float(e['x']), 3), y=round(float(e['y']), 3))
+            for e in events]
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Synthetic Scene and Critter Simulator
+#
+# Ray-casts a 2D scene (a perimeter polygon, static obstacles and moving,
+# critter-sized, circular blobs on scripted or random trajectories) from the
+# sensor at the origin, giving T-mini Pro-like rotations with configurable
+# angular resolution, range noise, dropouts and intensity.  All of a
+# rotation's rays are cast against all of the scene's edges and critters at
+# once, so rotations can be generated much faster than the device's 12Hz,
+# for stress testing the server, the clients and the detectors.
+#
+# SimulatedLidar presents the simulator with the same interface as the
+# native drivers, so that it can be served by wsLidar (the 'sim' driver),
+# either paced at the scan frequency or at any other (or no) rate.
+#
+# N.B. scene coordinates are meters relative to the sensor, in the frame
+#  the rotations' points are (i.e., x = d * cos(angle), y = d * sin(angle)),
+#  and critters are placed where they are at the start of each rotation.
+#
+################################################################################
+
+from datetime import timedelta
+import json
+import logging
+import time
+
+import numpy as np
+from shapely import contains_xy, prepare
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+import yaml
+
+from ..shared import MIN_ANGLE, MAX_ANGLE, MIN_SCAN_FREQ, MAX_SCAN_FREQ, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE
+from .asyncAcquire import AsyncAcquisition
+
+
+DEF_MAX_ANGLE = 180.0           # degrees
+DEF_MIN_ANGLE = -180.0          # degrees
+DEF_SCAN_FREQ = 10.0            # Hz
+DEF_MAX_RANGE = 12.0            # meters
+DEF_MIN_RANGE = 0.02            # meters
+DEF_SAMPLE_RATE = 4             # KHz
+DEF_RANGE_NOISE = 0.005         # meters, std dev of the range noise at zero range
+DEF_RANGE_NOISE_SLOPE = 0.002   # meters per meter of range, added to the std dev
+DEF_DROPOUT = 0.02              # probability of a sample returning nothing
+DEF_ANGLE_JITTER = 0.5          # fraction of a step, random offset of each rotation's first sample
+DEF_INTENSITY_FALLOFF = 10.0    # meters, range over which the intensity falls by 1/e
+DEF_INTENSITY_NOISE = 4.0       # std dev of the intensity noise
+DEF_REFLECTIVITY = 0.8          # of the perimeter and obstacles, 0-1
+DEF_CRITTER_RADIUS = 0.15       # meters
+DEF_CRITTER_REFLECTIVITY = 0.4
+DEF_CRITTER_SPEED = 0.5         # meters/sec, of random trajectories
+DEF_TURN_RATE = 1.5             # radians/sqrt(sec), of random trajectories' heading changes
+DEF_WALK_STEP = 0.05            # secs, between random trajectories' steps
+
+# a yard with a shed in it and a critter wandering around
+DEF_SCENE = {'perimeter': [[-4.0, -3.0], [5.0, -3.0], [5.0, 4.0], [-4.0, 4.0]],
+             'obstacles': [[[1.5, 1.0], [2.5, 1.0], [2.5, 2.0], [1.5, 2.0]]],
+             'critters': [{'random': {'seed': 1}}]}
+
+
+class Waypoints():
+    ''' Scripted trajectory, linearly interpolated between (t, x, y) waypoints '''
+    def __init__(self, points, loop=False):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        order = np.argsort(points[:, 0], kind='stable')
+        self.t, self.x, self.y = points[order].T
+        self.loop = loop
+
+    def position(self, t):
+        if self.loop and (len(self.t) > 1):
+            t = self.t[0] + ((t - self.t[0]) % (self.t[-1] - self.t[0]))
+        return float(np.interp(t, self.t, self.x)), float(np.interp(t, self.t, self.y))
+
+
+class RandomWalk():
+    ''' Random trajectory: constant speed, a randomly drifting heading, turning away from walls
+
+    Deterministic for a given seed, so it can be replayed (going back in
+    time restarts the walk).  'free' is a callable(x, y) -> bool saying
+    where the critter can be, 'start' defaults to a random free point
+    within 'bounds' (minx, miny, maxx, maxy).
+    '''
+    def __init__(self, free, bounds, start=None, speed=DEF_CRITTER_SPEED, turnRate=DEF_TURN_RATE,
+                 seed=None, step=DEF_WALK_STEP):
+        self.free = free
+        self.bounds = bounds
+        self.start = start
+        self.speed = speed
+        self.turnRate = turnRate
+        self.seed = seed
+        self.step = step
+        self._restart()
+
+    def _restart(self):
+        self.rng = np.random.default_rng(self.seed)
+        if self.start is not None:
+            self.x, self.y = self.start
+        else:
+            minx, miny, maxx, maxy = self.bounds
+            for _ in range(1000):
+                self.x, self.y = self.rng.uniform(minx, maxx), self.rng.uniform(miny, maxy)
+                if self.free(self.x, self.y):
+                    break
+        self.heading = self.rng.uniform(-np.pi, np.pi)
+        self.t = 0.0
+
+    def _advance(self):
+        self.heading += self.rng.normal(0.0, self.turnRate * np.sqrt(self.step))
+        for _ in range(8):
+            x = self.x + (self.speed * self.step * np.cos(self.heading))
+            y = self.y + (self.speed * self.step * np.sin(self.heading))
+            if self.free(x, y):
+                self.x, self.y = x, y
+                break
+            self.heading = self.rng.uniform(-np.pi, np.pi)
+        self.t += self.step
+
+    def position(self, t):
+        if t < self.t:
+            self._restart()
+        while self.t + self.step <= t:
+            self._advance()
+        return float(self.x), float(self.y)
+
+
+class Critter():
+    ''' Circular blob on a trajectory, present from 'start' until 'end' (secs, if given) '''
+    def __init__(self, trajectory, radius=DEF_CRITTER_RADIUS, reflectivity=DEF_CRITTER_REFLECTIVITY,
+                 start=None, end=None):
+        self.trajectory = trajectory
+        self.radius = radius
+        self.reflectivity = reflectivity
+        self.start = start
+        self.end = end
+
+    def position(self, t):
+        ''' (x, y) at time 't', or None if it's not in the scene then '''
+        if ((self.start is not None) and (t < self.start)) or ((self.end is not None) and (t >= self.end)):
+            return None
+        return self.trajectory.position(t)
+
+
+class Scene():
+    ''' Perimeter polygon, static obstacle polygons and critters, around the sensor at the origin '''
+    def __init__(self, perimeter, obstacles=[], critters=[], reflectivity=DEF_REFLECTIVITY,
+                 obstacleReflectivity=None):
+        self.perimeter = Polygon(perimeter)
+        self.obstacles = [Polygon(o) for o in obstacles]
+        self.critters = list(critters)
+        if obstacleReflectivity is None:
+            obstacleReflectivity = reflectivity
+
+        # every polygon's edges, as start points and direction vectors
+        starts, reflect = [], []
+        for polygon, r in [(self.perimeter, reflectivity)] + [(o, obstacleReflectivity) for o in self.obstacles]:
+            ring = np.asarray(polygon.exterior.coords)
+            starts.append(np.column_stack((ring[:-1], ring[1:] - ring[:-1])))
+            reflect.append(np.full(len(ring) - 1, r))
+        edges = np.concatenate(starts)
+        self.px, self.py, self.dx, self.dy = edges.T
+        self.edgeReflectivity = np.concatenate(reflect)
+        self.pCrossD = (self.px * self.dy) - (self.py * self.dx)
+        self._free = {}
+
+    def freeSpace(self, radius=0.0):
+        ''' Prepared polygon of where a critter of the given radius fits '''
+        if radius not in self._free:
+            space = self.perimeter.difference(unary_union(self.obstacles)) if self.obstacles else self.perimeter
+            space = space.buffer(-radius)
+            prepare(space)
+            self._free[radius] = space
+        return self._free[radius]
+
+    def positions(self, t):
+        ''' Ground truth: (x, y, radius, reflectivity) of the critters in the scene at time 't' '''
+        out = []
+        for critter in self.critters:
+            pos = critter.position(t)
+            if pos is not None:
+                out.append((pos[0], pos[1], critter.radius, critter.reflectivity))
+        return out
+
+    def cast(self, angles, t=0.0):
+        ''' Ranges (meters, inf where nothing is hit) and reflectivities along rays at 'angles' at time 't' '''
+        ux, uy = np.cos(angles)[:, None], np.sin(angles)[:, None]
+        denom = (ux * self.dy) - (uy * self.dx)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = self.pCrossD / denom
+            along = ((self.px * uy) - (self.py * ux)) / denom
+        hit = (np.abs(denom) > 1e-12) & (dist > 0) & (along >= 0) & (along <= 1)
+        dist = np.where(hit, dist, np.inf)
+        nearest = np.argmin(dist, axis=1)
+        ranges = dist[np.arange(len(angles)), nearest]
+        reflect = self.edgeReflectivity[nearest]
+
+        critters = self.positions(t)
+        if critters:
+            cx, cy, radius, cReflect = (np.array(v) for v in zip(*critters))
+            b = (ux * cx) + (uy * cy)
+            disc = (b * b) - ((cx * cx) + (cy * cy) - (radius * radius))
+            with np.errstate(invalid='ignore'):
+                cDist = b - np.sqrt(disc)
+            cDist = np.where((disc >= 0) & (cDist > 0), cDist, np.inf)
+            closest = np.argmin(cDist, axis=1)
+            cRanges = cDist[np.arange(len(angles)), closest]
+            inFront = cRanges < ranges
+            ranges = np.where(inFront, cRanges, ranges)
+            reflect = np.where(inFront, cReflect[closest], reflect)
+        return ranges, reflect
+
+    @staticmethod
+    def fromConfig(config=None):
+        ''' Build a scene from a dict (e.g., from YAML/JSON) like DEF_SCENE
+
+        Each critter is {'radius': <m>, 'reflectivity': <0-1>, 'start': <secs>,
+        'end': <secs>} with either 'waypoints': [[t, x, y], ...] (and 'loop')
+        or 'random': {'speed': <m/s>, 'turnRate': <rad/sqrt(s)>, 'seed': <int>,
+        'start': [x, y]}.
+        '''
+        config = DEF_SCENE if config is None else config
+        scene = Scene(config['perimeter'], config.get('obstacles', []),
+                      reflectivity=config.get('reflectivity', DEF_REFLECTIVITY),
+                      obstacleReflectivity=config.get('obstacleReflectivity', None))
+        for spec in config.get('critters', []):
+            radius = spec.get('radius', DEF_CRITTER_RADIUS)
+            if 'waypoints' in spec:
+                trajectory = Waypoints(spec['waypoints'], spec.get('loop', False))
+            else:
+                walk = dict(spec.get('random', {}))
+                space = scene.freeSpace(radius)
+                trajectory = RandomWalk(lambda x, y, space=space: bool(contains_xy(space, x, y)),
+                                        space.bounds, **walk)
+            scene.critters.append(Critter(trajectory, radius, spec.get('reflectivity', DEF_CRITTER_REFLECTIVITY),
+                                          spec.get('start', None), spec.get('end', None)))
+        return scene
+
+
+class Simulator():
+    ''' Generates T-mini Pro-like rotations of a scene
+
+    Rotations are dicts of arrays as the native driver gives them: 'angles'
+    (radians, in the device's sample order, wrapped to [-pi, pi)),
+    'distances' (meters, 0 for no return), 'intensities' (0-255) and
+    'flags'.  The angular resolution is that of the device (sampleRate
+    samples/sec at scanFreq rotations/sec) unless 'resolution' (degrees) is
+    given.
+    '''
+    def __init__(self, scene=None, scanFreq=DEF_SCAN_FREQ, sampleRate=DEF_SAMPLE_RATE, resolution=None,
+                 rangeNoise=DEF_RANGE_NOISE, rangeNoiseSlope=DEF_RANGE_NOISE_SLOPE, dropout=DEF_DROPOUT,
+                 angleJitter=DEF_ANGLE_JITTER, intensityFalloff=DEF_INTENSITY_FALLOFF,
+                 intensityNoise=DEF_INTENSITY_NOISE, minRange=DEF_MIN_RANGE, maxRange=DEF_MAX_RANGE, seed=None):
+        self.scene = scene if scene is not None else Scene.fromConfig()
+        self.scanFreq = scanFreq
+        self.sampleRate = sampleRate
+        self.resolution = resolution
+        self.rangeNoise = rangeNoise
+        self.rangeNoiseSlope = rangeNoiseSlope
+        self.dropout = dropout
+        self.angleJitter = angleJitter
+        self.intensityFalloff = intensityFalloff
+        self.intensityNoise = intensityNoise
+        self.minRange = minRange
+        self.maxRange = maxRange
+        self.rng = np.random.default_rng(seed)
+        self.t = 0.0
+
+    def numPoints(self):
+        if self.resolution:
+            return int(round(360.0 / self.resolution))
+        return int(round((self.sampleRate * 1000.0) / self.scanFreq))
+
+    def rotation(self, t=None):
+        ''' The rotation starting at time 't' (secs, default: the one after the last) '''
+        if t is None:
+            t = self.t
+        self.t = t + (1.0 / self.scanFreq)
+        n = self.numPoints()
+        step = (2 * np.pi) / n
+        # N.B. the device sweeps clockwise from its zero, its first sample isn't aligned with it
+        angles = (self.rng.uniform(0.0, self.angleJitter) + np.arange(n)) * step
+        angles = np.where(angles >= np.pi, angles - (2 * np.pi), angles)
+
+        ranges, reflect = self.scene.cast(angles, t)
+        sigma = self.rangeNoise + (self.rangeNoiseSlope * np.where(np.isfinite(ranges), ranges, 0.0))
+        distances = ranges + self.rng.normal(0.0, 1.0, n) * sigma
+        missed = ~np.isfinite(distances) | (distances < self.minRange) | (distances > self.maxRange) | \
+            (self.rng.random(n) < self.dropout)
+        distances = np.where(missed, 0.0, distances)
+        with np.errstate(invalid='ignore'):
+            intensities = (255.0 * reflect * np.exp(-ranges / self.intensityFalloff)) + \
+                self.rng.normal(0.0, self.intensityNoise, n)
+        intensities = np.where(missed, 0, np.clip(np.round(intensities), 0, 255)).astype(np.uint16)
+        return {'angles': angles, 'distances': distances, 'intensities': intensities,
+                'flags': np.zeros(n, dtype=np.uint16), 'scanFreq': self.scanFreq, 'simTime': t}
+
+    def rotations(self, count, start=0.0):
+        ''' Yield 'count' consecutive rotations, from time 'start' '''
+        self.t = start
+        for _ in range(count):
+            yield self.rotation()
+
+
+def writeRecording(path, simulator, count, startTime, start=0.0):
+    ''' Write 'count' rotations as a lidarPlot.py recording, with stamps from 'startTime' (a datetime)
+
+    Returns the simulated time of each rotation.  As with lidarPlot.py, only
+    the points with returns are recorded.
+    '''
+    times = []
+    with open(path, "w") as f:
+        print("[", file=f)
+        for rot in simulator.rotations(count, start):
+            keep = rot['distances'] > 0
+            points = np.column_stack((rot['angles'][keep], rot['distances'][keep], rot['intensities'][keep]))
+            if f.tell() > 2:
+                print(",", file=f)
+            print(f"  {{\"sampleTime\": \"{startTime + timedelta(seconds=rot['simTime'])}\", ", file=f)
+            print(f"   \"data\": {json.dumps(points.tolist())} }}", end="", file=f)
+            times.append(rot['simTime'])
+        print("]", file=f)
+    return np.array(times)
+
+
+class SimulatedLidar(AsyncAcquisition):
+    ''' Simulator with the same public surface as lib/lidar.py's Lidar (the 'sim' driver)
+
+    Besides the usual options, takes 'scene' (a scene config dict, see
+    Scene.fromConfig(), or the path of a YAML/JSON file holding one), 'seed',
+    the Simulator's noise options, 'rate', the rotations per second
+    delivered while scanning: the scan frequency (i.e., real time) by
+    default, 0 for as fast as they can be generated, and 'spinUp', the secs
+    it takes to turn the laser on (none by default).  Simulated time always
+    advances by one scan period per rotation.
+    '''
+    LIDAR_VERSION = "1.3.0"  # N.B. Must match lidar.py library's version
+
+    def __init__(self, **kwargs):
+        self.port = kwargs.get('port', None)
+        self.scanFreq = kwargs.get('scanFreq', DEF_SCAN_FREQ)
+        self.sampleRate = kwargs.get('sampleRate', DEF_SAMPLE_RATE)
+        self.maxAngle = kwargs.get('maxAngle', DEF_MAX_ANGLE)
+        self.minAngle = kwargs.get('minAngle', DEF_MIN_ANGLE)
+        self.maxRange = kwargs.get('maxRange', DEF_MAX_RANGE)
+        self.minRange = kwargs.get('minRange', DEF_MIN_RANGE)
+        self.zeroFilter = kwargs.get('zeroFilter', True)
+        self.rate = kwargs.get('rate', None)
+        self.spinUp = kwargs.get('spinUp', 0.0)
+        self.numScans = None
+        self.scanning = False
+        self.streaming = False
+        self.numRotations = 0
+        self.nextDue = None
+
+        scene = kwargs.get('scene', None)
+        if isinstance(scene, str):
+            with open(scene, "r") as f:
+                scene = yaml.safe_load(f)
+        noise = {k: kwargs[k] for k in ('resolution', 'rangeNoise', 'rangeNoiseSlope', 'dropout', 'angleJitter',
+                                        'intensityFalloff', 'intensityNoise', 'seed') if k in kwargs}
+        self.simulator = Simulator(Scene.fromConfig(scene), self.scanFreq, self.sampleRate, **noise)
+        self.deviceInfo = {'model': 'simulated', 'firmware': self.LIDAR_VERSION, 'hardware': 0,
+                           'serialNumber': f"sim{kwargs.get('seed', 0)}"}
+        if self.setScanFreq(self.scanFreq) or self.setSampleRate(self.sampleRate) or \
+           self.setAngles(self.minAngle, self.maxAngle) or \
+           self.setRanges(self.minRange, self.maxRange):
+            raise ValueError("Invalid lidar options")
+
+    def readRotation(self, timeout=None):
+        ''' Return the next rotation as a dict of arrays, paced at the delivery rate '''
+        rate = self.scanFreq if self.rate is None else self.rate
+        if rate:
+            now = time.monotonic()
+            if self.nextDue is None:
+                self.nextDue = now
+            if self.nextDue > now:
+                time.sleep(self.nextDue - now)
+            # N.B. don't try to catch up after falling behind
+            self.nextDue = max(self.nextDue, now - (1.0 / rate)) + (1.0 / rate)
+        self.numRotations += 1
+        rot = self.simulator.rotation()
+        rot['stamp'] = time.time()
+        return self._filter(rot)
+
+    def _filter(self, rot):
+        keep = (rot['angles'] >= np.radians(self.minAngle)) & (rot['angles'] <= np.radians(self.maxAngle))
+        outOfRange = (rot['distances'] < self.minRange) | (rot['distances'] > self.maxRange)
+        rot['distances'] = np.where(outOfRange, 0.0, rot['distances'])
+        if self.zeroFilter:
+            keep &= rot['distances'] > 0
+        for k in ('angles', 'distances', 'intensities', 'flags'):
+            rot[k] = rot[k][keep]
+        return rot
+
+    def laserEnable(self, enable):
+        if enable:
+            if not self.scanning:
+                # N.B. blocks like a real device's motor spin-up
+                if self.spinUp:
+                    time.sleep(self.spinUp)
+                self.nextDue = None
+                self.scanning = True
+        else:
+            self.scanning = False
+            self.streaming = False
+        return False
+
+    def _acquireOnce(self, names):
+        if (self.simulator is None) or (not self.scanning):
+            return None
+        rot = self.readRotation()
+        # N.B. the rotation's arrays are handed on as they are, they're only made lists when serialized
+        return {name: rot[name] for name in names if name in rot}
+
+    def _recover(self):
+        if (self.simulator is not None) and (not self.scanning):
+            self.laserEnable(True)
+
+    def scan(self, names=['angles', 'distances', 'intensities']):
+        self.streaming = False
+        wasScanning = self.scanning
+        self.laserEnable(True)
+        rot = self.readRotation()
+        if not wasScanning:
+            self.laserEnable(False)
+        # N.B. the (sync) scan's values are lists, as they've always been
+        return {name: rot[name].tolist() for name in names}
+
+    def stream(self, names):
+        self.streaming = True
+        self.numScans = 0
+        while self.streaming:
+            self.numScans += 1
+            rot = self.readRotation()
+            yield {name: rot[name] for name in names}
+
+    def status(self):
+        stat = {'laser': True, 'ok': self.simulator is not None, 'scanning': self.scanning,
+                'streaming': self.streaming, 'numScans': self.numScans,
+                'minAngle': self.minAngle, 'maxAngle': self.maxAngle,
+                'minRange': self.minRange, 'maxRange': self.maxRange,
+                'scanFreq': self.scanFreq, 'sampleRate': self.sampleRate,
+                'driver': 'sim', 'deviceInfo': self.deviceInfo,
+                'simRate': self.rate, 'simRotations': self.numRotations,
+                'simTime': self.simulator.t if self.simulator else None}
+        return stat
+
+    def setAngles(self, minAngle, maxAngle):
+        if minAngle >= maxAngle:
+            logging.error(f"Invalid minAngle and maxAngle pair ({minAngle} >= {maxAngle}))")
+            return True
+        return self.setMinAngle(minAngle) or self.setMaxAngle(maxAngle)
+
+    def setMinAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid minAngle ({angle})")
+            return True
+        self.minAngle = angle
+        return False
+
+    def setMaxAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid maxAngle ({angle})")
+            return True
+        self.maxAngle = angle
+        return False
+
+    def getAngles(self):
+        return self.maxAngle, self.minAngle
+
+    def setRanges(self, minRange, maxRange):
+        if minRange >= maxRange:
+            logging.error(f"Invalid minRange and maxRange pair ({minRange} >= {maxRange}))")
+            return True
+        return self.setMinRange(minRange) or self.setMaxRange(maxRange)
+
+    def setMinRange(self, range):
+        if (range > 1000) or (range <= 0):    #### FIXME
+            logging.error(f"Invalid minRange ({range})")
+            return True
+        self.minRange = range
+        self.simulator.minRange = range
+        return False
+
+    def setMaxRange(self, range):
+        if (range > 1000) or (range < 0):    #### FIXME
+            logging.error(f"Invalid maxRange ({range})")
+            return True
+        self.maxRange = range
+        self.simulator.maxRange = range
+        return False
+
+    def getRanges(self):
+        return self.maxRange, self.minRange
+
+    def setScanFreq(self, scanFreq):
+        if (scanFreq > MAX_SCAN_FREQ) or (scanFreq < MIN_SCAN_FREQ):
+            logging.error(f"Invalid scan frequency ({scanFreq})")
+            return True
+        self.scanFreq = scanFreq
+        self.simulator.scanFreq = scanFreq
+        return False
+
+    def getScanFreq(self):
+        return self.scanFreq
+
+    def setSampleRate(self, sampleRate):
+        if (sampleRate > MAX_SAMPLE_RATE) or (sampleRate < MIN_SAMPLE_RATE):
+            logging.error(f"Invalid sample rate ({sampleRate})")
+            return True
+        self.sampleRate = sampleRate
+        self.simulator.sampleRate = sampleRate
+        return False
+
+    def getSampleRate(self):
+        return self.sampleRate
+
+    def getVersion(self):
+        return SimulatedLidar.LIDAR_VERSION
+
+    def done(self):
+        self.streaming = False
+        self._shutdownExecutor()
+        res = self.laserEnable(False)
+        self.simulator = None
+        return not res
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Warm Standby for Lidar Devices
+#
+# Keeps the motor and laser running for an idle timeout after the last
+# request, so back-to-back single scans don't each pay the motor's spin-up
+# and stabilization time.  The power-down timer lives on the asyncio loop of
+# the server that owns the device.
+#
+################################################################################
+
+import asyncio
+import logging
+import time
+
+
+DEF_STANDBY_TIMEOUT = 30.0  # secs, 0 powers down right after each request
+
+
+class Standby():
+    def __init__(self, timeout=DEF_STANDBY_TIMEOUT):
+        self.timeout = timeout
+        self.scanner = None
+        self.active = False     # laser is on without anyone actively using it
+        self.handle = None
+        self.deadline = None
+        self.numWarm = 0        # requests that found the laser already on
+        self.numCold = 0        # requests that had to spin the motor up
+
+    def setTimeout(self, timeout):
+        if timeout < 0:
+            logging.error(f"Invalid standby timeout ({timeout})")
+            return True
+        self.timeout = timeout
+        if self.active:
+            self._arm()
+        return False
+
+    def getTimeout(self):
+        return self.timeout
+
+    def attach(self, scanner):
+        ''' A (new) device was initialized, so any standby of the previous one is over '''
+        self._cancel()
+        self.active = False
+        self.scanner = scanner
+
+    def acquire(self, scanner):
+        ''' Make sure the laser is on for a request, returns True on error '''
+        self._cancel()
+        if self.active and (scanner is self.scanner):
+            self.numWarm += 1
+            self.active = False
+            return False
+        self.numCold += 1
+        self.active = False
+        self.scanner = scanner
+        return scanner.laserEnable(True)
+
+    def release(self, scanner):
+        ''' Done with the laser for now, power down after the idle timeout '''
+        self.scanner = scanner
+        if self.timeout <= 0:
+            return self.powerDown()
+        self.active = True
+        self._arm()
+        return False
+
+    def _arm(self):
+        if self.handle:
+            self.handle.cancel()
+        self.deadline = time.monotonic() + self.timeout
+        self.handle = asyncio.get_running_loop().call_later(self.timeout, self._expire)
+
+    def _cancel(self):
+        if self.handle:
+            self.handle.cancel()
+        self.handle = None
+        self.deadline = None
+
+    def _expire(self):
+        self.handle = None
+        self.deadline = None
+        if self.active:
+            logging.info("Standby timeout, powering down")
+            self.powerDown()
+
+    def powerDown(self):
+        self._cancel()
+        self.active = False
+        if self.scanner:
+            return self.scanner.laserEnable(False)
+        return False
+
+    def cancel(self):
+        ''' Someone else (e.g., streaming or an explicit laser command) now owns the laser '''
+        self._cancel()
+        self.active = False
+
+    def status(self):
+        remaining = None
+        if self.deadline is not None:
+            remaining = max(0.0, self.deadline - time.monotonic())
+        return {'standby': self.active, 'standbyTimeout': self.timeout,
+                'standbyRemaining': remaining, 'warmScans': self.numWarm,
+                'coldScans': self.numCold}
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Multi-Rotation Temporal Filter
+#
+# Bins each rotation by angle and keeps a ring of the last K binned rotations,
+# emitting the per-bin median (or trimmed mean) of the ring every rotation.
+# Each bin also keeps its K values in sorted order: every rotation the oldest
+# value is removed and the new one inserted with a single vectorized
+# compare-and-shift pass, so nothing is re-sorted over the whole ring.  The
+# median is read off the middle of the sorted window, the trimmed mean sums
+# the window between the cuts.  Bins without a return hold +inf, which sorts
+# last.
+#
+################################################################################
+
+import numpy as np
+
+from ..shared import MIN_ANGLE_RESOLUTION
+
+
+FILTER_MODES = ('median', 'trimmed')
+
+DEF_NUM_ROTATIONS = 5
+DEF_MODE = 'median'
+DEF_TRIM = 0.2                         # fraction trimmed from each end
+DEF_ANGLE_BIN = MIN_ANGLE_RESOLUTION   # degrees
+DEF_MIN_COUNT = 1                      # returns in the ring for a bin to be emitted
+
+
+class TemporalFilter():
+    def __init__(self, numRotations=DEF_NUM_ROTATIONS, mode=DEF_MODE, trim=DEF_TRIM,
+                 angleBin=DEF_ANGLE_BIN, minCount=DEF_MIN_COUNT):
+        if mode not in FILTER_MODES:
+            raise ValueError(f"Invalid filter mode: {mode}")
+        if (numRotations < 1) or not (0.0 <= trim < 0.5) or not (1 <= minCount <= numRotations):
+            raise ValueError(f"Invalid filter: numRotations={numRotations}, trim={trim}, minCount={minCount}")
+        self.numRotations = numRotations
+        self.mode = mode
+        self.trim = trim
+        self.angleBin = angleBin
+        self.minCount = minCount
+        self.numBins = int(np.ceil(360.0 / angleBin))
+        self.angles = np.radians((np.arange(self.numBins) + 0.5) * angleBin - 180.0)
+        self._rows = np.arange(self.numBins)
+        self._cols = np.arange(numRotations, dtype=np.int16)[None, :]
+        self._base = (self._rows.astype(np.int32) * numRotations)[:, None]
+        self.reset()
+
+    def reset(self):
+        self.ring = np.full((self.numRotations, self.numBins), np.inf, dtype=np.float32)
+        self.window = np.full((self.numBins, self.numRotations), np.inf, dtype=np.float32)
+        self.counts = np.zeros(self.numBins, dtype=np.int32)
+        self.intensities = np.zeros(self.numBins, dtype=np.int32)
+        self.head = 0
+
+    def _bin(self, angles, distances, intensities):
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float32)
+        valid = distances > 0
+        bins = ((np.degrees(angles[valid]) + 180.0) / self.angleBin).astype(np.int64) % self.numBins
+        current = np.full(self.numBins, np.inf, dtype=np.float32)
+        current[bins] = distances[valid]
+        if intensities is not None:
+            self.intensities[:] = 0
+            self.intensities[bins] = np.asarray(intensities)[valid]
+        return current
+
+    def update(self, angles, distances, intensities=None):
+        ''' Add a rotation (radians, meters) and return the filtered one, as a dict of arrays '''
+        new = self._bin(angles, distances, intensities)
+        old = self.ring[self.head].copy()
+        self.ring[self.head] = new
+        self.head = (self.head + 1) % self.numRotations
+        self.counts += np.isfinite(new).astype(np.int32) - np.isfinite(old).astype(np.int32)
+        self._insert(old, new)
+        filtered = self._median() if self.mode == 'median' else self._trimmedMean()
+        emit = self.counts >= self.minCount
+        return {'angles': self.angles[emit], 'distances': filtered[emit].astype(np.float32),
+                'intensities': self.intensities[emit]}
+
+    def _insert(self, old, new):
+        # remove the oldest value (at p) and insert the new one (at q), shifting what's between
+        j = self._cols
+        p = np.argmax(self.window == old[:, None], axis=1).astype(np.int16)
+        q = (np.count_nonzero(self.window < new[:, None], axis=1) - (old < new)).astype(np.int16)
+        pp = p[:, None]
+        qq = q[:, None]
+        src = (j + ((j >= pp) & (j < qq)) - ((j > qq) & (j <= pp))) + self._base
+        w = self.window.ravel()[src]
+        w[self._rows, q] = new
+        self.window = w
+
+    def _median(self):
+        counts = np.maximum(self.counts, 1)
+        return (self.window[self._rows, (counts - 1) // 2] + self.window[self._rows, counts // 2]) * 0.5
+
+    def _trimmedMean(self):
+        # N.B. a bin's returns are the first 'counts' values of its window
+        counts = np.maximum(self.counts, 1)
+        cut = (counts * self.trim).astype(np.int32)
+        keep = (self._cols >= cut[:, None]) & (self._cols < (counts - cut)[:, None])
+        return np.where(keep, self.window, 0.0).sum(axis=1) / (counts - (2 * cut))
+
+    def toDict(self):
+        return {'numRotations': self.numRotations, 'mode': self.mode, 'trim': self.trim,
+                'angleBin': self.angleBin, 'minCount': self.minCount}
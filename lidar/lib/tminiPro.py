@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Native YDLIDAR T-mini Pro Serial Protocol Driver
+#
+# Pure Python/NumPy alternative to the ydlidar SDK bindings.  The serial byte
+# stream is decoded a chunk at a time: packet headers are located with a
+# vectorized search, checksums are validated for all candidate packets at
+# once, and the samples are decoded straight into arrays (see section 3 of
+# the T-mini Pro Development Manual in lidar/docs/).
+#
+################################################################################
+
+import logging
+import time
+
+import numpy as np
+
+from ..shared import (MIN_ANGLE, MAX_ANGLE, MIN_SAMPLE_RATE, MAX_SAMPLE_RATE,
+                      MIN_SCAN_FREQ, MAX_SCAN_FREQ)
+from .asyncAcquire import AsyncAcquisition
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+
+#### TODO
+####  * check the CT CRC8 and decode the health/version info carried in CT[7:1]
+
+
+DEF_PORT_PATH = "/dev/ydlidar"
+DEF_BAUD_RATE = 230400
+DEF_MAX_ANGLE = 180.0   # degrees
+DEF_MIN_ANGLE = -180.0  # degrees
+DEF_SCAN_FREQ = 10.0    # Hz
+DEF_MAX_RANGE = 8.0     # meters
+DEF_MIN_RANGE = 0.02    # meters
+DEF_SAMPLE_RATE = 4     # KHz
+DEF_TIMEOUT = 2.0       # secs to wait for a rotation before giving up
+
+READ_SIZE = 4096
+HEADER_LEN = 10
+SAMPLE_LEN = 3
+PACKET_HEADER = 0x55AA
+RESPONSE_HEADER_LEN = 7
+
+CMD_START = b'\xA5\x60'
+CMD_STOP = b'\xA5\x65'
+CMD_DEVICE_INFO = b'\xA5\x90'
+CMD_HEALTH = b'\xA5\x92'
+CMD_FREQ_UP_TENTH = b'\xA5\x09'
+CMD_FREQ_DOWN_TENTH = b'\xA5\x0A'
+CMD_FREQ_UP_ONE = b'\xA5\x0B'
+CMD_FREQ_DOWN_ONE = b'\xA5\x0C'
+CMD_GET_FREQ = b'\xA5\x0D'
+
+# sample flag values (section 3.1.3)
+FLAG_SPECULAR = 2
+FLAG_AMBIENT = 3
+
+
+def findHeaders(buf):
+    ''' Return the offsets of all candidate packet headers (0xAA 0x55) in a uint8 array '''
+    return np.flatnonzero((buf[:-1] == 0xAA) & (buf[1:] == 0x55))
+
+def decodePackets(data):
+    ''' Decode all the valid packets in a chunk of the serial byte stream
+
+    Returns a tuple of (packets, samples, consumed), where 'packets' is a dict
+    of per-packet arrays ('start', 'ct', 'lsn'), 'samples' is a dict of
+    per-sample arrays ('angles' in degrees clockwise, 'distances' in mm,
+    'intensities', 'flags'), and 'consumed' is the number of leading bytes of
+    'data' that no longer need to be kept.
+    '''
+    buf = np.frombuffer(data, dtype=np.uint8)
+    allStarts = findHeaders(buf)
+    hasHeader = allStarts + HEADER_LEN <= len(buf)
+    starts = allStarts[hasHeader]
+
+    ct = buf[starts + 2]
+    lsn = buf[starts + 3].astype(np.int64)
+    fsa = buf[starts + 4].astype(np.uint16) | (buf[starts + 5].astype(np.uint16) << 8)
+    lsa = buf[starts + 6].astype(np.uint16) | (buf[starts + 7].astype(np.uint16) << 8)
+    cs = buf[starts + 8].astype(np.uint16) | (buf[starts + 9].astype(np.uint16) << 8)
+    ends = starts + HEADER_LEN + (SAMPLE_LEN * lsn)
+    complete = ends <= len(buf)
+
+    # checksums, one vectorized pass per distinct packet size
+    valid = np.zeros(len(starts), dtype=bool)
+    head = (PACKET_HEADER ^ ((lsn.astype(np.uint16) << 8) | ct) ^ fsa ^ lsa).astype(np.uint16)
+    for n in np.unique(lsn[complete]):
+        idx = np.flatnonzero(complete & (lsn == n))
+        offs = (starts[idx] + HEADER_LEN)[:, None] + np.arange(SAMPLE_LEN * n)
+        s = buf[offs].reshape(len(idx), n, SAMPLE_LEN).astype(np.uint16)
+        check = np.bitwise_xor.reduce(s[:, :, 0] ^ (s[:, :, 1] | (s[:, :, 2] << 8)), axis=1)
+        valid[idx] = (head[idx] ^ check) == cs[idx]
+
+    # keep non-overlapping packets, a false header inside a valid packet is skipped
+    selected = []
+    prevEnd = 0
+    for i in np.flatnonzero(valid):
+        if starts[i] >= prevEnd:
+            selected.append(i)
+            prevEnd = ends[i]
+    sel = np.array(selected, dtype=np.int64)
+    # keep from the first packet that may still be arriving, or just the last
+    # byte (which could be the first half of a header)
+    pending = np.concatenate((allStarts[~hasHeader], starts[~complete]))
+    pending = pending[pending >= prevEnd]
+    consumed = int(pending.min()) if len(pending) else max(int(prevEnd), len(buf) - 1)
+
+    counts = lsn[sel]
+    total = int(counts.sum())
+    pktIdx = np.repeat(np.arange(len(sel)), counts)
+    within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    base = np.repeat(starts[sel] + HEADER_LEN, counts) + (SAMPLE_LEN * within)
+    s0 = buf[base]
+    s1 = buf[base + 1]
+    s2 = buf[base + 2]
+
+    fsaDeg = (fsa[sel] >> 1) / 64.0
+    lsaDeg = (lsa[sel] >> 1) / 64.0
+    diff = (lsaDeg - fsaDeg) % 360.0
+    step = np.where(counts > 1, diff / np.maximum(counts - 1, 1), 0.0)
+    angles = (fsaDeg[pktIdx] + (step[pktIdx] * within)) % 360.0
+
+    packets = {'start': (ct[sel] & 0x01).astype(bool), 'ct': ct[sel], 'lsn': counts}
+    samples = {'angles': angles,
+               'distances': (s2.astype(np.uint16) << 6) | (s1 >> 2),
+               'intensities': s0,
+               'flags': s1 & 0x03}
+    return packets, samples, consumed
+
+def encodePacket(angles, distances, intensities, flags=None, ct=0):
+    ''' Encode samples (degrees clockwise, mm) as one T-mini Pro packet '''
+    angles = np.asarray(angles, dtype=np.float64)
+    distances = np.asarray(distances, dtype=np.uint16)
+    if flags is None:
+        flags = np.zeros(len(angles), dtype=np.uint16)
+    n = len(angles)
+    quantize = lambda a: ((int(round((a % 360.0) * 64.0)) & 0x7FFF) << 1) | 0x01
+    fsa = quantize(angles[0])
+    lsa = quantize(angles[-1])
+    s = np.empty((n, SAMPLE_LEN), dtype=np.uint8)
+    s[:, 0] = np.asarray(intensities, dtype=np.uint8)
+    s[:, 1] = ((distances & 0x3F) << 2) | (np.asarray(flags, dtype=np.uint16) & 0x03)
+    s[:, 2] = distances >> 6
+    su = s.astype(np.uint16)
+    check = int(np.bitwise_xor.reduce(su[:, 0] ^ (su[:, 1] | (su[:, 2] << 8))))
+    cs = PACKET_HEADER ^ ((n << 8) | ct) ^ fsa ^ lsa ^ check
+    header = bytes([0xAA, 0x55, ct, n, fsa & 0xFF, fsa >> 8, lsa & 0xFF, lsa >> 8,
+                    cs & 0xFF, cs >> 8])
+    return header + s.tobytes()
+
+def encodeRotation(angles, distances, intensities, flags=None, scanFreq=DEF_SCAN_FREQ,
+                   packetSize=40):
+    ''' Encode a rotation (degrees clockwise, mm) as the device would send it
+
+    That is, a CRC byte and a zero packet carrying the first sample, followed
+    by data packets of up to 'packetSize' samples.  Used to build recorded
+    streams and byte-stream emulators.
+    '''
+    if flags is None:
+        flags = np.zeros(len(angles), dtype=np.uint16)
+    out = bytearray(b'\x00')
+    out += encodePacket(angles[:1], distances[:1], intensities[:1], flags[:1],
+                        ct=((int(round(scanFreq * 10)) << 1) & 0xFE) | 0x01)
+    for i in range(1, len(angles), packetSize):
+        out += encodePacket(angles[i:i + packetSize], distances[i:i + packetSize],
+                            intensities[i:i + packetSize], flags[i:i + packetSize])
+    return bytes(out)
+
+
+class RotationAssembler():
+    ''' Turn a T-mini Pro byte stream into complete rotations of sample arrays
+
+    Rotations are returned as dicts of arrays in the same units as the SDK's
+    LaserScan: 'angles' in radians (wrapped to [-pi, pi)), 'distances' in
+    meters, plus 'intensities', 'flags', 'stamp', and 'scanFreq' (as reported
+    by the zero packet).
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.parts = None   # None until the first zero packet has been seen
+        self.scanFreq = None
+        self.numRotations = 0
+        self.numBytes = 0
+
+    def feed(self, data):
+        self.numBytes += len(data)
+        self.buffer += data
+        packets, samples, consumed = decodePackets(bytes(self.buffer))
+        del self.buffer[:consumed]
+
+        rotations = []
+        if len(packets['lsn']) == 0:
+            return rotations
+        # split the samples at each zero packet
+        firsts = np.concatenate(([0], np.cumsum(packets['lsn'])[:-1]))
+        cuts = firsts[packets['start']]
+        freqs = (packets['ct'][packets['start']] >> 1) / 10.0
+        pieces = np.split(np.arange(len(samples['angles'])), cuts)
+        for i, piece in enumerate(pieces):
+            if i > 0:
+                if self.parts:
+                    rotations.append(self._assemble())
+                self.parts = []
+                if freqs[i - 1] > 0:
+                    self.scanFreq = float(freqs[i - 1])
+            if (self.parts is not None) and len(piece):
+                self.parts.append({k: v[piece] for k, v in samples.items()})
+        return rotations
+
+    def _assemble(self):
+        self.numRotations += 1
+        rot = {k: np.concatenate([p[k] for p in self.parts]) for k in self.parts[0]}
+        rad = np.radians(rot['angles'])
+        rot['angles'] = np.where(rad >= np.pi, rad - (2 * np.pi), rad)
+        rot['distances'] = rot['distances'] / 1000.0
+        rot['stamp'] = time.time()
+        rot['scanFreq'] = self.scanFreq
+        return rot
+
+
+class TminiProLidar(AsyncAcquisition):
+    ''' Native driver with the same public surface as lib/lidar.py's Lidar '''
+    LIDAR_VERSION = "1.3.0"  # N.B. Must match lidar.py library's version
+
+    def __init__(self, **kwargs):
+        self.port = kwargs.get('port', None) or DEF_PORT_PATH
+        self.baud = kwargs.get('baud', DEF_BAUD_RATE)
+        self.scanFreq = kwargs.get('scanFreq', DEF_SCAN_FREQ)
+        self.sampleRate = kwargs.get('sampleRate', DEF_SAMPLE_RATE)
+        self.maxAngle = kwargs.get('maxAngle', DEF_MAX_ANGLE)
+        self.minAngle = kwargs.get('minAngle', DEF_MIN_ANGLE)
+        self.maxRange = kwargs.get('maxRange', DEF_MAX_RANGE)
+        self.minRange = kwargs.get('minRange', DEF_MIN_RANGE)
+        self.zeroFilter = kwargs.get('zeroFilter', True)
+        self.timeout = kwargs.get('timeout', DEF_TIMEOUT)
+        self.numScans = None
+        self.scanning = False
+        self.streaming = False
+        self.deviceInfo = None
+        self.assembler = RotationAssembler()
+        self.rotations = []
+
+        if serial is None:
+            raise RuntimeError("The native T-mini Pro driver requires pyserial")
+        # N.B. 'device' may be any file-like serial stand-in (e.g., a pty)
+        self.device = kwargs.get('device', None)
+        if self.device is None:
+            self.device = serial.Serial(self.port, self.baud, timeout=0.1)
+        logging.debug(f"Port: {self.port}")
+
+        self._write(CMD_STOP)
+        time.sleep(0.05)
+        self._flush()
+        self.deviceInfo = self._getDeviceInfo()
+        if self.setScanFreq(self.scanFreq) or self.setSampleRate(self.sampleRate) or \
+           self.setAngles(self.minAngle, self.maxAngle) or \
+           self.setRanges(self.minRange, self.maxRange):
+            raise ValueError("Invalid lidar options")
+
+    def _write(self, data):
+        self.device.write(data)
+        if hasattr(self.device, 'flush'):
+            self.device.flush()
+
+    def _flush(self):
+        if hasattr(self.device, 'reset_input_buffer'):
+            self.device.reset_input_buffer()
+        self.assembler = RotationAssembler()
+        self.rotations = []
+
+    def _response(self, cmd, length):
+        ''' Send a single-response command and return its content (or None) '''
+        if self.scanning:
+            logging.error("Can't issue commands while scanning")
+            return None
+        self._write(cmd)
+        data = bytearray()
+        deadline = time.monotonic() + 0.5
+        while (len(data) < RESPONSE_HEADER_LEN + length) and (time.monotonic() < deadline):
+            data += self.device.read(RESPONSE_HEADER_LEN + length - len(data))
+        i = data.find(b'\xA5\x5A')
+        if (i < 0) or (len(data) < i + RESPONSE_HEADER_LEN + length):
+            logging.warning(f"No response to command: {cmd.hex()}")
+            return None
+        return bytes(data[i + RESPONSE_HEADER_LEN:i + RESPONSE_HEADER_LEN + length])
+
+    def _getDeviceInfo(self):
+        content = self._response(CMD_DEVICE_INFO, 20)
+        if not content:
+            return None
+        return {'model': content[0], 'firmware': f"{content[1]}.{content[2]}",
+                'hardware': content[3], 'serialNumber': content[4:].hex()}
+
+    def _getDeviceFreq(self):
+        content = self._response(CMD_GET_FREQ, 4)
+        if not content:
+            return None
+        return int.from_bytes(content, 'little') / 100.0
+
+    def _setDeviceFreq(self, scanFreq):
+        # the device can only step its frequency, in 1Hz and 0.1Hz increments
+        current = self._getDeviceFreq()
+        if current is None:
+            return True
+        steps = int(round((scanFreq - current) * 10))
+        for count, cmd in ((abs(steps) // 10, CMD_FREQ_UP_ONE if steps > 0 else CMD_FREQ_DOWN_ONE),
+                           (abs(steps) % 10, CMD_FREQ_UP_TENTH if steps > 0 else CMD_FREQ_DOWN_TENTH)):
+            for _ in range(count):
+                if self._response(cmd, 4) is None:
+                    return True
+        return False
+
+    def readRotation(self, timeout=None):
+        ''' Return the next complete rotation as a dict of arrays, or None on timeout '''
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while not self.rotations:
+            if time.monotonic() > deadline:
+                return None
+            waiting = getattr(self.device, 'in_waiting', 0)
+            data = self.device.read(max(waiting, READ_SIZE) if waiting else READ_SIZE)
+            if data:
+                self.rotations += self.assembler.feed(data)
+        return self._filter(self.rotations.pop(0))
+
+    def _filter(self, rot):
+        keep = (rot['angles'] >= np.radians(self.minAngle)) & (rot['angles'] <= np.radians(self.maxAngle))
+        outOfRange = (rot['distances'] < self.minRange) | (rot['distances'] > self.maxRange)
+        rot['distances'] = np.where(outOfRange, 0.0, rot['distances'])
+        if self.zeroFilter:
+            keep &= rot['distances'] > 0
+        for k in ('angles', 'distances', 'intensities', 'flags'):
+            rot[k] = rot[k][keep]
+        return rot
+
+    def laserEnable(self, enable):
+        if enable:
+            if not self.scanning:
+                self._flush()
+                self._write(CMD_START)
+                self.scanning = True
+        else:
+            if self.scanning:
+                self._write(CMD_STOP)
+                self.scanning = False
+                time.sleep(0.05)
+                self._flush()
+            self.streaming = False
+        return False
+
+    def _acquireOnce(self, names):
+        if (self.device is None) or (not self.scanning):
+            return None
+        rot = self.readRotation()
+        if rot is None:
+            return None
+        # N.B. the rotation's arrays are handed on as they are, they're only made lists when serialized
+        return {name: rot[name] for name in names if name in rot}
+
+    def _recover(self):
+        if (self.device is not None) and (not self.scanning):
+            self.laserEnable(True)
+
+    def scan(self, names=['angles', 'distances', 'intensities']):
+        self.streaming = False
+        wasScanning = self.scanning
+        self.laserEnable(True)
+        rot = self.readRotation()
+        if not wasScanning:
+            self.laserEnable(False)
+        if rot is None:
+            logging.error("Timed out waiting for a rotation")
+            return None
+        # N.B. the (sync) scan's values are lists, as they've always been
+        return {name: rot[name].tolist() for name in names}
+
+    def stream(self, names):
+        self.streaming = True
+        self.numScans = 0
+        while self.streaming:
+            self.numScans += 1
+            rot = self.readRotation()
+            if rot is None:
+                yield None
+                continue
+            yield {name: rot[name] for name in names}
+
+    def status(self):
+        stat = {'laser': True, 'ok': self.device is not None, 'scanning': self.scanning,
+                'streaming': self.streaming, 'numScans': self.numScans,
+                'minAngle': self.minAngle, 'maxAngle': self.maxAngle,
+                'minRange': self.minRange, 'maxRange': self.maxRange,
+                'scanFreq': self.scanFreq, 'sampleRate': self.sampleRate,
+                'driver': 'native', 'deviceInfo': self.deviceInfo,
+                'measuredScanFreq': self.assembler.scanFreq}
+        return stat
+
+    def setAngles(self, minAngle, maxAngle):
+        if minAngle >= maxAngle:
+            logging.error(f"Invalid minAngle and maxAngle pair ({minAngle} >= {maxAngle}))")
+            return True
+        return self.setMinAngle(minAngle) or self.setMaxAngle(maxAngle)
+
+    def setMinAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid minAngle ({angle})")
+            return True
+        self.minAngle = angle
+        return False
+
+    def setMaxAngle(self, angle):
+        if (angle > MAX_ANGLE) or (angle < MIN_ANGLE):
+            logging.error(f"Invalid maxAngle ({angle})")
+            return True
+        self.maxAngle = angle
+        return False
+
+    def getAngles(self):
+        return self.maxAngle, self.minAngle
+
+    def setRanges(self, minRange, maxRange):
+        if minRange >= maxRange:
+            logging.error(f"Invalid minRange and maxRange pair ({minRange} >= {maxRange}))")
+            return True
+        return self.setMinRange(minRange) or self.setMaxRange(maxRange)
+
+    def setMinRange(self, range):
+        if (range > 1000) or (range <= 0):    #### FIXME
+            logging.error(f"Invalid minRange ({range})")
+            return True
+        self.minRange = range
+        return False
+
+    def setMaxRange(self, range):
+        if (range > 1000) or (range < 0):    #### FIXME
+            logging.error(f"Invalid maxRange ({range})")
+            return True
+        self.maxRange = range
+        return False
+
+    def getRanges(self):
+        return self.maxRange, self.minRange
+
+    def setScanFreq(self, scanFreq):
+        if (scanFreq > MAX_SCAN_FREQ) or (scanFreq < MIN_SCAN_FREQ):
+            logging.error(f"Invalid scan frequency ({scanFreq})")
+            return True
+        # N.B. the device only takes frequency commands while stopped, so pause scanning
+        wasScanning = self.scanning
+        if wasScanning:
+            self.laserEnable(False)
+        self.scanFreq = scanFreq
+        if self._setDeviceFreq(scanFreq):
+            logging.warning("Failed to set the device's scan frequency")
+        if wasScanning:
+            streaming = self.streaming
+            self.laserEnable(True)
+            self.streaming = streaming
+        return False
+
+    def getScanFreq(self):
+        return self.scanFreq
+
+    def setSampleRate(self, sampleRate):
+        # N.B. the T-mini Pro's sample rate is fixed, so this is only validated
+        if (sampleRate > MAX_SAMPLE_RATE) or (sampleRate < MIN_SAMPLE_RATE):
+            logging.error(f"Invalid sample rate ({sampleRate})")
+            return True
+        self.sampleRate = sampleRate
+        return False
+
+    def getSampleRate(self):
+        return self.sampleRate
+
+    def getVersion(self):
+        return TminiProLidar.LIDAR_VERSION
+
+    def done(self):
+        self.streaming = False
+        self._shutdownExecutor()
+        res = self.laserEnable(False)
+        if hasattr(self.device, 'close'):
+            self.device.close()
+        self.device = None
+        return not res
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Duty-Cycled Watch Mode
+#
+# For battery/solar powered sensor nodes: the motor and laser sleep, and wake
+# up every 'period' secs for a burst of a few rotations.  The burst is compared
+# with the stored background, and the device goes back to sleep if nothing
+# changed, or hands over to continuous streaming if there's an intrusion.
+# Runs as a task on the asyncio loop of the server that owns the device.
+#
+################################################################################
+
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+from .scanRate import ActivityDetector, DEF_ACTIVE_BINS
+
+
+DEF_PERIOD = 10.0       # secs asleep between bursts
+DEF_BURST = 3           # rotations per burst
+DEF_MIN_HITS = 2        # active rotations in a burst that count as an intrusion
+DEF_WAKE_TIMEOUT = 5.0  # secs, allows for the motor spinning up
+
+# from the device's data sheet
+SUPPLY_VOLTAGE = 5.0    # volts
+WORKING_CURRENT = 0.34  # amps (typical)
+SLEEP_CURRENT = 0.045   # amps (max)
+
+
+class WatchMode():
+    def __init__(self, period=DEF_PERIOD, burst=DEF_BURST, minHits=DEF_MIN_HITS,
+                 activeBins=DEF_ACTIVE_BINS, **kwargs):
+        if (period <= 0) or (burst < 1) or (minHits < 1) or (minHits > burst):
+            raise ValueError(f"Invalid watch mode: period={period}, burst={burst}, minHits={minHits}")
+        self.period = period
+        self.burst = burst
+        self.minHits = minHits
+        self.activeBins = activeBins
+        self.detector = ActivityDetector(**kwargs)
+        self.task = None
+        self.numCycles = 0
+        self.numIntrusions = 0
+        self.numUnlearned = 0       # bursts with some activity, which the background didn't learn from
+        self.cycleTime = None       # secs awake in the last wake/sleep cycle
+        self.detectionLatency = None  # secs from waking to detecting the last intrusion
+        self.awakeTime = 0.0
+        self.asleepTime = 0.0
+
+    def toDict(self):
+        return {'period': self.period, 'burst': self.burst, 'minHits': self.minHits}
+
+    def start(self, scanner, onIntrusion):
+        ''' Start watching, calls onIntrusion() (with the laser left on) when something shows up '''
+        self.stop()
+        self.task = asyncio.get_running_loop().create_task(self._run(scanner, onIntrusion))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+        self.task = None
+
+    def running(self):
+        return self.task is not None
+
+    async def _burst(self, scanner):
+        ''' Returns the number of active rotations in a burst, or None on failure
+
+        N.B. the background only learns from bursts without any active rotations, so something that
+         shows up in fewer than 'minHits' of a burst's rotations (e.g., a critter sitting still) isn't
+         absorbed into it
+        '''
+        hits = 0
+        rotations = []
+        for _ in range(self.burst):
+            result = await scanner.ascan(['angles', 'distances'], timeout=DEF_WAKE_TIMEOUT)
+            if not result['ok']:
+                logging.warning(f"Watch: failed to get a rotation ({result['error']})")
+                return None
+            current = self.detector.binned(result['values']['angles'], result['values']['distances'])
+            if np.count_nonzero(self.detector.foreground(current)) >= self.activeBins:
+                hits += 1
+            rotations.append(current)
+        if hits == 0:
+            for current in rotations:
+                self.detector.updateBinned(current)
+        else:
+            self.numUnlearned += 1
+        return hits
+
+    async def _run(self, scanner, onIntrusion):
+        while True:
+            await scanner.acall(scanner.laserEnable, False)
+            start = time.monotonic()
+            await asyncio.sleep(self.period)
+            wake = time.monotonic()
+            self.asleepTime += wake - start
+
+            hits = None
+            if await scanner.acall(scanner.laserEnable, True):
+                logging.error("Watch: failed to turn the laser on")
+            else:
+                hits = await self._burst(scanner)
+            now = time.monotonic()
+            self.cycleTime = now - wake
+            self.awakeTime += self.cycleTime
+            self.numCycles += 1
+            if (hits is not None) and (hits >= self.minHits):
+                self.detectionLatency = now - wake
+                self.numIntrusions += 1
+                self.task = None
+                logging.info(f"Watch: intrusion ({hits}/{self.burst} active rotations)")
+                onIntrusion()
+                return
+
+    def energyPerHour(self):
+        ''' Estimated energy (Wh) per hour at the measured duty cycle '''
+        total = self.awakeTime + self.asleepTime
+        duty = (self.awakeTime / total) if total else 0.0
+        return SUPPLY_VOLTAGE * ((WORKING_CURRENT * duty) + (SLEEP_CURRENT * (1.0 - duty)))
+
+    def status(self):
+        total = self.awakeTime + self.asleepTime
+        return {'watching': self.running(), 'watchCycles': self.numCycles,
+                'watchIntrusions': self.numIntrusions, 'watchUnlearned': self.numUnlearned,
+                'watchCycleTime': self.cycleTime, 'watchPeriod': self.period,
+                'watchDutyCycle': (self.awakeTime / total) if total else None,
+                'watchDetectionLatency': self.detectionLatency,
+                'watchWorstLatency': self.period + (self.cycleTime or 0.0),
+                'watchEnergyPerHour': round(self.energyPerHour(), 3)}
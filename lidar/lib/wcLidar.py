@@ -6,18 +6,28 @@
 ################################################################################
 
 import asyncio
+from collections import deque
 from enum import Enum
 import json
 import logging
 #from queue import Queue
+import random
 import threading
+import time
+import urllib.parse
 import websockets
 
 from ..shared import MessageTypes, Commands
+from .frameBatcher import splitFrames
+from .replayBuffer import frameSeq, frameStream, frameEpoch
 
 
 DEF_PING = 20
 
+DEF_RECONNECT_MIN = 0.1     # secs, first wait before reconnecting the data socket, doubled on each failure
+DEF_RECONNECT_MAX = 5.0     # secs, longest wait before reconnecting
+DEF_DATA_TIMEOUT = 5.0      # secs without data while streaming before the data socket's taken to be dead
+
 DEF_SCAN_NAMES = ['angles', 'distances', 'intensities']
 
 
@@ -32,32 +42,123 @@ class LidarClient():
         self.dataURI = f"ws://{hostname}:{dataPort}"
         self.inited = False
         self.streaming = False
+        self.closing = False
         self.msgQ = asyncio.Queue()
-        self.thread = threading.Thread(target=self._runStreamReader)
+        # the last data frame's sequence number, a reconnected data socket resumes after it
+        self.lastSeq = None
+        self.epoch = None       # the server's epoch that lastSeq is from
+        self.streamId = None    # the filtered stream the data socket's for, None for the unfiltered one
+        self.dataSocket = None
+        self.readerLoop = None
+        self.numReconnects = 0
+        self.numGaps = 0
+        self.numMissed = 0
+        self.resumeTimes = deque(maxlen=100)
+        self.thread = threading.Thread(target=self._runStreamReader, daemon=True)
         self.thread.start()
 
     def _runStreamReader(self):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self.readerLoop = loop
         loop.run_until_complete(self._streamReader())
 
+    async def _queueFrames(self, message):
+        # N.B. a message can hold several (coalesced) frames, they're queued one by one
+        for frame in splitFrames(message):
+            seq = frameSeq(frame)
+            if seq is None:
+                gap = json.loads(frame)
+                if gap.get('type') == MessageTypes.GAP.value:
+                    self.numGaps += 1
+                    if gap.get('epoch', self.epoch) != self.epoch:
+                        # the server restarted, how many frames were missed isn't known
+                        logging.warning(f"Server restarted, missed data frames after {gap['after']}, "
+                                        f"resuming at {gap['next']}")
+                        self.epoch = gap['epoch']
+                    else:
+                        # frames were evicted from the server's replay buffer before we got them
+                        logging.warning(f"Missed data frames after {gap['after']}, resuming at {gap['next']}")
+                        self.numMissed += max(0, gap['next'] - gap['after'] - 1)
+                    self.lastSeq = gap['next'] - 1
+            elif (self.lastSeq is not None) and (seq <= self.lastSeq) and (frameEpoch(frame) == self.epoch):
+                continue
+            else:
+                self.lastSeq = seq
+                self.epoch = frameEpoch(frame)
+                # N.B. another stream's data frames come in until the data socket's reconnected for this one
+                if (frameStream(frame) != self.streamId) and \
+                   (json.loads(frame).get('type') == MessageTypes.REPLY.value):
+                    continue
+            await self.msgQ.put(frame)
+
+    def _dataURI(self):
+        params = {}
+        if self.lastSeq is not None:
+            params['resume'] = self.lastSeq
+            if self.epoch is not None:
+                params['epoch'] = self.epoch
+        if self.streamId is not None:
+            params['stream'] = self.streamId
+        return f"{self.dataURI}/?{urllib.parse.urlencode(params)}" if params else self.dataURI
+
+    def _switchStream(self, streamId):
+        ''' Reconnect the data socket for another stream's frames '''
+        self.streamId = streamId
+        dataSocket, loop = self.dataSocket, self.readerLoop
+        if dataSocket and loop:
+            loop.call_soon_threadsafe(dataSocket.transport.abort)
+
     async def _streamReader(self):
         print("STREAMREADER")
-        try:
-            async with websockets.connect(self.dataURI, ping_interval=DEF_PING, ping_timeout=DEF_PING) as dataSocket:
-                while True:
-                    try:
-                        response = await dataSocket.recv()
-                        print(f"STREAMREADER: {type(response)}")
-                        if response:
-                            await self.msgQ.put(response)
-                        else:
-                            break
-                    except websockets.exceptions.ConnectionClosed:
-                        print("DATA CONNECTION CLOSED")  #### FIXME
-                print("STREAMING break")
-        except ConnectionRefusedError as ex:
-            logging.error(f"Unable to connect to lidar server data socket: {ex}")
+        delay = DEF_RECONNECT_MIN
+        lost = received = None
+        while not self.closing:
+            uri = self._dataURI()
+            try:
+                async with websockets.connect(uri, ping_interval=DEF_PING, ping_timeout=DEF_PING) as dataSocket:
+                    self.dataSocket = dataSocket
+                    delay = DEF_RECONNECT_MIN
+                    if not self.streaming:
+                        lost = None
+                    while not self.closing:
+                        try:
+                            response = await asyncio.wait_for(dataSocket.recv(), DEF_DATA_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            if self.streaming:
+                                logging.warning("No data while streaming, reconnecting data socket")
+                                # N.B. don't wait for a closing handshake on a dead connection
+                                dataSocket.transport.abort()
+                                break
+                            continue
+                        received = time.monotonic()
+                        if lost is not None:
+                            # time-to-resume: from the last data before the data socket was lost to the first after
+                            self.resumeTimes.append(received - lost)
+                            lost = None
+                        await self._queueFrames(response)
+            except websockets.exceptions.ConnectionClosed:
+                logging.info("Data connection closed")
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as ex:
+                logging.error(f"Unable to connect to lidar server data socket: {ex}")
+            if self.closing:
+                break
+            if lost is None:
+                lost = received or time.monotonic()
+            self.numReconnects += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(2 * delay, DEF_RECONNECT_MAX)
+        print("STREAMING break")
+
+    def close(self):
+        ''' Stop (re)connecting the data socket '''
+        self.closing = True
+
+    def streamStatus(self):
+        times = [t * 1000.0 for t in self.resumeTimes]
+        return {'lastSeq': self.lastSeq, 'epoch': self.epoch, 'reconnects': self.numReconnects, 'gaps': self.numGaps,
+                'missed': self.numMissed, 'resumeLastMs': round(times[-1], 1) if times else None,
+                'resumeMeanMs': round(sum(times) / len(times), 1) if times else None}
 
     async def _sendHalt(self):
         try:
@@ -169,16 +270,20 @@ class LidarClient():
             return None
         return response['values']
 
-    async def scan(self, names=DEF_SCAN_NAMES):
+    async def scan(self, names=DEF_SCAN_NAMES, maxAgeMs=None):
         logging.info("SCAN")
-        response = await self._sendCmd(Commands.SCAN.value, {'names': names})
+        args = {'names': names}
+        if maxAgeMs is not None:
+            # accept a cached rotation up to this old, doesn't stop streaming
+            args['maxAgeMs'] = maxAgeMs
+        response = await self._sendCmd(Commands.SCAN.value, args)
         if (response == None) or ('values' not in response):
             print("ERROR: xxx") #### TMP TMP TMP
             return None
 #        print(f"SCAN: {response['values']}")
         return response['values']
 
-    async def stream(self, names=DEF_SCAN_NAMES):
+    async def stream(self, names=DEF_SCAN_NAMES, filter=None, batch=None):
         logging.info("STREAM")
         if self.streaming:
             logging.error("Already Streaming, can't start another stream")
@@ -191,15 +296,27 @@ class LidarClient():
                 break
         print("STREAM READY TO START")
 
-        response = await self._sendCmd(Commands.STREAM.value, {'names': names})
+        args = {'names': names}
+        if filter:
+            # e.g., {'numRotations': 5, 'mode': 'median'}, see TemporalFilter
+            args['filter'] = filter
+        if batch:
+            # e.g., {'maxLatencyMs': 20}, coalesce frames while the link is backed up, see FrameBatcher
+            args['batch'] = batch
+        response = await self._sendCmd(Commands.STREAM.value, args)
         if response == None:
             print("STREAM start failed")
             return True
         print("STREAMING STARTED")
+        # N.B. a filtered stream's frames are only sent to data sockets connected for it
+        streamId = response.get('stream') or None
+        if streamId != self.streamId:
+            self._switchStream(streamId)
         self.streaming = True
         return False
 
     async def getScan(self):
+        ''' The next data frame (JSON), a 'gap' frame says which frames were missed while reconnecting '''
         if not self.streaming:
             logging.error("Not streaming")
             return None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Precompiled Zone Masks Library
+#
+# User-defined polygonal zones (in the sensor frame, meters), each with a kind
+# (exclude, alert, watch) and per-zone thresholds.  Zones are compiled into a
+# single (angle bin x range bin) lookup table holding one bit per zone, so
+# labelling every point of a rotation is a vectorized gather.  The bins are
+# labelled by the region classifier (see regionClassify.py), and changing a
+# zone only re-rasterizes that zone's bit.
+#
+################################################################################
+
+import logging
+import numpy as np
+
+from ..shared import MAX_RANGE, MIN_ANGLE_RESOLUTION
+from .modelStore import loadModel, saveModel
+from .regionClassify import RegionClassifier
+
+
+ZONE_KINDS = ('exclude', 'alert', 'watch')
+MAX_ZONES = 32
+RASTER_VERSION = 3  # N.B. saved tables compiled by another version of the rasterizer are recompiled
+
+DEF_ANGLE_BIN = MIN_ANGLE_RESOLUTION / 2  # degrees
+DEF_RANGE_BIN = 0.02                      # meters
+DEF_THRESHOLDS = {'minPoints': 1, 'minIntensity': 0}
+
+
+class Zone():
+    def __init__(self, name, polygon, kind='watch', thresholds=None):
+        if kind not in ZONE_KINDS:
+            raise ValueError(f"Invalid zone kind: {kind}")
+        polygon = np.asarray(polygon, dtype=np.float64)
+        if (polygon.ndim != 2) or (polygon.shape[1] != 2) or (len(polygon) < 3):
+            raise ValueError(f"Invalid zone polygon: {name}")
+        self.name = name
+        self.polygon = polygon
+        self.kind = kind
+        self.thresholds = DEF_THRESHOLDS | dict(thresholds or {})
+
+    @classmethod
+    def fromDict(cls, name, d):
+        return cls(name, d['polygon'], d.get('kind', 'watch'), d.get('thresholds'))
+
+    def toDict(self):
+        return {'polygon': self.polygon.tolist(), 'kind': self.kind,
+                'thresholds': dict(self.thresholds)}
+
+
+class ZoneMap():
+    ''' Zones compiled into a lookup table of zone bits per (angle bin, range bin) '''
+    def __init__(self, angleBin=DEF_ANGLE_BIN, rangeBin=DEF_RANGE_BIN, maxRange=MAX_RANGE):
+        self.angleBin = angleBin
+        self.rangeBin = rangeBin
+        self.maxRange = maxRange
+        self.numAngleBins = int(np.ceil(360.0 / angleBin))
+        self.numRangeBins = int(np.ceil(maxRange / rangeBin))
+        self.table = np.zeros((self.numAngleBins, self.numRangeBins), dtype=np.uint32)
+        self.zones = {}
+        self.bits = {}
+        self.classifier = RegionClassifier(wedge=angleBin)
+        self._bins = None   # the bin centers as the classifier's points, made when a zone's first compiled
+        self.excludeMask = np.uint32(0)
+
+    @classmethod
+    def fromConfig(cls, conf, **kwargs):
+        zoneMap = cls(**kwargs)
+        for name, d in (conf or {}).items():
+            zoneMap.setZone(Zone.fromDict(name, d))
+        return zoneMap
+
+    def toConfig(self):
+        return {name: zone.toDict() for name, zone in self.zones.items()}
+
+    def _geometry(self):
+        return {'angleBin': self.angleBin, 'rangeBin': self.rangeBin, 'maxRange': self.maxRange,
+                'raster': RASTER_VERSION}
+
+    def save(self, path):
+        ''' Persist the compiled table, with the zones it was compiled from, returns True on error '''
+        return saveModel(path, 'zones', {'table': self.table},
+                         self._geometry() | {'zones': self.toConfig(), 'bits': self.bits})
+
+    @classmethod
+    def load(cls, path, conf, **kwargs):
+        ''' Return the saved zone map if it was compiled from 'conf' (with the same bins), else None
+
+        N.B. the table is memory-mapped copy-on-write, so changing zones doesn't touch the file
+        '''
+        zoneMap = cls(**kwargs)
+        zones = {name: Zone.fromDict(name, d) for name, d in (conf or {}).items()}
+        model = loadModel(path, 'zones', zoneMap._geometry() |
+                          {'zones': {name: zone.toDict() for name, zone in zones.items()}})
+        if model is None:
+            return None
+        arrays, meta = model
+        if arrays['table'].shape != zoneMap.table.shape:
+            logging.warning(f"Ignoring zones model '{path}': table is the wrong shape")
+            return None
+        zoneMap.table = arrays['table']
+        zoneMap.zones = zones
+        zoneMap.bits = dict(meta['bits'])
+        for zone in zones.values():
+            zoneMap.classifier.setZone(zone.name, zone.polygon)
+        zoneMap._updateMasks()
+        return zoneMap
+
+    def _rasterize(self, zone):
+        ''' Return the (angle bin x range bin) cells whose centers fall in the zone '''
+        if self._bins is None:
+            thetas = np.radians((np.arange(self.numAngleBins) + 0.5) * self.angleBin - 180.0)
+            ranges = (np.arange(self.numRangeBins) + 0.5) * self.rangeBin
+            self._bins = self.classifier.points(np.repeat(thetas, self.numRangeBins),
+                                                np.tile(ranges, self.numAngleBins))
+        self.classifier.setZone(zone.name, zone.polygon)
+        return self.classifier.inZone(zone.name, points=self._bins).reshape(self.table.shape)
+
+    def setZone(self, zone):
+        ''' Add or replace a zone, recompiling only that zone's bit '''
+        if zone.name in self.bits:
+            bit = self.bits[zone.name]
+        else:
+            used = set(self.bits.values())
+            free = [b for b in range(MAX_ZONES) if b not in used]
+            if not free:
+                logging.error(f"Too many zones, ignoring: {zone.name}")
+                return True
+            bit = free[0]
+        mask = np.uint32(1 << bit)
+        self.table &= ~mask
+        self.table[self._rasterize(zone)] |= mask
+        self.zones[zone.name] = zone
+        self.bits[zone.name] = bit
+        self._updateMasks()
+        return False
+
+    def removeZone(self, name):
+        if name not in self.zones:
+            logging.warning(f"No such zone: {name}")
+            return True
+        self.table &= ~np.uint32(1 << self.bits[name])
+        self.classifier.removeZone(name)
+        del self.zones[name]
+        del self.bits[name]
+        self._updateMasks()
+        return False
+
+    def _updateMasks(self):
+        mask = 0
+        for name, zone in self.zones.items():
+            if zone.kind == 'exclude':
+                mask |= 1 << self.bits[name]
+        self.excludeMask = np.uint32(mask)
+
+    def labels(self, angles, distances):
+        ''' Return the zone bits of each point (radians, meters) '''
+        angles = np.asarray(angles, dtype=np.float64)
+        distances = np.asarray(distances, dtype=np.float64)
+        a = ((np.degrees(angles) + 180.0) / self.angleBin).astype(np.int64) % self.numAngleBins
+        r = (distances / self.rangeBin).astype(np.int64)
+        valid = (distances > 0) & (r < self.numRangeBins)
+        out = np.zeros(len(a), dtype=np.uint32)
+        out[valid] = self.table[a[valid], r[valid]]
+        return out
+
+    def classify(self, angles, distances, intensities=None, mask=None):
+        ''' Label a rotation and evaluate each zone's thresholds
+
+        Returns (labels, keep, results), where 'keep' is False for points in
+        exclude zones, and 'results' maps each non-exclude zone name to its
+        point count and whether it triggered.  If 'mask' is given (e.g., the
+        foreground points), only those points count toward the thresholds.
+        '''
+        labels = self.labels(angles, distances)
+        keep = (labels & self.excludeMask) == 0
+        counting = keep if mask is None else (keep & np.asarray(mask, dtype=bool))
+        results = {}
+        for name, zone in self.zones.items():
+            if zone.kind == 'exclude':
+                continue
+            inZone = counting & ((labels & np.uint32(1 << self.bits[name])) != 0)
+            if (intensities is not None) and zone.thresholds['minIntensity']:
+                inZone &= np.asarray(intensities) >= zone.thresholds['minIntensity']
+            count = int(np.count_nonzero(inZone))
+            results[name] = {'kind': zone.kind, 'count': count,
+                             'triggered': count >= zone.thresholds['minPoints']}
+        return labels, keep, results
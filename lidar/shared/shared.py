@@ -31,6 +31,7 @@ class MessageTypes(Enum):
     REPLY = 'reply'
     ERROR = 'error'
     HALT = 'halt'
+    GAP = 'gap'
 
 @unique
 class Commands(Enum):
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Async acquisition test: drives a fake lidar driver through ascan() and
+# astream() to check retries, the backoff between attempts, the deadline
+# (covering slow attempts and slow recoveries), cancellation, and that the
+# event loop isn't blocked by the driver
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import time
+
+from ..lib.asyncAcquire import AsyncAcquisition
+
+
+BACKOFF = 0.05              # secs
+ROTATION = {'angles': [0.0, 0.1], 'distances': [1.0, 1.0]}
+
+
+class FakeDriver(AsyncAcquisition):
+    ''' Fails the first 'failures' attempts (None, or raises), each attempt and recovery taking the given secs '''
+    def __init__(self, failures=0, attemptSecs=0.0, recoverSecs=0.0, raises=False):
+        self.failures = failures
+        self.attemptSecs = attemptSecs
+        self.recoverSecs = recoverSecs
+        self.raises = raises
+        self.attempts = []      # when each attempt started
+        self.recoveries = 0
+        self.streaming = False
+
+    def _acquireOnce(self, names):
+        self.attempts.append(time.monotonic())
+        time.sleep(self.attemptSecs)
+        if len(self.attempts) <= self.failures:
+            if self.raises:
+                raise IOError("device error")
+            return None
+        return {name: ROTATION[name] for name in names}
+
+    def _recover(self):
+        self.recoveries += 1
+        time.sleep(self.recoverSecs)
+
+
+async def retryCheck():
+    driver = FakeDriver(failures=2)
+    result = await driver.ascan(['angles', 'distances'], timeout=2.0, retries=3, backoff=BACKOFF)
+    assert result['ok'] and (result['values'] == ROTATION) and (result['attempts'] == 3)
+    assert driver.recoveries == 2
+    # exponential backoff between attempts
+    gaps = [b - a for a, b in zip(driver.attempts, driver.attempts[1:])]
+    assert (gaps[0] >= BACKOFF) and (gaps[1] >= 2 * BACKOFF), gaps
+    # exceptions are failed attempts, and retries run out
+    driver = FakeDriver(failures=10, raises=True)
+    result = await driver.ascan(['angles'], timeout=2.0, retries=2, backoff=0.0)
+    assert (not result['ok']) and (result['error'] == "no data") and (result['attempts'] == 3)
+    print(f"retry: PASSED (backoff gaps {gaps[0] * 1000:.0f}, {gaps[1] * 1000:.0f} ms)")
+
+async def deadlineCheck():
+    # a slow attempt
+    driver = FakeDriver(attemptSecs=0.5)
+    result = await driver.ascan(['angles'], timeout=0.2)
+    assert (not result['ok']) and (result['error'] == "timeout") and (result['elapsed'] < 0.3)
+    attempt = result['elapsed']
+    # a slow recovery
+    driver = FakeDriver(failures=10, recoverSecs=1.0)
+    start = time.monotonic()
+    result = await driver.ascan(['angles'], timeout=0.3, retries=5, backoff=0.0)
+    recover = time.monotonic() - start
+    assert (not result['ok']) and (result['error'] == "timeout") and (recover < 0.4), recover
+    # the backoff is cut short by the deadline too
+    driver = FakeDriver(failures=10)
+    result = await driver.ascan(['angles'], timeout=0.1, retries=5, backoff=1.0)
+    assert (not result['ok']) and (result['elapsed'] < 0.2)
+    await asyncio.sleep(1.0)
+    print(f"deadline: PASSED (slow attempt {attempt * 1000:.0f} ms, slow recovery {recover * 1000:.0f} ms, "
+          f"with 200/300 ms deadlines)")
+
+async def cancelCheck():
+    driver = FakeDriver(attemptSecs=0.5)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    tick = asyncio.create_task(ticker())
+    scan = asyncio.create_task(driver.ascan(['angles'], timeout=2.0))
+    await asyncio.sleep(0.2)
+    scan.cancel()
+    try:
+        await scan
+        assert False, "not cancelled"
+    except asyncio.CancelledError:
+        pass
+    tick.cancel()
+    # N.B. the driver call in the executor runs to completion, the next one queues up behind it
+    start = time.monotonic()
+    result = await driver.ascan(['angles'], timeout=2.0)
+    assert result['ok'] and (len(driver.attempts) == 2)
+    queued = time.monotonic() - start
+    assert ticks > 10, "the event loop was blocked"
+    print(f"cancel: PASSED (loop ran {ticks} ticks during a blocking attempt, next scan queued {queued * 1000:.0f} ms)")
+
+async def streamCheck():
+    driver = FakeDriver()
+    results = []
+    async for result in driver.astream(['distances'], timeout=0.5):
+        results.append(result)
+        if len(results) == 3:
+            driver.failures = 10**6
+    # the failed result ends the stream
+    assert [r['ok'] for r in results] == [True, True, True, False] and not driver.streaming
+    try:
+        class NoDriver(AsyncAcquisition):
+            pass
+        assert False, "driver without _acquireOnce()"
+    except TypeError:
+        pass
+    print(f"stream: PASSED ({len(results)} results, stream ended by the failure)")
+
+
+if __name__ == "__main__":
+    asyncio.run(retryCheck())
+    asyncio.run(deadlineCheck())
+    asyncio.run(cancelCheck())
+    asyncio.run(streamCheck())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Data socket frame batching test: checks that the FrameBatcher sends frames
+# on their own while the link keeps up, and coalesces them (holding none
+# longer than its max latency, and sending them once the send backlog has
+# room) while it doesn't, that LidarClient unpacks batches into frames, and
+# compares the stream's throughput and latency with and without batching
+# over an emulated 1 Mbit/s link (a pacing TCP proxy between the server's
+# data port and the client): batching mustn't add more than its max latency
+# (beyond the run-to-run variation), and must raise the small frames'
+# throughput
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import json
+import multiprocessing
+import socket
+import tempfile
+import time
+
+import numpy as np
+import websockets
+
+from ..shared import MessageTypes, Commands
+from ..lib.frameBatcher import FrameBatcher, splitFrames
+from ..lib.wcLidar import LidarClient
+from .wsLoadTest import runServer, sendCmd, waitForServer
+
+
+CMD_PORT = 18765
+DATA_PORT = 18766
+LINK_PORT = 18767
+LINK_RATE = 1e6             # bits/sec
+LINK_CHUNK = 1460           # bytes forwarded at a time (a TCP segment)
+LINK_RCVBUF = 16384         # bytes, of the link's socket to the server
+RUN_SECS = 8.0
+MAX_LATENCY_MS = 20
+LATENCY_NOISE = 0.05        # run-to-run variation of the median latency over the link
+
+# (name, simulated rotations/sec, stream names, angle window)
+SCENARIOS = [("keeps up", 10, ['distances'], (-180.0, 180.0)),
+             ("small frames", 300, ['distances'], (-30.0, 30.0)),
+             ("large frames", 30, ['angles', 'distances', 'intensities'], (-180.0, 180.0))]
+
+
+def batcherTest():
+    async def run(sendSecs, interval, count, padding=0):
+        sent = []
+
+        async def send(message):
+            await asyncio.sleep(sendSecs)
+            sent.append((time.monotonic(), splitFrames(message)))
+
+        batcher = FrameBatcher(send, maxLatency=MAX_LATENCY_MS / 1000.0, maxFrames=100, maxBytes=1000)
+        batcher.start()
+        for i in range(count):
+            await batcher.put(json.dumps({'n': i, 'put': time.monotonic(), 'pad': "x" * padding}))
+            await asyncio.sleep(interval)
+        await asyncio.sleep(0.2)
+        batcher.stop()
+        frames = [(t, json.loads(f)) for t, fs in sent for f in fs]
+        assert [f['n'] for _, f in frames] == list(range(count)), "frames lost or reordered"
+        waited = max(t - f['put'] for t, f in frames)
+        return sent, waited, batcher.status()
+
+    # the link keeps up: every frame on its own
+    sent, _, status = asyncio.run(run(0.001, 0.01, 50))
+    assert all(len(frames) == 1 for _, frames in sent) and (status['batchBatches'] == 0)
+    # the link's slower than the frames: coalesced, none held longer than the max latency (plus a send)
+    sent, waited, status = asyncio.run(run(0.03, 0.005, 200))
+    assert status['batchBatches'] > 0 and (status['batchMessages'] < 200 / 3)
+    assert waited < (MAX_LATENCY_MS / 1000.0) + 0.03 + 0.02, f"a frame waited {waited * 1000:.0f} ms"
+    # frames over half the batch size: nothing can join them, so they aren't held
+    _, _, large = asyncio.run(run(0.03, 0.005, 20, 600))
+    # N.B. each waits for the send ahead of it, but isn't held for others to join it
+    assert (large['batchBatches'] == 0) and (large['batchMeanHeldMs'] < (1000 * 0.03) + 10.0), large
+    # a batch waits for the send backlog to drain enough for it
+    backlog = asyncio.run(drain())
+    print(f"batcher: PASSED ({status['batchMessages']} messages for 200 frames over a slow link, "
+          f"largest {status['batchLargest']}, longest wait {waited * 1000:.0f} ms; large frames sent alone, held {large['batchMeanHeldMs']:.0f} ms; "
+          f"batch sent once the backlog drained to {backlog} bytes)")
+
+async def drain():
+    sent = []
+    backlog = 3000
+
+    async def send(message):
+        sent.append(splitFrames(message))
+
+    batcher = FrameBatcher(send, maxLatency=0.01, maxFrames=100, maxBytes=1000, backlog=lambda: backlog)
+    batcher.start()
+    await batcher.put(json.dumps({'n': 0}))
+    await asyncio.sleep(0.01)
+    for i in range(1, 4):
+        await batcher.put(json.dumps({'n': i}))
+    await asyncio.sleep(0.05)
+    assert len(sent) == 1, "sent into the backlog"
+    backlog = 500
+    await asyncio.sleep(0.02)
+    batcher.stop()
+    assert (len(sent) == 2) and (len(sent[1]) == 3), sent
+    return backlog
+
+
+class Link():
+    ''' TCP proxy to the server's data port, pacing what's sent to the client at 'rate' (bits/sec) '''
+    def __init__(self, rate=LINK_RATE):
+        self.rate = rate
+        self.bytes = 0
+        self.writers = set()
+        self.stalled = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", LINK_PORT)
+
+    async def _pipe(self, reader, writer, paced):
+        due = time.monotonic()
+        try:
+            while data := await reader.read(LINK_CHUNK):
+                if writer in self.stalled:
+                    # N.B. a dead link, what's sent is lost and nothing's closed
+                    continue
+                if paced:
+                    self.bytes += len(data)
+                    due = max(due, time.monotonic()) + (len(data) * 8 / self.rate)
+                    await asyncio.sleep(due - time.monotonic())
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        writer.close()
+
+    async def _handle(self, reader, writer):
+        # N.B. a small receive buffer, so the backlog builds up in the server, as on a real link
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, LINK_RCVBUF)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", DATA_PORT))
+        upReader, upWriter = await asyncio.open_connection(sock=sock, limit=LINK_CHUNK)
+        self.writers |= {writer, upWriter}
+        try:
+            await asyncio.gather(self._pipe(reader, upWriter, False), self._pipe(upReader, writer, True))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.writers -= {writer, upWriter}
+            self.stalled -= {writer, upWriter}
+
+    def drop(self):
+        ''' Reset the connections through the link '''
+        for writer in list(self.writers):
+            writer.transport.abort()
+
+    def stall(self):
+        ''' Stop the connections through the link getting anything through, without closing them '''
+        self.stalled |= self.writers
+
+    def close(self):
+        self.server.close()
+
+
+async def measure(rate, names, angles, batch):
+    cmdURI = f"ws://127.0.0.1:{CMD_PORT}"
+    if await waitForServer(cmdURI):
+        raise RuntimeError("Lidar server didn't start")
+    link = Link()
+    await link.start()
+    options = {'driver': 'sim', 'rate': rate, 'seed': 1, 'minAngle': angles[0], 'maxAngle': angles[1]}
+    await sendCmd(cmdURI, {'type': MessageTypes.CMD.value, 'command': Commands.INIT.value, 'options': options})
+    latencies, messages = [], 0
+    async with websockets.connect(f"ws://127.0.0.1:{LINK_PORT}", max_size=None) as dataSocket:
+        stream = {'type': MessageTypes.CMD.value, 'command': Commands.STREAM.value, 'names': names}
+        if batch:
+            stream['batch'] = {'maxLatencyMs': MAX_LATENCY_MS}
+        await sendCmd(cmdURI, stream)
+        start = time.monotonic()
+        while time.monotonic() - start < RUN_SECS:
+            try:
+                message = await asyncio.wait_for(dataSocket.recv(), 1.0)
+            except asyncio.TimeoutError:
+                continue
+            now = time.time()
+            messages += 1
+            frames = [json.loads(frame) for frame in splitFrames(message)]
+            # N.B. skipped (stale) frames are reported by gap markers, they count as dropped
+            latencies += [now - frame['stamp'] for frame in frames if frame['type'] == MessageTypes.REPLY.value]
+            received = link.bytes
+        status = await sendCmd(cmdURI, {'type': MessageTypes.STATUS.value})
+    link.close()
+    ms = np.array(latencies) * 1000.0
+    return {'frames/s': len(ms) / RUN_SECS, 'messages/s': messages / RUN_SECS,
+            'bytes/frame': received / max(1, len(ms)), 'p50': np.percentile(ms, 50), 'p99': np.percentile(ms, 99),
+            'dropped': status['status'].get('sinkDropped', 0) + status['status'].get('replaySkipped', 0)}
+
+def serve(func, *args):
+    ''' Run a coroutine against a fresh server (N.B. a stream can't be cleanly restarted on one) '''
+    with tempfile.TemporaryDirectory() as directory:
+        server = multiprocessing.Process(target=runServer, args=(directory, CMD_PORT, DATA_PORT), daemon=True)
+        server.start()
+        try:
+            return asyncio.run(func(*args))
+        finally:
+            server.terminate()
+            server.join(5)
+
+async def clientCheck():
+    ''' LidarClient hands out the frames of batched messages one at a time, as single-frame messages '''
+    cmdURI = f"ws://127.0.0.1:{CMD_PORT}"
+    if await waitForServer(cmdURI):
+        raise RuntimeError("Lidar server didn't start")
+    link = Link()
+    await link.start()
+    client = LidarClient("127.0.0.1", CMD_PORT, LINK_PORT)
+    _, rate, names, angles = SCENARIOS[1]
+    assert not await client.init({'driver': 'sim', 'rate': rate, 'seed': 1, 'minAngle': angles[0],
+                                  'maxAngle': angles[1]})
+    assert not await client.stream(names, batch={'maxLatencyMs': MAX_LATENCY_MS})
+    frames = []
+    deadline = time.monotonic() + 4.0
+    while time.monotonic() < deadline:
+        try:
+            frames.append(json.loads(client.msgQ.get_nowait()))
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(0.005)
+    status = await client.status()
+    client.close()
+    link.close()
+    frames = [frame for frame in frames if frame['type'] != MessageTypes.GAP.value]
+    assert frames and all(len(frame['values']['distances']) > 0 for frame in frames)
+    assert status['batchBatches'] > 0, "nothing was coalesced"
+    print(f"client: PASSED ({len(frames)} frames from {status['batchMessages']} messages, "
+          f"{status['batchBatches']} of them batches)")
+
+
+if __name__ == "__main__":
+    batcherTest()
+    serve(clientCheck)
+    print(f"{'scenario':<14} {'batching':<9} {'frames/s':>9} {'msgs/s':>8} {'bytes/frame':>12} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'dropped':>8}")
+    results = {}
+    for name, rate, names, angles in SCENARIOS:
+        for batch in (False, True):
+            r = results[(name, batch)] = serve(measure, rate, names, angles, batch)
+            print(f"{name:<14} {'on' if batch else 'off':<9} {r['frames/s']:>9.1f} {r['messages/s']:>8.1f} "
+                  f"{r['bytes/frame']:>12.0f} {r['p50']:>8.0f} {r['p99']:>8.0f} {r['dropped']:>8}")
+    for name, _, _, _ in SCENARIOS:
+        off, on = results[(name, False)], results[(name, True)]
+        bound = (off['p50'] * (1.0 + LATENCY_NOISE)) + MAX_LATENCY_MS
+        assert on['p50'] <= bound, f"{name}: batching p50 {on['p50']:.0f} ms, over {bound:.0f} ms"
+    off, on = results[("small frames", False)], results[("small frames", True)]
+    assert on['frames/s'] > off['frames/s'], "batching didn't raise the small frames' throughput"
+    print(f"benchmark: PASSED (batched p50 latency within the {MAX_LATENCY_MS} ms bound, small frames "
+          f"{100.0 * (on['frames/s'] / off['frames/s'] - 1.0):+.1f}% frames/s, {on['p50'] - off['p50']:+.0f} ms p50)")
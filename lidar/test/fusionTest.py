@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Sensor fusion test: checks the extrinsic transforms (yaw, translation and
+# tilt foreshortening, against rotating the scan plane), that each sensor's rotation is fused into one tick at
+# most, that fused clouds go through a pipeline's zones in the site frame,
+# that a peer server's stream is fused, and measures the fusion rate against
+# four sensors at 12 Hz
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import time
+
+import numpy as np
+
+from ..shared import MAX_TILT_ANGLE
+from ..lib.fusion import Extrinsics, SensorFusion
+from ..lib.pipeline import FusionStage, Pipeline, Rotation, makeStage
+from ..lib.wcLidar import LidarClient
+from .batchingTest import CMD_PORT, DATA_PORT, serve
+from .wsLoadTest import waitForServer
+
+
+NUM_SENSORS = 4
+SCAN_FREQ = 12.0            # Hz, each sensor's rotation rate
+NUM_POINTS = 500            # samples per rotation
+NUM_TICKS = 500
+PEER_OPTIONS = {'driver': 'sim', 'rate': SCAN_FREQ, 'seed': 1, 'minAngle': -30.0, 'maxAngle': 30.0}
+PEER_TOLERANCE = 0.1        # secs, a peer's rotations arrive a bit after they're stamped
+
+
+def transformCheck():
+    angles = np.radians([0.0, 90.0, 180.0])
+    distances = np.array([1.0, 2.0, 3.0])
+    # yaw and translation
+    xy = Extrinsics(x=1.0, y=-2.0, yaw=90.0, tilt=0.0).toSite(angles, distances)
+    assert np.allclose(xy, [[1.0, -1.0], [-1.0, -2.0], [1.0, -5.0]])
+    # the tilt foreshortens the beams along the pitch axis, not across it
+    tilt = MAX_TILT_ANGLE
+    xy = Extrinsics(tilt=tilt).toSite(angles, distances)
+    assert np.allclose(xy, [[np.cos(np.radians(tilt)), 0.0], [0.0, 2.0], [-3.0 * np.cos(np.radians(tilt)), 0.0]])
+    # off-axis bearings, against pitching the scan plane's points about the y-axis
+    angles = np.radians([30.0, -45.0, 120.0, -160.0])
+    distances = np.array([2.0, 1.5, 4.0, 3.0])
+    t = np.radians(tilt)
+    pitch = np.array([[np.cos(t), 0.0, np.sin(t)], [0.0, 1.0, 0.0], [-np.sin(t), 0.0, np.cos(t)]])
+    points = np.stack([distances * np.cos(angles), distances * np.sin(angles), np.zeros(len(angles))], axis=1)
+    xy = Extrinsics(x=0.5, y=1.0, yaw=30.0, tilt=tilt).toSite(angles, distances)
+    yaw = np.radians(30.0)
+    expected = (points @ pitch.T)[:, :2] @ np.array([[np.cos(yaw), -np.sin(yaw)], [np.sin(yaw), np.cos(yaw)]]).T
+    assert np.allclose(xy, expected + [0.5, 1.0]), xy - (expected + [0.5, 1.0])
+    print("transforms: PASSED (yaw, translation, tilt foreshortening of off-axis bearings)")
+
+def consumeCheck():
+    fusion = SensorFusion({'a': {}, 'b': {'x': 1.0}, 'c': {'y': 1.0}}, tolerance=0.05)
+    rotation = {'angles': np.zeros(3), 'distances': np.array([1.0, 0.0, 2.0])}
+    fusion.add('a', rotation, 10.0)
+    fusion.add('b', rotation, 10.02)
+    cloud = fusion.fuse(10.0)
+    # samples without a return are left out
+    assert (cloud['sensorIds'] == ['a', 'b']) and (len(cloud['x']) == 4)
+    # a rotation is only fused once
+    assert fusion.fuse(10.0) is None
+    fusion.add('a', rotation, 11.0)
+    fusion.add('b', rotation, 10.5)
+    fusion.add('c', rotation, 11.2)
+    cloud = fusion.fuse(11.0)
+    assert cloud['sensorIds'] == ['a']
+    # the stale rotation's dropped, the one newer than the tick is kept for the next
+    assert (sorted(fusion.latest) == ['c']) and (fusion.numDropped == 1)
+    assert fusion.fuse(11.2)['sensorIds'] == ['c']
+    print("consume: PASSED (rotations fused once, stale ones dropped, newer ones kept)")
+
+def makeRotations(rng, num):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    return [{'angles': angles, 'distances': 3.0 + rng.normal(0.0, 0.02, NUM_POINTS),
+             'intensities': rng.integers(0, 255, NUM_POINTS)} for _ in range(num)]
+
+def rateCheck():
+    rng = np.random.default_rng(1)
+    extrinsics = {f"s{i}": {'x': 5.0 * (i % 2), 'y': 5.0 * (i // 2), 'yaw': 90.0 * i} for i in range(NUM_SENSORS)}
+    fusion = SensorFusion(extrinsics)
+    rotations = makeRotations(rng, NUM_SENSORS)
+    start = time.perf_counter()
+    for tick in range(NUM_TICKS):
+        stamp = tick / SCAN_FREQ
+        for i, sensorId in enumerate(extrinsics):
+            fusion.add(sensorId, rotations[i], stamp + (0.001 * i))
+        cloud = fusion.fuse(stamp)
+        fusion.toPolar(cloud)
+    elapsed = time.perf_counter() - start
+    assert (len(cloud['sensorIds']) == NUM_SENSORS) and (len(cloud['x']) == NUM_SENSORS * NUM_POINTS)
+    rate = NUM_TICKS / elapsed
+    assert rate > SCAN_FREQ, f"fusing {rate:.1f} ticks/sec"
+    print(f"rate: PASSED ({rate:.0f} ticks/sec of {NUM_SENSORS} x {NUM_POINTS} points, "
+          f"{SCAN_FREQ:.0f} Hz needed, {1000.0 / rate:.2f} ms/tick, {rate / SCAN_FREQ:.0f}x headroom)")
+
+def stageCheck():
+    ''' The zones after a fusion stage are in the site frame '''
+    zone = {'polygon': [[2.5, -0.5], [3.5, -0.5], [3.5, 0.5], [2.5, 0.5]], 'kind': 'alert'}
+    pipeline = Pipeline([makeStage({'stage': 'fusion', 'extrinsics': {'local': {'x': 2.0, 'tilt': 0.0}},
+                                    'detector': {'model': 'background'}}),
+                         makeStage({'stage': 'zones', 'zones': {'door': zone}})])
+    rotation = pipeline.process(Rotation({'angles': [0.0, np.pi / 2], 'distances': [1.0, 1.0],
+                                          'intensities': [10, 10]}))
+    # the point 1m ahead of the sensor is 3m from the site origin
+    assert np.allclose(rotation['distances'], [3.0, np.hypot(2.0, 1.0)])
+    assert rotation.meta['zones']['door']['count'] == 1
+    assert (rotation.meta['fusion']['sensors'] == ['local']) and ('cluster' in rotation.meta)
+    pipeline.shutdown()
+    print("stage: PASSED (fused cloud in the site frame through the zones stage)")
+
+async def peerCheck():
+    ''' A peer server's rotations are fused with the local ones '''
+    if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+        raise RuntimeError("Lidar server didn't start")
+    client = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+    assert not await client.init(PEER_OPTIONS)
+    assert not await client.stream(['angles', 'distances', 'intensities'])
+    stage = FusionStage(extrinsics={'peer': {'x': 1.0, 'tilt': 0.0}}, tolerance=PEER_TOLERANCE,
+                        peers={'peer': {'host': "127.0.0.1", 'cmdPort': CMD_PORT, 'dataPort': DATA_PORT}})
+    rng = np.random.default_rng(1)
+    local = makeRotations(rng, 1)[0]
+    sizes = []
+    for _ in range(int(3 * SCAN_FREQ)):
+        await asyncio.sleep(1.0 / SCAN_FREQ)
+        rotation = stage.process(Rotation(local))
+        sizes.append(len(rotation.meta['fusion']['sensors']))
+    stage.close()
+    client.close()
+    fused = sizes.count(2)
+    status = stage.status()
+    assert status['peerRotations'] > 0, "no rotations from the peer"
+    assert fused > (len(sizes) / 2), f"{fused} of {len(sizes)} ticks fused with the peer"
+    print(f"peer: PASSED ({fused} of {len(sizes)} ticks fused with the peer's {status['peerRotations']} rotations, "
+          f"{status['fusion']['numDropped']} dropped as stale)")
+
+
+if __name__ == "__main__":
+    transformCheck()
+    consumeCheck()
+    rateCheck()
+    stageCheck()
+    serve(peerCheck)
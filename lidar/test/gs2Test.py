@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# GS2 driver test, against a pty-based emulator of two cascaded modules
+#
+################################################################################
+
+import os
+import struct
+import threading
+import time
+import tty
+
+import numpy as np
+
+from ..lib.gs2 import (GS2Lidar, Calibration, decodeFrames, encodeFrame, encodePacket,
+                       CMD_GET_PARAMS, CMD_GET_VERSION, CMD_START, CMD_STOP, NUM_PIXELS)
+
+
+MODULES = {0x01: (9000, 3000, 9100, 2900, 5), 0x02: (8900, 3100, 9050, 3000, -3)}
+NUM_FRAMES = 30
+
+
+def makeFrames(rng):
+    frames = []
+    for _ in range(NUM_FRAMES):
+        for address in MODULES:
+            frames.append((address, rng.integers(30, 300, NUM_PIXELS), rng.integers(0, 128, NUM_PIXELS)))
+    return frames
+
+def emulator(fd, frames):
+    buf = b''
+    while True:
+        try:
+            buf += os.read(fd, 64)
+        except OSError:
+            return  # the driver side of the pty was closed
+        frames_, packets, consumed = decodeFrames(buf)
+        buf = buf[consumed:]
+        for _, cmd, _ in packets:
+            if cmd == CMD_GET_PARAMS:
+                for address, params in MODULES.items():
+                    os.write(fd, encodePacket(address, cmd, struct.pack('<4Hb', *params)))
+            elif cmd == CMD_GET_VERSION:
+                for address in MODULES:
+                    os.write(fd, encodePacket(address, cmd, bytes([1, 2, 3]) + bytes(16)))
+            elif cmd == CMD_STOP:
+                os.write(fd, encodePacket(max(MODULES), cmd))
+            elif cmd == CMD_START:
+                os.write(fd, encodePacket(max(MODULES), cmd))
+                for address, dists, ints in frames:
+                    os.write(fd, encodeFrame(address, dists, ints))
+                    time.sleep(0.001)
+
+def decodeTest():
+    rng = np.random.default_rng(1)
+    frames = makeFrames(rng)
+    stream = bytes(rng.integers(0, 256, 100, dtype=np.uint8)) + \
+             b''.join(encodeFrame(a, d, i) for a, d, i in frames)
+    bad = bytearray(stream)
+    bad[100 + 50] ^= 0x01
+    decoded, _, _ = decodeFrames(bytes(bad))
+    assert len(decoded['addresses']) == len(frames) - 1
+    for (a, d, i), da, dd, di in zip(frames[1:], decoded['addresses'], decoded['distances'], decoded['intensities']):
+        assert (a == da) and np.array_equal(d, dd) and np.array_equal(i, di)
+    print("decoder: PASSED")
+
+def ptyTest():
+    rng = np.random.default_rng(2)
+    frames = makeFrames(rng)
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    os.set_blocking(slave, False)
+    threading.Thread(target=emulator, args=(master, frames), daemon=True).start()
+
+    lidar = GS2Lidar(device=open(slave, 'r+b', buffering=0))
+    assert lidar.status()['modules'] == sorted(MODULES)
+    points = lidar.scan()
+    assert points and (len(points['angles']) == len(points['distances']) > 0)
+    expected = []
+    for address, dists, _ in frames[:len(MODULES)]:
+        _, d = Calibration.fromBytes(struct.pack('<4Hb', *MODULES[address])).correct(dists[None, :])
+        d = d[0] / 1000.0
+        expected.append(d[(d >= lidar.minRange) & (d <= lidar.maxRange)])
+    assert np.allclose(points['distances'], np.concatenate(expected))
+    print("pty emulator: PASSED")
+
+def benchmark():
+    rng = np.random.default_rng(3)
+    frames = makeFrames(rng)
+    stream = b''.join(encodeFrame(a, d, i) for a, d, i in frames)
+    cal = Calibration.fromBytes(struct.pack('<4Hb', *MODULES[0x01]))
+    start = time.perf_counter()
+    decoded, _, _ = decodeFrames(stream)
+    cal.correct(decoded['distances'])
+    elapsed = time.perf_counter() - start
+    print(f"decode+correct: {elapsed * 1000 / len(frames):.3f} ms/frame")
+
+
+if __name__ == "__main__":
+    decodeTest()
+    ptyTest()
+    benchmark()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# History store test: records a few hours of (synthetic, 12Hz) rotations,
+# checks queries against what was written, compacts, checks the aggregates
+# and the tiered retention (and that the status' running byte count matches
+# what's on disk), and times appends and queries
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from ..lib.history import HistoryStore, SEGMENT_SECS
+
+
+NUM_POINTS = 500
+SCAN_FREQ = 12
+NUM_HOURS = 3
+START = 1760000400.0    # on an hour boundary
+
+
+def record(store, rng):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False).astype(np.float32)
+    walls = (3.0 + (0.5 * np.cos(3 * angles))).astype(np.float32)
+    noise = rng.normal(0.0, 0.02, (64, NUM_POINTS)).astype(np.float32)
+    intensities = rng.integers(0, 255, NUM_POINTS)
+    numRotations = NUM_HOURS * SEGMENT_SECS * SCAN_FREQ
+    start = time.perf_counter()
+    for i in range(numRotations):
+        store.append(START + (i / SCAN_FREQ), angles, walls + noise[i % 64], intensities)
+    elapsed = time.perf_counter() - start
+    print(f"append: {numRotations} rotations, {elapsed / numRotations * 1e6:.1f} usecs/rotation")
+    return angles, walls, noise, intensities
+
+def checkBytes(store):
+    ''' The running byte count is what's on disk '''
+    size = sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(store.directory) for name in names)
+    assert store.status()['historyBytes'] == size, f"{store.status()['historyBytes']} bytes, {size} on disk"
+    return size
+
+def queryTest(store, angles, walls, noise, intensities):
+    # a minute that spans two segments
+    t0 = START + SEGMENT_SECS - 30
+    start = time.perf_counter()
+    raw = store.query(t0, t0 + 60, 'raw')
+    elapsed = time.perf_counter() - start
+    assert raw['tier'] == 'raw'
+    assert len(raw['stamps']) == 60 * SCAN_FREQ + 1, f"Wrong number of rotations: {len(raw['stamps'])}"
+    assert np.all(np.diff(raw['stamps']) > 0)
+    i = int(round((raw['stamps'][100] - START) * SCAN_FREQ))
+    first = raw['offsets'][100]
+    assert np.array_equal(raw['distances'][first:first + NUM_POINTS], walls + noise[i % 64])
+    assert np.array_equal(raw['angles'][first:first + NUM_POINTS], angles)
+    assert np.array_equal(raw['intensities'][first:first + NUM_POINTS], intensities)
+    print(f"raw query: PASSED ({len(raw['stamps'])} rotations (over 2 segments) in {elapsed * 1000:.2f} ms)")
+
+def compactTest(store):
+    # as if an hour after the last rotation: everything's closed, nothing's expired yet
+    now = START + ((NUM_HOURS + 1) * SEGMENT_SECS)
+    start = time.perf_counter()
+    store.close()
+    changed = store.compact(now)
+    print(f"compaction: {changed} segments in {time.perf_counter() - start:.2f} secs")
+    assert store.status()['historySegments'] == {'raw': NUM_HOURS, '1s': NUM_HOURS, '1m': NUM_HOURS}
+    compacted = checkBytes(store)
+
+    start = time.perf_counter()
+    seconds = store.query(START, START + SEGMENT_SECS - 1, '1s')
+    elapsed = time.perf_counter() - start
+    assert seconds['min'].shape == (SEGMENT_SECS, store.numBins)
+    assert np.all(seconds['min'] <= seconds['median'] + 1e-6)
+    assert np.all(np.abs(np.nanmedian(seconds['median'], axis=0) - 3.0) < 0.6)
+    print(f"1s query: an hour of aggregates in {elapsed * 1000:.2f} ms")
+
+    minutes = store.query(START, START + (NUM_HOURS * SEGMENT_SECS), '1m')
+    assert minutes['min'].shape == (NUM_HOURS * 60, store.numBins)
+
+    # past the raw retention, the raw segments go, the aggregates stay
+    later = START + ((NUM_HOURS + store.retention['raw'] // SEGMENT_SECS + 1) * SEGMENT_SECS)
+    store.compact(later)
+    assert store.status()['historySegments'] == {'raw': 0, '1s': NUM_HOURS, '1m': NUM_HOURS}
+    assert store.tierFor(START, later) == '1s'
+    assert len(store.query(START, START + 60, 'raw')['stamps']) == 0
+
+    # and past the 1s retention, only the 1m aggregates are left
+    store.compact(START + store.retention['1s'] + ((NUM_HOURS + 1) * SEGMENT_SECS))
+    assert store.status()['historySegments'] == {'raw': 0, '1s': 0, '1m': NUM_HOURS}
+    assert len(store.query(START, START + SEGMENT_SECS - 1, '1m')['stamps']) == 60
+    expired = checkBytes(store)
+    # a store opened on the directory starts from what's there
+    assert HistoryStore(store.directory).status()['historyBytes'] == expired
+    start = time.perf_counter()
+    store.status()
+    elapsed = time.perf_counter() - start
+    print(f"retention: PASSED ({compacted} bytes compacted, {expired} left; status in {elapsed * 1e6:.0f} usecs)")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as directory:
+        store = HistoryStore(directory, rawHours=6)
+        arrays = record(store, rng)
+        checkBytes(store)
+        queryTest(store, *arrays)
+        compactTest(store)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Persisted model test: saves and reloads zone tables, backgrounds and a
+# reference region, checks stale models are rejected, and compares a warm
+# start (first rotation) with compiling/learning from scratch
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import shapely
+
+from ..lib.modelStore import loadModel, modelPath, sensorConfig
+from ..lib.refGeometry import loadReference, saveReference, unionScans
+from ..lib.scanRate import ActivityDetector
+from ..lib.zones import ZoneMap
+
+
+NUM_POINTS = 2000
+SENSOR = {'minAngle': -180.0, 'maxAngle': 180.0, 'minRange': 0.02, 'maxRange': 12.0, 'scanFreq': 6}
+ZONES = {f"zone{i}": {'polygon': [[i, 1.0], [i + 0.8, 1.0], [i + 0.8, 2.0], [i, 2.0]], 'kind': 'alert'}
+         for i in range(8)}
+
+
+def makeRotation(rng, critter=False):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    distances = 3.0 + (0.5 * np.cos(3 * angles)) + rng.normal(0.0, 0.02, NUM_POINTS)
+    if critter:
+        distances[500:530] -= 1.0
+    return angles, distances
+
+def zonesTest(directory):
+    path = modelPath("zones", directory)
+    start = time.perf_counter()
+    compiled = ZoneMap.fromConfig(ZONES)
+    compileTime = time.perf_counter() - start
+    assert not compiled.save(path)
+
+    start = time.perf_counter()
+    loaded = ZoneMap.load(path, ZONES)
+    loadTime = time.perf_counter() - start
+    assert loaded is not None, "Saved zones not loaded"
+    assert isinstance(loaded.table, np.memmap), "Zone table not memory-mapped"
+    assert np.array_equal(loaded.table, compiled.table) and (loaded.bits == compiled.bits)
+
+    # changing a zone doesn't write through to the saved table
+    loaded.removeZone("zone0")
+    assert np.array_equal(loadModel(path, 'zones')[0]['table'], compiled.table)
+
+    changed = dict(ZONES, zone0={'polygon': [[0, 0], [1, 0], [1, 1]], 'kind': 'exclude'})
+    assert ZoneMap.load(path, changed) is None, "Stale zones loaded"
+    assert ZoneMap.load(path, ZONES, rangeBin=0.05) is None, "Zones with other bins loaded"
+    print(f"zones: PASSED (compile {compileTime * 1000:.1f} ms, load {loadTime * 1000:.1f} ms)")
+
+def backgroundTest(directory, rng):
+    path = modelPath("background-watch", directory)
+    learned = ActivityDetector()
+    for _ in range(30):
+        learned.update(*makeRotation(rng))
+    assert not learned.save(path, sensorConfig(SENSOR))
+
+    # a fresh detector has to learn before it can see anything, a restored one sees the first rotation
+    fresh = ActivityDetector()
+    restored = ActivityDetector()
+    assert not restored.restore(path, sensorConfig(SENSOR))
+    first = makeRotation(rng, critter=True)
+    assert fresh.update(*first) == 0
+    assert restored.update(*first) >= 3, "Restored background missed the first rotation's critter"
+
+    assert ActivityDetector().restore(path, sensorConfig(SENSOR | {'maxRange': 8.0})), "Stale background restored"
+    assert ActivityDetector(angleBin=0.5).restore(path, sensorConfig(SENSOR)), "Background with other bins restored"
+    print("background: PASSED (critter detected in the first rotation after a restart)")
+
+def referenceTest(directory, rng):
+    path = modelPath("reference", directory)
+    scans = []
+    for _ in range(50):
+        angles, distances = makeRotation(rng)
+        scans.append(np.column_stack((distances * np.cos(angles), distances * np.sin(angles))))
+    start = time.perf_counter()
+    reference = unionScans(scans)
+    captureTime = time.perf_counter() - start
+    assert not saveReference(path, reference, sensorConfig(SENSOR))
+
+    start = time.perf_counter()
+    loaded = loadReference(path, sensorConfig(SENSOR))
+    loadTime = time.perf_counter() - start
+    assert shapely.equals_exact(loaded, reference), "Reference region changed"
+    assert loadReference(path, sensorConfig(SENSOR | {'minAngle': -90.0})) is None, "Stale reference loaded"
+    print(f"reference: PASSED (union of 50 frames {captureTime * 1000:.1f} ms, plus ~{50 / SENSOR['scanFreq']:.1f} s "
+          f"capturing them, load {loadTime * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as directory:
+        zonesTest(directory)
+        backgroundTest(directory, rng)
+        referenceTest(directory, rng)
+        assert not [f for f in os.listdir(directory) if f.endswith(".tmp")]
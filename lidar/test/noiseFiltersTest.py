@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Noise filter test: checks which points each filter stage rejects (and
+# keeps), that rotations are filtered in the device's sample order with
+# neighbours across the angle wrap, the chain's removed-point counts, and
+# measures the chain's time per rotation on a simulated rotation
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import time
+
+import numpy as np
+
+from ..lib.noiseFilters import NoiseFilterChain, FLAG_GLASS, FLAG_SUN
+from ..lib.simulator import Simulator
+
+
+NUM_POINTS = 360
+NUM_ROTATIONS = 200
+ALL_STAGES = [{'stage': 'intensity', 'minIntensity': 5}, {'stage': 'isolated'}, {'stage': 'rangeJump'},
+              {'stage': 'sunNoise'}, {'stage': 'glassNoise'}]
+
+
+def makeRotation():
+    ''' A flat 2m wall all around, in the device's order: starting at 90 degrees and wrapping around '''
+    angles = np.radians(np.arange(NUM_POINTS) + 90.0)
+    angles = np.where(angles >= np.pi, angles - (2 * np.pi), angles)
+    return {'angles': angles, 'distances': np.full(NUM_POINTS, 2.0),
+            'intensities': np.full(NUM_POINTS, 100), 'flags': np.zeros(NUM_POINTS, dtype=np.uint16)}
+
+def rejected(stages, rotation):
+    ''' The indices of the points the chain drops '''
+    chain = NoiseFilterChain(stages)
+    rotation = dict(rotation, index=np.arange(NUM_POINTS))
+    kept = chain.apply(rotation)['index']
+    return sorted(set(range(NUM_POINTS)) - set(kept.tolist())), chain
+
+def intensityCheck():
+    rotation = makeRotation()
+    rotation['intensities'][[10, 20, 30]] = [2, 255, 254]
+    dropped, _ = rejected([{'stage': 'intensity', 'minIntensity': 5, 'maxIntensity': 254}], rotation)
+    assert dropped == [10, 20]
+    print("intensity: PASSED (points outside the intensity limits)")
+
+def isolatedCheck():
+    rotation = makeRotation()
+    # a lone spike, a consistent pair, and the points either side of the wrap
+    rotation['distances'][50] = 1.0
+    rotation['distances'][[100, 101]] = [1.0, 1.01]
+    wrap = int(np.argmin(rotation['angles']))
+    rotation['distances'][[wrap - 1, wrap]] = [1.5, 1.51]
+    dropped, _ = rejected([{'stage': 'isolated'}], rotation)
+    assert dropped == [50], dropped
+    # both neighbours needed: the ends of the pairs, and the spike's neighbours, go too
+    dropped, _ = rejected([{'stage': 'isolated', 'minNeighbors': 2}], rotation)
+    assert set(dropped) == {49, 50, 51, 99, 100, 101, 102, wrap - 2, wrap - 1, wrap, wrap + 1}, dropped
+    # neighbours too far apart in angle don't count
+    sparse = makeRotation()
+    sparse['angles'] = np.radians(np.arange(NUM_POINTS) * 0.5)
+    sparse['angles'][200] += np.radians(5.0)
+    dropped, _ = rejected([{'stage': 'isolated', 'maxAngleGap': 2.0}], sparse)
+    assert dropped == [200], dropped
+    print("isolated: PASSED (lone spikes, not consistent pairs or neighbours across the wrap)")
+
+def rangeJumpCheck():
+    rotation = makeRotation()
+    # a 1m step: the far side's first point at each edge is clipped
+    rotation['distances'][150:200] = 3.0
+    dropped, _ = rejected([{'stage': 'rangeJump'}], rotation)
+    assert dropped == [150, 199], dropped
+    dropped, _ = rejected([{'stage': 'rangeJump', 'maxJump': 1.5}], rotation)
+    assert dropped == []
+    print("rangeJump: PASSED (far-side points at range edges)")
+
+def flagCheck():
+    rotation = makeRotation()
+    rotation['flags'][[5, 6]] = FLAG_SUN
+    rotation['flags'][7] = FLAG_GLASS
+    dropped, chain = rejected([{'stage': 'sunNoise'}], rotation)
+    assert dropped == [5, 6]
+    assert chain.driverHooks() == {'enableSunNoise': True, 'enableGlassNoise': False}
+    dropped, _ = rejected([{'stage': 'glassNoise'}], rotation)
+    assert dropped == [7]
+    # without flags from the driver, the SDK filters them
+    del rotation['flags']
+    dropped, chain = rejected([{'stage': 'sunNoise'}, {'stage': 'glassNoise'}], rotation)
+    assert (dropped == []) and (chain.status()['noiseRemoved'] == {'sunNoise': 0, 'glassNoise': 0})
+    print("flags: PASSED (sun/glass flagged points, driver hooks without flags)")
+
+def chainCheck():
+    rotation = makeRotation()
+    rotation['intensities'][10] = 0
+    rotation['distances'][50] = 1.0
+    rotation['distances'][150:200] = 3.0
+    rotation['flags'][300] = FLAG_SUN
+    chain = NoiseFilterChain(ALL_STAGES)
+    filtered = chain.apply(rotation)
+    removed = chain.status()['noiseRemoved']
+    assert removed == {'intensity': 1, 'isolated': 1, 'rangeJump': 2, 'sunNoise': 1, 'glassNoise': 0}, removed
+    # still in the device's order
+    keep = np.ones(NUM_POINTS, dtype=bool)
+    keep[[10, 50, 150, 199, 300]] = False
+    assert np.array_equal(filtered['angles'], rotation['angles'][keep])
+    assert NoiseFilterChain().apply(rotation)['angles'].tolist() == rotation['angles'].tolist()
+    try:
+        NoiseFilterChain([{'stage': 'bogus'}])
+        assert False, "unknown stage"
+    except ValueError:
+        pass
+    print("chain: PASSED (stages in order, per-stage counts, device order kept)")
+
+def timingCheck():
+    simulator = Simulator(seed=1)
+    names = ('angles', 'distances', 'intensities', 'flags')
+    rotations = [{k: v for k, v in simulator.rotation().items() if k in names} for _ in range(NUM_ROTATIONS)]
+    chain = NoiseFilterChain(ALL_STAGES)
+    start = time.perf_counter()
+    for rotation in rotations:
+        chain.apply(rotation)
+    elapsed = (time.perf_counter() - start) / NUM_ROTATIONS
+    totals = chain.status()['noiseTotalRemoved']
+    print(f"timing: PASSED ({elapsed * 1000:.3f} ms/rotation of {len(rotations[0]['angles'])} points; "
+          f"removed {totals} over {NUM_ROTATIONS} rotations)")
+
+
+if __name__ == "__main__":
+    intensityCheck()
+    isolatedCheck()
+    rangeJumpCheck()
+    flagCheck()
+    chainCheck()
+    timingCheck()
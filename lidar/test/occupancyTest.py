@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Occupancy grid test: checks the hit and free (pass-through) updates, saving
+# and reloading a grid, the changes found against a baseline (also from a
+# pipeline stage), and measures the per-rotation update time
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from ..lib.occupancy import OccupancyGrid
+from ..lib.pipeline import Pipeline, Rotation, makeStage
+
+
+NUM_POINTS = 1000
+NUM_ROTATIONS = 100
+SCAN_FREQ = 12.0            # Hz, the update has to keep up with the rotations
+WALL = 3.0                  # meters
+CRITTER = 2.0
+
+
+def makeRotation(rng, critter=False):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    distances = WALL + rng.normal(0.0, 0.005, NUM_POINTS)
+    if critter:
+        # N.B. about 10 cm wide, straight ahead
+        distances[(NUM_POINTS // 2) - 4:(NUM_POINTS // 2) + 4] = CRITTER
+    return angles, distances
+
+def updateCheck():
+    grid = OccupancyGrid(maxRange=4.0, decay=1.0)
+    grid.integrate([0.0, np.pi / 2], [1.0, 0.0])
+    row, col = grid.center, grid.center + int(round(1.0 / grid.cellSize))
+    assert np.isclose(grid.grid[row, col], grid.logHit)
+    # the cells the ray passed through are free, once however many samples fell in them
+    assert np.allclose(grid.grid[row, grid.center:col - 1], grid.logMiss)
+    # a sample without a return updates nothing
+    assert np.count_nonzero(grid.grid) == (col - grid.center + 1)
+    for _ in range(20):
+        grid.integrate([0.0], [1.0])
+    assert np.isclose(grid.grid[row, col], grid.logMax) and np.isclose(grid.grid[row, grid.center], grid.logMin)
+    assert (grid.probabilities()[row, col] > 0.95) and (grid.probabilities()[row, grid.center] < 0.05)
+    # decay moves cells back toward unknown
+    grid.decay = 0.5
+    grid.integrate([], [])
+    assert np.isclose(grid.grid[row, col], grid.logMax / 2)
+    print("update: PASSED (hits, pass-throughs, clamping, decay)")
+
+def saveCheck(directory):
+    rng = np.random.default_rng(1)
+    grid = OccupancyGrid(maxRange=4.0)
+    for _ in range(10):
+        grid.integrate(*makeRotation(rng))
+    path = os.path.join(directory, "grid.npz")
+    grid.save(path)
+    loaded = OccupancyGrid.load(path)
+    assert np.array_equal(loaded.grid, grid.grid) and (loaded.numRotations == 10)
+    assert (loaded.cellSize, loaded.size, loaded.decay) == (grid.cellSize, grid.size, grid.decay)
+    print(f"save: PASSED ({os.path.getsize(path)} bytes)")
+
+def diffCheck(directory):
+    rng = np.random.default_rng(1)
+    baseline = OccupancyGrid(maxRange=4.0)
+    for _ in range(10):
+        baseline.integrate(*makeRotation(rng))
+    grid = OccupancyGrid.load(os.path.join(directory, "grid.npz"))
+    for _ in range(10):
+        grid.integrate(*makeRotation(rng, critter=True))
+    diff = grid.diff(baseline)
+    assert len(diff['appeared']) > 0, "critter not found"
+    # everything that appeared is the critter, straight ahead at its distance
+    assert np.allclose(diff['appearedXY'][:, 0], CRITTER, atol=0.05)
+    assert np.all(np.abs(diff['appearedXY'][:, 1]) < 0.1)
+    assert len(grid.diff(grid)['appeared']) == 0
+    try:
+        grid.diff(OccupancyGrid(maxRange=2.0))
+        assert False, "mismatched baseline"
+    except ValueError:
+        pass
+    print(f"diff: PASSED ({len(diff['appeared'])} cells appeared, {len(diff['vanished'])} vanished)")
+
+def stageCheck(directory):
+    rng = np.random.default_rng(2)
+    snapshot = os.path.join(directory, "stage.npz")
+    pipeline = Pipeline([makeStage({'stage': 'occupancy', 'maxRange': 4.0, 'snapshot': snapshot})])
+    for _ in range(10):
+        angles, distances = makeRotation(rng)
+        pipeline.process(Rotation({'angles': angles, 'distances': distances}))
+    pipeline.shutdown()
+    pipeline = Pipeline([makeStage({'stage': 'occupancy', 'maxRange': 4.0, 'baseline': snapshot,
+                                    'diffEvery': 5})])
+    for _ in range(10):
+        angles, distances = makeRotation(rng, critter=True)
+        rotation = pipeline.process(Rotation({'angles': angles, 'distances': distances}))
+    assert rotation.meta['occupancy']['appeared'] > 0
+    status = pipeline.status()['pipeline'][0]
+    pipeline.shutdown()
+    try:
+        makeStage({'stage': 'occupancy', 'worker': 'process'})
+        assert False, "process worker"
+    except ValueError:
+        pass
+    print(f"stage: PASSED (baseline snapshot, {status['occupancyChanges']['appeared']} cells appeared, "
+          f"{status['meanMs']} ms/rotation)")
+
+def timingCheck():
+    rng = np.random.default_rng(3)
+    grid = OccupancyGrid()
+    rotations = [makeRotation(rng, critter=(i % 2)) for i in range(NUM_ROTATIONS)]
+    times = []
+    for angles, distances in rotations:
+        start = time.perf_counter()
+        grid.integrate(angles, distances)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000.0
+    start = time.perf_counter()
+    grid.diff(grid)
+    diffMs = (time.perf_counter() - start) * 1000.0
+    assert np.median(times) < (1000.0 / SCAN_FREQ), "can't keep up with the rotations"
+    print(f"timing: PASSED ({NUM_POINTS} points/rotation, {grid.size}x{grid.size} cells: "
+          f"{np.median(times):.2f} ms/rotation median, {np.max(times):.2f} ms max, diff {diffMs:.2f} ms; "
+          f"{1000.0 / SCAN_FREQ:.0f} ms between rotations)")
+
+
+if __name__ == "__main__":
+    updateCheck()
+    with tempfile.TemporaryDirectory() as directory:
+        saveCheck(directory)
+        diffCheck(directory)
+        stageCheck(directory)
+    timingCheck()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Parameter sweep test: labels a session with critters at known times, sweeps
+# a grid of detector/tracker parameters over it, checks the scores against
+# running the session analyzer with the same parameters, and that cached
+# intermediates are shared (and reused by a second sweep), and compares the
+# sweep's time with analyzing the session once per configuration
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+from ..lib.paramSweep import gridConfigs, loadLabels, metrics, randomConfigs, score, sweep, TRACKER_DEFAULTS
+from ..lib.sessionAnalyzer import analyzeSession, secsStamp
+from .sessionAnalyzerTest import CRITTERS, writeSession
+
+
+SPACE = {'model': ['reference', 'background', 'both'], 'margin': [-0.0025, -0.05, -0.1],
+         'clusterDist': [0.05, 0.2], 'minCluster': [2, 3, 5], 'minHits': [1, 2, 3], 'maxMissed': [3, 6]}
+
+
+def writeLabels(directory, paths, stamps):
+    ''' Critters from their first to last rotation, empty from 2 secs after one to 2 secs before the next '''
+    critters = [[secsStamp(stamps[first]), secsStamp(stamps[last - 1])] for first, last in CRITTERS]
+    bounds = [stamps[0] - 2.0] + [stamps[i] for c in CRITTERS for i in c] + [stamps[-1] + 2.0]
+    empty = [[secsStamp(bounds[i] + 2.0), secsStamp(bounds[i + 1] - 2.0)] for i in range(0, len(bounds), 2)]
+    path = os.path.join(directory, "session.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump({'recordings': [os.path.basename(p) for p in paths], 'critters': critters, 'empty': empty}, f)
+    return path
+
+def agreementTest(labels, results, paths):
+    ''' A sweep's scores are the analyzer's, for the same parameters '''
+    byModel = {}
+    for result in results:
+        byModel.setdefault(result['model'], result)
+    for model, result in byModel.items():
+        detector = {k: result[k] for k in ('model', 'margin', 'tolerance', 'numRef', 'angleBin', 'foregroundDist',
+                                           'learnRate', 'clusterDist') if result[k] is not None}
+        tracker = {k: result[k] for k in TRACKER_DEFAULTS}
+        events, _, _ = analyzeSession(paths, detector=detector, tracker=tracker, workers=1)
+        expected = metrics([score(events, labels)])
+        assert all(result[k] == v for k, v in expected.items()), f"{model}: sweep scores differ from the analyzer's"
+    print("agreement: PASSED (best config per model scored the same by the analyzer)")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as directory:
+        paths, stamps = writeSession(directory, rng)
+        labels = loadLabels(writeLabels(directory, paths, stamps))
+        assert len(labels['critters']) == len(CRITTERS) and (labels['recordings'] == paths)
+        cacheDir = os.path.join(directory, "cache")
+
+        configs = gridConfigs(SPACE)
+        results, summary = sweep([labels], configs, workers=2, cacheDir=cacheDir)
+        best = results[0]
+        assert (best['precision'] == 1.0) and (best['recall'] == 1.0), f"No config found every critter: {best}"
+        assert summary['intermediatesComputed'] < summary['configs'] / 4
+        print(f"sweep: PASSED ({summary['configs']} configs in {summary['elapsedSecs']:.1f} secs, "
+              f"{summary['intermediatesComputed']} intermediates computed, best: {best['model']} "
+              f"margin={best['margin']} minCluster={best['minCluster']} minHits={best['minHits']}, "
+              f"latency {best['latencyMean']} secs)")
+
+        again, againSummary = sweep([labels], randomConfigs(SPACE, 20, seed=1), workers=2, cacheDir=cacheDir)
+        assert againSummary['intermediatesComputed'] == 0, "Cached intermediates recomputed"
+        print(f"cached: PASSED ({againSummary['configs']} random configs in {againSummary['elapsedSecs']:.2f} secs)")
+
+        agreementTest(labels, results, paths)
+        start = time.perf_counter()
+        analyzeSession(paths, detector={'margin': -0.1}, workers=1)
+        once = time.perf_counter() - start
+        print(f"analyzer: {once:.1f} secs per config, ~{once * summary['configs'] / 60:.1f} mins for the grid")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Pipeline test: streams rotations through a pipeline and checks that a stage
+# (or sink) that raises only loses that rotation, and that stages added and
+# removed while streaming take effect (a removed history stage being closed
+# only once it's done with its last rotation, without the event loop waiting
+# for it)
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+from concurrent.futures import wait
+import tempfile
+import time
+
+import numpy as np
+
+from ..lib.pipeline import Pipeline, Rotation, Stage, FunctionStage, makeStage
+
+
+NUM_ROTATIONS = 10
+PERIOD = 0.01               # secs between submitted rotations
+SLOW = 0.5                  # secs the slow stage takes per rotation
+
+
+def makeRotation(i):
+    return Rotation({'angles': np.linspace(-np.pi, np.pi, 100, endpoint=False), 'distances': np.full(100, 2.0)},
+                    meta={'i': i})
+
+async def stream(pipeline, first=0):
+    for i in range(first, first + NUM_ROTATIONS):
+        pipeline.submit(makeRotation(i))
+        await asyncio.sleep(PERIOD)
+    await asyncio.sleep(0.1)
+
+def failOdd(rotation):
+    if rotation.meta['i'] % 2:
+        raise ValueError("odd rotation")
+    return rotation
+
+async def errorCheck():
+    received = []
+
+    async def sink(rotation):
+        received.append(rotation.meta['i'])
+        if rotation.meta['i'] == 4:
+            raise RuntimeError("sink failed")
+
+    pipeline = Pipeline([FunctionStage('failOdd', failOdd), FunctionStage('threaded', failOdd, worker='thread')])
+    pipeline.start(sink)
+    await stream(pipeline)
+    status = pipeline.status()
+    pipeline.shutdown()
+    assert received == list(range(0, NUM_ROTATIONS, 2)), received
+    assert [stage['errors'] for stage in status['pipeline']] == [NUM_ROTATIONS // 2, 0]
+    assert status['sinkErrors'] == 1
+    print(f"errors: PASSED ({status['pipeline'][0]['errors']} stage errors and {status['sinkErrors']} sink "
+          f"error logged, kept streaming)")
+
+async def changeCheck():
+    received = []
+
+    async def sink(rotation):
+        received.append(rotation)
+
+    pipeline = Pipeline()
+    pipeline.start(sink)
+    await stream(pipeline)
+    with tempfile.TemporaryDirectory() as path:
+        try:
+            makeStage({'stage': 'history', 'directory': path, 'worker': 'process'})
+            assert False, "history store opened in a process worker"
+        except ValueError:
+            pass
+        assert not pipeline.add(makeStage({'stage': 'history', 'directory': path, 'worker': 'thread'}))
+        assert not pipeline.add(makeStage({'stage': 'zones', 'zones': {'door': {'polygon': [[1, -1], [3, -1],
+                                                                                            [3, 1], [1, 1]]}}}))
+        await stream(pipeline, NUM_ROTATIONS)
+        history = pipeline.stages[0]
+        assert history.count == NUM_ROTATIONS
+        # N.B. removed while its worker's appending
+        pipeline.submit(makeRotation(2 * NUM_ROTATIONS))
+        await asyncio.sleep(0)
+        assert not pipeline.remove('history')
+        await stream(pipeline, (2 * NUM_ROTATIONS) + 1)
+        assert history.count <= NUM_ROTATIONS + 1
+        pipeline.shutdown()
+        wait(pipeline.retiring)
+    assert (pipeline.names() == ['zones']) and not pipeline.tasks
+    zoned = [rotation.meta['i'] for rotation in received if 'zones' in rotation.meta]
+    assert [rotation.meta['i'] for rotation in received[:NUM_ROTATIONS]] == list(range(NUM_ROTATIONS))
+    assert zoned and (zoned[-1] == (3 * NUM_ROTATIONS)), zoned
+    print(f"change: PASSED ({len(received)} rotations received, stages added and removed while streaming)")
+
+class SlowStage(Stage):
+    def __init__(self):
+        super().__init__('slow', worker='thread')
+        self.busy = False
+        self.closedBusy = None
+
+    def process(self, rotation):
+        self.busy = True
+        time.sleep(SLOW)
+        self.busy = False
+        return rotation
+
+    def close(self):
+        self.closedBusy = self.busy
+
+async def removeCheck():
+    ''' Removing a stage that's in the middle of a rotation doesn't block the event loop '''
+    async def sink(rotation):
+        pass
+
+    pipeline = Pipeline()
+    pipeline.start(sink)
+    slow = SlowStage()
+    assert not pipeline.add(slow)
+    pipeline.submit(makeRotation(0))
+    await asyncio.sleep(0.05)
+    start = time.monotonic()
+    assert not pipeline.remove('slow')
+    removing = time.monotonic() - start
+    assert (removing < 0.05) and (slow.closedBusy is None), f"remove took {removing * 1000:.0f} ms"
+    await asyncio.get_running_loop().run_in_executor(None, wait, pipeline.retiring)
+    closed = time.monotonic() - start
+    pipeline.shutdown()
+    assert (slow.closedBusy is False) and (closed < SLOW)
+    print(f"remove: PASSED (returned in {removing * 1000:.1f} ms, stage closed {closed * 1000:.0f} ms later "
+          f"when its worker was done)")
+
+
+if __name__ == "__main__":
+    asyncio.run(errorCheck())
+    asyncio.run(changeCheck())
+    asyncio.run(removeCheck())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Recordings export test: writes lidarPlot.py-style JSON recordings, exports
+# them (in parallel) to Parquet, checks the rows against the recordings and
+# that time/angle predicates skip row groups, and measures the export's peak
+# memory against the size of its input
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+from datetime import datetime, timedelta
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from ..lib.recordings import exportRecording, exportRecordings, iterRecording, readExport, scanExport
+
+
+NUM_POINTS = 500
+SCAN_FREQ = 10
+START = datetime(2025, 6, 1, 21, 0, 0)
+
+
+def writeRecording(path, numRotations, rng, truncated=False):
+    ''' Like lidarPlot.py's update() does '''
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    with open(path, "w") as f:
+        print("[", file=f)
+        for i in range(numRotations):
+            distances = 3.0 + (0.5 * np.cos(3 * angles)) + rng.normal(0.0, 0.02, NUM_POINTS)
+            intensities = rng.integers(0, 255, NUM_POINTS)
+            if f.tell() > 2:
+                print(",", file=f)
+            print(f"  {{\"sampleTime\": \"{START + timedelta(seconds=(i / SCAN_FREQ))}\", ", file=f)
+            print(f"   \"data\": {[[float(a), float(d), int(n)] for a, d, n in zip(angles, distances, intensities)]} }}",
+                  end="", file=f)
+        if truncated:
+            print(",\n  {\"sampleTime\": \"2025-06-01 23:59:59\", \"data\": [[0.1, 1.0", end="", file=f)
+        else:
+            print("]", file=f)
+
+def correctnessTest(directory, rng):
+    paths = [os.path.join(directory, f"rec{i}.json") for i in range(3)]
+    for i, path in enumerate(paths):
+        writeRecording(path, 1200, rng, truncated=(i == 2))
+    outDir = os.path.join(directory, "export")
+    start = time.perf_counter()
+    summaries = exportRecordings(paths, outDir, workers=3, sliceSecs=30)
+    elapsed = time.perf_counter() - start
+    assert all(s['rotations'] == 1200 for s in summaries), "Rotations missing (or the truncated one included)"
+    assert summaries[0]['rowGroups'] == 4 * 4, f"Wrong row groups: {summaries[0]['rowGroups']}"
+
+    table = readExport(summaries[0]['output'])
+    assert table.num_rows == 1200 * NUM_POINTS
+    rotations = list(iterRecording(paths[0]))
+    rows = table.filter(ds.field('rotation') == 321).sort_by('angle')
+    stamp, angles, distances, intensities = rotations[321]
+    assert rows['timestamp'][0].value == stamp.astype(np.int64)
+    assert np.allclose(rows['angle'].to_numpy(), angles, atol=1e-6)
+    assert np.allclose(rows['range'].to_numpy(), distances, atol=1e-6)
+    assert np.array_equal(rows['intensity'].to_numpy(), intensities)
+
+    # a 10 sec window, in one quadrant
+    t0, t1 = START + timedelta(seconds=40), START + timedelta(seconds=50)
+    window = readExport(outDir, t0, t1, 0.0, np.pi / 2)
+    stored = angles.astype(np.float32).astype(np.float64)
+    expected = 3 * (10 * SCAN_FREQ + 1) * np.count_nonzero((stored >= 0.0) & (stored <= np.pi / 2))
+    assert window.num_rows == expected, f"Wrong rows: {window.num_rows} != {expected}"
+    batched = sum(batch.num_rows for batch in scanExport(outDir, t0.isoformat(), t1, 0.0, np.pi / 2))
+    assert batched == expected
+
+    fragment = next(ds.dataset(summaries[0]['output'], format="parquet").get_fragments())
+    expr = (ds.field('timestamp') >= pa.scalar(t0)) & (ds.field('timestamp') <= pa.scalar(t1)) & \
+           (ds.field('angle') >= 0.0) & (ds.field('angle') <= np.pi / 2)
+    kept = fragment.split_by_row_group(expr)
+    assert len(kept) == 1, f"Predicates didn't skip row groups: {len(kept)} of {summaries[0]['rowGroups']} read"
+    print(f"correctness: PASSED (3 recordings exported in {elapsed:.2f} secs, "
+          f"1 of {summaries[0]['rowGroups']} row groups read for a 10 sec quadrant)")
+
+def exportPeak(path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    summary = exportRecording(path, f"{path}.parquet", sliceSecs=30)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summary, elapsed, peak
+
+def memoryTest(directory, rng):
+    peaks = []
+    for numRotations in (1000, 3000):
+        path = os.path.join(directory, f"long{numRotations}.json")
+        writeRecording(path, numRotations, rng)
+        summary, elapsed, peak = exportPeak(path)
+        peaks.append(peak)
+    inSize = os.path.getsize(path)
+    outSize = os.path.getsize(summary['output'])
+    print(f"export: {summary['rotations'] / elapsed:.0f} rotations/sec (traced), {inSize / 1e6:.1f} MB JSON -> "
+          f"{outSize / 1e6:.1f} MB Parquet, peak memory {peaks[1] / 1e6:.1f} MB (Python) + "
+          f"{pa.default_memory_pool().max_memory() / 1e6:.1f} MB (Arrow), {peaks[0] / 1e6:.1f} MB for a third of it")
+    assert peaks[1] < (1.25 * peaks[0]), "Export memory grows with the input"
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as directory:
+        correctnessTest(directory, rng)
+        memoryTest(directory, rng)
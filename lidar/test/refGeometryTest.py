@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Reference geometry cache test: replays a typical margins slider-drag
+# session (dragging each margin out and back a few times, in slider steps)
+# and reports the cache's hit rate and the time it saved
+#
+# N.B. run this on the client machine for representative numbers
+#
+################################################################################
+
+import time
+
+import numpy as np
+
+from ..lib.refGeometry import ReferenceGeometryCache, unionScans
+
+
+NUM_POINTS = 2000
+NUM_FRAMES = 50
+TOLERANCE = 0.02
+STEP = 0.01     # the lidarMargins slider's step
+
+
+def makeScans(rng, num):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    walls = 3.0 + (0.5 * np.cos(3 * angles))
+    scans = []
+    for _ in range(num):
+        distances = walls + rng.normal(0.0, 0.02, NUM_POINTS)
+        scans.append(np.column_stack((distances * np.cos(angles), distances * np.sin(angles))))
+    return scans
+
+def dragSession():
+    ''' (inner, outer) margins seen while dragging each handle out and back, three times '''
+    inner = np.round(np.arange(-0.05, -0.25, -STEP), 2)
+    outer = np.round(np.arange(0.05, 0.25, STEP), 2)
+    session = []
+    for _ in range(3):
+        session += [(m, 0.05) for m in np.concatenate((inner, inner[::-1]))]
+        session += [(-0.05, m) for m in np.concatenate((outer, outer[::-1]))]
+    return session
+
+def invalidationTest(cache, scans):
+    entry = cache.derive((-0.1, 0.1), TOLERANCE)
+    assert cache.get((-0.1, 0.1), TOLERANCE) is entry
+    cache.setReference(unionScans(scans[:10]))
+    assert cache.get((-0.1, 0.1), TOLERANCE) is None, "Stale geometry after recapture"
+    assert cache.put((-0.1, 0.1), TOLERANCE, entry, cache.refId - 1), "Stale entry was cached"
+    inner = cache.derive((-0.1, 0.1), TOLERANCE)['envelope']['inner']
+    outer = cache.derive((-0.1, 0.1), TOLERANCE)['envelope']['outer']
+    assert np.all(inner < outer), "Inner envelope outside the outer one"
+    print("invalidation: PASSED")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    scans = makeScans(rng, NUM_FRAMES)
+    cache = ReferenceGeometryCache()
+    cache.setReference(unionScans(scans))
+
+    session = dragSession()
+    start = time.perf_counter()
+    for margins in session:
+        cache.derive(margins, TOLERANCE)
+    elapsed = time.perf_counter() - start
+    status = cache.status()
+    print(f"slider drag: {len(session)} updates in {elapsed * 1000:.1f} ms, hit rate {status['hitRate']}, "
+          f"time saved {status['timeSavedMs']} ms ({status['entries']} cached geometries)")
+
+    invalidationTest(cache, scans)
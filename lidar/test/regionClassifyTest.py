@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Region classifier test, against per-point shapely predicates, and a
+# benchmark against the per-scan Polygon construction and area comparison
+# that lidarGeom's updateDots() (and the web client's getSamples()) do
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import time
+
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon, box
+
+from ..lib.refGeometry import deriveGeometry, unionScans
+from ..lib.regionClassify import RegionClassifier, LABEL_INSIDE, LABEL_MARGIN, LABEL_OUTSIDE
+
+
+NUM_POINTS = 2000
+NUM_ROTATIONS = 200
+NUM_ZONES = 16
+
+
+def makeRotations(rng, num):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    walls = 3.0 + (0.5 * np.cos(3 * angles))
+    rotations = []
+    for _ in range(num):
+        distances = walls + rng.normal(0.0, 0.02, NUM_POINTS)
+        critter = rng.integers(0, NUM_POINTS - 20)
+        distances[critter:critter + 20] -= 1.0
+        distances[rng.random(NUM_POINTS) < 0.05] = 0.0
+        rotations.append((angles, distances))
+    return rotations
+
+def makeZones(num):
+    thetas = np.linspace(-np.pi, np.pi, num, endpoint=False)
+    return {f"zone{i}": box(2.0 * np.cos(t) - 0.4, 2.0 * np.sin(t) - 0.4, 2.0 * np.cos(t) + 0.4, 2.0 * np.sin(t) + 0.4)
+            for i, t in enumerate(thetas)}
+
+def currentMethod(refArea, angles, distances):
+    ''' What updateDots() does with each rotation '''
+    polarToCartesian = lambda theta, r: ((r * np.cos(theta)), (r * np.sin(theta)))
+    cartCoords = [polarToCartesian(theta, r) for theta, r in zip(angles, distances)]
+    poly = Polygon(cartCoords)
+    areaDiff = refArea - poly.area
+    xy = poly.exterior.coords
+    x, y = zip(*xy)
+    return areaDiff
+
+def correctnessTest(derived, rotations):
+    zones = makeZones(NUM_ZONES)
+    few = RegionClassifier.fromGeometry(derived, dict(list(zones.items())[:4]))
+    classifier = RegionClassifier.fromGeometry(derived, zones)
+    for angles, distances in rotations[:5]:
+        labels, zoneIds, counts = classifier.classify(angles, distances)
+        for i in range(0, NUM_POINTS, 7):
+            if distances[i] <= 0:
+                continue
+            p = Point(distances[i] * np.cos(angles[i]), distances[i] * np.sin(angles[i]))
+            expected = LABEL_INSIDE if derived['inner'].contains(p) else \
+                       LABEL_MARGIN if derived['outer'].contains(p) else LABEL_OUTSIDE
+            assert labels[i] == expected, f"Label mismatch at point {i}"
+            inZones = [j for j, z in enumerate(zones.values()) if z.contains(p)]
+            assert (zoneIds[i] in inZones) if inZones else (zoneIds[i] == -1), f"Zone mismatch at point {i}"
+        x, y = distances * np.cos(angles), distances * np.sin(angles)
+        expected = np.where(shapely.contains_xy(derived['inner'], x, y), LABEL_INSIDE,
+                            np.where(shapely.contains_xy(derived['outer'], x, y), LABEL_MARGIN, LABEL_OUTSIDE))
+        valid = distances > 0
+        assert np.array_equal(labels[valid], expected[valid]), "Radial bounds mislabelled a point"
+        _, _, fewCounts = few.classify(angles, distances)
+        assert fewCounts['regions'] == counts['regions']
+        assert all(counts['zones'][name] == n for name, n in fewCounts['zones'].items())
+        for name, zone in zones.items():
+            expected = valid & shapely.contains_xy(zone, x, y)
+            assert np.array_equal(classifier.inZone(name, angles, distances), expected), f"Zone bounds mislabelled {name}"
+    print("correctness: PASSED")
+
+def benchmark(reference, derived, rotations):
+    refArea = reference.area
+    start = time.perf_counter()
+    for angles, distances in rotations:
+        currentMethod(refArea, angles, distances)
+    current = (time.perf_counter() - start) / len(rotations)
+
+    results = []
+    for zones in ({}, makeZones(NUM_ZONES)):
+        classifier = RegionClassifier.fromGeometry(derived, zones)
+        start = time.perf_counter()
+        for angles, distances in rotations:
+            classifier.classify(angles, distances)
+        results.append((time.perf_counter() - start) / len(rotations))
+    print(f"per-scan Polygon: {current * 1000:.3f} ms/rotation")
+    print(f"classifier: {results[0] * 1000:.3f} ms/rotation ({current / results[0]:.1f}x), "
+          f"with {NUM_ZONES} zones: {results[1] * 1000:.3f} ms/rotation ({current / results[1]:.1f}x)")
+    assert (current / results[0]) >= 10.0, "Less than a 10x speedup"
+    assert (current / results[1]) >= 10.0, f"Less than a 10x speedup with {NUM_ZONES} zones"
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    rotations = makeRotations(rng, NUM_ROTATIONS)
+    scans = [np.column_stack((d * np.cos(a), d * np.sin(a))) for a, d in makeRotations(rng, 10)]
+    reference = unionScans([xy[np.hypot(xy[:, 0], xy[:, 1]) > 2.0] for xy in scans])
+    derived = deriveGeometry(reference, (-0.1, 0.1), 0.02)
+    correctnessTest(derived, rotations)
+    benchmark(reference, derived, rotations)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Resumable stream test: checks the replay buffer's sequencing and eviction,
+# that LidarClient reconnects by itself after its data connection is reset
+# or goes dead and gets every frame it missed (in order, once), that it's
+# told which frames it missed when they were evicted before it got back, or
+# when the server restarted (and its sequence numbers with it), and measures
+# the time-to-resume
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import json
+import multiprocessing
+import tempfile
+import time
+
+from ..shared import MessageTypes
+from ..lib.replayBuffer import ReplayBuffer, frameSeq, frameEpoch
+from ..lib.wcLidar import LidarClient, DEF_DATA_TIMEOUT
+from .batchingTest import CMD_PORT, DATA_PORT, LINK_PORT, Link, serve
+from .wsLoadTest import runServer, waitForServer
+
+
+LINK_RATE = 100e6           # bits/sec, i.e., the link isn't the bottleneck
+OPTIONS = {'driver': 'sim', 'rate': 50, 'seed': 1, 'minAngle': -30.0, 'maxAngle': 30.0}
+OUTAGE = 1.0                # secs the link refuses connections after a reset
+GAP_OUTAGE = 2.0            # secs, longer than the replay buffer keeps frames in the gap check
+GAP_REPLAY_SECS = 0.5
+RESTART_TIMEOUT = 10.0      # secs to get frames from the restarted server
+
+
+def bufferTest():
+    async def run():
+        replay = ReplayBuffer(maxSecs=60.0, maxFrames=5, maxBytes=1000)
+        waiter = asyncio.ensure_future(replay.next())
+        assert replay.since(0) == ([], None) and replay.since(3) == ([], 1)
+        seqs = [replay.add({'n': i}) for i in range(8)]
+        await asyncio.wait_for(waiter, 1.0)
+        assert seqs == list(range(1, 9))
+        assert all(frameSeq(frame) == s for s, frame in replay.since(3)[0])
+        assert all(frameEpoch(frame) == replay.epoch for _, frame in replay.since(3)[0])
+        other = ReplayBuffer(epoch=7)
+        other.add({'n': 0}, stream=2)
+        assert (frameEpoch(other.since(0)[0][0][1]) == 7) and (other.epoch != replay.epoch)
+        # the first three were evicted (at most five frames are kept)
+        assert [s for s, _ in replay.since(5)[0]] == [6, 7, 8] and replay.since(5)[1] is None
+        assert replay.since(8) == ([], None)
+        frames, nextSeq = replay.since(1)
+        assert [s for s, _ in frames] == [4, 5, 6, 7, 8] and (nextSeq == 4)
+        # a sequence number from before a restart
+        assert replay.since(20)[1] == 4
+        assert (replay.resume(5) == 3) and (replay.resume(1) == 0)
+        # a sequence number from another epoch picks up at the oldest frame kept
+        assert (replay.restart() == 4) and (other.restart() == 1)
+        assert frameEpoch(json.dumps({'type': MessageTypes.GAP.value, 'after': 1, 'next': 4, 'epoch': 7})) is None
+        # the byte bound, and the newest frame is kept whatever the bounds
+        replay.add({'big': "x" * 2000})
+        assert [s for s, _ in replay.since(0)[0]] == [9]
+        replay.configure(maxSecs=0.0, maxFrames=5, maxBytes=1000)
+        replay.add({'n': 10})
+        await asyncio.sleep(0.01)
+        assert [s for s, _ in replay.since(0)[0]] == [10]
+        assert frameSeq(json.dumps({'type': MessageTypes.GAP.value, 'after': 1, 'next': 4})) is None
+        # frames that have waited too long are skipped (live clients), but for the newest
+        live = ReplayBuffer()
+        [live.add({'n': i}) for i in range(3)]
+        await asyncio.sleep(0.05)
+        [live.add({'n': i}) for i in range(2)]
+        assert [s for s, _ in live.since(0, limit=2)[0]] == [1, 2]
+        frames, nextSeq = live.since(0, maxAge=0.03)
+        assert [s for s, _ in frames] == [4, 5] and (nextSeq == 4)
+        assert live.since(3, maxAge=0.03)[1] is None
+        await asyncio.sleep(0.05)
+        assert [s for s, _ in live.since(3, maxAge=0.03)[0]] == [5]
+        return replay.status() | {'liveSkipped': live.status()['replaySkipped']}
+
+    status = asyncio.run(run())
+    assert (status['replayLastSeq'] == 10) and (status['replayEvicted'] == 9) and (status['replayGaps'] == 6)
+    assert status['liveSkipped'] == 4
+    print("buffer: PASSED (sequencing, epochs, frame/byte/age eviction, gaps, skipping stale frames)")
+
+async def collect(client, secs, frames):
+    deadline = time.monotonic() + secs
+    while time.monotonic() < deadline:
+        try:
+            frames.append(json.loads(client.msgQ.get_nowait()))
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(0.005)
+
+async def startStream(replay=None):
+    if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+        raise RuntimeError("Lidar server didn't start")
+    link = Link(LINK_RATE)
+    await link.start()
+    client = LidarClient("127.0.0.1", CMD_PORT, LINK_PORT)
+    assert not await client.init(OPTIONS)
+    if replay:
+        assert await client.set({'replay': replay}) is not None
+    assert not await client.stream(['distances'])
+    return link, client
+
+async def outage(link, client, secs, frames):
+    ''' Reset the link's connections, and refuse new ones for a while '''
+    link.drop()
+    link.close()
+    await collect(client, secs, frames)
+    await link.start()
+    return time.monotonic()
+
+def contiguous(frames):
+    seqs = [frame['seq'] for frame in frames]
+    return (len(seqs) > 0) and (seqs == list(range(seqs[0], seqs[0] + len(seqs))))
+
+async def resumeCheck():
+    ''' No frames are lost or duplicated across a reset and a dead connection, as long as they're kept '''
+    link, client = await startStream()
+    frames = []
+    await collect(client, 2.0, frames)
+    await outage(link, client, OUTAGE, frames)
+    await collect(client, 2.0, frames)
+    link.stall()
+    stalledAt = time.monotonic()
+    while len(client.resumeTimes) < 2 and (time.monotonic() - stalledAt) < (DEF_DATA_TIMEOUT + 5.0):
+        await collect(client, 0.1, frames)
+    await collect(client, 1.0, frames)
+    client.close()
+    status = await client.status()
+    link.close()
+    stream = client.streamStatus()
+    assert all(frame['type'] == MessageTypes.REPLY.value for frame in frames), "unexpected gap/error"
+    assert contiguous(frames), "frames missing or repeated"
+    assert (len(client.resumeTimes) == 2) and (stream['gaps'] == 0) and (status['replayResumes'] >= 2)
+    reset, stall = client.resumeTimes
+    assert stall > DEF_DATA_TIMEOUT
+    print(f"resume: PASSED ({len(frames)} frames in order, {status['replayReplayed']} replayed; "
+          f"time-to-resume: reset {reset * 1000:.0f} ms (about {(reset - OUTAGE) * 1000:.0f} ms after the link "
+          f"came back), dead connection {stall * 1000:.0f} ms ({DEF_DATA_TIMEOUT:.0f} secs of it to notice))")
+
+async def gapCheck():
+    ''' Frames evicted before the client gets back are reported by a gap marker '''
+    link, client = await startStream({'maxSecs': GAP_REPLAY_SECS})
+    frames = []
+    await collect(client, 1.0, frames)
+    await outage(link, client, GAP_OUTAGE, frames)
+    await collect(client, 2.0, frames)
+    client.close()
+    link.close()
+    gaps = [i for i, frame in enumerate(frames) if frame['type'] == MessageTypes.GAP.value]
+    assert len(gaps) == 1, f"{len(gaps)} gap markers"
+    before, gap, after = frames[:gaps[0]], frames[gaps[0]], frames[gaps[0] + 1:]
+    assert contiguous(before) and contiguous(after)
+    assert (gap['after'] == before[-1]['seq']) and (gap['next'] == after[0]['seq'])
+    missed = gap['next'] - gap['after'] - 1
+    # N.B. about what's acquired during the outage, less what the replay buffer still has
+    expected = (GAP_OUTAGE - GAP_REPLAY_SECS) * OPTIONS['rate']
+    assert (0.5 * expected) < missed < (2.0 * expected), f"missed {missed} frames"
+    assert client.streamStatus()['missed'] == missed
+    print(f"gap: PASSED (missed {missed} frames during a {GAP_OUTAGE:.0f} sec outage, "
+          f"{len(after)} frames after resuming)")
+
+def startServer(directory):
+    server = multiprocessing.Process(target=runServer, args=(directory, CMD_PORT, DATA_PORT), daemon=True)
+    server.start()
+    return server
+
+def stopServer(server):
+    server.terminate()
+    server.join(5)
+
+async def restartCheck():
+    ''' A client resuming with the sequence number of a server that's since restarted is told, and picks up '''
+    with tempfile.TemporaryDirectory() as directory:
+        server = startServer(directory)
+        try:
+            if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+                raise RuntimeError("Lidar server didn't start")
+            # N.B. straight to the server's data port, the restart resets the connection
+            client = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+            assert not await client.init(OPTIONS)
+            assert not await client.stream(['distances'])
+            frames = []
+            await collect(client, 1.0, frames)
+            epoch = client.epoch
+            stopServer(server)
+            server = startServer(directory)
+            if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+                raise RuntimeError("Lidar server didn't restart")
+            restarted = time.monotonic()
+            # N.B. the client's still streaming, another one starts the restarted server's stream
+            other = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+            assert not await other.init(OPTIONS)
+            assert not await other.stream(['distances'])
+            while (client.epoch == epoch) and ((time.monotonic() - restarted) < RESTART_TIMEOUT):
+                await collect(client, 0.1, frames)
+            await collect(client, 1.0, frames)
+            client.close()
+            other.close()
+        finally:
+            stopServer(server)
+    gaps = [i for i, frame in enumerate(frames) if frame['type'] == MessageTypes.GAP.value]
+    assert len(gaps) == 1, f"{len(gaps)} gap markers"
+    before, gap, after = frames[:gaps[0]], frames[gaps[0]], frames[gaps[0] + 1:]
+    assert contiguous(before) and contiguous(after)
+    assert all(frame['epoch'] == epoch for frame in before) and all(frame['epoch'] == gap['epoch'] for frame in after)
+    assert (gap['epoch'] != epoch) and (gap['after'] == before[-1]['seq']) and (gap['next'] <= after[0]['seq'])
+    stream = client.streamStatus()
+    assert (stream['epoch'] == gap['epoch']) and (stream['gaps'] == 1) and (stream['missed'] == 0)
+    print(f"restart: PASSED (resumed after frame {gap['after']} of the old epoch at frame {after[0]['seq']} "
+          f"of the new one, {len(after)} frames after the restart)")
+
+
+if __name__ == "__main__":
+    bufferTest()
+    serve(resumeCheck)
+    serve(gapCheck)
+    asyncio.run(restartCheck())
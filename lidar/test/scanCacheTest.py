@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Cached scan test: checks that a SCAN with 'maxAgeMs' issued while streaming
+# is served from the latest rotation when it's fresh enough, waits for the
+# stream's next rotation otherwise, and returns an error (leaving the stream
+# running) when the stream doesn't deliver one in time, and that a cached
+# rotation's age counts from when it was acquired
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import json
+import time
+
+import websockets
+
+from ..shared import MessageTypes, Commands
+from ..lib.rotationCache import RotationCache
+from .batchingTest import CMD_PORT, DATA_PORT, serve
+from .wsLoadTest import waitForServer
+
+
+# N.B. longer than the server waits for the stream's next rotation, shorter than the stream's own deadline
+ROTATION_PERIOD = 1.8       # secs
+OPTIONS = {'driver': 'sim', 'rate': 1.0 / ROTATION_PERIOD, 'seed': 1, 'minAngle': -30.0, 'maxAngle': 30.0}
+NAMES = ['angles', 'distances']
+
+
+def ageCheck():
+    ''' A rotation that spent a while in the pipeline before it was cached is that much older '''
+    cache = RotationCache()
+    cache.put({'angles': [0.0]}, time.monotonic() - 0.5)
+    assert (cache.get(0.3) is None) and (cache.get(1.0) is not None) and (cache.age() >= 0.5)
+    cache.put({'angles': [0.0]})
+    assert cache.get(0.3) is not None
+    print("age: PASSED (counted from acquisition, a rotation acquired 500 ms before it was cached misses a 300 ms bound)")
+
+async def command(socket, command, **args):
+    await socket.send(json.dumps({'type': MessageTypes.CMD.value, 'command': command} | args))
+    return json.loads(await socket.recv())
+
+async def timedScan(socket, maxAgeMs):
+    start = time.monotonic()
+    response = await command(socket, Commands.SCAN.value, names=NAMES, maxAgeMs=maxAgeMs)
+    return response, time.monotonic() - start
+
+async def streamCheck():
+    cmdURI = f"ws://127.0.0.1:{CMD_PORT}"
+    if await waitForServer(cmdURI):
+        raise RuntimeError("Lidar server didn't start")
+    # N.B. a new command connection stops streaming, so everything goes over this one
+    async with websockets.connect(cmdURI) as socket, websockets.connect(f"ws://127.0.0.1:{DATA_PORT}") as data:
+        assert (await command(socket, Commands.INIT.value, options=OPTIONS))['type'] == MessageTypes.REPLY.value
+        assert (await command(socket, Commands.STREAM.value, names=NAMES))['type'] == MessageTypes.REPLY.value
+        # N.B. the stream command is answered twice
+        await socket.recv()
+        first = json.loads(await asyncio.wait_for(data.recv(), ROTATION_PERIOD))
+        # fresh enough
+        fresh, freshSecs = await timedScan(socket, 1000.0 * ROTATION_PERIOD)
+        assert fresh['type'] == MessageTypes.REPLY.value and fresh['values']['angles'], fresh
+        # too old, and the stream's next rotation doesn't come in time
+        await asyncio.sleep(0.5)
+        stalled, stalledSecs = await timedScan(socket, 10.0)
+        assert stalled['type'] == MessageTypes.ERROR.value, "expected an error"
+        # still streaming: the next rotation is waited for, and sent on the data socket
+        waited, waitedSecs = await timedScan(socket, 10.0)
+        second = json.loads(await asyncio.wait_for(data.recv(), ROTATION_PERIOD))
+    assert waited['type'] == MessageTypes.REPLY.value, waited
+    assert second['seq'] == first['seq'] + 1
+    assert stalledSecs < ROTATION_PERIOD
+    print(f"stream: PASSED (fresh rotation in {freshSecs * 1000:.1f} ms, error after {stalledSecs * 1000:.0f} ms "
+          f"without a rotation, next rotation waited for {waitedSecs * 1000:.0f} ms, stream kept running)")
+
+
+if __name__ == "__main__":
+    ageCheck()
+    serve(streamCheck)
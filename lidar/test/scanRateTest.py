@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Adaptive scan rate controller, replayed against a fixed 12Hz scan rate
+#
+# Replays lidarPlot JSON recordings (given on the command line), or a
+# synthetic one with a quiet scene and a short burst of activity, resampled to
+# whatever scan frequency and sample rate the controller picks.  Reports the
+# CPU time (controller plus JSON encoding), bandwidth (encoded bytes), and
+# motor-on time at each rate.
+#
+################################################################################
+
+from datetime import datetime
+import json
+import sys
+import time
+
+import numpy as np
+
+from ..shared import MIN_SCAN_FREQ, MAX_SCAN_FREQ, MAX_SAMPLE_RATE
+from ..lib.scanRate import ScanRateController
+
+
+DURATION = 120.0          # secs of synthetic recording
+ACTIVE = (60.0, 75.0)     # secs when a critter wanders through
+
+
+def syntheticRecording(rng):
+    ''' Rotations at the max rate, as (time, angles, distances, intensities) '''
+    numPoints = int((MAX_SAMPLE_RATE * 1000) / MAX_SCAN_FREQ)
+    angles = np.linspace(-np.pi, np.pi, numPoints, endpoint=False)
+    walls = 3.0 + np.abs(np.sin(angles * 2.0))
+    rotations = []
+    for t in np.arange(0.0, DURATION, 1.0 / MAX_SCAN_FREQ):
+        distances = walls + rng.normal(0.0, 0.01, numPoints)
+        if ACTIVE[0] <= t < ACTIVE[1]:
+            center = -np.pi + (2 * np.pi * (t - ACTIVE[0]) / (ACTIVE[1] - ACTIVE[0]))
+            critter = np.abs(np.angle(np.exp(1j * (angles - center)))) < 0.08
+            distances[critter] = 1.5
+        rotations.append((t, angles, distances, rng.integers(50, 200, numPoints)))
+    return rotations
+
+def loadRecording(path):
+    ''' lidarPlot's log data: [{'sampleTime': <datetime str>, 'data': [[<rad>, <m>, <int>], ...]}, ...] '''
+    with open(path, "r") as f:
+        samples = json.load(f)
+    start = datetime.fromisoformat(samples[0]['sampleTime'])
+    rotations = []
+    for sample in samples:
+        data = np.asarray(sample['data'], dtype=np.float64).reshape(-1, 3)
+        t = (datetime.fromisoformat(sample['sampleTime']) - start).total_seconds()
+        rotations.append((t, data[:, 0], data[:, 1], data[:, 2].astype(int)))
+    return rotations
+
+def replay(rotations, controller=None):
+    ''' Sample the recording at the rate being used, returns the totals '''
+    scanFreq, sampleRate = controller.setting() if controller else (MAX_SCAN_FREQ, MAX_SAMPLE_RATE)
+    times = np.array([r[0] for r in rotations])
+    end = times[-1]
+    t = 0.0
+    cpu = 0.0
+    numBytes = 0
+    numRotations = 0
+    motorTime = {}
+    firstActive = None
+    while t <= end:
+        stamp, angles, distances, intensities = rotations[min(np.searchsorted(times, t), len(rotations) - 1)]
+        step = max(1, int(round(MAX_SAMPLE_RATE / sampleRate)))
+        angles, distances, intensities = angles[::step], distances[::step], intensities[::step]
+        start = time.process_time()
+        if controller:
+            change = controller.update(angles, distances, now=t)
+            if change:
+                if controller.active and (firstActive is None):
+                    firstActive = stamp
+                scanFreq, sampleRate = change
+        msg = json.dumps({'type': 'reply', 'values': {'angles': angles.tolist(),
+                                                      'distances': distances.tolist(),
+                                                      'intensities': intensities.tolist()}})
+        cpu += time.process_time() - start
+        numBytes += len(msg)
+        numRotations += 1
+        motorTime[scanFreq] = motorTime.get(scanFreq, 0.0) + (1.0 / scanFreq)
+        t += 1.0 / scanFreq
+    return {'cpu': cpu, 'bytes': numBytes, 'rotations': numRotations, 'motorTime': motorTime,
+            'firstActive': firstActive}
+
+def report(name, rotations):
+    fixed = replay(rotations)
+    controller = ScanRateController()
+    adaptive = replay(rotations, controller)
+    duration = rotations[-1][0]
+    print(f"{name}: {duration:.1f} secs")
+    for label, res in (("fixed 12Hz", fixed), ("adaptive", adaptive)):
+        motor = ", ".join(f"{f:.0f}Hz: {s:.1f}s" for f, s in sorted(res['motorTime'].items()))
+        powerProxy = sum(f * s for f, s in res['motorTime'].items()) / (MAX_SCAN_FREQ * duration)
+        print(f"  {label:>10}: cpu {1000 * res['cpu'] / duration:.2f} ms/s, "
+              f"bandwidth {res['bytes'] / duration / 1024:.1f} KB/s, rotations {res['rotations']}, "
+              f"motor ({motor}), power proxy {powerProxy:.2f}")
+    print(f"  rate changes: {controller.numChanges}, controller cpu: "
+          f"{1000 * controller.cpuTime / controller.numRotations:.3f} ms/rotation")
+    return controller, adaptive
+
+def syntheticTest():
+    rotations = syntheticRecording(np.random.default_rng(1))
+    controller, adaptive = report("synthetic", rotations)
+    latency = adaptive['firstActive'] - ACTIVE[0]
+    print(f"  ramp-up latency: {latency * 1000:.0f} ms")
+    assert latency <= 2.0 / MIN_SCAN_FREQ, "Ramp up took more than two rotations"
+    assert controller.numChanges == 2, "Rate should ramp up once and back down once"
+    print("synthetic replay: PASSED")
+
+
+if __name__ == "__main__":
+    syntheticTest()
+    for path in sys.argv[1:]:
+        report(path, loadRecording(path))
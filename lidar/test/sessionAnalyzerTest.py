@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Session analyzer test: writes a session of (12Hz) recordings with critters
+# at known times (one spanning the two recordings), checks the events found,
+# that analyzing the session in parallel chunks finds the same events as one
+# pass over it, checks the (run-based) event tracking against the
+# per-rotation tracker, and measures the throughput
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+from datetime import datetime, timedelta
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from ..lib.sessionAnalyzer import analyzeSession, stampSecs, trackEvents, EventTracker
+
+
+NUM_POINTS = 400
+SCAN_FREQ = 12
+ROTATIONS_PER_FILE = 2500
+CRITTERS = [(600, 660), (1400, 1480), (2450, 2560), (4000, 4050)]   # [first, last) rotations
+START = datetime(2025, 6, 1, 21, 0, 0)
+DETECTOR = {'margin': -0.1, 'minCluster': 3}
+
+
+def writeSession(directory, rng):
+    ''' Recordings as lidarPlot.py writes them, returns their paths and the rotations' stamps '''
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False)
+    walls = 3.0 + (0.5 * np.cos(3 * angles))
+    paths, stamps = [], []
+    for n in range(2):
+        path = os.path.join(directory, f"session{n}.json")
+        with open(path, "w") as f:
+            print("[", file=f)
+            for i in range(n * ROTATIONS_PER_FILE, (n + 1) * ROTATIONS_PER_FILE):
+                distances = walls + rng.normal(0.0, 0.02, NUM_POINTS)
+                distances[rng.random(NUM_POINTS) < 0.02] = 0.0
+                for first, last in CRITTERS:
+                    if first <= i < last:
+                        center = (first * 7 + (i - first) // 4) % NUM_POINTS
+                        distances[center:center + 6] = 1.5 + rng.normal(0.0, 0.01, len(distances[center:center + 6]))
+                stamp = START + timedelta(seconds=(i / SCAN_FREQ))
+                stamps.append(np.datetime64(stamp, 'us'))
+                if f.tell() > 2:
+                    print(",", file=f)
+                print(f"  {{\"sampleTime\": \"{stamp}\", ", file=f)
+                print(f"   \"data\": {json.dumps(np.column_stack((angles, distances, np.full(NUM_POINTS, 100))).tolist())} }}",
+                      end="", file=f)
+            print("]", file=f)
+        paths.append(path)
+    return paths, stampSecs(stamps)
+
+def checkEvents(events, stamps, model):
+    assert len(events) == len(CRITTERS), f"{model}: found {len(events)} events, not {len(CRITTERS)}"
+    for event, (first, last) in zip(events, CRITTERS):
+        assert abs(event['start'] - stamps[first]) < 1e-3, f"{model}: event started late"
+        assert abs(event['end'] - stamps[last - 1]) < 1e-3, f"{model}: event ended early/late"
+
+def analyzerTest(paths, stamps):
+    for model in ('reference', 'background'):
+        detector = {'model': model, 'margin': DETECTOR['margin']}
+        tracker = {'minCluster': DETECTOR['minCluster']}
+        events, summary, _ = analyzeSession(list(reversed(paths)), detector=detector, tracker=tracker,
+                                            workers=1, chunkRotations=len(stamps))
+        checkEvents(events, stamps, model)
+        chunked, chunkedSummary, _ = analyzeSession(paths, detector=detector, tracker=tracker,
+                                                    workers=4, chunkRotations=700)
+        assert chunkedSummary['chunks'] == 8
+        assert chunked == events, f"{model}: chunked analysis found different events"
+        print(f"{model}: PASSED ({len(events)} events, one pass {summary['elapsedSecs']:.1f} secs, "
+              f"{chunkedSummary['chunks']} chunks on 4 workers {chunkedSummary['elapsedSecs']:.1f} secs)")
+    return summary
+
+def trackerTest(rng):
+    ''' trackEvents() (stepping through runs of hits) finds what an EventTracker does, rotation by rotation '''
+    for _ in range(200):
+        n = rng.integers(1, 400)
+        stamps = np.cumsum(np.where(rng.random(n) < 0.02, 2.0, 1 / SCAN_FREQ))
+        sizes = rng.integers(0, 6, n) * (rng.random(n) < rng.random())
+        x, y = rng.random(n), rng.random(n)
+        params = {'minCluster': int(rng.integers(1, 5)), 'minHits': int(rng.integers(1, 4)),
+                  'maxMissed': int(rng.integers(0, 4))}
+        tracker = EventTracker(**params)
+        for rotation in zip(stamps, sizes, x, y):
+            tracker.update(*rotation)
+        assert trackEvents({'stamps': stamps, 'clusterSize': sizes, 'x': x, 'y': y}, **params) == tracker.finish()
+    print("tracker: PASSED")
+
+def throughput(summary):
+    rate = summary['rotations'] / summary['elapsedSecs']
+    day = 24 * 3600 * SCAN_FREQ
+    print(f"throughput: {rate:.0f} rotations/sec/core ({summary['speedup']:.1f}x real time at {SCAN_FREQ}Hz), "
+          f"a day of recordings on 8 cores: ~{day / (8 * rate) / 60:.1f} mins")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as directory:
+        trackerTest(rng)
+        paths, stamps = writeSession(directory, rng)
+        throughput(analyzerTest(paths, stamps))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Simulator test: checks the ray casting against shapely, the noise model's
+# statistics, that a recorded simulated session has its critters found by the
+# session analyzer when they were there, that the 'sim' driver paces (or
+# doesn't) its rotations, and measures how many rotations/sec are generated
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+from datetime import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+from shapely.geometry import LineString, Point
+
+from ..lib.sessionAnalyzer import analyzeSession, stampSecs
+from ..lib.simulator import Critter, Scene, Simulator, SimulatedLidar, Waypoints, writeRecording
+
+
+PERIMETER = [[-4.0, -3.0], [5.0, -3.0], [6.0, 1.0], [5.0, 4.0], [-4.0, 4.0]]
+OBSTACLES = [[[1.5, 1.0], [2.5, 1.0], [2.5, 2.0], [1.5, 2.0]], [[-3.0, -2.0], [-2.5, -2.5], [-2.0, -2.0]]]
+SCAN_FREQ = 12
+START = datetime(2025, 6, 1, 21, 0, 0)
+# critters cross the yard during [start, end) secs of the session
+CROSSINGS = [(20.0, 30.0, [[20.0, -3.5, 3.0], [30.0, 4.0, -2.5]]),
+             (45.0, 52.0, [[45.0, 4.5, 3.5], [52.0, 0.5, -2.5]])]
+
+
+def scene(critters=[]):
+    return Scene(PERIMETER, OBSTACLES, critters)
+
+def geometryTest(rng):
+    ''' Noise-free ranges are the distances to the nearest boundary/critter crossing, as shapely finds them '''
+    critter = Critter(Waypoints([[0.0, -1.0, 1.5]]), radius=0.3)
+    s = scene([critter])
+    angles = rng.uniform(-np.pi, np.pi, 500)
+    ranges, _ = s.cast(angles)
+    shapes = [s.perimeter.exterior] + [o.exterior for o in s.obstacles] + \
+        [Point(-1.0, 1.5).buffer(0.3, quad_segs=256).exterior]
+    for a, r in zip(angles, ranges):
+        ray = LineString([(0, 0), (20 * np.cos(a), 20 * np.sin(a))])
+        expected = min(Point(0, 0).distance(g) for shape in shapes
+                       for g in getattr(ray.intersection(shape), 'geoms', [ray.intersection(shape)])
+                       if not g.is_empty)
+        assert abs(r - expected) < 1e-3, f"range at {a:.3f}: {r} != {expected}"
+    print("geometry: PASSED (ray ranges match shapely's intersections)")
+
+def noiseTest():
+    sim = Simulator(scene(), scanFreq=10, sampleRate=4, seed=1)
+    exact = Simulator(scene(), scanFreq=10, sampleRate=4, rangeNoise=0.0, rangeNoiseSlope=0.0, dropout=0.0,
+                      angleJitter=0.0, seed=1)
+    rots = list(sim.rotations(200))
+    assert all(len(rot['angles']) == 400 for rot in rots)
+    assert len(Simulator(scene(), resolution=0.54).rotation()['angles']) == 667
+    truth = exact.rotation()
+    assert np.all(truth['distances'] > 0)
+    distances = np.stack([rot['distances'] for rot in rots])
+    dropped = np.mean(distances == 0)
+    assert 0.01 < dropped < 0.03, f"dropout rate {dropped}"
+    assert np.all(np.diff(rots[0]['angles'][rots[0]['angles'] > 0]) > 0)
+    first = np.array([rot['angles'][0] for rot in rots])
+    assert np.all((first >= 0) & (first < (2 * np.pi / 400)))
+    intensities = np.stack([rot['intensities'] for rot in rots])
+    assert intensities.max() <= 255 and np.all(intensities[distances == 0] == 0)
+    print(f"noise: PASSED ({dropped:.3f} dropped)")
+
+def detectionTest():
+    ''' Critters in a recorded, simulated session are found when they're in the yard '''
+    critters = [Critter(Waypoints(points), start=start, end=end) for start, end, points in CROSSINGS]
+    sim = Simulator(scene(critters), scanFreq=SCAN_FREQ, seed=2)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sim.json")
+        times = writeRecording(path, sim, 60 * SCAN_FREQ, START)
+        events, summary, _ = analyzeSession([path], detector={'margin': -0.1}, workers=1)
+    t0 = stampSecs([np.datetime64(START, 'us')])[0]
+    assert len(events) == len(CROSSINGS), f"found {len(events)} events, not {len(CROSSINGS)}"
+    for event, (start, end, _) in zip(events, CROSSINGS):
+        # N.B. critters are only seen once inside the margin, and might be hidden for a while
+        assert (start - 0.5) <= (event['start'] - t0) <= (start + 3.0), f"event started at {event['start'] - t0}"
+        assert (end - 3.0) <= (event['end'] - t0) <= (end + 0.5), f"event ended at {event['end'] - t0}"
+    print(f"detection: PASSED ({len(events)} crossings found in {len(times)} rotations)")
+
+def driverTest():
+    async def stream(lidar, count):
+        lidar.laserEnable(True)
+        n = 0
+        start = time.monotonic()
+        async for result in lidar.astream(['angles', 'distances']):
+            assert result['ok'] and len(result['values']['angles']) > 300
+            n += 1
+            if n == count:
+                lidar.streaming = False
+        return count / (time.monotonic() - start)
+
+    lidar = SimulatedLidar(driver='sim', scanFreq=12, rate=0, seed=3)
+    unpaced = asyncio.run(stream(lidar, 500))
+    lidar.rate = 50
+    paced = asyncio.run(stream(lidar, 50))
+    stat = lidar.status()
+    assert stat['driver'] == 'sim' and stat['simRotations'] == 550
+    assert abs(stat['simTime'] - (550 / 12)) < 1e-6
+    assert 40 < paced < 55, f"paced at {paced:.1f} rotations/sec"
+    assert lidar.setScanFreq(20) and not lidar.setScanFreq(6)
+    lidar.done()
+    print(f"driver: PASSED (streamed {unpaced:.0f} rotations/sec unpaced, {paced:.1f} paced at 50)")
+
+def throughput():
+    for name, critters, resolution in (("T-mini Pro (400 points), 1 critter", 1, None),
+                                       ("0.54 deg (667 points), 10 critters", 10, 0.54)):
+        s = Scene.fromConfig({'perimeter': PERIMETER, 'obstacles': OBSTACLES,
+                              'critters': [{'random': {'seed': i}} for i in range(critters)]})
+        sim = Simulator(s, resolution=resolution, seed=4)
+        count = 2000
+        start = time.perf_counter()
+        for _ in sim.rotations(count):
+            pass
+        rate = count / (time.perf_counter() - start)
+        assert rate > 200, f"{name}: only {rate:.0f} rotations/sec"
+        print(f"throughput: {name}: {rate:.0f} rotations/sec ({rate / 12:.0f}x real time at 12Hz)")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1)
+    geometryTest(rng)
+    noiseTest()
+    detectionTest()
+    driverTest()
+    throughput()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Warm standby test: checks the standby state machine on the sim driver (warm
+# and cold requests, the idle timeout, re-initializing the device), and
+# measures single-scan latency through the server with a simulated motor
+# spin-up, warm scans against the one rotation period they should take at most
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import time
+
+import numpy as np
+
+from ..lib.simulator import SimulatedLidar
+from ..lib.standby import Standby
+from ..lib.wcLidar import LidarClient
+from .batchingTest import CMD_PORT, DATA_PORT, serve
+from .wsLoadTest import waitForServer
+
+
+SCAN_FREQ = 12.0            # Hz
+SPIN_UP = 0.5               # secs, simulated motor spin-up
+TIMEOUT = 1.0               # secs, standby idle timeout
+NUM_SCANS = 20
+OPTIONS = {'driver': 'sim', 'scanFreq': SCAN_FREQ, 'seed': 1, 'spinUp': SPIN_UP}
+
+
+def stateCheck():
+    async def run():
+        standby = Standby(timeout=0.2)
+        scanner = SimulatedLidar(seed=1)
+        assert not standby.acquire(scanner) and scanner.scanning
+        assert not standby.release(scanner) and standby.active and scanner.scanning
+        assert not standby.acquire(scanner)
+        assert not standby.release(scanner)
+        await asyncio.sleep(0.3)
+        # the idle timeout powered the laser down
+        assert (not standby.active) and (not scanner.scanning)
+        assert not standby.acquire(scanner)
+        assert not standby.release(scanner)
+        # a new device ends the previous one's standby, without powering it down later
+        other = SimulatedLidar(seed=2)
+        standby.attach(other)
+        assert (not standby.active) and (standby.scanner is other) and (standby.status()['standbyRemaining'] is None)
+        await asyncio.sleep(0.3)
+        assert scanner.scanning
+        assert not standby.acquire(other)
+        # a zero timeout powers down right after the request
+        assert not standby.setTimeout(0) and not standby.release(other)
+        assert not other.scanning
+        assert standby.setTimeout(-1)
+        return standby.status()
+
+    status = asyncio.run(run())
+    assert (status['warmScans'] == 1) and (status['coldScans'] == 3)
+    print(f"state: PASSED ({status['warmScans']} warm, {status['coldScans']} cold requests)")
+
+async def timedScan(client):
+    start = time.perf_counter()
+    values = await client.scan(['angles', 'distances'])
+    assert values and values['angles'], "scan failed"
+    return time.perf_counter() - start
+
+async def latencyCheck():
+    if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+        raise RuntimeError("Lidar server didn't start")
+    client = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+    assert not await client.init(OPTIONS)
+    assert await client.set({'standbyTimeout': TIMEOUT}) is not None
+    cold = [await timedScan(client)]
+    warm = []
+    for _ in range(NUM_SCANS):
+        # N.B. at random points in the rotation
+        await asyncio.sleep(np.random.uniform(0.0, 2.0 / SCAN_FREQ))
+        warm.append(await timedScan(client))
+    await asyncio.sleep(TIMEOUT + 0.5)
+    asleep = await client.status()
+    cold.append(await timedScan(client))
+    client.close()
+    status = await client.status()
+    assert not asleep['standby'], "didn't power down after the idle timeout"
+    assert (status['warmScans'] == NUM_SCANS) and (status['coldScans'] == 2)
+    period = 1.0 / SCAN_FREQ
+    warm = np.array(warm) * 1000.0
+    cold = np.array(cold) * 1000.0
+    assert np.all(cold > SPIN_UP * 1000.0)
+    assert warm.max() <= period * 1000.0, f"warm scans take up to {warm.max():.1f} ms"
+    print(f"latency: PASSED (warm scans {np.median(warm):.1f} ms p50, {warm.max():.1f} ms max, "
+          f"one rotation is {period * 1000.0:.1f} ms; cold scans {cold.mean():.0f} ms with a "
+          f"{SPIN_UP * 1000.0:.0f} ms spin-up)")
+
+
+if __name__ == "__main__":
+    stateCheck()
+    serve(latencyCheck)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Temporal filter test, against a brute-force median/trimmed mean over the
+# ring, a benchmark of the incremental median and trimmed mean vs recomputing
+# them over K, and a check that each stream gets its own filter
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import json
+import time
+import warnings
+
+import numpy as np
+
+from ..shared import MessageTypes
+from ..lib.temporalFilter import TemporalFilter
+from ..lib.wcLidar import LidarClient
+from .batchingTest import CMD_PORT, DATA_PORT, serve
+from .wsLoadTest import waitForServer
+
+
+NUM_POINTS = 667    # 4KHz at 6Hz
+NUM_ROTATIONS = 200
+OPTIONS = {'driver': 'sim', 'rate': 20, 'seed': 1}
+FILTER = {'numRotations': 5, 'mode': 'median'}
+
+
+def makeRotations(rng, num):
+    angles = np.linspace(-np.pi, np.pi, NUM_POINTS, endpoint=False) + 1e-4
+    rotations = []
+    for _ in range(num):
+        distances = np.round(rng.normal(3.0, 0.05, NUM_POINTS), 2).astype(np.float32)
+        distances[rng.random(NUM_POINTS) < 0.1] = 0.0   # dropouts
+        rotations.append((angles, distances, rng.integers(0, 255, NUM_POINTS)))
+    return rotations
+
+def bruteForce(ring, mode, trim):
+    out = []
+    for values in ring.T:
+        values = np.sort(values[np.isfinite(values)])
+        if len(values) == 0:
+            continue
+        if mode == 'median':
+            out.append(np.median(values))
+        else:
+            cut = int(len(values) * trim)
+            out.append(values[cut:len(values) - cut].mean())
+    return np.array(out)
+
+def correctnessTest():
+    rng = np.random.default_rng(1)
+    rotations = makeRotations(rng, 30)
+    for k in (1, 3, 5, 10):
+        for mode in ('median', 'trimmed'):
+            filt = TemporalFilter(k, mode)
+            for angles, distances, intensities in rotations:
+                out = filt.update(angles, distances, intensities)
+                expected = bruteForce(filt.ring, mode, filt.trim)
+                assert np.allclose(out['distances'], expected, atol=1e-5), f"Mismatch: k={k}, mode={mode}"
+    print("correctness: PASSED")
+
+def timeFilter(filt, rotations):
+    start = time.perf_counter()
+    for angles, distances, intensities in rotations:
+        filt.update(angles, distances, intensities)
+    return (time.perf_counter() - start) / len(rotations)
+
+def recomputeTrimmed(filt, rotations):
+    ''' Sort the whole ring every rotation, and sum between the cuts '''
+    start = time.perf_counter()
+    for angles, distances, intensities in rotations:
+        filt.ring[filt.head] = filt._bin(angles, distances, intensities)
+        filt.head = (filt.head + 1) % filt.numRotations
+        ring = np.sort(filt.ring, axis=0)
+        counts = np.maximum(np.isfinite(filt.ring).sum(axis=0), 1)
+        cut = (counts * filt.trim).astype(np.int32)
+        keep = (filt._cols.T >= cut) & (filt._cols.T < (counts - cut))
+        np.where(keep, ring, 0.0).sum(axis=0) / (counts - (2 * cut))
+    return (time.perf_counter() - start) / len(rotations)
+
+def benchmark():
+    rng = np.random.default_rng(2)
+    rotations = makeRotations(rng, NUM_ROTATIONS)
+    for k in (3, 5, 10, 50):
+        incremental = timeFilter(TemporalFilter(k, 'median'), rotations)
+        # recompute the median over the whole ring every rotation
+        filt = TemporalFilter(k, 'median')
+        start = time.perf_counter()
+        for angles, distances, intensities in rotations:
+            filt.ring[filt.head] = filt._bin(angles, distances, intensities)
+            filt.head = (filt.head + 1) % k
+            # N.B. bins without any returns in the ring are all-nan
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                np.nanmedian(np.where(np.isfinite(filt.ring), filt.ring, np.nan), axis=0)
+        recompute = (time.perf_counter() - start) / NUM_ROTATIONS
+        trimmed = timeFilter(TemporalFilter(k, 'trimmed'), rotations)
+        resorted = recomputeTrimmed(TemporalFilter(k, 'trimmed'), rotations)
+        print(f"K={k:2d}: median incremental {incremental * 1000:.3f} ms/rotation, "
+              f"recompute {recompute * 1000:.3f} ms/rotation; trimmed mean incremental {trimmed * 1000:.3f} "
+              f"ms/rotation, recompute {resorted * 1000:.3f} ms/rotation")
+
+async def collect(client, secs):
+    frames = []
+    deadline = time.monotonic() + secs
+    while time.monotonic() < deadline:
+        try:
+            frames.append(json.loads(client.msgQ.get_nowait()))
+        except asyncio.QueueEmpty:
+            await asyncio.sleep(0.005)
+    return frames
+
+async def streamCheck():
+    ''' A filtered stream's clients get its filter's output, other clients are unaffected '''
+    if await waitForServer(f"ws://127.0.0.1:{CMD_PORT}"):
+        raise RuntimeError("Lidar server didn't start")
+    filtered = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+    plain = LidarClient("127.0.0.1", CMD_PORT, DATA_PORT)
+    assert not await filtered.init(OPTIONS)
+    assert not await filtered.stream(['angles', 'distances'], filter=FILTER)
+    await collect(filtered, 0.5)
+    # a later unfiltered stream doesn't take the filter away from the first one's clients
+    assert not await plain.stream(['angles', 'distances'])
+    await collect(plain, 0.5)
+    await collect(filtered, 0.5)
+    filteredFrames, plainFrames = await asyncio.gather(collect(filtered, 1.5), collect(plain, 1.5))
+    filtered.close()
+    plain.close()
+    filteredFrames = [frame for frame in filteredFrames if frame['type'] == MessageTypes.REPLY.value]
+    plainFrames = [frame for frame in plainFrames if frame['type'] == MessageTypes.REPLY.value]
+    assert filteredFrames and plainFrames
+    assert all(frame['stream'] == filtered.streamId for frame in filteredFrames) and (plain.streamId is None)
+    assert not any('stream' in frame for frame in plainFrames)
+    # the filter's output is at its bins' centers
+    bins = TemporalFilter(**FILTER).angles
+    assert all(np.isin(frame['values']['angles'], bins).all() for frame in filteredFrames)
+    assert not any(np.isin(frame['values']['angles'], bins).all() for frame in plainFrames)
+    print(f"stream: PASSED ({len(filteredFrames)} filtered frames on stream {filtered.streamId}, "
+          f"{len(plainFrames)} unfiltered frames on another client)")
+
+
+if __name__ == "__main__":
+    correctnessTest()
+    benchmark()
+    serve(streamCheck)
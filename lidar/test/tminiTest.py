@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Native T-mini Pro driver test and benchmark
+#
+# Decodes a synthetic recorded byte stream (split at random points, with
+# corrupted packets and line noise), runs the driver against a pty stand-in
+# for the device, and compares decode cost against the SDK-style per-point
+# LaserPoint path.
+#
+################################################################################
+
+import os
+import threading
+import tty
+import time
+
+import numpy as np
+
+from ..lib.tminiPro import (RotationAssembler, TminiProLidar, encodeRotation,
+                            RESPONSE_HEADER_LEN)
+
+
+NUM_ROTATIONS = 50
+NUM_POINTS = 400  # T-mini Pro at 10Hz and 4KHz
+
+
+def makeRotation(rng, n=NUM_POINTS):
+    angles = np.arange(n) * (360.0 / n)
+    distances = rng.integers(20, 12000, n)
+    intensities = rng.integers(0, 256, n)
+    return angles, distances, intensities
+
+def makeStream(rng, numRotations=NUM_ROTATIONS):
+    rots = [makeRotation(rng) for _ in range(numRotations)]
+    stream = b''.join(encodeRotation(*r) for r in rots)
+    return rots, stream
+
+def recordedTest():
+    rng = np.random.default_rng(1)
+    rots, stream = makeStream(rng)
+
+    # line noise in front and random chunking
+    data = bytes(rng.integers(0, 256, 333, dtype=np.uint8)) + stream
+    asm = RotationAssembler()
+    out = []
+    i = 0
+    while i < len(data):
+        n = int(rng.integers(1, 2000))
+        out += asm.feed(data[i:i + n])
+        i += n
+    # the last rotation is only complete when the next zero packet arrives
+    assert len(out) == NUM_ROTATIONS - 1, len(out)
+    for (angles, distances, intensities), rot in zip(rots, out):
+        assert np.array_equal(np.round(rot['distances'] * 1000), distances)
+        assert np.array_equal(rot['intensities'], intensities)
+        degs = np.degrees(rot['angles']) % 360.0
+        assert np.allclose(degs, angles, atol=(1 / 64.0) + 1e-6)
+
+    # a corrupted packet is dropped, not decoded
+    bad = bytearray(stream)
+    bad[500] ^= 0xFF
+    rotsBad = RotationAssembler().feed(bytes(bad))
+    assert len(rotsBad) == NUM_ROTATIONS - 1
+    assert sum(len(r['angles']) for r in rotsBad) < (NUM_ROTATIONS - 1) * NUM_POINTS
+    print("recorded stream: PASSED")
+
+def ptyTest():
+    rng = np.random.default_rng(2)
+    _, stream = makeStream(rng, 20)
+    master, slave = os.openpty()
+    tty.setraw(slave)
+
+    def emulator():
+        # answer the init-time commands, then play the recording once started
+        freq = 1000
+        while True:
+            cmd = os.read(master, 2)
+            if cmd == b'\xA5\x90':
+                os.write(master, b'\xA5\x5A\x14\x00\x00\x00\x04' + bytes([150, 1, 2, 1]) + bytes(16))
+            elif cmd in (b'\xA5\x0D', b'\xA5\x0B', b'\xA5\x0C', b'\xA5\x09', b'\xA5\x0A'):
+                freq += {b'\xA5\x0B': 100, b'\xA5\x0C': -100, b'\xA5\x09': 10, b'\xA5\x0A': -10}.get(cmd, 0)
+                os.write(master, b'\xA5\x5A\x04\x00\x00\x00\x04' + freq.to_bytes(4, 'little'))
+            elif cmd == b'\xA5\x60':
+                os.write(master, b'\xA5\x5A\x05\x00\x00\x40\x81')
+                for i in range(0, len(stream), 512):
+                    os.write(master, stream[i:i + 512])
+                    time.sleep(0.001)
+                return
+
+    t = threading.Thread(target=emulator, daemon=True)
+    t.start()
+    device = open(slave, 'r+b', buffering=0)
+    lidar = TminiProLidar(device=device, scanFreq=8.0, maxRange=12.0)
+    assert lidar.status()['deviceInfo']['model'] == 150
+    points = lidar.scan()
+    assert points and (len(points['angles']) == NUM_POINTS), points and len(points['angles'])
+    print("pty emulator: PASSED")
+
+class LaserPoint():
+    def __init__(self, angle, range, intensity):
+        self.angle = angle
+        self.range = range
+        self.intensity = intensity
+
+def benchmark():
+    rng = np.random.default_rng(3)
+    rots, stream = makeStream(rng, 200)
+
+    start = time.perf_counter()
+    out = RotationAssembler().feed(stream)
+    native = (time.perf_counter() - start) / len(out)
+
+    # N.B. only the per-point Python cost of the SDK path, the SWIG decode is not included
+    points = [[LaserPoint(np.radians(a), d / 1000.0, i) for a, d, i in zip(*r)] for r in rots]
+    start = time.perf_counter()
+    for scan in points:
+        angles, distances, intensities = zip(*[(p.angle, p.range, int(p.intensity)) for p in scan if not (p.range <= 0)])
+    sdk = (time.perf_counter() - start) / len(points)
+    print(f"native decode: {native * 1000:.3f} ms/rotation, SDK per-point path: {sdk * 1000:.3f} ms/rotation")
+
+
+if __name__ == "__main__":
+    recordedTest()
+    ptyTest()
+    benchmark()
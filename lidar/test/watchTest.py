@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Watch mode test: runs the duty-cycled watch mode on the sim driver, with a
+# critter that sits still in the yard, and checks that the device sleeps
+# while the yard is empty, that a burst where the critter only shows up in
+# some rotations isn't learned into the background, and that it wakes up
+# (leaving the laser on) once the critter's seen; reports the cycle time and
+# detection latency
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import asyncio
+import time
+
+import numpy as np
+
+from ..lib.simulator import SimulatedLidar, DEF_SCENE
+from ..lib.watch import WatchMode
+
+
+SCAN_FREQ = 10.0            # Hz, i.e., each rotation advances the simulated time by 0.1 secs
+SPIN_UP = 0.1               # secs
+PERIOD = 0.3                # secs asleep between bursts
+BURST = 3
+MIN_HITS = 2
+QUIET_CYCLES = 3
+CRITTER = (2.0, -1.5)       # meters, in the open part of the yard
+# N.B. the critter shows up in the last rotation of the burst after the quiet ones, and stays
+CRITTER_START = (((QUIET_CYCLES + 1) * BURST) - 1.5) / SCAN_FREQ
+
+
+class RecordingWatch(WatchMode):
+    ''' Records each burst's hits, and whether the background changed during it '''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bursts = []
+
+    async def _burst(self, scanner):
+        before = self.detector.background.copy()
+        hits = await super()._burst(scanner)
+        self.bursts.append((hits, not np.array_equal(before, self.detector.background, equal_nan=True)))
+        return hits
+
+def critterBins(detector):
+    angle = np.arctan2(CRITTER[1], CRITTER[0])
+    bins = ((np.degrees(angle) + 180.0) / detector.angleBin).astype(np.int64) % detector.numBins
+    return detector.background[[bins - 1, bins, bins + 1]]
+
+async def wakeCheck():
+    scene = dict(DEF_SCENE, critters=[{'waypoints': [[0.0, CRITTER[0], CRITTER[1]]], 'start': CRITTER_START}])
+    scanner = SimulatedLidar(scene=scene, scanFreq=SCAN_FREQ, seed=1, spinUp=SPIN_UP)
+    watch = RecordingWatch(period=PERIOD, burst=BURST, minHits=MIN_HITS)
+    woken = asyncio.Event()
+    start = time.monotonic()
+    watch.start(scanner, woken.set)
+    await asyncio.wait_for(woken.wait(), (QUIET_CYCLES + 3) * (PERIOD + 1.0))
+    elapsed = time.monotonic() - start
+    status = watch.status()
+    assert not watch.running() and scanner.scanning, "the laser should be left on for streaming"
+    # slept through the quiet bursts, didn't learn the partial one, woke up on the next
+    assert (status['watchCycles'] == QUIET_CYCLES + 2) and (status['watchIntrusions'] == 1)
+    assert (status['watchUnlearned'] == 2) and ([hits for hits, _ in watch.bursts] == [0, 0, 0, 1, BURST]), watch.bursts
+    assert [learned for _, learned in watch.bursts] == [True, True, True, False, False]
+    # the critter isn't in the background
+    distance = np.hypot(*CRITTER)
+    assert np.all(critterBins(watch.detector) > distance + watch.detector.foregroundDist)
+    assert status['watchCycleTime'] < (BURST / SCAN_FREQ) + SPIN_UP + 0.2
+    print(f"wake: PASSED (woke after {status['watchCycles']} cycles, {elapsed:.2f} secs; cycle time "
+          f"{status['watchCycleTime'] * 1000:.0f} ms, detection latency {status['watchDetectionLatency'] * 1000:.0f} ms "
+          f"from waking, worst case {status['watchWorstLatency'] * 1000:.0f} ms; duty cycle "
+          f"{status['watchDutyCycle']:.2f})")
+
+
+if __name__ == "__main__":
+    asyncio.run(wakeCheck())
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Concurrent-client load test of the lidar server's command and data ports
+#
+# Runs many asyncio clients against wsLidar (by default, one started here,
+# with the simulated device): command clients issuing a random mix of
+# STATUS/GET/SET/SCAN commands, and stream clients each holding a data
+# stream of its own set of values.  Every command carries an id, which the
+# server returns in its response, so a response that isn't the one a client
+# is waiting for (or doesn't have what it asked for), and a streamed
+# rotation without the values its client asked for, are counted as
+# mix-ups.  Reports per-command latency percentiles and error rates, the
+# streams' delivery rates and gaps, and the event loop lag of the server and
+# of the clients.
+#
+# N.B. run the server on the sensor node (e.g., a Pi) for representative
+#  numbers, e.g., start it there with the 'sim' driver and point --host at it
+#
+################################################################################
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import websockets
+
+from ..shared import MessageTypes, Commands, COMMAND_PORT, DATA_PORT
+from ..lib.loopMonitor import LoopMonitor
+
+
+DEF_CLIENTS = 8
+DEF_STREAMERS = 2
+DEF_DURATION = 20.0             # secs
+DEF_RATE = 50                   # rotations/sec delivered by the simulated device
+DEF_THINK = 0.05                # secs, mean pause between a client's commands
+DEF_MIX = "status:2,get:4,set:1,scan:3"
+RESPONSE_TIMEOUT = 5.0          # secs
+STREAM_RESTART = 2.0            # secs without a rotation before a stream client asks for it again
+MAX_EXAMPLES = 10
+
+ALL_NAMES = ['angles', 'distances', 'intensities']
+GET_NAMES = ['minAngle', 'maxAngle', 'minRange', 'maxRange', 'scanFreq', 'sampleRate', 'standbyTimeout']
+STREAM_NAMES = [['angles', 'distances'], ['angles', 'distances', 'intensities'], ['angles', 'intensities']]
+
+
+class Stats():
+    ''' Shared results of all the clients '''
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.mixups = []
+        self.reconnects = 0
+
+    def record(self, command, latency, error=None):
+        self.latencies.setdefault(command, [])
+        self.errors.setdefault(command, 0)
+        if error:
+            self.errors[command] += 1
+        else:
+            self.latencies[command].append(latency)
+
+    def mixup(self, client, expected, got):
+        self.mixups.append({'client': client, 'expected': expected, 'got': got})
+
+    def commands(self):
+        report = {}
+        for command, latencies in self.latencies.items():
+            count = len(latencies) + self.errors[command]
+            ms = np.array(latencies) * 1000.0
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99]) if len(ms) else (np.nan, np.nan, np.nan)
+            report[command] = {'count': count, 'errors': self.errors[command],
+                               'errorRate': round(self.errors[command] / count, 4) if count else None,
+                               'p50Ms': round(float(p50), 2), 'p90Ms': round(float(p90), 2),
+                               'p99Ms': round(float(p99), 2),
+                               'maxMs': round(float(ms.max()), 2) if len(ms) else None}
+        return report
+
+
+class CommandClient():
+    ''' Issues a random mix of commands, each on a connection of its own or all on one '''
+    def __init__(self, name, cmdURI, stats, mix, think, perCommand=False):
+        self.name = name
+        self.cmdURI = cmdURI
+        self.stats = stats
+        self.commands, self.weights = zip(*mix.items())
+        self.think = think
+        self.perCommand = perCommand
+        self.socket = None
+        self.count = 0
+
+    async def _connect(self):
+        if self.socket is None:
+            self.socket = await websockets.connect(self.cmdURI, max_size=None)
+        return self.socket
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+            self.socket = None
+
+    async def request(self, message):
+        ''' Send a command and wait for the response with its id, returns (response, error) '''
+        self.count += 1
+        message['id'] = f"{self.name}-{self.count}"
+        for attempt in range(2):
+            try:
+                socket = await self._connect()
+                await socket.send(json.dumps(message))
+                while True:
+                    response = json.loads(await asyncio.wait_for(socket.recv(), RESPONSE_TIMEOUT))
+                    if response.get('id') == message['id']:
+                        break
+                    # N.B. keep waiting for our own response, but note what was received instead
+                    self.stats.mixup(self.name, message['id'], response.get('id'))
+                return response, None
+            except websockets.exceptions.ConnectionClosed:
+                # N.B. the server closes the connection after some commands (e.g., STATUS)
+                self.socket = None
+                if attempt == 0:
+                    self.stats.reconnects += 1
+                    continue
+                return None, "connection closed"
+            except (asyncio.TimeoutError, OSError) as ex:
+                await self.close()
+                return None, str(ex) or type(ex).__name__
+            finally:
+                if self.perCommand:
+                    await self.close()
+
+    def makeCommand(self, command):
+        ''' Return the message for a command, and a check of its response's contents '''
+        if command == 'status':
+            return {'type': MessageTypes.STATUS.value}, lambda r: 'status' in r
+        cmd = {'type': MessageTypes.CMD.value}
+        if command == 'get':
+            names = random.sample(GET_NAMES, random.randint(1, len(GET_NAMES)))
+            return cmd | {'command': Commands.GET.value, 'get': names}, \
+                lambda r: set(r.get('values', {})) == set(names)
+        if command == 'set':
+            values = random.choice([{'scanFreq': random.choice([8, 10, 12])},
+                                    {'standbyTimeout': random.choice([5.0, 10.0])}])
+            return cmd | {'command': Commands.SET.value, 'set': values}, \
+                lambda r: set(r.get('results', {})) == set(values)
+        if command == 'scan':
+            names = ['angles'] + random.sample(ALL_NAMES[1:], random.randint(0, 2))
+            args = {'command': Commands.SCAN.value, 'names': names}
+            if random.random() < 0.5:
+                args['maxAgeMs'] = 500
+            return cmd | args, \
+                lambda r: set(r.get('values', {})) & set(ALL_NAMES) == set(names)
+        raise ValueError(f"Unknown command: {command}")
+
+    async def run(self, deadline):
+        while time.monotonic() < deadline:
+            command = random.choices(self.commands, self.weights)[0]
+            message, check = self.makeCommand(command)
+            start = time.monotonic()
+            response, error = await self.request(message)
+            latency = time.monotonic() - start
+            if (error is None) and (response.get('type') != MessageTypes.REPLY.value):
+                error = response.get('error', "bad response")
+            if (error is None) and not check(response):
+                self.stats.mixup(self.name, message['id'], f"{command} response without the requested values")
+                error = "mixed up"
+            self.stats.record(command, latency, error)
+            await asyncio.sleep(random.expovariate(1.0 / self.think) if self.think else 0)
+        await self.close()
+
+
+class StreamClient():
+    ''' Holds a data stream of its own names, asking for it again if it stops '''
+    def __init__(self, name, cmdURI, dataURI, stats, names):
+        self.name = name
+        self.command = CommandClient(name, cmdURI, stats, {'stream': 1}, 0)
+        self.dataURI = dataURI
+        self.stats = stats
+        self.names = names
+        self.arrivals = []
+        self.mixups = 0
+        self.errors = 0
+        self.restarts = 0
+
+    async def startStream(self):
+        message = {'type': MessageTypes.CMD.value, 'command': Commands.STREAM.value, 'names': self.names}
+        start = time.monotonic()
+        response, error = await self.command.request(message)
+        if (error is None) and (response.get('type') != MessageTypes.REPLY.value):
+            error = response.get('error', "bad response")
+        self.stats.record('stream', time.monotonic() - start, error)
+
+    async def run(self, deadline):
+        async with websockets.connect(self.dataURI, max_size=None) as dataSocket:
+            await self.startStream()
+            while time.monotonic() < deadline:
+                try:
+                    frame = json.loads(await asyncio.wait_for(dataSocket.recv(),
+                                                              min(STREAM_RESTART, max(0.01, deadline - time.monotonic()))))
+                except asyncio.TimeoutError:
+                    if time.monotonic() < deadline:
+                        self.restarts += 1
+                        await self.startStream()
+                    continue
+                except websockets.exceptions.ConnectionClosed:
+                    self.errors += 1
+                    break
+                if frame.get('type') != MessageTypes.REPLY.value:
+                    self.errors += 1
+                    continue
+                self.arrivals.append(time.monotonic())
+                got = sorted(set(frame.get('values', {})) & set(ALL_NAMES))
+                if got != sorted(self.names):
+                    self.mixups += 1
+                    if self.mixups <= MAX_EXAMPLES:
+                        self.stats.mixup(self.name, self.names, got)
+        await self.command.close()
+
+    def report(self, duration):
+        gaps = np.diff(self.arrivals) * 1000.0 if len(self.arrivals) > 1 else np.zeros(1)
+        return {'client': self.name, 'names': self.names, 'frames': len(self.arrivals),
+                'rateHz': round(len(self.arrivals) / duration, 2),
+                'gapP50Ms': round(float(np.percentile(gaps, 50)), 2),
+                'gapP99Ms': round(float(np.percentile(gaps, 99)), 2), 'gapMaxMs': round(float(gaps.max()), 2),
+                'mixups': self.mixups, 'errors': self.errors, 'restarts': self.restarts}
+
+
+def runServer(directory, cmdPort, dataPort):
+    ''' A lidar server (in a process of its own), keeping its config and models in 'directory' '''
+    from ..webServer import wsLidar
+
+    os.chdir(directory)
+    sys.stdout = open(os.devnull, "w")
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(wsLidar.main("127.0.0.1", cmdPort, dataPort))
+
+async def waitForServer(cmdURI, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with websockets.connect(cmdURI):
+                return False
+        except OSError:
+            await asyncio.sleep(0.2)
+    return True
+
+async def sendCmd(cmdURI, message):
+    async with websockets.connect(cmdURI, max_size=None) as socket:
+        await socket.send(json.dumps(message))
+        return json.loads(await asyncio.wait_for(socket.recv(), RESPONSE_TIMEOUT))
+
+async def loadTest(opts):
+    cmdURI = f"ws://{opts.host}:{opts.cmdPort}"
+    dataURI = f"ws://{opts.host}:{opts.dataPort}"
+    if await waitForServer(cmdURI):
+        logging.error(f"No lidar server at {cmdURI}")
+        return None
+    init = {'type': MessageTypes.CMD.value, 'command': Commands.INIT.value,
+            'options': {'driver': 'sim', 'rate': opts.rate, 'seed': 1}}
+    response = await sendCmd(cmdURI, init)
+    if response.get('type') != MessageTypes.REPLY.value:
+        logging.error(f"Failed to initialize the lidar: {response}")
+        return None
+
+    random.seed(opts.seed)
+    mix = {k: float(v) for k, v in (item.split(":") for item in opts.mix.split(","))}
+    stats = Stats()
+    monitor = LoopMonitor()
+    monitor.start()
+    commandClients = [CommandClient(f"c{i}", cmdURI, stats, mix, opts.think, opts.perCommand)
+                      for i in range(opts.clients)]
+    streamClients = [StreamClient(f"s{i}", cmdURI, dataURI, stats, STREAM_NAMES[i % len(STREAM_NAMES)])
+                     for i in range(opts.streamers)]
+    start = time.monotonic()
+    deadline = start + opts.duration
+    await asyncio.gather(*[c.run(deadline) for c in streamClients + commandClients])
+    duration = time.monotonic() - start
+    monitor.stop()
+
+    status = (await sendCmd(cmdURI, {'type': MessageTypes.STATUS.value})).get('status', {})
+    report = {'config': {'host': opts.host, 'clients': opts.clients, 'streamers': opts.streamers,
+                         'durationSecs': round(duration, 2), 'rate': opts.rate, 'mix': mix,
+                         'think': opts.think, 'perCommand': opts.perCommand},
+              'commands': stats.commands(),
+              'streams': [c.report(duration) for c in streamClients],
+              'mixups': {'total': len(stats.mixups) + sum(max(0, c.mixups - MAX_EXAMPLES) for c in streamClients),
+                         'examples': stats.mixups[:MAX_EXAMPLES]},
+              'reconnects': stats.reconnects,
+              'loopLag': {'server': {k: status.get(k) for k in ('loopLagP50Ms', 'loopLagP99Ms', 'loopLagMaxMs')},
+                          'clients': monitor.status()},
+              'server': {k: status.get(k) for k in ('simRotations', 'cacheHits', 'cacheMisses', 'sinkDropped')}}
+    return report
+
+def printReport(report):
+    print(f"{'command':<8} {'count':>7} {'errors':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for command, r in sorted(report['commands'].items()):
+        print(f"{command:<8} {r['count']:>7} {r['errors']:>7} {r['p50Ms']:>8} {r['p90Ms']:>8} {r['p99Ms']:>8} "
+              f"{r['maxMs']}")
+    for s in report['streams']:
+        print(f"stream {s['client']} {s['names']}: {s['frames']} frames, {s['rateHz']} Hz, gap p99 "
+              f"{s['gapP99Ms']} ms (max {s['gapMaxMs']}), {s['mixups']} mixed up, {s['restarts']} restarts")
+    print(f"mix-ups: {report['mixups']['total']}, reconnects: {report['reconnects']}")
+    for example in report['mixups']['examples']:
+        print(f"  {example}")
+    print(f"loop lag (p50/p99/max ms): server {report['loopLag']['server']}, clients {report['loopLag']['clients']}")
+
+def getOpts():
+    ap = argparse.ArgumentParser(description="Load test the lidar server with concurrent command and stream clients")
+    ap.add_argument(
+        "--host", action="store", type=str, default=None,
+        help="Lidar server to test (default: start one here, with the simulated device)")
+    ap.add_argument(
+        "--cmdPort", action="store", type=int, default=COMMAND_PORT,
+        help="Server's command port")
+    ap.add_argument(
+        "--dataPort", action="store", type=int, default=DATA_PORT,
+        help="Server's data port")
+    ap.add_argument(
+        "-c", "--clients", action="store", type=int, default=DEF_CLIENTS,
+        help="Number of command clients")
+    ap.add_argument(
+        "-s", "--streamers", action="store", type=int, default=DEF_STREAMERS,
+        help="Number of stream clients")
+    ap.add_argument(
+        "-d", "--duration", action="store", type=float, default=DEF_DURATION,
+        help="Length of the test (secs)")
+    ap.add_argument(
+        "-r", "--rate", action="store", type=float, default=DEF_RATE,
+        help="Rotations/sec delivered by the simulated device (0 for as fast as possible)")
+    ap.add_argument(
+        "-m", "--mix", action="store", type=str, default=DEF_MIX,
+        help="Relative weights of the commands issued, as <command>:<weight>,...")
+    ap.add_argument(
+        "-t", "--think", action="store", type=float, default=DEF_THINK,
+        help="Mean pause between a client's commands (secs)")
+    ap.add_argument(
+        "-p", "--perCommand", action="store_true", default=False,
+        help="Open a connection per command (as LidarClient does), instead of one per client")
+    ap.add_argument(
+        "-o", "--output", action="store", type=str, default=None,
+        help="Path of a JSON file to write the report into")
+    ap.add_argument(
+        "--seed", action="store", type=int, default=1,
+        help="Random seed of the clients' command choices")
+    ap.add_argument(
+        "-L", "--logLevel", action="store", type=str, default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Logging level")
+    opts = ap.parse_args()
+    logging.basicConfig(level=opts.logLevel)
+    return opts
+
+def run(opts):
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        if opts.host is None:
+            opts.host = "127.0.0.1"
+            server = multiprocessing.Process(target=runServer, args=(directory, opts.cmdPort, opts.dataPort),
+                                             daemon=True)
+            server.start()
+        try:
+            report = asyncio.run(loadTest(opts))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join(5)
+    if report is None:
+        exit(1)
+    printReport(report)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    opts = getOpts()
+    run(opts)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+################################################################################
+#
+# Zone masks test: checks each zone's compiled mask against shapely's
+# point-in-polygon test (and the region classifier's labels), for zones away
+# from the sensor, around it, and concave ones, and measures the compile and
+# labelling times
+#
+# N.B. run this on the sensor node (e.g., a Pi) for representative numbers
+#
+################################################################################
+
+import time
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from ..lib.zones import ZoneMap, Zone
+
+
+NUM_POINTS = 20000
+ZONES = {
+    'ahead': {'polygon': [[1.0, -0.5], [2.0, -0.5], [2.0, 0.5], [1.0, 0.5]], 'kind': 'alert'},
+    # the sensor's in these
+    'around': {'polygon': [[-1.0, -1.0], [1.5, -1.0], [1.5, 1.0], [-1.0, 1.0]], 'kind': 'watch'},
+    'offCenter': {'polygon': [[-0.2, -3.0], [4.0, -3.0], [4.0, -2.0], [0.3, 0.3], [-0.2, 0.3]], 'kind': 'exclude'},
+    # concave, behind the sensor
+    'ell': {'polygon': [[-4.0, -1.0], [-2.0, -1.0], [-2.0, 2.0], [-3.0, 2.0], [-3.0, 0.0], [-4.0, 0.0]],
+            'kind': 'alert'},
+}
+
+
+def maskCheck():
+    zoneMap = ZoneMap.fromConfig(ZONES)
+    rng = np.random.default_rng(1)
+    angles = rng.uniform(-np.pi, np.pi, NUM_POINTS)
+    distances = rng.uniform(0.01, 5.0, NUM_POINTS)
+    x, y = distances * np.cos(angles), distances * np.sin(angles)
+    labels = zoneMap.labels(angles, distances)
+    # N.B. a point is labelled by its bin's center, so points within a bin of an edge can go either way
+    slack = zoneMap.rangeBin + (distances * np.radians(zoneMap.angleBin))
+    results = {}
+    for name, d in ZONES.items():
+        polygon = Polygon(d['polygon'])
+        expected = shapely.contains_xy(polygon, x, y)
+        got = (labels & np.uint32(1 << zoneMap.bits[name])) != 0
+        wrong = np.flatnonzero(got != expected)
+        nearEdge = shapely.distance(polygon.exterior, shapely.points(x[wrong], y[wrong])) <= slack[wrong]
+        assert np.all(nearEdge), f"zone '{name}': {np.count_nonzero(~nearEdge)} points mislabelled"
+        results[name] = (int(np.count_nonzero(expected)), len(wrong))
+    # the same labels as the region classifier gives the bins' centers
+    a = ((np.degrees(angles) + 180.0) / zoneMap.angleBin).astype(np.int64)
+    r = (distances / zoneMap.rangeBin).astype(np.int64)
+    centers = (np.radians((a + 0.5) * zoneMap.angleBin) - np.pi, (r + 0.5) * zoneMap.rangeBin)
+    for name in ZONES:
+        got = (labels & np.uint32(1 << zoneMap.bits[name])) != 0
+        assert np.array_equal(got, zoneMap.classifier.inZone(name, *centers)), f"zone '{name}' not the classifier's"
+    # replacing a zone only changes its own bit
+    before = zoneMap.table.copy()
+    zoneMap.setZone(Zone('ahead', [[1.0, -0.5], [3.0, -0.5], [3.0, 0.5], [1.0, 0.5]], 'alert'))
+    bit = np.uint32(1 << zoneMap.bits['ahead'])
+    assert np.array_equal(zoneMap.table & ~bit, before & ~bit)
+    zones = ", ".join(f"{name} {inside}/{wrong}" for name, (inside, wrong) in results.items())
+    print(f"masks: PASSED (points inside/within a bin of an edge: {zones})")
+
+def timingCheck():
+    start = time.perf_counter()
+    zoneMap = ZoneMap.fromConfig(ZONES)
+    compileMs = (time.perf_counter() - start) * 1000.0
+    rng = np.random.default_rng(2)
+    angles = np.linspace(-np.pi, np.pi, 1000, endpoint=False)
+    distances = 3.0 + rng.normal(0.0, 0.02, len(angles))
+    start = time.perf_counter()
+    for _ in range(100):
+        zoneMap.classify(angles, distances)
+    classifyMs = (time.perf_counter() - start) * 10.0
+    print(f"timing: PASSED ({len(ZONES)} zones compiled in {compileMs:.1f} ms, "
+          f"{classifyMs:.3f} ms to classify a rotation of {len(angles)} points)")
+
+
+if __name__ == "__main__":
+    maskCheck()
+    timingCheck()
@@ -12,16 +12,20 @@
 ####  * figure out how to make asyncio and Dash play together properly
 
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import dash_bootstrap_components as dbc
 from dash import Dash, html, dash_table, dcc, callback, ctx, Input, Output, State
 import dash_daq as daq
 import logging
 import plotly.graph_objs as go
-from shapely import union_all
-from shapely.geometry import Polygon, MultiPolygon
 import numpy as np
 
 from  ..shared import MIN_ANGLE, MAX_ANGLE, MIN_RANGE, MAX_RANGE, COMMAND_PORT, DATA_PORT
+from ..lib.geomJobs import GeometryJobs
+from ..lib.modelStore import modelPath, sensorConfig
+from ..lib.refGeometry import ReferenceGeometryCache, deriveGeometry, loadReference, saveReference, unionScans
+from ..lib.regionClassify import RegionClassifier, LABEL_MARGIN, LABEL_NONE
 from ..lib.wcLidar import LidarClient
 
 
@@ -34,6 +38,9 @@ DEF_INTERVAL = 10000  #### FIXME: 1000.0 / DEF_SCAN_FREQ  # in msecs
 EPSILON = 0.0000001
 MAX_MARGIN = 0.5
 MIN_MARGIN = -0.5
+DEF_TOLERANCE = 0.02
+
+REF_MODEL = modelPath("reference")
 
 OPTS_SAMPLE = 0
 OPTS_MARGIN = 1
@@ -50,6 +57,14 @@ maxMargin = MAX_MARGIN
 minMargin = MIN_MARGIN
 
 lidar = None
+geomJobs = None         # N.B. created on first use, not in Dash's reloader process
+captureWorker = None    # thread that captures the reference frames, off the callbacks
+capture = None          # future of the capture in progress
+refCache = ReferenceGeometryCache()
+reference = None        # derived geometry of the reference region, for the current margins
+lastMargins = None
+classifier = None       # for the reference geometry it was made from (classifierSource)
+classifierSource = None
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
@@ -260,7 +275,19 @@ app.index_string = '''
 '''
 
 
-async def getSamples():
+def getClassifier():
+    ''' Classifier for the current reference geometry (None if there isn't one yet) '''
+    global classifier, classifierSource
+
+    if not reference:
+        return None
+    if classifierSource is not reference:
+        classifier = RegionClassifier.fromGeometry(reference)
+        classifierSource = reference
+    return classifier
+
+async def getSamples(outside=False):
+    ''' Figure of a scan's samples, colored by region if there's a reference (only those off the perimeter if outside) '''
     if not lidar:
         logging.error("Lidar not initialized")
         return None  #### FIXME throw exception
@@ -272,11 +299,19 @@ async def getSamples():
         logging.warning("No lidar samples returned, skipping")
         return go.Figure()
     '''
-    polarToCartesian = lambda theta, r: ((r * np.cos(theta)), (r * np.sin(theta)))
-    cartCoords = [polarToCartesian(theta, r) for theta, r in zip(samples['angles'], samples['distances'])]
-    poly = Polygon(cartCoords)
-    xy = poly.exterior.coords
-    xSamples, ySamples = zip(*xy)
+    angles = np.asarray(samples['angles'])
+    distances = np.asarray(samples['distances'])
+    xSamples = distances * np.cos(angles)
+    ySamples = distances * np.sin(angles)
+    marker = {}
+    regionClassifier = getClassifier()
+    if regionClassifier:
+        labels, _, _ = regionClassifier.classify(angles, distances)
+        if outside:
+            keep = (labels != LABEL_MARGIN) & (labels != LABEL_NONE)
+            xSamples, ySamples, labels = xSamples[keep], ySamples[keep], labels[keep]
+        marker = {"color": labels, "colorscale": [[0.0, "red"], [0.5, "blue"], [1.0, "orange"]],
+                  "cmin": 0, "cmax": 2}
 
     fig = go.Figure(
         data=[
@@ -284,8 +319,8 @@ async def getSamples():
                 x=xSamples,
                 y=ySamples,
                 mode="markers",
-                #marker={"size": 8},
-                fill="toself"
+                marker=marker,
+                fill=None if outside else "toself"
             )
         ],
         layout={
@@ -298,6 +333,87 @@ async def getSamples():
     app.config.suppress_callback_exceptions = True
     return fig
 
+async def getScans(num):
+    ''' Capture num frames as x, y arrays, for the reference region '''
+    scans = []
+    for _ in range(num):
+        samples = await lidar.scan(['angles', 'distances'])
+        if not samples:
+            logging.warning("No lidar samples returned, skipping frame")
+            continue
+        angles = np.asarray(samples['angles'])
+        distances = np.asarray(samples['distances'])
+        scans.append(np.column_stack((distances * np.cos(angles), distances * np.sin(angles))))
+    return scans
+
+def captureReference(num):
+    ''' Capture num frames (on the capture thread), then union them in the geometry jobs' processes '''
+    scans = asyncio.run(getScans(num))
+    if scans:
+        geomJobs.submit('union', unionScans, scans)
+
+def derived(refId, margins, future):
+    ''' Cache the derived geometry a job returned, and use it if it's for the current margins '''
+    global reference
+
+    if future.cancelled() or future.exception():
+        return
+    entry = future.result()
+    if refCache.put(margins, DEF_TOLERANCE, entry, refId):
+        return  # the reference was recaptured since
+    if margins == lastMargins:
+        reference = entry
+
+def getSensorConfig():
+    status = asyncio.run(lidar.status())
+    return sensorConfig(status or {})
+
+def restoreReference():
+    ''' Start with the last captured reference region, if it's for the sensor's current angles/ranges '''
+    union = loadReference(REF_MODEL, getSensorConfig())
+    if union is not None:
+        refCache.setReference(union)
+        logging.info("Restored the reference region")
+
+def updateReference(margins):
+    ''' Pick up a recaptured reference region, and get its derived geometry for the margins '''
+    global reference, lastMargins
+
+    if not geomJobs:
+        return
+    union = geomJobs.get('union')
+    if (union is not None) and (union is not refCache.reference):
+        refCache.setReference(union)
+        saveReference(REF_MODEL, union, getSensorConfig())
+        reference = None
+        lastMargins = None
+    if (refCache.reference is None) or (margins == lastMargins):
+        return
+    lastMargins = margins
+    entry = refCache.get(margins, DEF_TOLERANCE)
+    if entry:
+        reference = entry
+    else:
+        future = geomJobs.submit('derive', deriveGeometry, refCache.reference, margins, DEF_TOLERANCE)
+        future.add_done_callback(partial(derived, refCache.refId, margins))
+    logging.debug(f"Reference geometry cache: {refCache.status()}")
+
+def addReference(fig, options):
+    ''' Draw the reference region (and its margins), if its geometry jobs have finished '''
+    if not reference:
+        return fig
+    shapes = []
+    if OPTS_REGION in options:
+        shapes.append(("region", reference['region'], "green"))
+    if OPTS_MARGIN in options:
+        shapes += [("inner", reference['inner'], "orange"), ("outer", reference['outer'], "red")]
+    for name, poly, color in shapes:
+        if poly.is_empty:
+            continue
+        xy = np.asarray(poly.exterior.coords)
+        fig.add_trace(go.Scatter(x=xy[:, 0], y=xy[:, 1], mode="lines", name=name, line={"color": color}))
+    return fig
+
 @app.callback(
     Output("lidarRanges", "value"),
     Output("lidarAngles", "value"),
@@ -329,7 +445,7 @@ def resetOptions(numClicks):
     State("numFrames", "value"),
 )
 def update(ranges, angles, margins, intersect, options, intensityEnb, numIntervals, numFrames):
-    global lastRanges, lastAngles, lidar
+    global lastRanges, lastAngles, lidar, geomJobs, captureWorker, capture
 
     if not lidar:
         lidar = LidarClient(HOSTNAME, COMMAND_PORT)
@@ -355,24 +471,28 @@ def update(ranges, angles, margins, intersect, options, intensityEnb, numInterva
             logging.warning("Set Angles failed")
             return None
 
-#    print(f"margins: {margins}")  #### TODO
-
-#    print(f"intersect: {intersect}, numFrames: {numFrames}")  #### TODO
+    # N.B. the reference frames are captured on a thread and the geometry is built in worker
+    #  processes, a newer request supersedes the one in flight, and the figure keeps refreshing
+    #  with the last finished region meanwhile
+    if not geomJobs:
+        geomJobs = GeometryJobs()
+        captureWorker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        restoreReference()
+    if (ctx.triggered_id == "intersectFrames") and intersect and numFrames:
+        if capture and not capture.done():
+            logging.warning("Still capturing reference frames, ignoring")
+        else:
+            capture = captureWorker.submit(captureReference, numFrames)
+    updateReference(margins)
 
     print(f"displayOptions: {options}")
     fig = None
     if OPTS_SAMPLE in options:
         print("SAMPLE")  #### TODO
 #        print(f"intensityEnb: {intensityEnb}")
-        fig = asyncio.run(getSamples())
-    '''
-    elif OPTS_MARGIN in options:
-        print("MARGIN")  #### TODO
-    elif OPTS_REGION in options:
-        print("REGION")  #### TODO
-    elif OPTS_OUTSIDE in options:
-        print("OUTSIDE")  #### TODO
-    '''
+        fig = asyncio.run(getSamples(OPTS_OUTSIDE in options))
+    if (OPTS_MARGIN in options) or (OPTS_REGION in options):
+        fig = addReference(fig if fig else go.Figure(), options)
 
     return fig if fig else go.Figure()
 
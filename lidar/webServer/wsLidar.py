@@ -13,13 +13,40 @@
 
 import asyncio
 from enum import Enum
+import itertools
 import json
 import logging
+import numpy as np
+import os
 import signal
+import socket
+import time
+import urllib.parse
 import websockets
+import yaml
 
 from ..shared import MessageTypes, Commands, COMMAND_PORT, DATA_PORT
-from ..lib.lidar import Lidar
+from ..lib.tminiPro import TminiProLidar
+from ..lib.gs2 import GS2Lidar
+from ..lib.simulator import SimulatedLidar
+from ..lib.zones import ZoneMap, Zone
+from ..lib.standby import Standby
+from ..lib.rotationCache import RotationCache
+from ..lib.scanRate import ScanRateController
+from ..lib.watch import WatchMode
+from ..lib.temporalFilter import TemporalFilter
+from ..lib.noiseFilters import NoiseFilterChain
+from ..lib.pipeline import Pipeline, Rotation, Stage, makeStage, registerStage
+from ..lib.modelStore import modelPath, sensorConfig
+from ..lib.loopMonitor import LoopMonitor
+from ..lib.frameBatcher import FrameBatcher, DEF_MAX_LATENCY, DEF_MAX_FRAMES, DEF_MAX_BYTES
+from ..lib.replayBuffer import ReplayBuffer
+
+# N.B. the SDK driver needs the manufacturer's ydlidar bindings, the others don't
+try:
+    from ..lib.lidar import Lidar
+except ImportError:
+    Lidar = None
 
 #import pdb  ## pdb.set_trace()
 
@@ -30,16 +57,310 @@ WS_LIDAR_VERSION = "1.3.0"  # N.B. Must match lidar.py library's version
 
 HOSTNAME = "0.0.0.0"
 
+CONFIGS_FILE = "./.lidar.yaml"
+
+# persisted models, so a restart can detect from the first rotation
+ZONES_MODEL = modelPath("zones")
+
 PING = 20       # ping every 20????
 
+# lidar device drivers, selected with the 'driver' init option
+DRIVERS = {k: v for k, v in {'sdk': Lidar, 'native': TminiProLidar, 'gs2': GS2Lidar,
+                              'sim': SimulatedLidar}.items() if v is not None}
+DEF_DRIVER = 'sdk'
+
+# rotations are acquired (and cached) with all the names, and trimmed per request
+ALL_NAMES = ['angles', 'distances', 'intensities']
+# N.B. only some drivers report the per-point (interference) flags
+ACQUIRE_NAMES = ALL_NAMES + ['flags']
+
+# N.B. a small kernel send buffer, so a slow link backs up the sends (and stale rotations are dropped or
+#  coalesced) rather than queueing seconds of rotations in the socket
+DATA_SEND_BUFFER = 16384     # bytes
+DATA_WRITE_LIMIT = 16384     # bytes buffered by the data socket before sends wait
+# N.B. frames missed while disconnected are all replayed (if they're still kept), but once a client's
+#  caught up, frames that have waited longer than this to be sent are skipped, so a slow link stays live
+DATA_MAX_LAG = 0.2           # secs
+DATA_SEND_CHUNK = 16         # frames taken from the replay buffer at a time
+
+NEXT_ROTATION_TIMEOUT = 1.0  # secs to wait for the stream's next rotation
+SCAN_TIMEOUT = 2.0           # secs, deadline for acquiring a rotation (including retries)
+
+UNFILTERED_STREAM = 0        # the stream id of data clients that didn't ask for a filtered stream
+MAX_FILTERED_STREAMS = 4     # filtered streams kept, the oldest are dropped
+
+# stages applied to every acquired rotation, before it's cached and sent
+DEF_PIPELINE = [{'stage': 'noiseFilters'}, {'stage': 'cache'}, {'stage': 'adaptiveRate'}]
+
 scanner = None
 cmdServer = dataServer = None
 streamNames = None
+streamFilters = {}      # stream id -> temporal filter, of the streams the stream command asked to filter
+streamIds = itertools.count(UNFILTERED_STREAM + 1)
+streamBatch = None      # per-stream frame coalescing options, selected by the stream command
+batcher = None          # the data socket's frame batcher, while streaming with batching
+replay = ReplayBuffer()  # the stream's recent (sequenced) frames, for clients resuming after a disconnect
+acquirer = None         # the task streaming rotations into the replay buffer
+noiseFilters = NoiseFilterChain()
+pipeline = None
+zoneMap = ZoneMap()
+standby = Standby()
+cache = RotationCache()
+rateController = None   # adaptive scan rate, off by default
+watch = None            # duty-cycled watch mode, off by default
 streaming = asyncio.Event()
+loopMonitor = LoopMonitor()
+
+
+def loadConfig(path=CONFIGS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as confFile:
+        return yaml.safe_load(confFile) or {}
+
+def saveConfig(conf, path=CONFIGS_FILE):
+    with open(path, "w") as confFile:
+        yaml.safe_dump(conf, confFile)
+
+def setZones(zones):
+    # zones: {<name>: <zoneDict> | None}, where None deletes the zone
+    err = False
+    for name, d in zones.items():
+        try:
+            if d is None:
+                err |= zoneMap.removeZone(name)
+            else:
+                err |= zoneMap.setZone(Zone.fromDict(name, d))
+        except (KeyError, ValueError) as ex:
+            logging.error(f"Invalid zone '{name}': {ex}")
+            err = True
+    # N.B. the config and compiled zones are only rewritten if the zones changed
+    zones = zoneMap.toConfig()
+    conf = loadConfig()
+    if conf.get('zones') != zones:
+        conf['zones'] = zones
+        saveConfig(conf)
+        zoneMap.save(ZONES_MODEL)
+    return err
+
+def saveBackground(name, detector):
+    if scanner:
+        detector.save(modelPath(f"background-{name}"), sensorConfig(scanner.status()))
+
+def restoreBackground(name, detector):
+    # N.B. a saved background is only used with the sensor config it was learned with
+    if scanner and not detector.restore(modelPath(f"background-{name}"), sensorConfig(scanner.status())):
+        logging.info(f"Restored {name} background")
+
+def backgrounds():
+    # the learned backgrounds in use, by name
+    models = {}
+    if rateController:
+        models['adaptiveRate'] = rateController.detector
+    if watch:
+        models['watch'] = watch.detector
+    return models
+
+def saveBackgrounds():
+    for name, detector in backgrounds().items():
+        saveBackground(name, detector)
+
+def setAdaptiveRate(enable):
+    global rateController
+
+    if enable and not rateController:
+        rateController = ScanRateController()
+        restoreBackground('adaptiveRate', rateController.detector)
+    elif not enable:
+        if rateController:
+            saveBackground('adaptiveRate', rateController.detector)
+        rateController = None
+    return False
+
+async def setRate(scanFreq, sampleRate):
+    logging.info(f"Adaptive rate: scanFreq={scanFreq}, sampleRate={sampleRate}")
+    if (await scanner.acall(scanner.setScanFreq, scanFreq)) or \
+       (await scanner.acall(scanner.setSampleRate, sampleRate)):
+        logging.warning("Failed to change the scan rate")
+
+# N.B. the server's own stages use its state, so they always run inline (on the event loop)
+class NoiseFiltersStage(Stage):
+    ''' The noise filter chain set with the 'noiseFilters' value '''
+    def process(self, rotation):
+        if noiseFilters.stages:
+            rotation.update(noiseFilters.apply(rotation))
+        return rotation
+
+class CacheStage(Stage):
+    def process(self, rotation):
+        # N.B. stages replace arrays rather than change them, so the arrays can be shared
+        cache.put(Rotation(rotation.arrays, rotation.stamp, dict(rotation.meta)), rotation.stamp)
+        return rotation
+
+class AdaptiveRateStage(Stage):
+    def process(self, rotation):
+        # N.B. the rate only changes while streaming, single scans don't show activity
+        if rateController and streaming.is_set():
+            change = rateController.update(rotation['angles'], rotation['distances'])
+            if change:
+                asyncio.get_running_loop().create_task(setRate(*change))
+        return rotation
+
+registerStage('noiseFilters', NoiseFiltersStage)
+registerStage('cache', CacheStage)
+registerStage('adaptiveRate', AdaptiveRateStage)
+
+def setPipeline(confs):
+    global pipeline
+
+    try:
+        newPipeline = Pipeline.fromConfig(confs)
+    except (TypeError, ValueError) as ex:
+        logging.error(f"Invalid pipeline, ignoring: {ex}")
+        return True
+    sink = None
+    if pipeline:
+        sink = pipeline.sink
+        pipeline.shutdown()
+    pipeline = newPipeline
+    # N.B. while streaming, the rotations go through the new pipeline from now on
+    if sink:
+        pipeline.start(sink)
+    return False
+
+def savePipeline():
+    conf = loadConfig()
+    conf['pipeline'] = pipeline.toConfig()
+    saveConfig(conf)
+
+def addStage(conf):
+    # conf: {'stage': <type>, 'name': <str>, 'worker': None|'thread'|'process', 'index': <int>, ...}
+    conf = dict(conf)
+    index = conf.pop('index', None)
+    try:
+        stage = makeStage(conf)
+    except (TypeError, ValueError) as ex:
+        logging.error(f"Invalid pipeline stage: {ex}")
+        return True
+    if pipeline.add(stage, index):
+        return True
+    savePipeline()
+    return False
+
+def removeStage(name):
+    if pipeline.remove(name):
+        return True
+    savePipeline()
+    return False
+
+def onIntrusion():
+    global streamNames
+
+    # the watch mode left the laser on, hand over to continuous streaming
+    if not streamNames:
+        streamNames = ALL_NAMES
+    streaming.set()
+
+def setWatch(conf):
+    # conf: {'period': <secs>, 'burst': <int>, 'minHits': <int>} to start watching, None to stop
+    global watch
+
+    stopWatch()
+    if watch:
+        saveBackground('watch', watch.detector)
+    if not conf:
+        watch = None
+        return False
+    try:
+        watch = WatchMode(**conf)
+    except (TypeError, ValueError) as ex:
+        logging.error(f"Invalid watch mode: {ex}")
+        watch = None
+        return True
+    restoreBackground('watch', watch.detector)
+    streaming.clear()
+    standby.cancel()
+    watch.start(scanner, onIntrusion)
+    return False
 
+def stopWatch():
+    # explicit requests take the device over from the watch mode
+    if watch:
+        watch.stop()
+
+def applyZones(points, names):
+    # returns the requested values as lists, with the points in exclude zones removed
+    if not points:
+        return points
+    meta = getattr(points, 'meta', {})
+    if not zoneMap.zones:
+        return meta | {k: np.asarray(v).tolist() for k, v in points.items() if k in names}
+    _, keep, results = zoneMap.classify(points['angles'], points['distances'],
+                                        points.get('intensities'))
+    points = {k: np.asarray(v)[keep].tolist() for k, v in points.items() if k in names}
+    points['zones'] = results
+    return meta | points
+
+def setNoiseFilters(stages):
+    # stages: [{'stage': <name>, <param>: <value>, ...}, ...], None or [] for no filtering
+    global noiseFilters
+
+    try:
+        noiseFilters = NoiseFilterChain(stages or [])
+    except (TypeError, ValueError) as ex:
+        logging.error(f"Invalid noise filters: {ex}")
+        return True
+    conf = loadConfig()
+    conf['noiseFilters'] = noiseFilters.config
+    saveConfig(conf)
+    return applyNoiseHooks()
+
+def setReplay(bounds):
+    # bounds: {'maxSecs': <secs>, 'maxFrames': <int>, 'maxBytes': <int>}, None for the defaults
+    try:
+        replay.configure(**(bounds or {}))
+    except (TypeError, ValueError) as ex:
+        logging.error(f"Invalid replay bounds: {ex}")
+        return True
+    conf = loadConfig()
+    conf['replay'] = replay.config
+    saveConfig(conf)
+    return False
+
+def applyNoiseHooks():
+    # drivers that don't report interference flags filter those points themselves
+    err = False
+    if scanner:
+        for hook, enable in noiseFilters.driverHooks().items():
+            if hasattr(scanner, hook):
+                err |= getattr(scanner, hook)(enable)
+    return err
+
+def echoId(msg, response):
+    # a command's (optional) 'id' is returned in its response, so clients can match them up
+    if isinstance(msg, dict) and ('id' in msg):
+        response['id'] = msg['id']
+    return response
+
+def filterPoints(streamFilter, points):
+    filtered = streamFilter.update(points['angles'], points['distances'], points.get('intensities'))
+    return {k: v.tolist() for k, v in filtered.items()}
+
+def addStreamFilter(conf):
+    ''' A new filtered stream, returns its id (the unfiltered stream's if the filter's invalid) '''
+    try:
+        streamFilter = TemporalFilter(**conf)
+    except (TypeError, ValueError) as ex:
+        logging.warning(f"Invalid stream filter, not filtering: {ex}")
+        return UNFILTERED_STREAM
+    streamId = next(streamIds)
+    streamFilters[streamId] = streamFilter
+    while len(streamFilters) > MAX_FILTERED_STREAMS:
+        del streamFilters[next(iter(streamFilters))]
+    return streamId
 
 async def cmdHandler(websocket):
-    global scanner, streamNames
+    global scanner, streamNames, streamBatch
 
     streaming.clear()
     async for message in websocket:
@@ -52,6 +373,9 @@ async def cmdHandler(websocket):
             await websocket.send(json.dumps(response))  #### TODO should I block here? catch error?
             return True
         if msg['type'] == MessageTypes.HALT.value:
+            standby.cancel()
+            stopWatch()
+            saveBackgrounds()
             if scanner:
                 scanner.done()
             if cmdServer:
@@ -65,8 +389,16 @@ async def cmdHandler(websocket):
             status = {}
             if scanner:
                 status = scanner.status()
+            status |= standby.status() | cache.status() | noiseFilters.status() | pipeline.status() | \
+                loopMonitor.status() | replay.status()
+            if rateController:
+                status |= rateController.status()
+            if watch:
+                status |= watch.status()
+            if batcher:
+                status |= batcher.status()
             res = {'scanner': not scanner == None, 'status': status}
-            response = {'type': MessageTypes.REPLY.value} | res
+            response = echoId(msg, {'type': MessageTypes.REPLY.value} | res)
             logging.debug(f"Send Response: {response}")
             await websocket.send(json.dumps(response))  #### TODO should I block here? catch error?
             return True
@@ -93,14 +425,19 @@ async def cmdHandler(websocket):
             else:
                 try:
                     print(f">>>>> {msg}")
-                    if ('options' in msg) and msg['options']:
-                        scanner = Lidar(**msg['options'])
-                    else:
-                        scanner = Lidar()
+                    options = dict(msg['options']) if ('options' in msg) and msg['options'] else {}
+                    driver = options.pop('driver', DEF_DRIVER)
+                    if driver not in DRIVERS:
+                        raise ValueError(f"Unknown driver: {driver}")
+                    scanner = DRIVERS[driver](**options)
                 except Exception as ex:
                     logging.error(f"Failed to attach to lidar: {ex}")
                     return True
                 if scanner:
+                    standby.attach(scanner)
+                    applyNoiseHooks()
+                    for name, detector in backgrounds().items():
+                        restoreBackground(name, detector)
                     response = {'type': MessageTypes.REPLY.value, 'version': WS_LIDAR_VERSION}
                 else:
                     errMsg = "Failed to initialize the lidar device"
@@ -108,6 +445,10 @@ async def cmdHandler(websocket):
                     response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
         elif msg['command'] == Commands.STOP.value:
             streaming.clear()
+            standby.cancel()
+            stopWatch()
+            cache.clear()
+            saveBackgrounds()
             if scanner.done():
                 scanner = None
                 response = {'type': MessageTypes.REPLY.value}
@@ -135,6 +476,22 @@ async def cmdHandler(websocket):
                         results['minRange'] = scanner.setMinRange(msg['set']['minRange'])
                     elif k == 'maxRange':
                         results['maxRange'] = scanner.setMaxRange(msg['set']['maxRange'])
+                    elif k == 'zones':
+                        results['zones'] = setZones(msg['set']['zones'])
+                    elif k == 'standbyTimeout':
+                        results['standbyTimeout'] = standby.setTimeout(msg['set']['standbyTimeout'])
+                    elif k == 'adaptiveRate':
+                        results['adaptiveRate'] = setAdaptiveRate(msg['set']['adaptiveRate'])
+                    elif k == 'watch':
+                        results['watch'] = setWatch(msg['set']['watch'])
+                    elif k == 'noiseFilters':
+                        results['noiseFilters'] = setNoiseFilters(msg['set']['noiseFilters'])
+                    elif k == 'replay':
+                        results['replay'] = setReplay(msg['set']['replay'])
+                    elif k == 'pipelineAdd':
+                        results['pipelineAdd'] = addStage(msg['set']['pipelineAdd'])
+                    elif k == 'pipelineRemove':
+                        results['pipelineRemove'] = removeStage(msg['set']['pipelineRemove'])
                 response = {'type': MessageTypes.REPLY.value, 'results': results}
         elif msg['command'] == Commands.GET.value:
             if ('get' not in msg) or (msg['get'] is None):
@@ -144,7 +501,12 @@ async def cmdHandler(websocket):
             else:
                 GETTERS = {'minAngle': scanner.getAngles, 'maxAngle': scanner.getAngles,
                            'minRange': scanner.getRanges, 'maxRange': scanner.getRanges,
-                           'scanFreq': scanner.getScanFreq, 'sampleRate': scanner.getSampleRate}
+                           'scanFreq': scanner.getScanFreq, 'sampleRate': scanner.getSampleRate,
+                           'zones': zoneMap.toConfig, 'standbyTimeout': standby.getTimeout,
+                           'adaptiveRate': lambda: rateController is not None,
+                           'watch': lambda: watch.toDict() if watch and watch.running() else None,
+                           'noiseFilters': lambda: noiseFilters.config, 'pipeline': pipeline.toConfig,
+                           'replay': lambda: replay.config}
                 vals = {}
                 for k in msg['get']:
                     v = GETTERS[k]()
@@ -156,29 +518,54 @@ async def cmdHandler(websocket):
                         vals[k] = v[0]
                     elif k == 'maxRange':
                         vals[k] = v[1]
-                    elif k in ['scanFreq', 'sampleRate']:
+                    elif k in ['scanFreq', 'sampleRate', 'zones', 'standbyTimeout', 'adaptiveRate', 'watch',
+                               'noiseFilters', 'pipeline', 'replay']:
                         vals[k] = v
                 response = {'type': MessageTypes.REPLY.value, 'values': vals}
         elif msg['command'] == Commands.SCAN.value:
-            streaming.clear()
-            if scanner.laserEnable(True):
-                errMsg = "Failed to enable laser"
+            points = None
+            stalled = False
+            maxAgeMs = msg.get('maxAgeMs')
+            if maxAgeMs is not None:
+                # serve a recent enough rotation without touching the device or the stream
+                points = cache.get(maxAgeMs / 1000.0)
+                if (points is None) and streaming.is_set():
+                    points = await cache.next(NEXT_ROTATION_TIMEOUT)
+                    # N.B. a blocking acquisition would stop the stream
+                    stalled = points is None
+            if stalled:
+                errMsg = f"No rotation from the stream within {NEXT_ROTATION_TIMEOUT} secs"
                 logging.warning(errMsg)
                 response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
+            elif points is not None:
+                response = {'type': MessageTypes.REPLY.value, 'values': applyZones(points, msg['names'])}
             else:
-                points = scanner.scan(msg['names'])
-                if scanner.laserEnable(False):
-                    errMsg = "Failed to disable laser"
+                streaming.clear()
+                stopWatch()
+                # the laser stays on (in standby) for a while after the scan
+                if standby.acquire(scanner):
+                    errMsg = "Failed to enable laser"
                     logging.warning(errMsg)
                     response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
                 else:
-                    if points:
-                        response = {'type': MessageTypes.REPLY.value, 'values': points}
-                    else:
-                        errMsg = "Failed to get requested samples"
+                    result = await scanner.ascan(ACQUIRE_NAMES, timeout=SCAN_TIMEOUT)
+                    points = None
+                    if result['ok']:
+                        points = applyZones(await pipeline.aprocess(Rotation(result['values'])), msg['names'])
+                    if standby.release(scanner):
+                        errMsg = "Failed to disable laser"
                         logging.warning(errMsg)
                         response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
+                    else:
+                        if points:
+                            response = {'type': MessageTypes.REPLY.value, 'values': points}
+                        else:
+                            errMsg = f"Failed to get requested samples ({result['error']}, {result['attempts']} attempts)"
+                            logging.warning(errMsg)
+                            response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
         elif msg['command'] == Commands.LASER.value:
+            standby.cancel()
+            stopWatch()
             if scanner.laserEnable(msg['enable']):
                 response = {'type': MessageTypes.REPLY.value}
             else:
@@ -187,16 +574,32 @@ async def cmdHandler(websocket):
                 response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
         elif msg['command'] == Commands.STREAM.value:
             print("STREAM: got command")
+            standby.cancel()
+            stopWatch()
             if scanner.laserEnable(True):
                 errMsg = "Failed to enable laser"
                 logging.warning(errMsg)
                 response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
                 streaming.clear()
             else:
-                response = {'type': MessageTypes.REPLY.value}
+                # N.B. each filtered stream has its own filter, its frames only go to its data clients
+                streamId = addStreamFilter(msg['filter']) if msg.get('filter') else UNFILTERED_STREAM
+                # e.g., {'maxLatencyMs': 20, 'maxFrames': 16, 'maxBytes': 4096}, see FrameBatcher
+                batch = msg.get('batch')
+                streamBatch = None
+                if batch:
+                    batch = batch if isinstance(batch, dict) else {}
+                    streamBatch = {'maxLatency': batch.get('maxLatencyMs', DEF_MAX_LATENCY * 1000.0) / 1000.0,
+                                   'maxFrames': batch.get('maxFrames', DEF_MAX_FRAMES),
+                                   'maxBytes': batch.get('maxBytes', DEF_MAX_BYTES)}
+                    if (streamBatch['maxLatency'] < 0) or (streamBatch['maxFrames'] < 1) or \
+                       (streamBatch['maxBytes'] < 1):
+                        logging.warning(f"Invalid stream batching, not batching: {batch}")
+                        streamBatch = None
+                response = {'type': MessageTypes.REPLY.value, 'stream': streamId}
                 streamNames = msg['names']
                 streaming.set()
-            await websocket.send(json.dumps(response))  #### TODO should I block here? catch error?
+            await websocket.send(json.dumps(echoId(msg, response)))  #### TODO should I block here? catch error?
             print("STREAM: responded")
         elif msg['command'] == Commands.VERSION.value:
             version = scanner.getVersion()
@@ -210,26 +613,157 @@ async def cmdHandler(websocket):
             errMsg = f"Unknown command: {msg['command']}"
             logging.warning(errMsg)
             response = {'type': MessageTypes.ERROR.value, 'error': errMsg}
+        response = echoId(msg, response)
         logging.debug(f"Send Response: {response}")
         await websocket.send(json.dumps(response))  #### TODO should I block here? catch error?
 
-async def dataHandler(websocket):
-    print("STREAM: startup")
+async def publish(rotation):
+    # N.B. 'stamp' is when the rotation was acquired (wall clock secs)
+    stamp = time.time() - (time.monotonic() - rotation.stamp)
+    #### TODO send points on data socket -- binary or JSON????
+    replay.add({'type': MessageTypes.REPLY.value, 'stamp': stamp, 'values': applyZones(rotation, streamNames)},
+               UNFILTERED_STREAM)
+    for streamId, streamFilter in list(streamFilters.items()):
+        points = applyZones(filterPoints(streamFilter, rotation), streamNames)
+        replay.add({'type': MessageTypes.REPLY.value, 'stamp': stamp, 'values': points}, streamId)
+
+async def acquire():
+    # N.B. acquisition doesn't depend on a data connection, rotations acquired while a client is
+    #  disconnected are kept (for a while) in the replay buffer
     while True:
         await streaming.wait()
         print("STREAM: run")
-        for points in scanner.stream(streamNames):
-            response = {'type': MessageTypes.REPLY.value, 'values': points}
-            #### TODO send points on data socket -- binary or JSON????
-            await websocket.send(json.dumps(response))  #### TODO should I block here? catch error?
-            print("STREAM: sent")
+        for streamFilter in streamFilters.values():
+            streamFilter.reset()
+        # rotations go through the pipeline's stage queues, so a slow stage doesn't hold up acquisition
+        pipeline.start(publish)
+        try:
+            async for result in scanner.astream(ACQUIRE_NAMES, timeout=SCAN_TIMEOUT):
+                if not streaming.is_set():
+                    scanner.streaming = False
+                    break
+                if not result['ok']:
+                    errMsg = f"Streaming stopped, failed to get samples ({result['error']})"
+                    logging.warning(errMsg)
+                    streaming.clear()
+                    replay.add({'type': MessageTypes.ERROR.value, 'error': errMsg})
+                    break
+                pipeline.submit(Rotation(result['values']))
+        except Exception as ex:
+            logging.error(f"Streaming failed: {ex}")
+            streaming.clear()
+        finally:
+            pipeline.stop()
+
+def dataParam(websocket, name):
+    # a data client gives its (int) parameters in the query string, e.g., a reconnecting client asks
+    #  for the frames after the last one it got with ws://<host>:<port>/?resume=<seq>
+    request = getattr(websocket, 'request', None)
+    path = request.path if request else getattr(websocket, 'path', "")
+    try:
+        return int(urllib.parse.parse_qs(urllib.parse.urlparse(path).query)[name][0])
+    except (KeyError, ValueError):
+        return None
+
+async def dataHandler(websocket):
+    global batcher
+
+    def backlog():
+        return websocket.transport.get_write_buffer_size() if websocket.transport else 0
+
+    sock = websocket.transport.get_extra_info('socket') if websocket.transport else None
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, DATA_SEND_BUFFER)
+    # N.B. a client of a filtered stream connects with ?stream=<id> (from the stream command's reply)
+    streamId = dataParam(websocket, 'stream')
+    if streamId is None:
+        streamId = UNFILTERED_STREAM
+    seq = dataParam(websocket, 'resume')
+    epoch = dataParam(websocket, 'epoch')
+    restart = None
+    if seq is None:
+        # a new client starts with the next frame
+        seq = replay.lastSeq
+    elif (epoch is not None) and (epoch != replay.epoch):
+        # N.B. the client's sequence number is from before the server restarted, it's sent every frame kept
+        nextSeq = replay.restart()
+        logging.info(f"Data client resuming after frame {seq} of another epoch, restarting at frame {nextSeq}")
+        restart = {'type': MessageTypes.GAP.value, 'after': seq, 'next': nextSeq, 'epoch': replay.epoch}
+        seq = nextSeq - 1
+    else:
+        logging.info(f"Data client resuming after frame {seq}, {replay.resume(seq)} frame(s) to replay")
+    caughtUp = replay.lastSeq
+    print("STREAM: startup")
+    batchOpts = frameBatcher = None
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    try:
+        if restart:
+            await websocket.send(json.dumps(restart))
+        while not closed.done():
+            frames, nextSeq = replay.since(seq, DATA_MAX_LAG if seq >= caughtUp else None, DATA_SEND_CHUNK,
+                                           streamId)
+            if (not frames) and (nextSeq is None):
+                waiter = asyncio.ensure_future(replay.next())
+                await asyncio.wait({waiter, closed}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                continue
+            if streamBatch is not batchOpts:
+                # the stream's batching changed, send what's waiting the old way first
+                if frameBatcher:
+                    await frameBatcher.flush()
+                    frameBatcher.stop()
+                    if batcher is frameBatcher:
+                        batcher = None
+                batchOpts = streamBatch
+                frameBatcher = FrameBatcher(websocket.send, backlog=backlog, **batchOpts) if batchOpts else None
+                if frameBatcher:
+                    frameBatcher.start()
+                    batcher = frameBatcher
+            sendFrame = frameBatcher.put if frameBatcher else websocket.send
+            if nextSeq is not None:
+                # the frames after 'after' and before 'next' are missed (all of them if 'next' isn't after 'after')
+                await sendFrame(json.dumps({'type': MessageTypes.GAP.value, 'after': seq, 'next': nextSeq}))
+                seq = nextSeq - 1
+            for seq, frame in frames:
+                if frame is not None:
+                    await sendFrame(frame)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        closed.cancel()
+        if frameBatcher:
+            frameBatcher.stop()
+            # N.B. another connection's batcher may have replaced this one in the status since
+            if batcher is frameBatcher:
+                batcher = None
     print("STREAM: done")
 
-async def main():
-    global cmdServer, dataServer
+async def main(hostname=HOSTNAME, cmdPort=COMMAND_PORT, dataPort=DATA_PORT):
+    global cmdServer, dataServer, zoneMap, noiseFilters, acquirer
+
+    conf = loadConfig()
+    try:
+        zoneMap = ZoneMap.load(ZONES_MODEL, conf.get('zones'))
+    except (KeyError, ValueError) as ex:
+        logging.warning(f"Invalid zones config: {ex}")
+        zoneMap = None
+    if not zoneMap:
+        zoneMap = ZoneMap.fromConfig(conf.get('zones'))
+        zoneMap.save(ZONES_MODEL)
+    setAdaptiveRate(conf.get('adaptiveRate', False))
+    noiseFilters = NoiseFilterChain(conf.get('noiseFilters') or [])
+    if setPipeline(conf.get('pipeline', DEF_PIPELINE)):
+        setPipeline(DEF_PIPELINE)
+    try:
+        replay.configure(**conf.get('replay', {}))
+    except (TypeError, ValueError) as ex:
+        logging.warning(f"Invalid replay config, using the defaults: {ex}")
 
-    cmdServer = await websockets.serve(cmdHandler, HOSTNAME, COMMAND_PORT, ping_interval=PING, ping_timeout=PING)
-    dataServer = await websockets.serve(dataHandler, HOSTNAME, DATA_PORT, ping_interval=PING, ping_timeout=PING)
+    loopMonitor.start()
+    acquirer = asyncio.get_running_loop().create_task(acquire())
+    cmdServer = await websockets.serve(cmdHandler, hostname, cmdPort, ping_interval=PING, ping_timeout=PING)
+    dataServer = await websockets.serve(dataHandler, hostname, dataPort, ping_interval=PING, ping_timeout=PING,
+                                        write_limit=DATA_WRITE_LIMIT)
     await asyncio.gather(cmdServer.wait_closed(), dataServer.wait_closed())
     logging.debug("Done, exiting")
 
@@ -238,7 +772,7 @@ if __name__ == "__main__":
     logging.basicConfig(level=LOG_LEVEL)
     logging.debug("Starting Lidar Server")
 
-    if (Lidar.LIDAR_VERSION != WS_LIDAR_VERSION):  #### FIXME just check major(/minor?) number
+    if Lidar and (Lidar.LIDAR_VERSION != WS_LIDAR_VERSION):  #### FIXME just check major(/minor?) number
         logging.error(f"Version mismatch: ({Lidar.LIDAR_VERSION} != {WS_LIDAR_VERSION})")
         exit(1)
 
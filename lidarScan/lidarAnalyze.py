@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Headless detection over recorded (lidarPlot.py) sessions, faster than
+#  real time, with the events and summary stats written out as JSON
+#
+################################################################################
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from lidar.lib.modelStore import modelPath
+from lidar.lib.refGeometry import loadReference
+from lidar.lib.sessionAnalyzer import (analyzeSession, eventsToDicts, MODELS, DEF_MODEL, DEF_MARGIN,
+                                       DEF_TOLERANCE, DEF_NUM_REF, DEF_CLUSTER_DIST, DEF_MIN_CLUSTER,
+                                       DEF_MIN_HITS, DEF_MAX_MISSED, DEF_MAX_GAP, DEF_CHUNK_ROTATIONS,
+                                       DEF_WARMUP)
+from lidar.lib.scanRate import DEF_ANGLE_BIN, DEF_FOREGROUND_DIST, DEF_LEARN_RATE
+
+
+def getOpts():
+    ap = argparse.ArgumentParser(description="Run detection over recorded sessions, without plotting")
+    ap.add_argument(
+        "recordings", nargs="+", type=str,
+        help="Paths of the session's recordings (analyzed as one session, in time order)")
+    ap.add_argument(
+        "-o", "--output", action="store", type=str, default=None,
+        help="Path of the JSON file to write the events and summary into (default: stdout)")
+    ap.add_argument(
+        "-j", "--workers", action="store", type=int, default=None,
+        help="Number of worker processes (default: one per CPU)")
+    ap.add_argument(
+        "-c", "--chunkRotations", action="store", type=int, default=DEF_CHUNK_ROTATIONS,
+        help="Rotations per chunk of work")
+    ap.add_argument(
+        "-w", "--warmup", action="store", type=int, default=DEF_WARMUP,
+        help="Rotations the background is learned over before each chunk")
+    ap.add_argument(
+        "-r", "--reference", action="store", type=str, nargs="?", const=modelPath("reference"), default=None,
+        help="Use a saved reference region (default path if none given), instead of capturing one")
+    ap.add_argument(
+        "-m", "--model", action="store", type=str, choices=MODELS, default=DEF_MODEL,
+        help="Candidate points: inside the reference region, closer than the background, or both")
+    ap.add_argument(
+        "--margin", action="store", type=float, default=DEF_MARGIN,
+        help="Reference region margin (meters, negative shrinks it)")
+    ap.add_argument(
+        "--tolerance", action="store", type=float, default=DEF_TOLERANCE,
+        help="Reference region simplification tolerance (meters)")
+    ap.add_argument(
+        "--numRef", action="store", type=int, default=DEF_NUM_REF,
+        help="Number of rotations captured for the reference region")
+    ap.add_argument(
+        "--angleBin", action="store", type=float, default=DEF_ANGLE_BIN,
+        help="Background angle bin (degrees)")
+    ap.add_argument(
+        "--foregroundDist", action="store", type=float, default=DEF_FOREGROUND_DIST,
+        help="Distance closer than the background that's foreground (meters)")
+    ap.add_argument(
+        "--learnRate", action="store", type=float, default=DEF_LEARN_RATE,
+        help="Background learning rate")
+    ap.add_argument(
+        "--clusterDist", action="store", type=float, default=DEF_CLUSTER_DIST,
+        help="Maximum distance between neighbouring points of a cluster (meters)")
+    ap.add_argument(
+        "--minCluster", action="store", type=int, default=DEF_MIN_CLUSTER,
+        help="Minimum points in a cluster for a rotation to be a hit")
+    ap.add_argument(
+        "--minHits", action="store", type=int, default=DEF_MIN_HITS,
+        help="Consecutive hits that start an event")
+    ap.add_argument(
+        "--maxMissed", action="store", type=int, default=DEF_MAX_MISSED,
+        help="Rotations without a hit that end an event")
+    ap.add_argument(
+        "--maxGap", action="store", type=float, default=DEF_MAX_GAP,
+        help="Gap between rotations (secs) that ends an event")
+    ap.add_argument(
+        "-L", "--logLevel", action="store", type=str, default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Logging level")
+    opts = ap.parse_args()
+    logging.basicConfig(level=opts.logLevel)
+
+    missing = [path for path in opts.recordings if not os.path.isfile(path)]
+    if missing:
+        logging.error(f"Invalid recording(s): {', '.join(missing)}")
+        exit(1)
+    return opts
+
+def run(opts):
+    reference = None
+    if opts.reference:
+        reference = loadReference(opts.reference)
+        if reference is None:
+            logging.error(f"No valid reference region: {opts.reference}")
+            exit(1)
+    detector = {k: getattr(opts, k) for k in ('model', 'margin', 'tolerance', 'numRef', 'angleBin',
+                                              'foregroundDist', 'learnRate', 'clusterDist')}
+    tracker = {k: getattr(opts, k) for k in ('minCluster', 'minHits', 'maxMissed', 'maxGap')}
+    events, summary, _ = analyzeSession(opts.recordings, reference, detector, tracker, opts.workers,
+                                        opts.chunkRotations, opts.warmup)
+    results = {'summary': summary, 'detector': detector, 'tracker': tracker, 'events': eventsToDicts(events)}
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print("")
+    print(f"{summary.get('events', 0)} events in {summary['rotations']} rotations "
+          f"({summary.get('speedup', 0)}x real time)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    opts = getOpts()
+    run(opts)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Export lidarPlot.py recordings to Parquet, for offline analytics
+#
+################################################################################
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from lidar.lib.recordings import (exportRecordings, DEF_SLICE_SECS, DEF_ANGLE_SECTORS, DEF_MAX_ROWS,
+                                  DEF_COMPRESSION)
+
+
+def getOpts():
+    ap = argparse.ArgumentParser(description="Export lidarPlot.py recordings (JSON) to Parquet files")
+    ap.add_argument(
+        "recordings", nargs="+", type=str,
+        help="Paths of the recordings to export")
+    ap.add_argument(
+        "-o", "--outDir", action="store", type=str, default=".",
+        help="Directory to write a <recording>.parquet file per recording into")
+    ap.add_argument(
+        "-j", "--workers", action="store", type=int, default=None,
+        help="Number of recordings exported in parallel (default: one per CPU)")
+    ap.add_argument(
+        "-s", "--sliceSecs", action="store", type=float, default=DEF_SLICE_SECS,
+        help="Time slice (secs) of each row group")
+    ap.add_argument(
+        "-a", "--angleSectors", action="store", type=int, default=DEF_ANGLE_SECTORS,
+        help="Number of angle sectors (row groups) per time slice")
+    ap.add_argument(
+        "-m", "--maxRows", action="store", type=int, default=DEF_MAX_ROWS,
+        help="Maximum number of rows buffered (bounds memory use)")
+    ap.add_argument(
+        "-c", "--compression", action="store", type=str, default=DEF_COMPRESSION,
+        help="Parquet compression codec")
+    ap.add_argument(
+        "-L", "--logLevel", action="store", type=str, default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Logging level")
+    ap.add_argument(
+        "-v", "--verbose", action="count", default=0,
+        help="Print the summary of each export")
+    opts = ap.parse_args()
+    logging.basicConfig(level=opts.logLevel)
+
+    missing = [path for path in opts.recordings if not os.path.isfile(path)]
+    if missing:
+        logging.error(f"Invalid recording(s): {', '.join(missing)}")
+        exit(1)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in opts.recordings]
+    if len(set(names)) != len(names):
+        logging.error("Recordings must have distinct names (each is exported to <name>.parquet)")
+        exit(1)
+    return opts
+
+def run(opts):
+    start = time.time()
+    summaries = exportRecordings(opts.recordings, opts.outDir, opts.workers, sliceSecs=opts.sliceSecs,
+                                 angleSectors=opts.angleSectors, maxRows=opts.maxRows,
+                                 compression=opts.compression)
+    failed = [path for path, summary in zip(opts.recordings, summaries) if summary is None]
+    done = [summary for summary in summaries if summary]
+    if opts.verbose:
+        json.dump(done, sys.stdout, indent=4)
+        print("")
+    print(f"Exported {len(done)} recording(s), {sum(s['rotations'] for s in done)} rotations, "
+          f"{sum(s['rows'] for s in done)} points in {time.time() - start:.1f} secs")
+    if failed:
+        logging.error(f"Failed to export: {', '.join(failed)}")
+        exit(1)
+
+
+if __name__ == '__main__':
+    opts = getOpts()
+    run(opts)
@@ -4,6 +4,10 @@ from shapely import union_all
 from shapely.geometry import Polygon, MultiPolygon
 import numpy as np
 import lidar
+from lidar.lib.geomJobs import GeometryJobs
+from lidar.lib.modelStore import modelPath, sensorConfig
+from lidar.lib.refGeometry import loadReference, referenceRegion, saveReference
+from lidar.lib.regionClassify import RegionClassifier, LABEL_INSIDE
 
 
 fig = None
@@ -11,6 +15,8 @@ ax = None
 scanner = None
 points = None
 refArea = 0
+classifier = None
+REF_MODEL = modelPath("reference")
 
 def init():
     global scanner
@@ -120,53 +126,53 @@ def plot(tol, num):
                         blit=False, repeat=True)
     plt.show()
 
-minDiff = 10000
-maxDiff = 0
-avgDiff = 0
+maxInside = 0
 
-def updateDots(frame, ax, foo):
-    global points
-    global minDiff, maxDiff, avgDiff
+def drawRef(ax, jobs):
+    global refArea, classifier
+    ref = jobs.get('reference')
+    if refArea or not ref or (ref['inner'] is None):
+        return
+    classifier = RegionClassifier(ref['inner'], ref['outer'])
+    refArea = classifier.inner.area
+    saveReference(REF_MODEL, ref['reference'], sensorConfig(scanner.status()))
+    print(f"Ref Area: {refArea}")
+    x, y = ref['inner'][:, 0], ref['inner'][:, 1]
+    ax.plot(x, y, 'o-', color='green')
+    ax.fill(x, y, alpha=0.3, color='gray')
+
+def updateDots(frame, ax, jobs):
+    global points, maxInside
+    drawRef(ax, jobs)
+    if not refArea:
+        return
     angles, distances, intensities = scanner.scanIntensity()
-    cartCoords = [polarToCartesian(theta, r) for theta, r in zip(angles, distances)]
-    poly = Polygon(cartCoords)
-    polyArea = poly.area
-    areaDiff = refArea - polyArea
-    if abs(areaDiff) < abs(minDiff):
-        minDiff = areaDiff
-    if abs(areaDiff) > abs(maxDiff):
-        maxDiff = areaDiff
-    avgDiff = (avgDiff + areaDiff) / 2
-    print(f"minDiff: {minDiff}, avgDiff: {avgDiff}, maxDiff: {maxDiff}\r", end="")
-    xy = poly.exterior.coords
-    x, y = zip(*xy)
+    angles, distances = np.asarray(angles), np.asarray(distances)
+    labels, _, counts = classifier.classify(angles, distances)
+    maxInside = max(maxInside, counts['regions']['inside'])
+    print(f"counts: {counts['regions']}, maxInside: {maxInside}\r", end="")
+    x, y = polarToCartesian(angles, distances)
     if points:
         points.remove()
-    points = ax.scatter(x, y, marker='o', c='blue')
+    points = ax.scatter(x, y, marker='o', c=np.where(labels == LABEL_INSIDE, 'red', 'blue'))
 
 def detect(margin=-0.0025, tol=0.02, num=50):
-    global refArea
     fig, ax = plt.subplots()
 
-    # get reference area and plot it
-    refPoly = MultiPolygon()
-    while refPoly.geom_type != 'Polygon':
-        poly = intersect(num)
-        if tol:
-            poly = poly.simplify(tolerance=tol)
-        refPoly = poly.buffer(margin)
-    refArea = refPoly.area
-    print(f"Ref Area: {refArea}")
-    xy = refPoly.exterior.coords
-    x, y = zip(*xy)
-    ax.plot(x, y, 'o-', color='green')
-    ax.fill(x, y, alpha=0.3, color='gray')
+    # build the reference area in a worker process, it's plotted when it's ready
+    #  N.B. the last captured reference is reused, if it's for the current angles/ranges
+    jobs = GeometryJobs()
+    scans = loadReference(REF_MODEL, sensorConfig(scanner.status()))
+    if scans is None:
+        scans = [np.array(scan()[1]) for _ in range(num)]
+    jobs.submit('reference', referenceRegion, scans, tol, (margin, margin))
 
-    # get scans, plot them, and compare their area
-    ani = FuncAnimation(fig, updateDots, fargs=(ax, 1), frames=1000,
+    # get scans, plot them, and count the points inside the reference area
+    ani = FuncAnimation(fig, updateDots, fargs=(ax, jobs), frames=1000,
                         interval=(1000 / scanner.scanFreq),
                         blit=False, repeat=True)
     plt.show()
+    jobs.shutdown()
 
 '''
 +def getRef(tol=0.02, num=50):
@@ -25,6 +25,7 @@ from time import sleep
 import yaml
 
 import lidar
+from lidar.lib.temporalFilter import TemporalFilter
 
 import pdb  ## pdb.set_trace()
 
@@ -50,6 +51,7 @@ DEFAULTS = {
 
 
 scanner = None
+temporalFilter = None
 numFrames = 0
 logDataFd = None
 
@@ -65,7 +67,11 @@ def stop():
 
 def getPoints():
     angles, distances, intensities = scanner.scanIntensity()
-    #### TODO do filtering here
+    if temporalFilter:
+        points = temporalFilter.update(angles, distances, intensities)
+        # N.B. the filter returns arrays, the data log is written as (JSON) lists
+        angles, distances, intensities = (points['angles'].tolist(), points['distances'].tolist(),
+                                          points['intensities'].tolist())
     return angles, distances, intensities
 
 def update(frame, axes, maxDistance):
@@ -225,8 +231,11 @@ def getOpts():
     return conf
 
 def run(options):
-    global scanner
+    global scanner, temporalFilter
 
+    if options['filter']:
+        # per-angle median over the last 'filter' scans
+        temporalFilter = TemporalFilter(options['filter'])
     scanner = lidar.Lidar(**options)
     if scanner:
         fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})
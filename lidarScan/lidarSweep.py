@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''
+################################################################################
+#
+# Sweep detection parameters over labelled (lidarPlot.py) recordings, and
+#  rank the configurations by precision, recall and detection latency
+#
+################################################################################
+'''
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import yaml
+
+from lidar.lib.paramSweep import gridConfigs, loadLabels, randomConfigs, sweep, DEF_CACHE_DIR, DEF_SPACE
+
+
+def getOpts():
+    ap = argparse.ArgumentParser(description="Sweep detection parameters over labelled recordings")
+    ap.add_argument(
+        "labels", nargs="+", type=str,
+        help="Paths of labelled sessions (YAML: recordings, critters and empty intervals)")
+    ap.add_argument(
+        "-s", "--space", action="store", type=str, default=None,
+        help="Path of a YAML parameter space (<param>: [<value>, ...] | {min, max[, step]})")
+    ap.add_argument(
+        "-n", "--random", action="store", type=int, default=None,
+        help="Number of random configs to try (default: the whole grid)")
+    ap.add_argument(
+        "--seed", action="store", type=int, default=None,
+        help="Random search seed")
+    ap.add_argument(
+        "-j", "--workers", action="store", type=int, default=None,
+        help="Number of worker processes (default: one per CPU)")
+    ap.add_argument(
+        "-C", "--cacheDir", action="store", type=str, default=DEF_CACHE_DIR,
+        help="Directory of cached intermediate results")
+    ap.add_argument(
+        "-o", "--output", action="store", type=str, default=None,
+        help="Path of the JSON file to write all the results into")
+    ap.add_argument(
+        "-t", "--top", action="store", type=int, default=10,
+        help="Number of the best configs to print")
+    ap.add_argument(
+        "-L", "--logLevel", action="store", type=str, default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+        help="Logging level")
+    opts = ap.parse_args()
+    logging.basicConfig(level=opts.logLevel)
+
+    missing = [path for path in opts.labels + ([opts.space] if opts.space else []) if not os.path.isfile(path)]
+    if missing:
+        logging.error(f"Invalid file(s): {', '.join(missing)}")
+        exit(1)
+    return opts
+
+def run(opts):
+    space = DEF_SPACE
+    if opts.space:
+        with open(opts.space, "r") as f:
+            space = yaml.safe_load(f)
+    configs = randomConfigs(space, opts.random, opts.seed) if opts.random else gridConfigs(space)
+    results, summary = sweep([loadLabels(path) for path in opts.labels], configs, opts.workers, opts.cacheDir)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump({'summary': summary, 'results': results}, f, indent=4)
+
+    varied = [k for k in space if len({str(r[k]) for r in results}) > 1]
+    print(f"{summary['configs']} configs, {summary['intermediatesComputed']} intermediates computed, "
+          f"{summary['elapsedSecs']} secs")
+    for result in results[:opts.top]:
+        params = " ".join(f"{k}={result[k]}" for k in varied)
+        print(f"  f1={result['f1']:.3f} precision={result['precision']} recall={result['recall']} "
+              f"latency={result['latencyMean']} falsePerHour={result['falsePerHour']}: {params}", file=sys.stdout)
+
+
+if __name__ == '__main__':
+    opts = getOpts()
+    run(opts)